@@ -7,34 +7,97 @@ __author__ = """Willeke A'Campo"""
 __email__ = "willeke.acampo@nina.com"
 __version__ = "0.1.0"
 
+import importlib
 import logging
 
-from src.logger import setup_logging  # noqa
-from src.utils import yaml_load  # noqa
-
-# Import specific functions and classes
-from src.utils.config import (  # noqa
-    ADMIN_GDB,
-    AR5_LANDUSE_PATH,
-    COORD_SYSTEM,
-    DATA_PATH,
-    FKB_BUILDING_PATH,
-    FKB_WATER_PATH,
-    FOCAL_MAX_RADIUS,
-    IN_SITU_TREES_GDB,
-    INTERIM_PATH,
-    LASER_TREES_GDB,
-    MIN_HEIGHT,
-    MUNICIPALITY,
-    POINT_DENSITY,
-    PROCESSED_PATH,
-    RAW_PATH,
-    RGB_AVAILABLE,
-    SPATIAL_REFERENCE,
-    SSB_DISTRICT_PATH,
-    TOOL_PATH,
-    URBAN_TREES_GDB,
-    VEG_CLASSES_AVAILABLE,
-)
+# The names are imported on first access (PEP 562): "import src" does not
+# read the project configuration and does not import arcpy, so worker
+# processes only pay for the modules they use.
+# name -> module
+_LAZY_IMPORTS = {
+    # logging and yaml
+    "setup_logging": "src.logger",
+    "yaml_load": "src.utils",
+    # run report and journal
+    "RunReport": "src.utils.resource_monitor",
+    "get_run_report": "src.utils.resource_monitor",
+    "set_run_report": "src.utils.resource_monitor",
+    "RunJournal": "src.utils.run_journal",
+    # run options (prompts or environment, see run_options.py)
+    "confirm_municipality": "src.utils.run_options",
+    "get_bool_option": "src.utils.run_options",
+    "get_option": "src.utils.run_options",
+    "get_workers": "src.utils.run_options",
+    # run context (municipal parameters and paths of a run)
+    "RunContext": "src.utils.run_context",
+    # dependency graph of the pipeline stages
+    "StageGraph": "src.utils.stage_graph",
+    # project configuration (resolved on first use, see config.py)
+    "ADMIN_GDB": "src.utils.config",
+    "AR5_LANDUSE_PATH": "src.utils.config",
+    "COORD_SYSTEM": "src.utils.config",
+    "DATA_PATH": "src.utils.config",
+    "FKB_BUILDING_PATH": "src.utils.config",
+    "FKB_WATER_PATH": "src.utils.config",
+    "FOCAL_MAX_RADIUS": "src.utils.config",
+    "IN_SITU_TREES_GDB": "src.utils.config",
+    "INTERIM_PATH": "src.utils.config",
+    "LAS_CATALOG_PATH": "src.utils.config",
+    "LASER_TREES_GDB": "src.utils.config",
+    "MIN_HEIGHT": "src.utils.config",
+    "MUNICIPALITY": "src.utils.config",
+    "POINT_DENSITY": "src.utils.config",
+    "PROCESSED_PATH": "src.utils.config",
+    "RAW_PATH": "src.utils.config",
+    "RGB_AVAILABLE": "src.utils.config",
+    "SPATIAL_REFERENCE": "src.utils.config",
+    "SSB_DISTRICT_PATH": "src.utils.config",
+    "TOOL_PATH": "src.utils.config",
+    "URBAN_TREES_GDB": "src.utils.config",
+    "VEG_CLASSES_AVAILABLE": "src.utils.config",
+    "get_config": "src.utils.config",
+    "get_spatial_resolution": "src.utils.config",
+    # LAS header catalog
+    "LasCatalog": "src.data.las_catalog",
+    "catalog_point_density": "src.data.las_catalog",
+}
+
+# arcpy-backed modules and classes, arcpy is imported when they are used
+_LAZY_ARCPY_IMPORTS = {
+    "AdminAttributes": "src.compute_attributes.admin_attributes",
+    "AttributeBuffer": "src.compute_attributes.attribute_buffer",
+    "GeometryAttributes": "src.compute_attributes.geometry_attributes",
+    "LaserAttributes": "src.compute_attributes.laser_attributes",
+    "ReferenceCache": "src.utils.reference_cache",
+}
+_LAZY_MODULES = {"arcpy_utils": "src.utils.arcpy_utils"}
+
+# "from src import *" resolves the configuration, but not the arcpy modules
+__all__ = list(_LAZY_IMPORTS) + ["logger", "logging"]
+
+
+def __getattr__(name: str):
+    if name in _LAZY_MODULES:
+        value = importlib.import_module(_LAZY_MODULES[name])
+    else:
+        module_name = _LAZY_IMPORTS.get(name) or _LAZY_ARCPY_IMPORTS.get(name)
+        if module_name is None:
+            raise AttributeError(
+                f"module {__name__!r} has no attribute {name!r}"
+            )
+        value = getattr(importlib.import_module(module_name), name)
+    # cache, the next access does not call __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(
+        set(globals())
+        | set(_LAZY_IMPORTS)
+        | set(_LAZY_ARCPY_IMPORTS)
+        | set(_LAZY_MODULES)
+    )
+
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -0,0 +1,263 @@
+"""Headless batch runner for the tree detection of several municipalities.
+
+The runner reads a job file (YAML) with a global worker budget and a list of
+jobs. A job runs the stages of one municipality back to back, each stage as
+a separate process without prompts. Jobs run side by side as long as their
+workers fit in the budget, a job that does not fit waits until running jobs
+finish.
+
+Job file (see config/batch_jobs.yaml):
+
+    workers: 16                 # global worker budget
+    jobs:
+      - municipality: baerum
+        stages: [las_catalog, model_chm, watershed_segmentation]
+        workers: 8              # share of the budget, default 1
+        options:                # run options, see src/utils/run_options.py
+          run_mode: PROD
+          keep_temp: false
+
+The municipality, the workers and the options are passed to the stages as
+the environment variables TREKRONER_MUNICIPALITY, TREKRONER_WORKERS and
+TREKRONER_<OPTION>. The output of each stage is written to
+src/log/batch_<municipality>_<stage>.log.
+
+Usage:
+    python -m src.batch_runner config/batch_jobs.yaml [--workers 16] [--dry-run]
+"""
+import argparse
+import datetime
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir)
+)
+log_dir = os.path.join(project_dir, "src", "log")
+
+# stage name -> python arguments, in the order of the workflow
+STAGES = {
+    "prepare_lidar": [os.path.join(project_dir, "src", "prepare_lidar.py")],
+    "las_catalog": ["-m", "src.data.las_catalog"],
+    "model_chm": [
+        os.path.join(project_dir, "src", "tree_detection", "model_chm.py")
+    ],
+    "watershed_segmentation": [
+        os.path.join(
+            project_dir, "src", "tree_detection", "watershed_segmentation.py"
+        )
+    ],
+}
+
+
+class WorkerBudget:
+    """
+    Global number of workers shared by the jobs of a batch run.
+
+    Attributes:
+    -----------
+    total : int
+        number of workers of the machine available to the batch run
+    available : int
+        number of workers not used by running jobs
+
+    Methods:
+    --------
+    - acquire(self, n)
+    - release(self, n)
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.available = total
+        self._condition = threading.Condition()
+
+    def acquire(self, n: int) -> int:
+        """Waits until n workers (at most the total) are free, takes them."""
+        n = min(n, self.total)
+        with self._condition:
+            self._condition.wait_for(lambda: self.available >= n)
+            self.available -= n
+        return n
+
+    def release(self, n: int):
+        """Returns n workers to the budget."""
+        with self._condition:
+            self.available += n
+            self._condition.notify_all()
+
+
+def load_jobs(job_file: str) -> dict:
+    """
+    Reads and validates a job file.
+
+    Args:
+        job_file (str): path to the YAML job file
+
+    Returns:
+        dict: {"workers": int, "jobs": list of dicts}
+    """
+    with open(job_file, "r") as f:
+        batch = yaml.safe_load(f) or {}
+    jobs = batch.get("jobs") or []
+    if not jobs:
+        raise ValueError(f"The job file {job_file} contains no jobs")
+    for job in jobs:
+        if not job.get("municipality"):
+            raise ValueError(f"Job without municipality in {job_file}: {job}")
+        unknown = [s for s in job.get("stages", []) if s not in STAGES]
+        if unknown:
+            raise ValueError(
+                f"Unknown stages {unknown} for {job['municipality']}, valid stages are {list(STAGES)}"
+            )
+        job.setdefault("stages", list(STAGES))
+        job["workers"] = max(1, int(job.get("workers", 1)))
+        job.setdefault("options", {})
+    return {
+        "workers": int(batch.get("workers", os.cpu_count() or 1)),
+        "jobs": jobs,
+    }
+
+
+def job_environment(job: dict, workers: int) -> dict:
+    """Returns the environment of the stage processes of a job."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in [project_dir, env.get("PYTHONPATH")] if p
+    )
+    env["TREKRONER_BATCH"] = "1"
+    env["TREKRONER_MUNICIPALITY"] = str(job["municipality"])
+    env["TREKRONER_WORKERS"] = str(workers)
+    for name, value in job["options"].items():
+        if isinstance(value, bool):
+            value = "y" if value else "n"
+        env["TREKRONER_" + name.upper()] = str(value)
+    return env
+
+
+def run_job(job: dict, budget: WorkerBudget, dry_run: bool = False) -> dict:
+    """
+    Runs the stages of a job one after the other, a failed stage stops the
+    job.
+
+    Args:
+        job (dict): job of the job file
+        budget (WorkerBudget): global worker budget
+        dry_run (bool): log the commands without running them
+
+    Returns:
+        dict: municipality, status per stage and run time
+    """
+    municipality = job["municipality"]
+    workers = budget.acquire(job["workers"])
+    start = time.time()
+    result = {"municipality": municipality, "stages": {}}
+    try:
+        env = job_environment(job, workers)
+        for stage in job["stages"]:
+            command = [sys.executable] + STAGES[stage]
+            logger.info(
+                f"\t{municipality} | {stage}: started with {workers} workers"
+            )
+            if dry_run:
+                logger.info(f"\t\t{' '.join(command)}")
+                result["stages"][stage] = "dry-run"
+                continue
+
+            log_file = os.path.join(
+                log_dir, f"batch_{municipality}_{stage}.log"
+            )
+            stage_start = time.time()
+            with open(log_file, "w") as f:
+                process = subprocess.run(
+                    command,
+                    cwd=project_dir,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=f,
+                    stderr=subprocess.STDOUT,
+                )
+            if process.returncode != 0:
+                result["stages"][stage] = "failed"
+                logger.error(
+                    f"\t{municipality} | {stage}: failed (exit code {process.returncode}), see {log_file}"
+                )
+                break
+            result["stages"][stage] = "done"
+            logger.info(
+                "\t{} | {}: done in {:.0f} sec".format(
+                    municipality, stage, time.time() - stage_start
+                )
+            )
+    finally:
+        budget.release(workers)
+    result["seconds"] = time.time() - start
+    return result
+
+
+def run_batch(job_file: str, workers: int = None, dry_run: bool = False):
+    """
+    Runs all jobs of a job file within the worker budget.
+
+    Args:
+        job_file (str): path to the YAML job file
+        workers (int, optional): overrides the worker budget of the file
+        dry_run (bool): log the commands without running them
+
+    Returns:
+        list: result of each job (see run_job)
+    """
+    batch = load_jobs(job_file)
+    budget = WorkerBudget(workers or batch["workers"])
+    os.makedirs(log_dir, exist_ok=True)
+    logger.info(
+        "Batch run of {} jobs with a budget of {} workers".format(
+            len(batch["jobs"]), budget.total
+        )
+    )
+    # one thread per job, the budget decides how many run at the same time
+    with ThreadPoolExecutor(max_workers=len(batch["jobs"])) as executor:
+        futures = [
+            executor.submit(run_job, job, budget, dry_run)
+            for job in batch["jobs"]
+        ]
+        results = [future.result() for future in futures]
+
+    for result in results:
+        logger.info(
+            "\t{}:\t{}\t({})".format(
+                result["municipality"],
+                result["stages"],
+                datetime.timedelta(seconds=round(result["seconds"])),
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the tree detection for the jobs of a job file."
+    )
+    parser.add_argument("job_file", help="YAML job file")
+    parser.add_argument("--workers", type=int, help="global worker budget")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    results = run_batch(args.job_file, args.workers, args.dry_run)
+    failed = any(
+        status == "failed" for r in results for status in r["stages"].values()
+    )
+    sys.exit(1 if failed else 0)
@@ -2,9 +2,14 @@ import logging
 import os
 
 import arcpy
+import numpy as np
 
 from src import arcpy_utils as au
 from src import logger
+from src.compute_attributes.attribute_buffer import (
+    AttributeBuffer,
+    lookup_columns,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +23,40 @@ logger = logging.getLogger(__name__)
 # ------------------------------------------------------ #
 
 
+def sample_labels(labels, x_min, y_max, cell_size, xy):
+    """
+    Samples a label array at point coordinates.
+
+    Args:
+        labels (np.ndarray): 2D label array, row 0 is the northern edge
+        x_min (float): x coordinate of the western edge
+        y_max (float): y coordinate of the northern edge
+        cell_size (float): cell size in map units
+        xy (np.ndarray): (n, 2) array of point coordinates
+
+    Returns:
+        tuple: (label, unique), label is 0 outside the array. unique is True
+            if the 3x3 cells around the point have the same label, the point
+            is then inside the polygon of that label.
+    """
+    n_rows, n_cols = labels.shape
+    cols = np.floor((xy[:, 0] - x_min) / cell_size).astype(np.int64)
+    rows = np.floor((y_max - xy[:, 1]) / cell_size).astype(np.int64)
+
+    # pad by one cell so the 3x3 window exists for all points in the array
+    padded = np.pad(labels, 1, constant_values=0)
+    inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+    r = np.where(inside, rows, -1) + 1
+    c = np.where(inside, cols, -1) + 1
+
+    label = np.where(inside, padded[r, c], 0)
+    unique = inside & (label > 0)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            unique &= padded[r + dr, c + dc] == label
+    return label, unique
+
+
 class AdminAttributes:
     """
     A class for computing administrative attributes.
@@ -30,21 +69,35 @@ class AdminAttributes:
         filename of the crown feature class
     top_filename : str
         filename of the top feature class
+    crowns : AttributeBuffer
+        staging buffer of the crown attributes
+    tops : AttributeBuffer
+        staging buffer of the top attributes
 
     Methods:
     --------
     - attr_GlobalID(self)
     - attr_crownID(self, nb_code)
-    - join_crownID_toTop(self)
+    - join_crownID_toTop(self, cell_size)
     - attr_neighbCode(self, n_code)
     - delete_adminAttr(self)
 
     """
 
-    def __init__(self, path: str, crown_filename: str, point_filename: str):
+    def __init__(
+        self,
+        path: str,
+        crown_filename: str,
+        point_filename: str,
+        crown_buffer: AttributeBuffer = None,
+        top_buffer: AttributeBuffer = None,
+    ):
         self.path = path
         self.crown_filename = crown_filename
         self.top_filename = point_filename
+        # without shared (deferred) buffers each method writes its attributes
+        self.crowns = crown_buffer or AttributeBuffer(crown_filename)
+        self.tops = top_buffer or AttributeBuffer(point_filename)
 
     def attr_GlobalID(self):
         """
@@ -55,87 +108,146 @@ class AdminAttributes:
         - the crown feature class must have a field 'crown_id' with unique values
         - the top feature class must have a field 'crown_id' with unique values
         """
+        # the crown ids must be in the table before the schema change
+        self.crowns.flush()
         arcpy.AddGlobalIDs_management(self.crown_filename)
 
         # add GlobalID to top feature class if top intersects with crown polygon
-        au.addField_ifNotExists(self.top_filename, "FKID_crown", "GUID")
-
-        au.join_and_copy(
-            t_dest=self.top_filename,
-            join_a_dest="crown_id",
-            t_src=self.crown_filename,
-            join_a_src="crown_id",
-            a_src=["GlobalID"],
-            a_dest=["FKID_crown"],
+        crowns = self.crowns.read(["crown_id", "GlobalID"])
+        columns = lookup_columns(
+            self.tops.read(["crown_id"])["crown_id"],
+            crowns["crown_id"],
+            {"FKID_crown": crowns["GlobalID"]},
         )
+        self.tops.stage("FKID_crown", columns["FKID_crown"], "GUID")
+        self.tops.flush_ifNotDeferred()
 
     def attr_crownID(self, nb_code: str):
         """
         Adds the attribute 'crown_id' (TEXT) to the crown feature class.
             > Computes crown id from OBJECTID.Gl
-            > Only populates the field if it contains any null or empty values
         """
         logger.info("\tATTRIBUTE | crown_id:")
-        au.addField_ifNotExists(self.crown_filename, "crown_id", "TEXT")
-
-        # Check if the crown_id field contains any null or empty values
-        if au.check_isNull(self.crown_filename, "crown_id") == True:
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["OBJECTID", "crown_id"]
-            ) as cursor:
-                for row in cursor:
-                    # format id to <bydelcode>_<OBJECTID>
-                    row[1] = "b_" + str(nb_code) + "_" + str(row[0])
-                    # row[1] = row[0]
-                    cursor.updateRow(row)
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
+        # format id to <bydelcode>_<OBJECTID>
+        crown_id = [
+            "b_" + str(nb_code) + "_" + str(oid)
+            for oid in self.crowns.oids.tolist()
+        ]
+        self.crowns.stage("crown_id", crown_id, "TEXT")
+        self.crowns.flush_ifNotDeferred()
 
-    def join_crownID_toTop(self):
-        """
-        Joins the attribtue 'crown_id' (LONG) to the top feature class.
+    def join_crownID_toTop(self, cell_size: float = 0.25):
         """
+        Joins the attribute 'crown_id' (TEXT) of the crown that contains the
+        top to the top feature class. If the crowns have a GlobalID, it is
+        written as 'FKID_crown' (GUID) in the same pass.
 
-        # temporary ID for tree points to avoid issues with au.join_and_copy()
-        logger.info(
-            "\tAdding a temporary id 'top_id' using ObjectID to tree top feature class... "
-        )
-        arcpy.AddField_management(self.top_filename, "tmp_id", "LONG")
-        with arcpy.da.UpdateCursor(
-            self.top_filename, ["OBJECTID", "tmp_id"]
-        ) as cursor:
-            for row in cursor:
-                row[1] = row[0]
-                cursor.updateRow(row)
+        The crowns are rasterized (in memory) by OBJECTID and the label raster
+        is sampled at the top coordinates. Tops near a crown edge (the 3x3
+        cells around the top have more than one label) are resolved with a
+        point-in-polygon test of the crowns with these labels.
 
+        Args:
+            cell_size (float): cell size of the label raster, use the CHM
+                resolution
+        """
         logger.info(
             "\tJoining the tree crown id 'crown_id' to the tree top feature class... "
         )
-        v_join = os.path.join(self.path, "join_tmp")
-        arcpy.SpatialJoin_analysis(
-            self.top_filename,
-            self.crown_filename,
-            v_join,
-            "JOIN_ONE_TO_ONE",
-            "KEEP_ALL",
-            match_option="INTERSECT",
+        has_globalid = au.fieldExist(self.crown_filename, "GlobalID")
+        # crown_id (and GlobalID), staged or from the table
+        crown_columns = self.crowns.read(
+            ["crown_id"] + (["GlobalID"] if has_globalid else [])
         )
-
-        # Assign tree crown ID to tree points
-        arcpy.AddField_management(self.top_filename, "crown_id", "TEXT")
-        au.join_and_copy(
-            self.top_filename,
-            "tmp_id",
-            v_join,
-            "tmp_id",
-            ["crown_id"],
-            ["crown_id"],
+        crowns = dict(
+            zip(
+                self.crowns.oids.tolist(),
+                zip(*[c.tolist() for c in crown_columns.values()]),
+            )
         )
+        tops = {
+            row[0]: row[1]
+            for row in arcpy.da.SearchCursor(
+                self.top_filename, ["OID@", "SHAPE@XY"]
+            )
+            if row[1] is not None
+        }
+        top_oids = list(tops)
+        top_crown = dict.fromkeys(top_oids, 0)
+
+        if crowns and tops:
+            # rasterize the crowns by OBJECTID
+            desc_crowns = arcpy.Describe(self.crown_filename)
+            r_labels = r"memory\crown_labels"
+            arcpy.conversion.PolygonToRaster(
+                in_features=self.crown_filename,
+                value_field=desc_crowns.OIDFieldName,
+                out_rasterdataset=r_labels,
+                cell_assignment="CELL_CENTER",
+                cellsize=cell_size,
+            )
+            desc = arcpy.Describe(r_labels)
+            labels = arcpy.RasterToNumPyArray(r_labels, nodata_to_value=0)
+            x_min, y_max = desc.extent.XMin, desc.extent.YMax
+            cell_size = desc.meanCellWidth
+            arcpy.Delete_management(r_labels)
+
+            xy = np.array([tops[oid] for oid in top_oids], dtype=np.float64)
+            label, unique = sample_labels(labels, x_min, y_max, cell_size, xy)
+
+            # point-in-polygon fallback for the tops near a crown edge
+            candidates = {}
+            for i in np.flatnonzero(~unique):
+                row = int(np.floor((y_max - xy[i, 1]) / cell_size))
+                col = int(np.floor((xy[i, 0] - x_min) / cell_size))
+                window = labels[
+                    max(row - 1, 0) : max(row + 2, 0),
+                    max(col - 1, 0) : max(col + 2, 0),
+                ]
+                candidates[i] = sorted(set(window[window > 0].tolist()))
+                label[i] = 0
+
+            candidate_oids = {o for oids in candidates.values() for o in oids}
+            geometries = {}
+            if candidate_oids:
+                where = "{} IN ({})".format(
+                    desc_crowns.OIDFieldName,
+                    ", ".join(str(o) for o in candidate_oids),
+                )
+                geometries = {
+                    row[0]: row[1]
+                    for row in arcpy.da.SearchCursor(
+                        self.crown_filename, ["OID@", "SHAPE@"], where
+                    )
+                }
+            for i, oids in candidates.items():
+                point = arcpy.PointGeometry(
+                    arcpy.Point(*xy[i]), desc_crowns.spatialReference
+                )
+                for oid in oids:
+                    if not geometries[oid].disjoint(point):
+                        label[i] = oid
+                        break
+
+            top_crown = dict(zip(top_oids, label.tolist()))
+            logger.info(
+                "\t\t{} tops linked by the label raster, {} by point-in-polygon, {} without crown.".format(
+                    int(unique.sum()),
+                    sum(1 for i in candidates if label[i] > 0),
+                    int(np.count_nonzero(label == 0)),
+                )
+            )
 
-        arcpy.Delete_management(v_join)
-        # arcpy.DeleteField_management(self.top_filename, "tmp_id")
+        # stage crown_id (and FKID_crown)
+        no_crown = (None,) * len(crown_columns)
+        linked = [
+            crowns.get(top_crown.get(oid, 0), no_crown)
+            for oid in self.tops.oids.tolist()
+        ]
+        self.tops.stage("crown_id", [c[0] for c in linked], "TEXT")
+        if has_globalid:
+            self.tops.stage("FKID_crown", [c[1] for c in linked], "GUID")
+        self.tops.flush_ifNotDeferred()
 
     def attr_neighbCode(self, n_code):
         """
@@ -147,15 +259,15 @@ class AdminAttributes:
         logger.info(
             f"\tAdding the attribute <<bydelnummer>> with value {n_code} to crown features... "
         )
-        au.addField_ifNotExists(self.crown_filename, "bydelnummer", "TEXT")
-        au.calculateField_ifEmpty(self.crown_filename, "bydelnummer", n_code)
+        self.crowns.stage("bydelnummer", str(n_code), "TEXT")
+        self.crowns.flush_ifNotDeferred()
 
         # add bydelcode to top feature class
         logger.info(
             f"\tAdding the attribute <<bydelnummer>> with value {n_code} to top features... "
         )
-        au.addField_ifNotExists(self.top_filename, "bydelnummer", "TEXT")
-        au.calculateField_ifEmpty(self.top_filename, "bydelnummer", n_code)
+        self.tops.stage("bydelnummer", str(n_code), "TEXT")
+        self.tops.flush_ifNotDeferred()
 
     def delete_adminAttr(self):
         """
@@ -0,0 +1,235 @@
+"""Columnar staging buffer for the attributes of a feature class.
+
+The attribute classes compute their columns in memory (numpy arrays aligned
+to the object ids of the table) and stage them in an AttributeBuffer. A flush
+adds all missing fields in one schema change and writes all staged values,
+already rounded, in one UpdateCursor pass. A table is then rewritten once per
+flush instead of once per AddField, CalculateField, join and rounding step.
+
+Staged columns can be read back (e.g. crown_area for the ratio attributes)
+before they are written to the table.
+"""
+import logging
+
+import arcpy
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FLOAT_TYPES = ("FLOAT", "DOUBLE")
+INTEGER_TYPES = ("SHORT", "LONG")
+
+# FLOAT and DOUBLE attributes are rounded to two decimals
+DECIMALS = 2
+
+
+def _to_array(values: list) -> np.ndarray:
+    """Converts cursor values to a float array (NULL is NaN) if all values
+    are numbers, else to an object array."""
+    if all(v is None or isinstance(v, (int, float)) for v in values):
+        return np.array(
+            [np.nan if v is None else v for v in values], dtype=np.float64
+        )
+    return np.array(values, dtype=object)
+
+
+def _to_values(values: np.ndarray, field_type: str) -> list:
+    """Converts a staged column to cursor values (NaN is NULL)."""
+    if field_type in FLOAT_TYPES:
+        return [None if v != v else v for v in values.tolist()]
+    if field_type in INTEGER_TYPES:
+        return [None if v != v else int(v) for v in values.tolist()]
+    # NaN of columns that were read as numbers (all NULL)
+    return [
+        None if isinstance(v, float) and v != v else v for v in values.tolist()
+    ]
+
+
+def read_columns(table: str, fields: list, where_clause: str = None) -> dict:
+    """
+    Reads fields of a table into numpy arrays in one cursor pass.
+
+    Args:
+        table (str): path to the table or feature class
+        fields (list): field names or tokens (e.g. "OID@", "SHAPE@AREA")
+        where_clause (str, optional): selects the rows
+
+    Returns:
+        dict: field -> array, numeric fields are float arrays with NaN for
+            NULL, other fields are object arrays
+    """
+    rows = list(arcpy.da.SearchCursor(table, fields, where_clause))
+    return {
+        field: _to_array([row[i] for row in rows])
+        for i, field in enumerate(fields)
+    }
+
+
+def lookup_columns(keys, src_keys, src_columns: dict) -> dict:
+    """
+    Aligns the columns of a source table to a list of keys (a join).
+
+    Args:
+        keys: keys of the destination rows
+        src_keys: keys of the source rows
+        src_columns (dict): field -> array of the source rows
+
+    Returns:
+        dict: field -> array aligned to keys, NaN (numeric) or None for keys
+            without source row
+    """
+    # the first source row of a key is joined (as AddJoin does)
+    position = {}
+    for i, k in enumerate(np.asarray(src_keys).tolist()):
+        position.setdefault(k, i)
+    index = np.array(
+        [position.get(k, -1) for k in np.asarray(keys).tolist()],
+        dtype=np.int64,
+    )
+    found = index >= 0
+    result = {}
+    for field, column in src_columns.items():
+        missing = np.nan if column.dtype.kind == "f" else None
+        out = np.full(len(index), missing, dtype=column.dtype)
+        out[found] = column[index[found]]
+        result[field] = out
+    return result
+
+
+class AttributeBuffer:
+    """
+    Staging buffer for the attribute columns of a table.
+
+    Attributes:
+    -----------
+    table : str
+        path to the table or feature class
+    deferred : bool
+        if True, flush_ifNotDeferred() does not write, the owner of the
+        buffer calls flush() once after all attributes are staged
+
+    Methods:
+    --------
+    - read(self, fields)
+    - stage(self, field, values, field_type, decimals)
+    - flush(self)
+    - flush_ifNotDeferred(self)
+    """
+
+    def __init__(self, table: str, deferred: bool = False):
+        self.table = table
+        self.deferred = deferred
+        self._oids = None
+        self._staged = {}
+
+    @property
+    def oids(self) -> np.ndarray:
+        """Object ids of the rows, the staged columns are aligned to them."""
+        if self._oids is None:
+            self._oids = np.array(
+                [row[0] for row in arcpy.da.SearchCursor(self.table, "OID@")],
+                dtype=np.int64,
+            )
+        return self._oids
+
+    def __len__(self):
+        return len(self.oids)
+
+    def read(self, fields: list) -> dict:
+        """
+        Returns columns aligned to oids, staged columns are returned from the
+        buffer, all other fields are read from the table in one pass.
+
+        Args:
+            fields (list): field names or tokens
+
+        Returns:
+            dict: field -> array
+        """
+        result = {f: self._staged[f][1] for f in fields if f in self._staged}
+        to_read = [f for f in fields if f not in self._staged]
+        if to_read:
+            columns = read_columns(self.table, ["OID@"] + to_read)
+            result.update(
+                lookup_columns(
+                    self.oids,
+                    columns.pop("OID@").astype(np.int64),
+                    columns,
+                )
+            )
+        return result
+
+    def stage(
+        self,
+        field: str,
+        values,
+        field_type: str = "FLOAT",
+        decimals: int = DECIMALS,
+    ):
+        """
+        Stages a column, the field is added on flush if it does not exist.
+
+        Args:
+            field (str): field name
+            values: array aligned to oids, or a single value for all rows
+            field_type (str): field type used if the field is added
+            decimals (int): FLOAT and DOUBLE values are rounded to decimals
+        """
+        n_rows = len(self.oids)
+        if field_type in FLOAT_TYPES + INTEGER_TYPES:
+            column = np.broadcast_to(
+                np.asarray(values, dtype=np.float64), (n_rows,)
+            ).copy()
+            if field_type in FLOAT_TYPES and decimals is not None:
+                column = np.round(column, decimals)
+        else:
+            if np.ndim(values) == 0:
+                column = np.full(n_rows, values, dtype=object)
+            else:
+                column = np.asarray(values, dtype=object)
+        if len(column) != n_rows:
+            raise ValueError(
+                f"Column {field} has {len(column)} values, {self.table} has {n_rows} rows"
+            )
+        self._staged[field] = (field_type, column)
+
+    def flush(self):
+        """
+        Adds the missing fields in one schema change and writes all staged
+        columns in one cursor pass.
+        """
+        if not self._staged:
+            return
+        existing = {f.name.lower() for f in arcpy.ListFields(self.table)}
+        new_fields = [
+            [field, field_type]
+            for field, (field_type, _) in self._staged.items()
+            if field.lower() not in existing
+        ]
+        if new_fields:
+            arcpy.management.AddFields(self.table, new_fields)
+
+        fields = list(self._staged)
+        columns = [
+            _to_values(column, field_type)
+            for field_type, column in self._staged.values()
+        ]
+        position = {oid: i for i, oid in enumerate(self.oids.tolist())}
+        with arcpy.da.UpdateCursor(self.table, ["OID@"] + fields) as cursor:
+            for row in cursor:
+                i = position.get(row[0])
+                if i is None:
+                    continue
+                cursor.updateRow([row[0]] + [column[i] for column in columns])
+
+        logger.info(
+            "\tWrote {} attributes ({} new fields) to {} rows of {}.".format(
+                len(fields), len(new_fields), len(position), self.table
+            )
+        )
+        self._staged = {}
+
+    def flush_ifNotDeferred(self):
+        """Flushes the buffer unless the owner flushes it later."""
+        if not self.deferred:
+            self.flush()
@@ -0,0 +1,306 @@
+"""Minimum bounding geometries of all crowns at once (numpy).
+
+MinimumBoundingGeometry writes a feature class per geometry type that is
+joined back to the crowns, and CalculatePolygonMainAngle adds another pass.
+The functions here compute the same measures for all crowns from their
+vertices in one pass, without temporary layers:
+
+- convex_hulls: the convex hull of each group of points (monotone chain,
+  all groups at once: the points that make a non-convex turn are removed in
+  rounds until none is left)
+- minimum_rectangles: the minimum-area rectangle of each hull by rotating
+  calipers. One side of the rectangle lies on a hull edge; for each edge the
+  vertices touching the three other sides are found with a search on the
+  edge angles of the hull, which increase around a convex polygon.
+- enclosing_circles: the minimum enclosing circle of each hull (Welzl)
+
+The points of a crown are its vertices as (x, y) rows with the index of the
+crown as group, e.g. from SearchCursor(["OID@", "SHAPE@XY"],
+explode_to_points=True).
+"""
+import numpy as np
+
+TWO_PI = 2 * np.pi
+
+
+def _group_starts(group: np.ndarray) -> np.ndarray:
+    """Returns the first index of each run of a sorted group array."""
+    return np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+
+
+def _half_hull(xy: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """
+    Returns the indices of the lower chain of points sorted by (group, x, y),
+    reversed input gives the upper chain. The first and last point of each
+    group are kept.
+    """
+    alive = np.arange(len(xy))
+    x, y, g = xy[:, 0], xy[:, 1], group
+    while len(alive) > 2:
+        # b is on or above the segment between its neighbours a and c
+        cross = (x[1:-1] - x[:-2]) * (y[2:] - y[:-2]) - (y[1:-1] - y[:-2]) * (
+            x[2:] - x[:-2]
+        )
+        drop = (g[:-2] == g[1:-1]) & (g[1:-1] == g[2:]) & (cross <= 0)
+        if not drop.any():
+            break
+        keep = np.r_[True, ~drop, True]
+        alive, x, y, g = alive[keep], x[keep], y[keep], g[keep]
+    return alive
+
+
+def convex_hulls(xy: np.ndarray, group: np.ndarray) -> tuple:
+    """
+    Computes the convex hull of each group of points.
+
+    Args:
+        xy (np.ndarray): (n, 2) coordinates
+        group (np.ndarray): group (e.g. crown index) of each point
+
+    Returns:
+        tuple: (hull_xy, hull_group), the hull vertices counter-clockwise
+            without closing vertex, sorted by group. A hull of collinear
+            points has two vertices, of a single point one.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    group = np.asarray(group, dtype=np.int64)
+    order = np.lexsort((xy[:, 1], xy[:, 0], group))
+    xy, group = xy[order], group[order]
+    # repeated points (e.g. the closing vertex of each ring)
+    unique = np.r_[
+        True,
+        (group[1:] != group[:-1]) | np.any(xy[1:] != xy[:-1], axis=1),
+    ]
+    xy, group = xy[unique], group[unique]
+
+    lower = _half_hull(xy, group)
+    reverse = np.arange(len(xy))[::-1]
+    upper = reverse[_half_hull(xy[reverse], group[reverse])]
+
+    # upper chain without its first and last point (the ends of the lower
+    # chain), in the order of the chains
+    upper_group = group[upper]
+    inner = np.zeros(len(upper), dtype=bool)
+    inner[1:-1] = (upper_group[1:-1] == upper_group[:-2]) & (
+        upper_group[1:-1] == upper_group[2:]
+    )
+    upper = upper[inner]
+
+    index = np.r_[lower, upper]
+    position = np.r_[np.arange(len(lower)), np.arange(len(upper)) + len(xy)]
+    # groups are sorted descending in the upper chain, sort by group first
+    index = index[np.lexsort((position, group[index]))]
+    return xy[index], group[index]
+
+
+def minimum_rectangles(xy: np.ndarray, group: np.ndarray, n_groups: int):
+    """
+    Computes the minimum-area bounding rectangle of each group of points
+    (MinimumBoundingGeometry RECTANGLE_BY_AREA) and its main angle.
+
+    Args:
+        xy (np.ndarray): (n, 2) coordinates
+        group (np.ndarray): group index (0 ... n_groups - 1) of each point
+        n_groups (int): number of groups, groups without points are NaN
+
+    Returns:
+        dict: arrays of n_groups values
+            "length", "width": the long and the short side
+            "area": area of the rectangle
+            "angle": direction of the long side in degrees clockwise from
+            north, -90 < angle <= 90
+            "ns_extent", "ew_extent": north-south and east-west extent of
+            the points
+    """
+    result = {
+        name: np.full(n_groups, np.nan)
+        for name in ["length", "width", "area", "angle"]
+        + ["ns_extent", "ew_extent"]
+    }
+    if len(xy) == 0:
+        return result
+    hull, hull_group = convex_hulls(xy, group)
+    starts = _group_starts(hull_group)
+    groups = hull_group[starts]
+    n_vertices = np.diff(np.r_[starts, len(hull)])
+
+    # axis-aligned extent (of the hull, the same as of the points)
+    for name, axis in [("ns_extent", 1), ("ew_extent", 0)]:
+        result[name][groups] = np.maximum.reduceat(
+            hull[:, axis], starts
+        ) - np.minimum.reduceat(hull[:, axis], starts)
+
+    # edge i goes from vertex i to the next vertex of the hull
+    local = np.arange(len(hull)) - np.repeat(starts, n_vertices)
+    group_run = np.repeat(np.arange(len(starts)), n_vertices)
+    following = np.where(
+        local == n_vertices[group_run] - 1,
+        starts[group_run],
+        np.arange(len(hull)) + 1,
+    )
+    edge = hull[following] - hull
+    phi = np.arctan2(edge[:, 1], edge[:, 0])
+    # edge angles relative to the first edge of the hull increase from 0 to
+    # 2 pi, shifted by 4 pi per hull to search all hulls at once
+    relative = np.mod(phi - phi[starts][group_run], TWO_PI)
+    relative[starts] = 0.0
+    offset = group_run * 2 * TWO_PI
+    searchable = relative + offset
+
+    def caliper(turn: float) -> np.ndarray:
+        """Returns the vertices that are extreme in the direction
+        phi + turn - pi / 2: the edges before and after a vertex enclose the
+        angle phi + turn."""
+        query = np.mod(relative + turn, TWO_PI) + offset
+        k = np.searchsorted(searchable, query, side="left")
+        k = np.minimum(k, len(hull))
+        past_end = (k >= starts[group_run] + n_vertices[group_run]) | (
+            k == len(hull)
+        )
+        return np.where(past_end, starts[group_run], k)
+
+    u = np.column_stack([np.cos(phi), np.sin(phi)])
+    normal = np.column_stack([-u[:, 1], u[:, 0]])  # inward (left) normal
+    front = hull[caliper(np.pi / 2)]  # extreme along the edge
+    back = hull[caliper(3 * np.pi / 2)]  # extreme against the edge
+    far = hull[caliper(np.pi)]  # farthest from the edge
+    side_u = np.einsum("ij,ij->i", front - back, u)
+    side_n = np.einsum("ij,ij->i", far - hull, normal)
+    area = side_u * side_n
+
+    # smallest rectangle per hull (first edge of the smallest area)
+    best = np.lexsort((area, group_run))[starts]
+    long_is_u = side_u[best] >= side_n[best]
+    length = np.where(long_is_u, side_u[best], side_n[best])
+    width = np.where(long_is_u, side_n[best], side_u[best])
+    direction = np.where(long_is_u[:, None], u[best], normal[best])
+    angle = np.degrees(np.arctan2(direction[:, 0], direction[:, 1]))
+    angle = np.where(angle <= -90, angle + 180, angle)
+    angle = np.where(angle > 90, angle - 180, angle)
+
+    result["length"][groups] = length
+    result["width"][groups] = width
+    result["area"][groups] = area[best]
+    result["angle"][groups] = angle
+    return result
+
+
+def _circle_2(a: np.ndarray, b: np.ndarray) -> tuple:
+    """Circles with the segments a-b as diameter."""
+    centre = (a + b) / 2
+    return centre, np.hypot(*(a - centre).T)
+
+
+def _circle_3(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> tuple:
+    """Circles through a, b and c, the largest circle of two of the points
+    for collinear points."""
+    b, c = b - a, c - a
+    d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    bb, cc = (b**2).sum(axis=1), (c**2).sum(axis=1)
+    collinear = np.abs(d) <= 1e-12 * np.maximum(bb, cc)
+    d = np.where(collinear, 1.0, d)
+    ux = (c[:, 1] * bb - b[:, 1] * cc) / d
+    uy = (b[:, 0] * cc - c[:, 0] * bb) / d
+    centre = np.column_stack([ux, uy]) + a
+    radius = np.hypot(ux, uy)
+    if collinear.any():
+        # the two points farthest apart
+        pairs = [(a, b + a), (a, c + a), (b + a, c + a)]
+        circles = [_circle_2(p[0][collinear], p[1][collinear]) for p in pairs]
+        widest = np.argmax(np.column_stack([r for _, r in circles]), axis=1)
+        centre[collinear] = np.stack([c for c, _ in circles])[
+            widest, np.arange(widest.size)
+        ]
+        radius[collinear] = np.column_stack([r for _, r in circles])[
+            np.arange(widest.size), widest
+        ]
+    return centre, radius
+
+
+def enclosing_circles(
+    xy: np.ndarray, group: np.ndarray, n_groups: int, seed: int = 0
+) -> dict:
+    """
+    Computes the minimum enclosing circle of each group of points
+    (MinimumBoundingGeometry CIRCLE).
+
+    Welzl's algorithm (iterative form) on the convex hull vertices of each
+    group in random order, expected linear time in the number of hull
+    vertices. The groups are processed in lockstep, one vertex position at a
+    time; groups with hulls of similar size are processed together, so the
+    loops of the few large hulls do not run over all groups.
+
+    Args:
+        xy (np.ndarray): (n, 2) coordinates
+        group (np.ndarray): group index (0 ... n_groups - 1) of each point
+        n_groups (int): number of groups, groups without points are NaN
+        seed (int): seed of the random vertex order
+
+    Returns:
+        dict: arrays of n_groups values "x", "y" (centre), "diameter" and
+            "area"
+    """
+    result = {
+        name: np.full(n_groups, np.nan)
+        for name in ["x", "y", "diameter", "area"]
+    }
+    if len(xy) == 0:
+        return result
+    hull, hull_group = convex_hulls(xy, group)
+    starts = _group_starts(hull_group)
+    groups = hull_group[starts]
+    n_vertices = np.diff(np.r_[starts, len(hull)])
+
+    # random order of the vertices within each hull
+    rng = np.random.default_rng(seed)
+    group_run = np.repeat(np.arange(len(starts)), n_vertices)
+    shuffled = np.lexsort((rng.random(len(hull)), group_run))
+    hull = hull[shuffled]
+    # hull coordinates relative to the first vertex (precision)
+    origin = hull[starts]
+    hull = hull - np.repeat(origin, n_vertices, axis=0)
+
+    centre = np.zeros((len(starts), 2))
+    radius = np.zeros(len(starts))
+
+    def outside(runs, index):
+        distance = np.hypot(*(hull[index] - centre[runs]).T)
+        return distance > radius[runs] * (1 + 1e-9) + 1e-9
+
+    # buckets of hull sizes up to 8, 16, 32, ...
+    bucket = np.ceil(np.log2(np.maximum(n_vertices, 8))).astype(int)
+    for size_bits in np.unique(bucket):
+        runs = np.flatnonzero(bucket == size_bits)
+        first, count = starts[runs], n_vertices[runs]
+        centre[runs] = hull[first]
+        for i in range(1, int(count.max())):
+            has_i = count > i
+            active = runs[has_i][outside(runs[has_i], first[has_i] + i)]
+            if active.size == 0:
+                continue
+            # circle with vertex i on its boundary
+            p_i = hull[starts[active] + i]
+            centre[active], radius[active] = p_i, 0.0
+            for j in range(i):
+                sub = active[outside(active, starts[active] + j)]
+                if sub.size == 0:
+                    continue
+                # circle with vertices i and j on its boundary
+                p_i, p_j = hull[starts[sub] + i], hull[starts[sub] + j]
+                centre[sub], radius[sub] = _circle_2(p_i, p_j)
+                for k in range(j):
+                    last = sub[outside(sub, starts[sub] + k)]
+                    if last.size == 0:
+                        continue
+                    centre[last], radius[last] = _circle_3(
+                        hull[starts[last] + i],
+                        hull[starts[last] + j],
+                        hull[starts[last] + k],
+                    )
+
+    centre = centre + origin
+    result["x"][groups] = centre[:, 0]
+    result["y"][groups] = centre[:, 1]
+    result["diameter"][groups] = 2 * radius
+    result["area"][groups] = np.pi * radius**2
+    return result
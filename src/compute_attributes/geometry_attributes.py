@@ -1,14 +1,46 @@
 import logging
+import math
 import os
 
 import arcpy
+import numpy as np
 
-from src import arcpy_utils as au
 from src import logger
+from src.compute_attributes.attribute_buffer import (
+    AttributeBuffer,
+    lookup_columns,
+    read_columns,
+)
+from src.compute_attributes.bounding_geometry import (
+    enclosing_circles,
+    minimum_rectangles,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def classify_outlier(values, mild: float, extreme: float, greater=True):
+    """
+    Classifies values in normal (0), mild outlier (1) or extreme outlier (2).
+
+    Args:
+        values (np.ndarray): attribute values, NaN is an extreme outlier
+        mild (float): threshold of the mild outliers
+        extreme (float): threshold of the extreme outliers
+        greater (bool): outliers are values above (True) or below (False) the
+            thresholds
+
+    Returns:
+        np.ndarray: outlier class per value
+    """
+    with np.errstate(invalid="ignore"):
+        if greater:
+            normal, not_extreme = values <= mild, values <= extreme
+        else:
+            normal, not_extreme = values >= mild, values >= extreme
+    return np.where(normal, 0, np.where(not_extreme, 1, 2))
+
+
 class GeometryAttributes:
     """
     A class for computing administrative attributes.
@@ -21,6 +53,10 @@ class GeometryAttributes:
         filename of the crown feature class
     top_filename : str
         filename of the top feature class
+    crowns : AttributeBuffer
+        staging buffer of the crown attributes
+    tops : AttributeBuffer
+        staging buffer of the top attributes
 
     Methods:
     --------
@@ -32,10 +68,67 @@ class GeometryAttributes:
     - attr_envelope(self, keep_temp: bool)
     """
 
-    def __init__(self, path: str, crown_filename: str, point_filename: str):
+    def __init__(
+        self,
+        path: str,
+        crown_filename: str,
+        point_filename: str,
+        crown_buffer: AttributeBuffer = None,
+        top_buffer: AttributeBuffer = None,
+    ):
         self.path = path
         self.crown_filename = crown_filename
         self.top_filename = point_filename
+        # without shared (deferred) buffers each method writes its attributes
+        self.crowns = crown_buffer or AttributeBuffer(crown_filename)
+        self.tops = top_buffer or AttributeBuffer(point_filename)
+        self._vertices = None
+
+    def _boundingGeometry(self, v_out: str, geometry_type: str, fields: list):
+        """
+        Computes the minimum bounding geometry of each crown and returns the
+        MBG fields aligned to the crowns (joined on ORIG_FID).
+        """
+        arcpy.MinimumBoundingGeometry_management(
+            self.crown_filename,
+            v_out,
+            geometry_type,
+            "NONE",
+            "",
+            "MBG_FIELDS",
+        )
+        columns = read_columns(v_out, ["ORIG_FID"] + fields)
+        return lookup_columns(
+            self.crowns.oids, columns.pop("ORIG_FID").astype(np.int64), columns
+        )
+
+    def _crownVertices(self) -> tuple:
+        """
+        Reads the vertices of all crowns in one cursor pass (once, the
+        bounding geometries share them).
+
+        Returns:
+            tuple: (xy, group), the (n, 2) vertex coordinates and the index
+                of their crown in self.crowns.oids
+        """
+        if self._vertices is not None:
+            return self._vertices
+        oids = self.crowns.oids
+        rows = list(
+            arcpy.da.SearchCursor(
+                self.crown_filename,
+                ["OID@", "SHAPE@XY"],
+                explode_to_points=True,
+            )
+        )
+        xy = np.array([row[1] for row in rows], dtype=np.float64).reshape(-1, 2)
+        vertex_oids = np.array([row[0] for row in rows], dtype=np.int64)
+        order = np.argsort(oids)
+        group = order[np.searchsorted(oids[order], vertex_oids)]
+        # vertices read with NULL coordinates (empty parts)
+        valid = np.all(np.isfinite(xy), axis=1)
+        self._vertices = (xy[valid], group[valid])
+        return self._vertices
 
     def attr_crownArea(self):
         """
@@ -59,67 +152,34 @@ class GeometryAttributes:
             "\tComputing the crown perimeter by using the shape length... "
         )
 
-        # Get the linear units of the feature layer's spatial reference
-        linear_units = arcpy.Describe(
-            self.crown_filename
-        ).spatialReference.linearUnitName
-
-        # Calculate the area of each feature based on its geometry and write the result to the crown_area field
-        if linear_units == "Meter":
-            logger.info("\tThe linear unit to calculate the area is Meter")
-            expression_area = "float(!SHAPE.area@squaremeters!)"
-            expression_perimeter = "float(!SHAPE.length@meters!)"
-        else:
-            conversion_factor = arcpy.Describe(
-                self.crown_filename
-            ).spatialReference.metersPerUnit
-            expression_area = "float(!SHAPE.area@squaremeters!) * {}".format(
-                conversion_factor
-            )
-            expression_perimeter = "float(!SHAPE.length@meters!) * {}".format(
-                conversion_factor
+        # convert the shape area and length to meters
+        spatial_reference = arcpy.Describe(self.crown_filename).spatialReference
+        logger.info(
+            "\tThe linear unit to calculate the area is {}".format(
+                spatial_reference.linearUnitName
             )
-
-        field_list = ["crown_area", "crown_peri"]
-        for field in field_list:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        au.addField_ifNotExists(self.crown_filename, "outlier_CA", "SHORT")
-
-        au.calculateField_ifEmpty(
-            self.crown_filename, "crown_area", expression_area
         )
-        au.calculateField_ifEmpty(
-            self.crown_filename, "crown_peri", expression_perimeter
-        )
-
-        if au.check_isNull(self.crown_filename, "outlier_CA") == True:
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["crown_area", "outlier_CA"]
-            ) as cursor:
-                for row in cursor:
-                    if row[0] <= 250:
-                        row[1] = 0
-                    elif row[0] > 250 and row[0] <= 350:
-                        row[1] = 1
-                    else:
-                        row[1] = 2
-                    cursor.updateRow(row)
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-
-        au.round_fields_two_decimals(
-            self.crown_filename, ["crown_area", "crown_peri"]
+        meters_per_unit = spatial_reference.metersPerUnit or 1.0
+
+        shape = self.crowns.read(["SHAPE@AREA", "SHAPE@LENGTH"])
+        crown_area = shape["SHAPE@AREA"] * meters_per_unit**2
+        crown_peri = shape["SHAPE@LENGTH"] * meters_per_unit
+
+        self.crowns.stage("crown_area", crown_area, "FLOAT")
+        self.crowns.stage("crown_peri", crown_peri, "FLOAT")
+        self.crowns.stage(
+            "outlier_CA",
+            classify_outlier(
+                self.crowns.read(["crown_area"])["crown_area"], 250, 350
+            ),
+            "SHORT",
         )
+        self.crowns.flush_ifNotDeferred()
 
     def attr_crownVolume(self):
         """
         Adds the attribute 'tree_volume' (FlOAT) to the crown feature class.
         """
-
-        au.addField_ifNotExists(self.crown_filename, "tree_volume", "FLOAT")
         # Calculate tree volume
         formula = str(
             "tree volume =(1/3)π * (crown diameter/2)^2 * tree height"
@@ -128,30 +188,36 @@ class GeometryAttributes:
             f"\tComputing the crown volume by using the formula: \t{formula}"
         )
 
-        expression = "(1.0/3.0) * math.pi * ( !crown_diam! /2.0 ) * ( !crown_diam! /2.0) * float(!tree_height_laser!)"
-        au.calculateField_ifEmpty(
-            in_table=self.crown_filename,
-            field="tree_volume",
-            expression=expression,
+        columns = self.crowns.read(["crown_diam", "tree_height_laser"])
+        tree_volume = (
+            (1.0 / 3.0)
+            * math.pi
+            * (columns["crown_diam"] / 2.0) ** 2
+            * columns["tree_height_laser"]
         )
-
-        au.round_fields_two_decimals(self.crown_filename, ["tree_volume"])
-        # round attribute to 2 decimals
+        self.crowns.stage("tree_volume", tree_volume, "FLOAT")
+        self.crowns.flush_ifNotDeferred()
 
     def attr_enclosingCircle(self, keep_temp: bool):
         """
         Calculates the enclosing circle geometry attributes and adds them to the crown feature class.
         The ratio between Crown Area / Enclosing Cirlce Area identifies elongated polygons.
+        The minimum enclosing circles of all crowns are computed at once (Welzl on the
+        convex hull vertices, see bounding_geometry.py), no temporary layer is written.
 
         -----------------------------------
-        EC_diam (MBG_Diameter): the diameter of the enclosing circle (can be used to estimate crown diameter)
-        EC_area (Shape_Area): the area of the resulting circle
+        EC_diam: the diameter of the enclosing circle (can be used to estimate crown diameter)
+        EC_area: the area of the resulting circle
         ratio_CA_ECA: ratio crown area / enclosing circle area
         outlier_ratio_CA_ECA: classifies the tree crown in normal (0), mild outlier (1) or extreme outlier (2).
             - normal (0) if ratio crown area / enclosing circle area >= 0.25
             - mild outlier (1) if ratio crown area / enclosing circle area < 0.25
             - extreme outlier (2) if ratio crown area / enclosing circle area < 0.02
         -----------------------------------
+
+        Args:
+            keep_temp (bool): unused, kept for the callers of the
+                MinimumBoundingGeometry version
         """
 
         logger.info("\tATTRIBUTE | EC_diam:")
@@ -170,80 +236,28 @@ class GeometryAttributes:
                 - extreme outlier (2) if ratio crown area / enclosing circle area < 0.02... "
         )
 
-        v_enclosing_circle = os.path.join(self.path, "enclosing_circle_temp")
-
-        # calculate enclosing circle
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_enclosing_circle,
-            "CIRCLE",
-            "NONE",
-            "",
-            "MBG_FIELDS",
-        )
-
-        # add attribute fields
-        field_list = ["EC_diam", "EC_area", "ratio_CA_ECA"]
-
-        for field in field_list:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        au.addField_ifNotExists(
-            self.crown_filename, "outlier_ratio_CA_ECA", "SHORT"
+        xy, group = self._crownVertices()
+        circle = enclosing_circles(xy, group, len(self.crowns))
+        self.crowns.stage("EC_diam", circle["diameter"], "FLOAT")
+        self.crowns.stage("EC_area", circle["area"], "FLOAT")
+
+        # ratio of the rounded areas, as written to the table
+        columns = self.crowns.read(["crown_area", "EC_area"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = columns["crown_area"] / columns["EC_area"]
+        self.crowns.stage("ratio_CA_ECA", ratio, "FLOAT")
+        self.crowns.stage(
+            "outlier_ratio_CA_ECA",
+            classify_outlier(
+                self.crowns.read(["ratio_CA_ECA"])["ratio_CA_ECA"],
+                0.25,
+                0.02,
+                greater=False,
+            ),
+            "SHORT",
         )
 
-        # fill attribute fields
-        if (
-            au.check_isNull(self.crown_filename, "EC_diam") == True
-            or au.check_isNull(self.crown_filename, "EC_area") == True
-        ):
-            # EC_diam and EC_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_enclosing_circle,
-                join_a_src="crown_id",
-                a_src=["MBG_Diameter", "Shape_Area"],
-                a_dest=["EC_diam", "EC_area"],
-            )
-
-            # calculate ratio crown area / enclosing circle area
-            arcpy.CalculateField_management(
-                in_table=self.crown_filename,
-                field="ratio_CA_ECA",
-                expression="!crown_area! / !EC_area!",
-                expression_type="PYTHON3",
-            )
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-            # classify tree crown as normal, mild outlier or extreme outlier
-
-        if au.check_isNull(self.crown_filename, "outlier_ratio_CA_ECA") == True:
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["ratio_CA_ECA", "outlier_ratio_CA_ECA"]
-            ) as cursor:
-                for row in cursor:
-                    if row[0] >= 0.25:
-                        row[1] = 0
-                    elif row[0] < 0.25 and row[0] >= 0.02:
-                        row[1] = 1
-                    else:
-                        row[1] = 2
-                    cursor.updateRow(row)
-
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-
-        if keep_temp == False:
-            arcpy.Delete_management(v_enclosing_circle)
-
-        au.round_fields_two_decimals(
-            self.crown_filename, ["EC_diam", "EC_area", "ratio_CA_ECA"]
-        )
+        self.crowns.flush_ifNotDeferred()
 
     def attr_convexHull(self, keep_temp: bool):
         """
@@ -279,85 +293,56 @@ class GeometryAttributes:
 
         v_convex_hull = os.path.join(self.path, "convex_hull_temp")
 
-        field_list = ["CH_length", "CH_width", "CH_area", "ratio_CA_CHA"]
-
-        for field in field_list:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        au.addField_ifNotExists(
-            self.crown_filename, "outlier_ratio_CA_CHA", "SHORT"
-        )
-
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
+        mbg = self._boundingGeometry(
             v_convex_hull,
             "CONVEX_HULL",
-            "NONE",
-            "",
-            "MBG_FIELDS",
+            ["MBG_Length", "MBG_Width", "SHAPE@AREA"],
+        )
+        self.crowns.stage("CH_length", mbg["MBG_Length"], "FLOAT")
+        self.crowns.stage("CH_width", mbg["MBG_Width"], "FLOAT")
+        self.crowns.stage("CH_area", mbg["SHAPE@AREA"], "FLOAT")
+
+        columns = self.crowns.read(["crown_area", "CH_area"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = columns["crown_area"] / columns["CH_area"]
+        self.crowns.stage("ratio_CA_CHA", ratio, "FLOAT")
+        self.crowns.stage(
+            "outlier_ratio_CA_CHA",
+            classify_outlier(
+                self.crowns.read(["ratio_CA_CHA"])["ratio_CA_CHA"],
+                0.7,
+                0.6,
+                greater=False,
+            ),
+            "SHORT",
         )
-
-        # fill attribute fields
-        if au.check_isNull(self.crown_filename, field) == True:
-            # CH_length, CH_width and CH_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_convex_hull,
-                join_a_src="crown_id",
-                a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
-                a_dest=["CH_length", "CH_width", "CH_area"],
-            )
-            # arcpy.Delete_management(v_convex_hull)
-
-            # calculate ratio crown area / convex hull area
-            arcpy.CalculateField_management(
-                in_table=self.crown_filename,
-                field="ratio_CA_CHA",
-                expression="!crown_area! / !CH_area!",
-                expression_type="PYTHON3",
-            )
-
-            with arcpy.da.UpdateCursor(
-                self.crown_filename, ["ratio_CA_CHA", "outlier_ratio_CA_CHA"]
-            ) as cursor:
-                for row in cursor:
-                    if row[0] >= 0.7:
-                        row[1] = 0
-                    elif row[0] < 0.7 and row[0] >= 0.6:
-                        row[1] = 1
-                    else:
-                        row[1] = 2
-                    cursor.updateRow(row)
-
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
 
         if keep_temp == False:
             arcpy.Delete_management(v_convex_hull)
 
-        au.round_fields_two_decimals(
-            self.crown_filename,
-            ["CH_length", "CH_width", "CH_area", "ratio_CA_CHA"],
-        )
+        self.crowns.flush_ifNotDeferred()
 
     def attr_envelope(self, keep_temp: bool):
         """
         Calculates the envelope attributes and adds them to the crown feature class.
+        The envelope is the minimum-area rectangle of the crown, computed for
+        all crowns at once by rotating calipers on their convex hulls (see
+        bounding_geometry.py), no temporary layer is written.
 
         -----------------------------------
-        EV_length (MBG_Length): the lenght of the longer side of the resulting rectangle
-        EV_width (MBG_Width): the lenght of the shorter side of the resulting rectangle
-        EV_area (Shape_Area): envelope area
-        EV_angle (FLOAT): the dominant angle of the envelope, in decimal degrees.
+        EV_length: the lenght of the longer side of the rectangle
+        EV_width: the lenght of the shorter side of the rectangle
+        EV_area: envelope area
+        EV_angle (FLOAT): the main angle of the envelope (direction of the longer side),
+            in decimal degrees clockwise from north (-90 < angle <= 90).
         NS_width: the width of the crown in the north-south direction (0 deg)
         ES_width: the width of the crown in the east-west direction (90 or -90 deg)
-        - if angle -90 or 90 degrees, NS_width = envelope length and ES_width = envelope width
-        - elif angle 0 or 180 degrees, NS_width = envelope width and ES_width = envelope length
-        - else NS_width = None and ES_width = None
+            (the north-south and east-west extent of the crown vertices)
         -----------------------------------
+
+        Args:
+            keep_temp (bool): unused, kept for the callers of the
+                MinimumBoundingGeometry version
         """
 
         logger.info("\tATTRIBUTE | EV_length:")
@@ -366,123 +351,22 @@ class GeometryAttributes:
         logger.info("\tComputing the envelope width... ")
         logger.info("\tATTRIBUTE | EV_area:")
         logger.info("\tComputing the envelope area... ")
-
-        v_envelope = os.path.join(self.path, "envelope_temp")
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
-            v_envelope,
-            "ENVELOPE",
-            "NONE",
-            "",
-            "MBG_FIELDS",
+        logger.info("\tATTRIBUTE | EV_angle, NS_width, ES_width:")
+        logger.info(
+            "\tComputing the envelope angle and the NS and EW width... "
         )
 
-        field_list_crown = [
-            "EV_length",
-            "EV_width",
-            "EV_area",
-            "EV_angle",
-            "NS_width",
-            "ES_width",
-        ]
-
-        for field in field_list_crown:
-            au.addField_ifNotExists(self.crown_filename, field, "FLOAT")
-
-        field_list_envelop = ["EV_angle", "NS_width", "ES_width"]
-        for field in field_list_envelop:
-            au.addField_ifNotExists(v_envelope, field, "FLOAT")
-
-        # fill attribute fields
-        if (
-            au.check_isNull(self.crown_filename, "EV_length") == True
-            or au.check_isNull(self.crown_filename, "EV_width") == True
-            or au.check_isNull(self.crown_filename, "EV_area") == True
-        ):
-            # CH_length, CH_width and CH_area
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_envelope,
-                join_a_src="crown_id",
-                a_src=["MBG_Length", "MBG_Width", "Shape_Area"],
-                a_dest=["EV_length", "EV_width", "EV_area"],
-            )
-            # arcpy.Delete_management(v_convex_hull)
-
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-
-        # Calculate angle and NS and ES width
-        codeblock = """def classify_envAngle(envelope_width, envelope_length, envelope_angle, computed_measure):
-                        eps = 1e-2
-                        if abs(envelope_angle+90) < eps:
-                            if computed_measure == "NS":
-                                return envelope_length
-                            elif computed_measure == "EW":
-                                return envelope_width
-                            else:    
-                                return None
-                        elif abs(envelope_angle) < eps:
-                            if computed_measure == "NS":
-                                return envelope_width
-                            elif computed_measure == "EW":
-                                return envelope_length
-                            else:    
-                                return None
-                        else:
-                            return None
-                    """
-
-        if au.check_isNull(self.crown_filename, "EV_angle") == True:
-            arcpy.CalculatePolygonMainAngle_cartography(
-                v_envelope, "EV_angle", "GEOGRAPHIC"
-            )
-            arcpy.CalculateField_management(
-                in_table=v_envelope,
-                field="NS_width",
-                expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'NS')",
-                expression_type="PYTHON_9.3",
-                code_block=codeblock,
-            )
-            arcpy.CalculateField_management(
-                in_table=v_envelope,
-                field="ES_width",
-                expression="classify_envAngle(!MBG_Width!, !MBG_Length!, !EV_angle!, 'EW')",
-                expression_type="PYTHON_9.3",
-                code_block=codeblock,
-            )
-            # join measures to corresponding crown polygon
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_envelope,
-                join_a_src="crown_id",
-                a_src=["EV_angle", "NS_width", "ES_width"],
-                a_dest=["EV_angle", "NS_width", "ES_width"],
-            )
-
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
+        xy, group = self._crownVertices()
+        rectangle = minimum_rectangles(xy, group, len(self.crowns))
 
-        if keep_temp == False:
-            arcpy.Delete_management(v_envelope)
+        self.crowns.stage("EV_length", rectangle["length"], "FLOAT")
+        self.crowns.stage("EV_width", rectangle["width"], "FLOAT")
+        self.crowns.stage("EV_area", rectangle["area"], "FLOAT")
+        self.crowns.stage("EV_angle", rectangle["angle"], "FLOAT")
+        self.crowns.stage("NS_width", rectangle["ns_extent"], "FLOAT")
+        self.crowns.stage("ES_width", rectangle["ew_extent"], "FLOAT")
 
-        au.round_fields_two_decimals(
-            self.crown_filename,
-            [
-                "EV_length",
-                "EV_width",
-                "EV_area",
-                "EV_angle",
-                "NS_width",
-                "ES_width",
-            ],
-        )
+        self.crowns.flush_ifNotDeferred()
 
     def attr_crownDiam(self):
         """
@@ -494,34 +378,12 @@ class GeometryAttributes:
             "\tComputing the crown diameter as maximum length of the convex hull... "
         )
         v_mbg = os.path.join(self.path, "mbg_temp")
-        arcpy.MinimumBoundingGeometry_management(
-            self.crown_filename,
+        mbg = self._boundingGeometry(
             v_mbg,
-            "CONVEX_HULL",  # tree_detection_v1 uses "CIRCLE"
-            "NONE",
-            "",
-            "MBG_FIELDS",
+            "CONVEX_HULL",
+            ["MBG_Length"],  # tree_detection_v1 uses "CIRCLE"
         )
+        arcpy.Delete_management(v_mbg)
 
-        in_table = self.crown_filename
-        field = "crown_diam"
-
-        logger.info("\tAdding the attribute <<crown_diam>>... ")
-        au.addField_ifNotExists(in_table, field, "FLOAT")
-
-        if au.check_isNull(in_table, field) == True:
-            au.join_and_copy(
-                t_dest=self.crown_filename,
-                join_a_dest="crown_id",
-                t_src=v_mbg,
-                join_a_src="crown_id",
-                a_src=["MBG_Length"],
-                a_dest=["crown_diam"],
-            )
-            arcpy.Delete_management(v_mbg)
-        else:
-            logger.info(
-                "\tAll rows in field are already populated. Exiting function."
-            )
-
-        au.round_fields_two_decimals(self.crown_filename, ["crown_diam"])
+        self.crowns.stage("crown_diam", mbg["MBG_Length"], "FLOAT")
+        self.crowns.flush_ifNotDeferred()
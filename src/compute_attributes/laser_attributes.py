@@ -1,9 +1,14 @@
 import logging
 
 import arcpy
+import numpy as np
 
-from src import arcpy_utils as au
 from src import logger
+from src.compute_attributes.attribute_buffer import (
+    AttributeBuffer,
+    lookup_columns,
+)
+from src.tree_detection.array_engine import crown_profiles
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +25,10 @@ class LaserAttributes:
         filename of the crown feature class
     top_filename : str
         filename of the top feature class
+    crowns : AttributeBuffer
+        staging buffer of the crown attributes
+    tops : AttributeBuffer
+        staging buffer of the top attributes
 
     Methods:
     --------
@@ -27,13 +36,24 @@ class LaserAttributes:
     - attr_segMethod(self, segmentation_method)
     - attr_topHeight(self, v_top, r_chm_h, r_dtm, str_multiplier)
     - join_topAttr_toCrown(self)
+    - attr_canopyProfile(self, r_chm, cell_size, encoding)
 
     """
 
-    def __init__(self, path: str, crown_filename: str, point_filename: str):
+    def __init__(
+        self,
+        path: str,
+        crown_filename: str,
+        point_filename: str,
+        crown_buffer: AttributeBuffer = None,
+        top_buffer: AttributeBuffer = None,
+    ):
         self.path = path
         self.crown_filename = crown_filename
         self.top_filename = point_filename
+        # without shared (deferred) buffers each method writes its attributes
+        self.crowns = crown_buffer or AttributeBuffer(crown_filename)
+        self.tops = top_buffer or AttributeBuffer(point_filename)
 
     def attr_lidarTile(self, tile_code: str):
         """
@@ -48,29 +68,23 @@ class LaserAttributes:
         )
 
         # Store information on lidar tile
-        au.addField_ifNotExists(self.crown_filename, "kartblad", "TEXT")
-        au.calculateField_ifEmpty(
-            self.crown_filename, "kartblad", format_tile_code
-        )
+        self.crowns.stage("kartblad", format_tile_code, "TEXT")
+        self.crowns.flush_ifNotDeferred()
 
     def attr_segMethod(self, segmentation_method):
         """
         Adds the attribute 'seg_method' (TEXT) to the crown feature class.
 
         Args:
-            method (str): watershed or other
+            method (str): watershed or other, quotes are removed
         """
 
         logger.info("\tATTRIBUTE | seg_method:")
-        au.addField_ifNotExists(self.crown_filename, "seg_method", "TEXT")
-        au.addField_ifNotExists(self.top_filename, "seg_method", "TEXT")
-
-        au.calculateField_ifEmpty(
-            self.crown_filename, "seg_method", segmentation_method
-        )
-        au.calculateField_ifEmpty(
-            self.top_filename, "seg_method", segmentation_method
-        )
+        segmentation_method = segmentation_method.strip("\"'")
+        self.crowns.stage("seg_method", segmentation_method, "TEXT")
+        self.tops.stage("seg_method", segmentation_method, "TEXT")
+        self.crowns.flush_ifNotDeferred()
+        self.tops.flush_ifNotDeferred()
 
     def attr_topHeight(
         self, v_top, r_chm_h: str, r_dtm: str, str_multiplier: str
@@ -105,31 +119,24 @@ class LaserAttributes:
         )
 
         # divide tree_height_laser and tree_alittude by multiplier if raster is integer
-        arcpy.management.CalculateField(
-            in_table=v_top,
-            field="tree_height_laser",
-            expression="!tree_height_laser_int! /{}".format(multiplier),
-            expression_type="PYTHON3",
-            code_block="",
-            field_type="FLOAT",
-            enforce_domains="NO_ENFORCE_DOMAINS",
+        tops = (
+            self.tops if v_top == self.top_filename else AttributeBuffer(v_top)
         )
-
-        arcpy.management.CalculateField(
-            in_table=v_top,
-            field="tree_altit",
-            expression="!tree_altit_int! /{}".format(multiplier),
-            expression_type="PYTHON3",
-            code_block="",
-            field_type="FLOAT",
-            enforce_domains="NO_ENFORCE_DOMAINS",
+        columns = tops.read(["tree_height_laser_int", "tree_altit_int"])
+        tops.stage(
+            "tree_height_laser",
+            columns["tree_height_laser_int"] / float(multiplier),
+            "FLOAT",
         )
+        tops.stage(
+            "tree_altit", columns["tree_altit_int"] / float(multiplier), "FLOAT"
+        )
+        tops.flush_ifNotDeferred()
 
-        # detelete int fields
+        # detelete int fields (the values are read into the buffer)
         arcpy.DeleteField_management(
             v_top, ["tree_height_laser_int", "tree_altit_int"]
         )
-        au.round_fields_two_decimals(v_top, ["tree_height_laser", "tree_altit"])
 
     # join tree_heigh, tree_altit from tree points to tree polygons
     def join_topAttr_toCrown(self):
@@ -144,30 +151,118 @@ class LaserAttributes:
         logger.info(
             "\tJoining the tree top attributes: tree_height_laser and tree_altit to the crown polygons... "
         )
-        au.addField_ifNotExists(
-            self.crown_filename, "tree_height_laser", "FLOAT"
+        # crown_id and the heights of the tops, staged or from the table
+        tops = self.tops.read(["crown_id", "tree_height_laser", "tree_altit"])
+        crown_ids = self.crowns.read(["crown_id"])["crown_id"]
+        # crowns without top get NULL
+        has_crown = np.array(
+            [isinstance(c, str) and c != "" for c in tops["crown_id"]],
+            dtype=bool,
+        )
+        columns = lookup_columns(
+            crown_ids,
+            tops["crown_id"][has_crown],
+            {
+                "tree_height_laser": tops["tree_height_laser"][has_crown],
+                "tree_altit": tops["tree_altit"][has_crown],
+            },
+        )
+        self.crowns.stage(
+            "tree_height_laser", columns["tree_height_laser"], "FLOAT"
         )
-        au.addField_ifNotExists(self.crown_filename, "tree_altit", "FLOAT")
-
-        # Check if the  field contains any null or empty values
-        if (
-            au.check_isNull(self.crown_filename, "tree_height_laser")
-            or au.check_isNull(self.crown_filename, "tree_altit") == True
-        ):
-            # populate field with join
-            au.join_and_copy(
-                self.crown_filename,
-                "crown_id",
-                self.top_filename,
-                "crown_id",
-                ["tree_height_laser", "tree_altit"],
-                ["tree_height_laser", "tree_altit"],
+        self.crowns.stage("tree_altit", columns["tree_altit"], "FLOAT")
+        self.crowns.flush_ifNotDeferred()
+
+    def attr_canopyProfile(self, r_chm: str, cell_size: float, encoding=None):
+        """
+        Adds the canopy profile attributes, integrated from the CHM over the cells of each crown.
+            > The crowns are rasterized (in memory) by OBJECTID on the CHM grid, all crowns are
+              reduced at once over the label grid (array_engine.crown_profiles).
+
+        -----------------------------------
+        canopy_vol: canopy volume (m3), the sum of the CHM heights x cell area of the crown cells
+            (tree_volume is the cone estimate from crown_diam and tree_height_laser)
+        height_mean: mean CHM height of the crown
+        height_p25, height_p50, height_p75, height_p95: CHM height percentiles of the crown
+        centroid_x, centroid_y: height-weighted centroid of the crown
+        -----------------------------------
+
+        Args:
+            r_chm (str): path to the CHM
+            cell_size (float): cell size of the label raster, use the CHM
+                resolution
+            encoding (HeightEncoding, optional): encoding of an integer CHM,
+                None for a float CHM
+        """
+        logger.info(
+            "\tATTRIBUTE | canopy_vol, height_mean, height_pXX, centroid_x/y:"
+        )
+        logger.info("\tIntegrating the CHM over the cells of each crown... ")
+
+        oids = self.crowns.oids
+        profile = None
+        if len(oids):
+            # rasterize the crowns by OBJECTID on the CHM grid
+            r_labels = r"memory\crown_labels_profile"
+            with arcpy.EnvManager(snapRaster=r_chm):
+                arcpy.conversion.PolygonToRaster(
+                    in_features=self.crown_filename,
+                    value_field=arcpy.Describe(
+                        self.crown_filename
+                    ).OIDFieldName,
+                    out_rasterdataset=r_labels,
+                    cell_assignment="CELL_CENTER",
+                    cellsize=cell_size,
+                )
+            desc = arcpy.Describe(r_labels)
+            labels = arcpy.RasterToNumPyArray(r_labels, nodata_to_value=0)
+            arcpy.Delete_management(r_labels)
+
+            # CHM cells of the label raster extent
+            n_rows, n_cols = labels.shape
+            nodata = np.nan if encoding is None else encoding.nodata
+            values = arcpy.RasterToNumPyArray(
+                r_chm,
+                arcpy.Point(desc.extent.XMin, desc.extent.YMin),
+                n_cols,
+                n_rows,
+                nodata_to_value=nodata,
+            )
+            chm = (
+                values.astype(np.float32)
+                if encoding is None
+                else encoding.decode(values)
+            )
+            profile = crown_profiles(
+                chm,
+                labels,
+                int(max(labels.max(), oids.max())),
+                desc.meanCellWidth,
+                desc.extent.XMin,
+                desc.extent.YMax,
             )
-        else:
             logger.info(
-                "\tAll rows in field are already populated. Exiting function."
+                "\t\t{} of {} crowns cover a CHM cell.".format(
+                    int(np.count_nonzero(profile["cells"][oids - 1])),
+                    len(oids),
+                )
             )
 
-        au.round_fields_two_decimals(
-            self.crown_filename, ["tree_height_laser", "tree_altit"]
-        )
+        for field, name in [
+            ("canopy_vol", "volume"),
+            ("height_mean", "mean"),
+            ("height_p25", "p25"),
+            ("height_p50", "p50"),
+            ("height_p75", "p75"),
+            ("height_p95", "p95"),
+            ("centroid_x", "x"),
+            ("centroid_y", "y"),
+        ]:
+            # crowns without cells (smaller than a cell) get NULL
+            values = np.nan if profile is None else profile[name][oids - 1]
+            self.crowns.stage(
+                field,
+                values,
+                "DOUBLE" if field.startswith("centroid") else "FLOAT",
+            )
+        self.crowns.flush_ifNotDeferred()
@@ -0,0 +1,296 @@
+""" Catalog of the LAS/LAZ tiles of a municipality built from the file headers.
+
+Only the public header block and the VLRs of each tile are read (in
+parallel), the point records are never opened. The catalog stores per tile
+the bounds, point counts, coordinate system and the point density derived
+from the point count and the header extent in a local sqlite database.
+Planning (e.g. the grid resolution) and work estimates can then be derived
+from the catalog in seconds.
+
+The LAS header has no class histogram, the points per return are stored
+instead.
+
+Usage:
+    python -m src.data.las_catalog
+"""
+import json
+import logging
+import os
+import sqlite3
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils.las_utils import read_crs, read_header
+
+logger = logging.getLogger(__name__)
+
+LAS_EXTENSIONS = (".las", ".laz")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    tile TEXT,
+    folder TEXT,
+    file_size INTEGER,
+    mtime REAL,
+    version TEXT,
+    point_format INTEGER,
+    point_count INTEGER,
+    points_by_return TEXT,
+    min_x REAL,
+    min_y REAL,
+    min_z REAL,
+    max_x REAL,
+    max_y REAL,
+    max_z REAL,
+    area REAL,
+    density REAL,
+    crs TEXT
+)
+"""
+
+
+def read_tile(las_path: str) -> dict:
+    """
+    Reads the catalog record of one tile from its header.
+
+    Args:
+        las_path (str): path to the .las/.laz file
+
+    Returns:
+        dict: catalog record of the tile
+    """
+    header = read_header(las_path)
+    stat = os.stat(las_path)
+    area = (header["max_x"] - header["min_x"]) * (
+        header["max_y"] - header["min_y"]
+    )
+    return {
+        "path": os.path.abspath(las_path),
+        "tile": os.path.splitext(os.path.basename(las_path))[0],
+        "folder": os.path.basename(os.path.dirname(os.path.abspath(las_path))),
+        "file_size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "version": header["version"],
+        "point_format": header["point_format"],
+        "point_count": header["point_count"],
+        "points_by_return": json.dumps(header["points_by_return"]),
+        "min_x": header["min_x"],
+        "min_y": header["min_y"],
+        "min_z": header["min_z"],
+        "max_x": header["max_x"],
+        "max_y": header["max_y"],
+        "max_z": header["max_z"],
+        "area": area,
+        "density": header["point_count"] / area if area > 0 else None,
+        "crs": read_crs(las_path),
+    }
+
+
+class LasCatalog:
+    """
+    Header catalog of LAS/LAZ tiles stored in a sqlite database.
+
+    Attributes:
+    -----------
+    db_path : str
+        path to the sqlite database
+
+    Methods:
+    --------
+    - build(self, las_folder, workers)
+    - tiles(self)
+    - point_density(self)
+    - bounds(self)
+    - points_per_folder(self)
+    - summary(self)
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as con:
+            con.execute(_SCHEMA)
+
+    def _connect(self):
+        con = sqlite3.connect(self.db_path)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def build(self, las_folder: str, workers: int = 8) -> int:
+        """
+        Adds all tiles in a folder (recursively) to the catalog.
+
+        Tiles that are unchanged since the last build (same size and
+        modification time) are not read again, tiles that no longer exist
+        are removed.
+
+        Args:
+            las_folder (str): folder with .las/.laz tiles
+            workers (int): number of threads reading headers
+
+        Returns:
+            int: number of tiles read
+        """
+        paths = [
+            os.path.abspath(os.path.join(root, f))
+            for root, dirs, files in os.walk(las_folder)
+            for f in files
+            if f.lower().endswith(LAS_EXTENSIONS)
+        ]
+        root_path = os.path.abspath(las_folder)
+
+        with self._connect() as con:
+            known = {
+                row["path"]: (row["file_size"], row["mtime"])
+                for row in con.execute(
+                    "SELECT path, file_size, mtime FROM tiles"
+                )
+            }
+        changed = []
+        for path in paths:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                changed.append(path)
+        removed = [
+            p
+            for p in set(known) - set(paths)
+            if os.path.commonpath([p, root_path]) == root_path
+        ]
+
+        records = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, future in zip(
+                changed, [executor.submit(read_tile, p) for p in changed]
+            ):
+                try:
+                    records.append(future.result())
+                except (OSError, ValueError) as e:
+                    logger.error(
+                        f"\t\tCould not read the header of {path}: {e}"
+                    )
+
+        # one transaction for all inserts
+        with self._connect() as con:
+            con.executemany(
+                "DELETE FROM tiles WHERE path = ?", [(p,) for p in removed]
+            )
+            if records:
+                columns = list(records[0])
+                con.executemany(
+                    "INSERT OR REPLACE INTO tiles ({}) VALUES ({})".format(
+                        ", ".join(columns), ", ".join("?" * len(columns))
+                    ),
+                    [[r[c] for c in columns] for r in records],
+                )
+
+        logger.info(
+            f"\tLAS catalog: {len(paths)} tiles, {len(records)} read, {len(paths) - len(changed)} unchanged, {len(removed)} removed"
+        )
+        return len(records)
+
+    def tiles(self) -> list:
+        """Returns the catalog records of all tiles as a list of dicts."""
+        with self._connect() as con:
+            return [dict(r) for r in con.execute("SELECT * FROM tiles")]
+
+    def point_density(self) -> float:
+        """
+        Returns the median point density (points/m2) of the tiles.
+
+        The median is used because tiles on the border of the study area
+        have a header extent that is partly empty.
+        """
+        with self._connect() as con:
+            densities = [
+                r["density"]
+                for r in con.execute(
+                    "SELECT density FROM tiles WHERE density IS NOT NULL"
+                )
+            ]
+        return statistics.median(densities) if densities else None
+
+    def bounds(self) -> tuple:
+        """Returns the extent (min_x, min_y, max_x, max_y) of all tiles."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT MIN(min_x), MIN(min_y), MAX(max_x), MAX(max_y) FROM tiles"
+            ).fetchone()
+        return tuple(row)
+
+    def points_per_folder(self) -> dict:
+        """
+        Returns the number of points per tile folder (map sheet), the unit of
+        work of model_chm, sorted from large to small.
+        """
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT folder, SUM(point_count) AS n FROM tiles "
+                "GROUP BY folder ORDER BY n DESC"
+            ).fetchall()
+        return {r["folder"]: r["n"] for r in rows}
+
+    def summary(self) -> dict:
+        """Returns the number of tiles, points, bytes and the CRS's."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT COUNT(*) AS n_tiles, SUM(point_count) AS n_points, "
+                "SUM(file_size) AS n_bytes FROM tiles"
+            ).fetchone()
+            crs = [
+                r["crs"] for r in con.execute("SELECT DISTINCT crs FROM tiles")
+            ]
+        return {
+            "tiles": row["n_tiles"],
+            "points": row["n_points"] or 0,
+            "bytes": row["n_bytes"] or 0,
+            "point_density": self.point_density(),
+            "bounds": self.bounds(),
+            "crs": crs,
+        }
+
+
+def catalog_point_density(catalog_path: str, default: float) -> float:
+    """
+    Returns the measured point density of the catalog, or the default if the
+    catalog does not exist or is empty.
+
+    Args:
+        catalog_path (str): path to the sqlite catalog
+        default (float): point density used without catalog (POINT_DENSITY)
+    """
+    if not os.path.exists(catalog_path):
+        return default
+    density = LasCatalog(catalog_path).point_density()
+    if density is None:
+        return default
+    logger.info(
+        f"\tMeasured point density (LAS catalog): {density:.2f} points/m2"
+    )
+    return density
+
+
+if __name__ == "__main__":
+    from src import (
+        INTERIM_PATH,
+        LAS_CATALOG_PATH,
+        get_spatial_resolution,
+        get_workers,
+    )
+    from src.logger import setup_custom_logging  # noqa
+
+    setup_custom_logging()
+    logger = logging.getLogger(__name__)
+
+    catalog = LasCatalog(LAS_CATALOG_PATH)
+    catalog.build(os.path.join(INTERIM_PATH, "lidar"), workers=get_workers(16))
+    summary = catalog.summary()
+    logger.info(f"LAS catalog:\t{LAS_CATALOG_PATH}")
+    for key, value in summary.items():
+        logger.info(f"\t{key}:\t{value}")
+    if summary["point_density"]:
+        logger.info(
+            "\tspatial resolution:\t{}".format(
+                get_spatial_resolution(summary["point_density"])
+            )
+        )
@@ -0,0 +1,171 @@
+""" Sort .laz tiles into inside/outside the build-up zone using a lookup table.
+
+The lookup file (<kommune>_LUT.csv) lists the names of the tiles, without
+extension, that are inside the build-up zone. It is loaded once into a set,
+all moves are planned up front and then executed by a thread pool. Files are
+renamed when the source and target are on the same filesystem; otherwise they
+are moved (copy + delete). With ``mode="link"`` the files are hardlinked and
+the input folder is left untouched.
+"""
+import csv
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+INSIDE = "inside"
+OUTSIDE = "outside"
+
+
+def load_lookup(lookup_file: str) -> set:
+    """
+    Loads the tile names of the lookup file into a set.
+
+    Args:
+        lookup_file (str): path to the lookup csv, one tile name per line
+
+    Returns:
+        set: tile names without file extension
+    """
+    with open(lookup_file, "r", newline="") as f:
+        return {row[0].strip() for row in csv.reader(f) if row and row[0]}
+
+
+def plan_moves(
+    input_folder: str,
+    lookup: set,
+    inside_folder: str,
+    outside_folder: str,
+    extension: str = ".laz",
+) -> list:
+    """
+    Plans the target path of every file in the input folder.
+
+    Args:
+        input_folder (str): folder that is searched recursively
+        lookup (set): tile names inside the build-up zone
+        inside_folder (str): target folder for tiles in the lookup
+        outside_folder (str): target folder for all other tiles
+        extension (str): file extension of the tiles
+
+    Returns:
+        list: (source, target, zone) tuples, zone is "inside" or "outside"
+    """
+    plan = []
+    for root, dirs, files in os.walk(input_folder):
+        for filename in files:
+            if not filename.endswith(extension):
+                continue
+            if filename[: -len(extension)] in lookup:
+                target, zone = os.path.join(inside_folder, filename), INSIDE
+            else:
+                target, zone = os.path.join(outside_folder, filename), OUTSIDE
+            plan.append((os.path.join(root, filename), target, zone))
+    return plan
+
+
+def _transfer(source: str, target: str, mode: str) -> str:
+    """Moves or links one file. Returns "done" or "skipped"."""
+    if os.path.exists(target):
+        return "skipped"
+    if mode == "link":
+        try:
+            os.link(source, target)
+        except OSError:
+            # no hardlinks across filesystems (or on this filesystem)
+            shutil.copy2(source, target)
+    else:
+        try:
+            os.rename(source, target)
+        except OSError:
+            # target on another filesystem
+            shutil.move(source, target)
+    return "done"
+
+
+def sort_files(plan: list, mode: str = "move", workers: int = 8) -> dict:
+    """
+    Executes the planned moves with a thread pool.
+
+    Args:
+        plan (list): (source, target, zone) tuples, e.g. from plan_moves()
+        mode (str): "move" to move the files, "link" to hardlink them
+        workers (int): number of threads
+
+    Returns:
+        dict: number of files per zone (target folder) and the number of
+            skipped and failed files
+    """
+    if mode not in ("move", "link"):
+        raise ValueError(f"mode must be 'move' or 'link', not '{mode}'")
+
+    summary = {zone: 0 for _, _, zone in plan}
+    summary.update({"skipped": 0, "failed": 0})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (executor.submit(_transfer, source, target, mode), source, zone)
+            for source, target, zone in plan
+        ]
+        for future, source, zone in futures:
+            try:
+                status = future.result()
+            except OSError as e:
+                logger.error(f"\t\tCould not {mode} {source}: {e}")
+                summary["failed"] += 1
+                continue
+            if status == "skipped":
+                logger.info(
+                    f"\t\tFile {os.path.basename(source)} already exists in the {zone} folder, skipping..."
+                )
+                summary["skipped"] += 1
+            else:
+                summary[zone] += 1
+    return summary
+
+
+def sort_laz(
+    input_folder: str,
+    lookup_file: str,
+    inside_folder: str,
+    outside_folder: str,
+    mode: str = "move",
+    workers: int = 8,
+) -> dict:
+    """
+    Sorts the .laz tiles into inside/outside the build-up zone.
+
+    Args:
+        input_folder (str): folder with all .laz tiles
+        lookup_file (str): path to <kommune>_LUT.csv
+        inside_folder (str): target folder for tiles inside the zone
+        outside_folder (str): target folder for tiles outside the zone
+        mode (str): "move" to move the files, "link" to hardlink them
+        workers (int): number of threads
+
+    Returns:
+        dict: see sort_files()
+    """
+    os.makedirs(inside_folder, exist_ok=True)
+    os.makedirs(outside_folder, exist_ok=True)
+
+    lookup = load_lookup(lookup_file)
+    plan = plan_moves(input_folder, lookup, inside_folder, outside_folder)
+    logger.info(
+        f"\t{len(plan)} .laz files found, {len(lookup)} tiles in the lookup file"
+    )
+
+    summary = sort_files(plan, mode, workers)
+    summary.setdefault(INSIDE, 0)
+    summary.setdefault(OUTSIDE, 0)
+    logger.info(
+        "\tinside_BuildUpZone: {}, outside_BuildUpZone: {}, skipped: {}, failed: {}".format(
+            summary[INSIDE],
+            summary[OUTSIDE],
+            summary["skipped"],
+            summary["failed"],
+        )
+    )
+    return summary
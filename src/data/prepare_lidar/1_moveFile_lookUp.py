@@ -1,8 +1,8 @@
 import logging
 import os
-import shutil
 
-from src import MUNICIPALITY, RAW_PATH
+from src import MUNICIPALITY, RAW_PATH, get_workers
+from src.data.lidar_sorter import sort_laz
 
 kommune = MUNICIPALITY
 
@@ -17,40 +17,21 @@ logger = logging.getLogger(__name__)
 # print(output_folder_2)
 # print(lookup_file)
 
-if not os.path.exists(output_folder_1):
-    os.mkdir(output_folder_1)
-
-if not os.path.exists(output_folder_2):
-    os.mkdir(output_folder_2)
-
-for root, dirs, files in os.walk(input_folder):
-    for filename in files:
-        if filename.endswith(".laz"):
-            found = False
-            with open(lookup_file, "r") as f:
-                for line in f:
-                    if filename[:-4] == line.strip():
-                        found = True
-                        break
-
-            if found:
-                output_path = os.path.join(output_folder_1, filename)
-                if os.path.exists(output_path):
-                    print(
-                        f"File {filename} already exists in output_folder_1, skipping..."
-                    )
-                    continue
-                shutil.move(os.path.join(root, filename), output_folder_1)
-                print(f"Moving file {filename} to inside_BuildUpZone")
-            else:
-                output_path = os.path.join(output_folder_2, filename)
-                if os.path.exists(output_path):
-                    print(
-                        f"File {filename} already exists in output_folder_2, skipping..."
-                    )
-                    continue
-                shutil.move(os.path.join(root, filename), output_folder_2)
+# "move" renames the files, "link" hardlinks them and keeps the input folder
+summary = sort_laz(
+    input_folder,
+    lookup_file,
+    output_folder_1,
+    output_folder_2,
+    mode="move",
+    workers=get_workers(min(32, (os.cpu_count() or 1) * 4)),
+)
 
 print(
-    "The .laz files are succesfully split into inside_BuildUpZone and outside_BuildUpZone \nusing the LookUp file and moved to specified katalogs accordingly."
+    "The .laz files are succesfully split into inside_BuildUpZone ({}) and outside_BuildUpZone ({}) \nusing the LookUp file and moved to specified katalogs accordingly. {} files skipped, {} failed.".format(
+        summary["inside"],
+        summary["outside"],
+        summary["skipped"],
+        summary["failed"],
+    )
 )
@@ -1,9 +1,11 @@
 import os
-import shutil
 
 import dotenv
 from dotenv import dotenv_values
 
+from src.data.lidar_sorter import sort_files
+from src.utils.run_options import get_workers
+
 kommune = "kristiansand"
 
 # search for .env file in USER directory
@@ -24,11 +26,11 @@ print(target_dir)
 
 # "raw_data\baerum\lidar\las_inside_BuildUpZone
 
-# Loop through the file list
+# Plan the target folder of each file
+plan = []
 for file_name in os.listdir(source_dir):
     # Extract the substring we're interested in
     substring = file_name.split("-")[2] + "-" + file_name.split("-")[3]
-    print(substring)
     f_substring = substring[:3] + "_" + substring[4:]
 
     # Define the folder path using the substring
@@ -39,8 +41,15 @@ for file_name in os.listdir(source_dir):
         print(f"Make directory {f_substring}")
         os.makedirs(folder_path)
 
-    # Move the file to the appropriate folder
-    print(f"copy the file '{file_name}'to the folder '{folder_path}'")
-    shutil.copy(os.path.join(source_dir, file_name), folder_path)
-
-    # break
+    plan.append(
+        (
+            os.path.join(source_dir, file_name),
+            os.path.join(folder_path, file_name),
+            f_substring,
+        )
+    )
+
+# Hardlink the files to the folders instead of copying them, the link only
+# writes a directory entry (falls back to a copy across filesystems)
+summary = sort_files(plan, mode="link", workers=get_workers(16))
+print(f"Linked {len(plan)} files to {len(summary) - 2} folders: {summary}")
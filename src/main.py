@@ -8,12 +8,7 @@ setup_custom_logging()
 logger = logging.getLogger(__name__)
 
 # check municipality
-confirm_municipality = (
-    input(f"Is '{MUNICIPALITY}' the correct municipality? (y/n): ")
-    .strip()
-    .lower()
-)
-if confirm_municipality != "y":
+if not confirm_municipality(MUNICIPALITY):
     logger.info("User disagreed with the municipality.")
     exit()
 
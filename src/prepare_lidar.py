@@ -1,6 +1,6 @@
 import logging
 import os
-import subprocess
+import runpy
 
 # local modules
 from src import *
@@ -20,20 +20,27 @@ def main(kommune):
         dir_path, "data/prepare_lidar/1_moveFile_lookUp.py"
     )
 
-    ## TODO add the other 4 files as subprocesses!
+    ## TODO add the other 4 files as stages!
+    # the scripts run in this process as stages of a graph, a stage that
+    # reads the output of another stage waits for it
+    graph = StageGraph("prepare_lidar")
+    graph.add_stage(
+        "move_files",
+        run_script,
+        inputs=["laz_all"],
+        outputs=["laz_inside_BuildUpZone"],
+    )
     try:
-        # subprocess - moveFile
-        command = ["python", script_path, kommune]
-        output = subprocess.run(
-            command, check=True, capture_output=True, text=True
-        )
-        logger.info(f"Subprocess stdout:\n{output.stdout}")
-
-    except subprocess.CalledProcessError as e:
+        graph.run([], script_path)
+    except RuntimeError:
         script_name = os.path.basename(script_path)
-        # logger.error(f"An error occured: {str(e)}")
         logger.error(f"An error occured in the script {script_name}.")
-        logger.error(f"Subprocess stderr:\n{e.stderr}")
+
+
+def run_script(script_path):
+    """Runs a data processing script in this process."""
+    logger.info(f"Run {os.path.basename(script_path)}")
+    runpy.run_path(script_path, run_name="__main__")
 
 
 if __name__ == "__main__":
@@ -42,12 +49,7 @@ if __name__ == "__main__":
     logger = logging.getLogger(__name__)
 
     # check municipality
-    confirm_municipality = (
-        input(f"Is '{MUNICIPALITY}' the correct municipality? (y/n): ")
-        .strip()
-        .lower()
-    )
-    if confirm_municipality != "y":
+    if not confirm_municipality(MUNICIPALITY):
         logger.info("User disagreed with the municipality.")
         exit()
 
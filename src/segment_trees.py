@@ -5,51 +5,78 @@
 
 import logging
 import os
-import subprocess
+import sys
 
 # local modules
 from src import *  # Assuming there's a logger.py module in the src directory
+from src import arcpy_utils as au
 
 # set up logger
 # logger.setup_logger(logfile=True)
+logger = logging.getLogger(__name__)
 
+# the tree_detection modules import their siblings by name (as scripts)
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(dir_path, "tree_detection"))
 
-def run_model_chm():
 
-    logger.info("Start main script")
+def run_segmentation(ctx, neighbourhood_list, workers=1):
+    """Runs the CHM model and the tree detection per neighbourhood in one
+    stage graph (see src/utils/stage_graph.py), in-process instead of
+    chained subprocesses.
 
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    script_path_chm = os.path.join(dir_path, "segmentation", "model_chm.py")
+    Args:
+        ctx (RunContext): parameters and paths of the municipality
+        neighbourhood_list (list): neighbourhood codes
+        workers (int): number of stages that run at the same time
 
-    try:
-        command = ["python", script_path_chm]
-        subprocess.run(command, check=True, capture_output=True, text=True)
+    Returns:
+        dict: wall time, summed stage time and the critical path
+    """
+    from model_chm import list_tiles, model_chm_tiles, mosaic_chm
+    from watershed_segmentation import build_stageGraph
 
-    except subprocess.CalledProcessError as e:
-        script_name = os.path.basename(script_path_chm)
-        # logger.error(f"An error occured: {str(e)}")
-        logger.error(f"An error occured in the script {script_name}.")
-        logger.error(f"Subprocess stderr:\n{e.stderr}")
+    logger.info("Start main script")
 
-    script_watershed = os.path.join(dir_path, "segmentation", "watershed.py")
+    graph = StageGraph("segment_trees")
+    # the tiles are modelled in parallel, their units are the tile codes
+    graph.add_stage(
+        "model_chm",
+        model_chm_tiles,
+        outputs=["chm_tiles"],
+        per_unit=True,
+        units=list_tiles(ctx),
+    )
+    graph.add_stage(
+        "mosaic_chm",
+        mosaic_chm,
+        inputs=["chm_tiles"],
+        outputs=["chm"],
+        locks=["gdb_elevation_data"],
+    )
+    build_stageGraph(
+        graph, municipal_watershed=ctx.watershed_mode == "municipality"
+    )
+    report = graph.run(neighbourhood_list, ctx, workers=workers, processes=True)
 
     logger.info("End main script")
+    return report
 
 
 if __name__ == "__main__":
+    from src.logger import setup_custom_logging  # noqa
 
     # setup logger
-    logger.setup_logger(logfile=False)
+    setup_custom_logging()
     logger = logging.getLogger(__name__)
 
     # check municipality
-    confirm_municipality = (
-        input(f"Is '{MUNICIPALITY}' the correct municipality? (y/n): ")
-        .strip()
-        .lower()
-    )
-    if confirm_municipality != "y":
+    if not confirm_municipality(MUNICIPALITY):
         logger.info("User disagreed with the municipality.")
         exit()
 
-    run_model_chm()
+    ctx = RunContext.from_config(MUNICIPALITY)
+    neighbourhood_list = au.get_neighbourhood_list(
+        ctx.neighbourhood_path, ctx.n_field_name
+    )
+    run_segmentation(ctx, neighbourhood_list, get_workers(1))
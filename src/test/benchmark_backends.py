@@ -0,0 +1,823 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: benchmark_backends.py
+# Description: Runs the same synthetic scene through each backend of each
+# stage (CHM, watershed labels, tree tops, crowns, attributes, false
+# positives) and reports the agreement with a reference next to the wall time
+# and the peak memory (tracemalloc) of each backend.
+#
+# The numpy backends run anywhere (e.g. in CI on Linux). The arcpy outputs
+# are recorded once on a machine with ArcGIS Pro (--record) and saved in
+# src/test/reference/; without a recording the numpy reference backends are
+# used (whole-array watershed, staircase crowns).
+#
+# Agreement metrics:
+# - chm: RMSE of the CHM against the heights of the scene
+# - watershed: mean IoU of each reference crown with its best matching crown
+# - tops: share of the reference tops with a top within TOP_DISTANCE
+# - crowns: area-weighted relative area change, vertices
+# - attributes: mean absolute delta of the matched crowns
+# - false_positives: share of the matched crowns with the same lamp post flag
+#
+# Usage: python src/test/benchmark_backends.py [--size 400] [--check]
+#        python src/test/benchmark_backends.py --record   (ArcGIS Pro)
+# --------------------------------------------------------------------------- #
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, project_dir)
+sys.path.insert(0, os.path.join(project_dir, "src", "tree_detection"))
+
+import block_watershed  # noqa: E402
+import crown_simplify  # noqa: E402
+import las_rasterizer  # noqa: E402
+from false_positives import lamppost_rule  # noqa: E402
+from void_fill import fill_voids  # noqa: E402
+
+from src.compute_attributes.bounding_geometry import (  # noqa: E402
+    convex_hulls,
+    enclosing_circles,
+)
+
+REFERENCE_DIR = os.path.join(os.path.dirname(__file__), "reference")
+
+# tops closer than this (m) are the same tree top
+TOP_DISTANCE = 1.0
+
+# minimum tree height (m) of the watershed input
+MIN_HEIGHT = 2.5
+
+# --check fails if a metric is outside its limit
+THRESHOLDS = {
+    "chm_rmse": ("<=", 0.5),
+    "label_iou": (">=", 0.9),
+    "top_match": (">=", 0.95),
+    "area_change": ("<=", 0.05),
+    "height_delta": ("<=", 0.05),
+    # mean per crown in m2, 4 cells of 0.25 m
+    "crown_area_delta": ("<=", 0.25),
+    "false_positive_agreement": (">=", 0.95),
+}
+
+
+# --------------------------------------------------------------------------- #
+# Synthetic scene
+# --------------------------------------------------------------------------- #
+
+
+def make_scene(size: int = 400, cell_size: float = 0.25, seed: int = 0):
+    """
+    Creates a scene of trees, lamp posts and a building on a sloped ground,
+    and the LAS points sampled from it.
+
+    Args:
+        size (int): number of rows and columns of the grid
+        cell_size (float): cell size in meters
+        seed (int): seed of the random generator
+
+    Returns:
+        dict: "heights" (true CHM, row 0 is north), "points" (arrays as
+            las_utils.read_points), "cell_size", "extent"
+    """
+    rng = np.random.default_rng(seed)
+    extent = size * cell_size
+    centres = (np.arange(size) + 0.5) * cell_size
+    x, y = np.meshgrid(centres, centres[::-1])
+    heights = np.zeros((size, size), dtype=np.float32)
+    kind = np.zeros((size, size), dtype=np.uint8)  # 5 vegetation, 6 building
+
+    n_trees = max(int(extent * extent / 120), 1)
+    for _ in range(n_trees):
+        cx, cy = rng.uniform(5, extent - 5, 2)
+        radius, height = rng.uniform(1.5, 4.5), rng.uniform(6, 20)
+        crown = height * (1 - ((x - cx) ** 2 + (y - cy) ** 2) / radius**2)
+        update = crown > heights
+        heights[update], kind[update] = crown[update], 5
+
+    # lamp posts: small round crowns on their own
+    for cx, cy in rng.uniform(3, extent - 3, (max(n_trees // 10, 1), 2)):
+        d2 = (x - cx) ** 2 + (y - cy) ** 2
+        post = (d2 < 1.55**2) & (heights == 0)
+        heights[post], kind[post] = 6.0 - 0.5 * d2[post], 5
+
+    # building with a flat roof
+    b0, b1 = int(size * 0.1), int(size * 0.25)
+    heights[b0:b1, b0 : b1 + size // 10] = 9.0
+    kind[b0:b1, b0 : b1 + size // 10] = 6
+
+    # first returns on the surface, a last return on the ground under 30 %
+    # of the vegetation returns
+    n_points = int(extent * extent * 8)
+    px, py = rng.uniform(0, extent, (2, n_points))
+    row = np.minimum(((extent - py) / cell_size).astype(int), size - 1)
+    col = np.minimum((px / cell_size).astype(int), size - 1)
+    ground = 100 + 0.02 * px + 0.01 * py
+    surface_kind = kind[row, col]
+    on_ground = surface_kind == 0
+    under = (surface_kind == 5) & (rng.random(n_points) < 0.3)
+    points = {
+        "x": np.r_[px, px[under]],
+        "y": np.r_[py, py[under]],
+        "z": np.r_[ground + heights[row, col], ground[under]],
+        "classification": np.r_[
+            np.where(on_ground, 2, surface_kind), np.full(under.sum(), 2)
+        ].astype(np.uint8),
+        "return_number": np.r_[
+            np.ones(n_points), np.full(under.sum(), 2)
+        ].astype(np.uint8),
+        "number_of_returns": np.r_[
+            np.where(under, 2, 1), np.full(under.sum(), 2)
+        ].astype(np.uint8),
+    }
+    points["withheld"] = np.zeros(len(points["x"]), dtype=bool)
+    return {
+        "heights": heights,
+        "points": points,
+        "cell_size": cell_size,
+        "extent": extent,
+    }
+
+
+# --------------------------------------------------------------------------- #
+# Backends
+# --------------------------------------------------------------------------- #
+
+
+def chm_numpy(scene: dict) -> np.ndarray:
+    """CHM of the scene points, single pass rasterizer and void fill."""
+    cell_size, extent = scene["cell_size"], scene["extent"]
+    products = [
+        las_rasterizer.GridProduct("dtm", cell_size, class_codes=[2]),
+        las_rasterizer.GridProduct("dsm", cell_size, statistic="max"),
+    ]
+    half = cell_size / 2
+    rasterizer = las_rasterizer.LasRasterizer(
+        products, (0.0, half, extent - half, extent)
+    )
+    rasterizer.add_points(scene["points"])
+    dtm = fill_voids(rasterizer.result("dtm")[0])
+    dsm = fill_voids(rasterizer.result("dsm")[0])
+    return np.maximum(dsm - dtm, 0)
+
+
+def watershed_window(chm: np.ndarray) -> tuple:
+    """Watershed of the whole CHM in one window (reference)."""
+    valid = np.isfinite(chm)
+    codes, tops, _ = block_watershed.segment_window(
+        chm, valid, 0, 0, chm.shape[1], (False, False, False, False)
+    )
+    sink_ids = np.sort(np.asarray(tops["id"], dtype=np.int64))
+    labels = np.zeros(chm.shape, dtype=np.int32)
+    has_sink = codes >= 0
+    labels[has_sink] = np.searchsorted(sink_ids, codes[has_sink]) + 1
+    order = np.argsort(tops["id"])
+    rows = np.asarray(tops["row"])[order]
+    cols = np.asarray(tops["col"])[order]
+    return labels, rows, cols
+
+
+def watershed_blocks(chm: np.ndarray, block_size=128, halo=16) -> tuple:
+    """Watershed of the CHM block by block (block_watershed.py)."""
+    labels = np.zeros(chm.shape, dtype=np.int32)
+
+    def read_window(r0, r1, c0, c1):
+        return chm[r0:r1, c0:c1]
+
+    def write_labels(block_labels, r0, c0):
+        n_rows, n_cols = block_labels.shape
+        labels[r0 : r0 + n_rows, c0 : c0 + n_cols] = block_labels
+
+    watershed = block_watershed.BlockWatershed(
+        chm.shape, block_size=block_size, halo=halo
+    )
+    tops = watershed.run(read_window, write_labels)
+    return labels, tops["row"], tops["col"]
+
+
+def label_rings(labels: np.ndarray, cell_size: float) -> dict:
+    """
+    Traces the cell boundaries of each label (RasterToPolygon NO_SIMPLIFY).
+
+    The edges are oriented clockwise around the cells of a label, outer
+    rings are clockwise and holes counter-clockwise (as in a feature class).
+    The lower left corner of the grid is (0, 0).
+
+    Returns:
+        dict: label -> list of closed (n, 2) rings in map units
+    """
+    n_rows, n_cols = labels.shape
+    padded = np.pad(labels, 1)
+    core = padded[1:-1, 1:-1]
+    # (row, col) of the start and end vertex of the four cell sides
+    sides = [
+        (padded[:-2, 1:-1], (0, 0), (0, 1)),  # north: TL -> TR
+        (padded[1:-1, 2:], (0, 1), (1, 1)),  # east: TR -> BR
+        (padded[2:, 1:-1], (1, 1), (1, 0)),  # south: BR -> BL
+        (padded[1:-1, :-2], (1, 0), (0, 0)),  # west: BL -> TL
+    ]
+    n_vertex_cols = n_cols + 1
+    edges = []
+    for neighbour, start, end in sides:
+        r, c = np.nonzero((core > 0) & (core != neighbour))
+        edges.append(
+            np.column_stack(
+                [
+                    core[r, c],
+                    (r + start[0]) * n_vertex_cols + c + start[1],
+                    (r + end[0]) * n_vertex_cols + c + end[1],
+                ]
+            )
+        )
+    edges = np.concatenate(edges)
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+    rings = {}
+    starts = np.flatnonzero(np.r_[True, edges[1:, 0] != edges[:-1, 0]])
+    for first, last in zip(starts, np.r_[starts[1:], len(edges)]):
+        label = int(edges[first, 0])
+        outgoing = {}
+        for _, a, b in edges[first:last]:
+            outgoing.setdefault(int(a), []).append(int(b))
+        rings[label] = []
+        while outgoing:
+            start = next(iter(outgoing))
+            ring = [start]
+            previous, current = None, start
+            while True:
+                targets = outgoing[current]
+                if len(targets) > 1 and previous is not None:
+                    # pinch vertex: turn right, the rings stay separate
+                    targets.sort(
+                        key=lambda t: _turn(previous, current, t, n_vertex_cols)
+                    )
+                target = targets.pop(0)
+                if not targets:
+                    del outgoing[current]
+                previous, current = current, target
+                ring.append(current)
+                if current == start:
+                    break
+            vertices = np.array(ring)
+            row, col = np.divmod(vertices, n_vertex_cols)
+            rings[label].append(
+                np.column_stack([col * cell_size, (n_rows - row) * cell_size])
+            )
+    return rings
+
+
+def _turn(a: int, b: int, c: int, n_vertex_cols: int) -> int:
+    """Sort key of the next vertex c after the edge a -> b: right turn
+    first (rows grow southwards)."""
+    ar, ac = divmod(a, n_vertex_cols)
+    br, bc = divmod(b, n_vertex_cols)
+    cr, cc = divmod(c, n_vertex_cols)
+    cross = (bc - ac) * (cr - br) - (br - ar) * (cc - bc)
+    return -cross
+
+
+def crowns_staircase(rings: dict, cell_size: float) -> dict:
+    """Crown polygons on the cell boundaries (reference)."""
+    return rings
+
+
+def crowns_sharedEdge(rings: dict, cell_size: float) -> dict:
+    """Crown polygons simplified along their shared edges."""
+    labels = list(rings)
+    simplifier = crown_simplify.SharedEdgeSimplifier(cell_size, (0.0, 0.0))
+    simplified, _ = simplifier.simplify(
+        [rings[label] for label in labels], tolerance=cell_size
+    )
+    return dict(zip(labels, simplified))
+
+
+def ring_area(ring: np.ndarray) -> float:
+    """Signed area of a ring, clockwise rings are positive."""
+    x, y = ring[:, 0], ring[:, 1]
+    return -0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def crown_attributes(polygons: dict, labels: np.ndarray, chm: np.ndarray):
+    """
+    Geometry attributes of the crowns (GeometryAttributes, LaserAttributes).
+
+    Returns:
+        dict: arrays "label", "crown_area", "CH_area", "EC_area",
+            "ratio_CA_CHA", "ratio_CA_ECA", "tree_height"
+    """
+    from scipy import ndimage
+
+    crown_labels = np.array(sorted(polygons), dtype=np.int64)
+    columns = {
+        "label": crown_labels,
+        "crown_area": np.array(
+            [sum(ring_area(r) for r in polygons[int(k)]) for k in crown_labels]
+        ),
+    }
+    xy = np.vstack([r for k in crown_labels for r in polygons[int(k)]])
+    group = np.repeat(
+        np.arange(len(crown_labels)),
+        [sum(len(r) for r in polygons[int(k)]) for k in crown_labels],
+    )
+
+    # hull area (shoelace of the counter-clockwise hulls)
+    hull, hull_group = convex_hulls(xy, group)
+    first = np.r_[True, hull_group[1:] != hull_group[:-1]]
+    last = np.r_[first[1:], True]
+    following = np.arange(1, len(hull) + 1)
+    following[last] = np.flatnonzero(first)
+    cross = hull[:, 0] * hull[following, 1] - hull[following, 0] * hull[:, 1]
+    columns["CH_area"] = 0.5 * np.bincount(
+        hull_group, cross, minlength=len(crown_labels)
+    )
+    columns["EC_area"] = enclosing_circles(xy, group, len(crown_labels))["area"]
+    # crowns that collapsed to a line (simplified) have no ratios
+    for ratio, area in [
+        ("ratio_CA_CHA", "CH_area"),
+        ("ratio_CA_ECA", "EC_area"),
+    ]:
+        columns[ratio] = np.divide(
+            columns["crown_area"],
+            columns[area],
+            out=np.zeros(len(crown_labels)),
+            where=columns[area] > 0,
+        )
+    columns["tree_height"] = np.asarray(
+        ndimage.maximum(np.nan_to_num(chm), labels, crown_labels)
+    )
+    return columns
+
+
+# --------------------------------------------------------------------------- #
+# Agreement metrics
+# --------------------------------------------------------------------------- #
+
+
+def match_labels(reference: np.ndarray, test: np.ndarray) -> tuple:
+    """
+    Matches each reference crown with the test crown of the largest IoU.
+
+    Returns:
+        tuple: (labels, matches, iou) of the reference crowns, 0 for a
+            reference crown without overlapping test crown
+    """
+    both = (reference > 0) & (test > 0)
+    n_test = int(test.max()) + 1
+    pairs, intersection = np.unique(
+        reference[both].astype(np.int64) * n_test + test[both],
+        return_counts=True,
+    )
+    ref_area = np.bincount(reference.ravel())
+    test_area = np.bincount(test.ravel(), minlength=n_test)
+    ref_label, test_label = np.divmod(pairs, n_test)
+    iou = intersection / (
+        ref_area[ref_label] + test_area[test_label] - intersection
+    )
+
+    labels = np.flatnonzero(ref_area)
+    labels = labels[labels > 0]
+    best_iou = np.zeros(ref_area.size)
+    best_match = np.zeros(ref_area.size, dtype=np.int64)
+    order = np.lexsort((iou, ref_label))  # best pair last per reference
+    last = np.r_[ref_label[order][1:] != ref_label[order][:-1], True]
+    best = order[last]
+    best_iou[ref_label[best]] = iou[best]
+    best_match[ref_label[best]] = test_label[best]
+    return labels, best_match[labels], best_iou[labels]
+
+
+def top_matchRate(ref_rows, ref_cols, rows, cols, cell_size) -> float:
+    """Share of the reference tops with a test top within TOP_DISTANCE."""
+    from scipy.spatial import cKDTree
+
+    if len(ref_rows) == 0:
+        return 1.0
+    if len(rows) == 0:
+        return 0.0
+    tree = cKDTree(np.column_stack([rows, cols]) * cell_size)
+    distance, _ = tree.query(np.column_stack([ref_rows, ref_cols]) * cell_size)
+    return float(np.mean(distance <= TOP_DISTANCE))
+
+
+def attribute_deltas(reference: dict, test: dict, matches: tuple) -> dict:
+    """Mean absolute attribute deltas of the matched crowns."""
+    ref_labels, test_labels, _ = matches
+    matched = test_labels > 0
+    ref_index = np.searchsorted(reference["label"], ref_labels[matched])
+    test_index = np.searchsorted(test["label"], test_labels[matched])
+    valid = (ref_index < len(reference["label"])) & (
+        test_index < len(test["label"])
+    )
+    valid[valid] &= (
+        reference["label"][ref_index[valid]] == ref_labels[matched][valid]
+    ) & (test["label"][test_index[valid]] == test_labels[matched][valid])
+    ref_index, test_index = ref_index[valid], test_index[valid]
+    deltas = {}
+    for name in ["crown_area", "ratio_CA_CHA", "ratio_CA_ECA", "tree_height"]:
+        deltas[name] = (
+            float(
+                np.mean(
+                    np.abs(test[name][test_index] - reference[name][ref_index])
+                )
+            )
+            if ref_index.size
+            else 0.0
+        )
+    ref_fp = lamppost_rule(
+        reference["crown_area"][ref_index],
+        reference["ratio_CA_CHA"][ref_index],
+        reference["ratio_CA_ECA"][ref_index],
+    )
+    test_fp = lamppost_rule(
+        test["crown_area"][test_index],
+        test["ratio_CA_CHA"][test_index],
+        test["ratio_CA_ECA"][test_index],
+    )
+    deltas["false_positive_agreement"] = (
+        float(np.mean(ref_fp == test_fp)) if ref_index.size else 1.0
+    )
+    deltas["lampposts"] = int(test_fp.sum())
+    return deltas
+
+
+# --------------------------------------------------------------------------- #
+# Harness
+# --------------------------------------------------------------------------- #
+
+
+def measure(function, *args):
+    """Runs a backend, returns (result, wall time s, peak memory MB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def reference_path(size: int, seed: int) -> str:
+    return os.path.join(REFERENCE_DIR, f"arcpy_scene{seed}_{size}.npz")
+
+
+def load_reference(path: str, chm: np.ndarray):
+    """Loads the recorded arcpy outputs, None if missing or made from a
+    different CHM."""
+    if not os.path.exists(path):
+        return None
+    recorded = dict(np.load(path))
+    if recorded["chm"].shape != chm.shape or not np.allclose(
+        recorded["chm"], chm, equal_nan=True, atol=1e-3
+    ):
+        print(f"{path} was recorded from a different CHM, not used")
+        return None
+    return recorded
+
+
+def run(size: int, seed: int) -> list:
+    """Runs all stages and returns one result row per stage and backend."""
+    scene = make_scene(size, seed=seed)
+    cell_size = scene["cell_size"]
+    rows = []
+
+    # CHM
+    chm, seconds, peak = measure(chm_numpy, scene)
+    canopy = scene["heights"] >= MIN_HEIGHT
+    rmse = float(
+        np.sqrt(np.mean((chm[canopy] - scene["heights"][canopy]) ** 2))
+    )
+    rows.append(("chm", "numpy", seconds, peak, {"chm_rmse": rmse}))
+    chm = np.where(chm >= MIN_HEIGHT, chm, np.nan).astype(np.float32)
+
+    recorded = load_reference(reference_path(size, seed), chm)
+    if recorded is not None:
+        ref_name = "arcpy"
+        ref_labels = recorded["labels"]
+        ref_rows, ref_cols = recorded["tops_row"], recorded["tops_col"]
+        rows.append(
+            (
+                "watershed",
+                "arcpy",
+                float(recorded["seconds_watershed"]),
+                np.nan,
+                {},
+            )
+        )
+    else:
+        ref_name = "window"
+        (ref_labels, ref_rows, ref_cols), seconds, peak = measure(
+            watershed_window, chm
+        )
+        rows.append(("watershed", "window", seconds, peak, {}))
+
+    # watershed labels and tops
+    (labels, top_rows, top_cols), seconds, peak = measure(watershed_blocks, chm)
+    matches = match_labels(ref_labels, labels)
+    rows.append(
+        (
+            "watershed",
+            "block",
+            seconds,
+            peak,
+            {
+                "label_iou": float(np.mean(matches[2])),
+                "crowns": int(labels.max()),
+                "reference_crowns": int(ref_labels.max()),
+            },
+        )
+    )
+    rows.append(
+        (
+            "tops",
+            "block",
+            0.0,
+            0.0,
+            {
+                "top_match": top_matchRate(
+                    ref_rows, ref_cols, top_rows, top_cols, cell_size
+                )
+            },
+        )
+    )
+
+    # crowns
+    ref_rings = label_rings(ref_labels, cell_size)
+    rings, seconds, peak = measure(label_rings, labels, cell_size)
+    reference_area = {k: sum(ring_area(r) for r in v) for k, v in rings.items()}
+    n_staircase = sum(len(r) for v in rings.values() for r in v)
+    crowns = {}
+    for name, backend in [
+        ("staircase", crowns_staircase),
+        ("shared_edge", crowns_sharedEdge),
+    ]:
+        polygons, seconds, peak = measure(backend, rings, cell_size)
+        crowns[name] = polygons
+        area_change = sum(
+            abs(sum(ring_area(r) for r in polygons[k]) - reference_area[k])
+            for k in polygons
+        ) / max(sum(reference_area.values()), 1e-9)
+        rows.append(
+            (
+                "crowns",
+                name,
+                seconds,
+                peak,
+                {
+                    "area_change": area_change,
+                    "vertices": sum(
+                        len(r) for v in polygons.values() for r in v
+                    ),
+                    "staircase_vertices": n_staircase,
+                },
+            )
+        )
+
+    # attributes and false positives
+    if recorded is not None:
+        reference = {
+            name: recorded[name]
+            for name in [
+                "label",
+                "crown_area",
+                "CH_area",
+                "EC_area",
+                "ratio_CA_CHA",
+                "ratio_CA_ECA",
+                "tree_height",
+            ]
+        }
+    else:
+        reference = crown_attributes(ref_rings, ref_labels, chm)
+    for name, polygons in crowns.items():
+        attributes, seconds, peak = measure(
+            crown_attributes, polygons, labels, chm
+        )
+        deltas = attribute_deltas(reference, attributes, matches)
+        rows.append(
+            (
+                "attributes",
+                name,
+                seconds,
+                peak,
+                {
+                    "height_delta": deltas["tree_height"],
+                    "crown_area_delta": deltas["crown_area"],
+                    "ratio_CA_CHA_delta": deltas["ratio_CA_CHA"],
+                    "ratio_CA_ECA_delta": deltas["ratio_CA_ECA"],
+                },
+            )
+        )
+        rows.append(
+            (
+                "false_positives",
+                name,
+                0.0,
+                0.0,
+                {
+                    "false_positive_agreement": deltas[
+                        "false_positive_agreement"
+                    ],
+                    "lampposts": deltas["lampposts"],
+                },
+            )
+        )
+    return ref_name, rows
+
+
+def record(size: int, seed: int) -> str:
+    """
+    Records the arcpy outputs of the scene (needs ArcGIS Pro): the watershed
+    labels, the tree tops, the crowns (RasterToPolygon NO_SIMPLIFY) and
+    their geometry attributes (MinimumBoundingGeometry).
+    """
+    import arcpy
+    import tree
+
+    scene = make_scene(size, seed=seed)
+    cell_size = scene["cell_size"]
+    chm = chm_numpy(scene)
+    chm = np.where(chm >= MIN_HEIGHT, chm, np.nan).astype(np.float32)
+
+    arcpy.env.overwriteOutput = True
+    folder = tempfile.mkdtemp(prefix="benchmark_backends_")
+    gdb = arcpy.management.CreateFileGDB(folder, "reference.gdb")[0]
+    path = {
+        name: os.path.join(gdb, name)
+        for name in [
+            "chm",
+            "chm_flip",
+            "flowdir",
+            "sinks",
+            "watersheds",
+            "focflow",
+            "top_poly",
+            "top_singlepoly",
+            "tops",
+            "crowns",
+            "hulls",
+            "circles",
+        ]
+    }
+    arcpy.NumPyArrayToRaster(
+        chm, arcpy.Point(0, 0), cell_size, cell_size, value_to_nodata=np.nan
+    ).save(path["chm"])
+
+    start = time.perf_counter()
+    tree.watershed_segmentation(
+        path["chm"],
+        path["chm_flip"],
+        path["flowdir"],
+        path["sinks"],
+        path["watersheds"],
+    )
+    seconds_watershed = time.perf_counter() - start
+    labels = arcpy.RasterToNumPyArray(
+        path["watersheds"], arcpy.Point(0, 0), size, size, nodata_to_value=0
+    ).astype(np.int32)
+
+    tree.identify_treeTops(
+        path["sinks"],
+        path["focflow"],
+        path["top_poly"],
+        path["top_singlepoly"],
+        path["tops"],
+    )
+    xy = np.array(
+        [row[0] for row in arcpy.da.SearchCursor(path["tops"], ["SHAPE@XY"])]
+    ).reshape(-1, 2)
+    tops_row = np.floor((size * cell_size - xy[:, 1]) / cell_size)
+    tops_col = np.floor(xy[:, 0] / cell_size)
+
+    tree.identify_treeCrowns(path["watersheds"], path["crowns"])
+    columns = {}
+    for name, geometry_type in [
+        ("hulls", "CONVEX_HULL"),
+        ("circles", "CIRCLE"),
+    ]:
+        arcpy.management.MinimumBoundingGeometry(
+            path["crowns"], path[name], geometry_type, "LIST", "gridcode"
+        )
+        columns[name] = dict(
+            arcpy.da.SearchCursor(path[name], ["gridcode", "SHAPE@AREA"])
+        )
+    crown_area = {}
+    for label, area in arcpy.da.SearchCursor(
+        path["crowns"], ["gridcode", "SHAPE@AREA"]
+    ):
+        crown_area[label] = crown_area.get(label, 0.0) + area
+
+    label = np.array(sorted(crown_area), dtype=np.int64)
+    area = np.array([crown_area[k] for k in label])
+    hull_area = np.array([columns["hulls"][k] for k in label])
+    circle_area = np.array([columns["circles"][k] for k in label])
+
+    from scipy import ndimage
+
+    os.makedirs(REFERENCE_DIR, exist_ok=True)
+    out_path = reference_path(size, seed)
+    np.savez_compressed(
+        out_path,
+        chm=chm,
+        labels=labels,
+        tops_row=tops_row,
+        tops_col=tops_col,
+        label=label,
+        crown_area=area,
+        CH_area=hull_area,
+        EC_area=circle_area,
+        ratio_CA_CHA=area / hull_area,
+        ratio_CA_ECA=area / circle_area,
+        tree_height=np.asarray(
+            ndimage.maximum(np.nan_to_num(chm), labels, label)
+        ),
+        seconds_watershed=seconds_watershed,
+    )
+    arcpy.Delete_management(gdb)
+    return out_path
+
+
+def check(rows: list) -> list:
+    """Returns the metrics that are outside their threshold."""
+    failed = []
+    for stage, backend, _, _, metrics in rows:
+        for name, value in metrics.items():
+            if name not in THRESHOLDS:
+                continue
+            operator, limit = THRESHOLDS[name]
+            ok = value <= limit if operator == "<=" else value >= limit
+            if not ok:
+                failed.append(
+                    f"{stage}/{backend}: {name} {value:.4f} {operator} {limit}"
+                )
+    return failed
+
+
+def main(size: int, seed: int, check_thresholds: bool, json_path: str) -> int:
+    ref_name, rows = run(size, seed)
+    print(f"scene {seed}, {size} x {size} cells, reference backend: {ref_name}")
+    print(
+        f"{'stage':<16}{'backend':<13}{'time (s)':>10}{'peak (MB)':>11}  metrics"
+    )
+    for stage, backend, seconds, peak, metrics in rows:
+        text = ", ".join(
+            f"{k} {v:.4f}" if isinstance(v, float) else f"{k} {v}"
+            for k, v in metrics.items()
+        )
+        print(f"{stage:<16}{backend:<13}{seconds:>10.3f}{peak:>11.1f}  {text}")
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(
+                {
+                    "size": size,
+                    "seed": seed,
+                    "reference": ref_name,
+                    "rows": [
+                        {
+                            "stage": stage,
+                            "backend": backend,
+                            "seconds": seconds,
+                            "peak_mb": peak,
+                            "metrics": metrics,
+                        }
+                        for stage, backend, seconds, peak, metrics in rows
+                    ],
+                },
+                f,
+                indent=2,
+            )
+
+    if not check_thresholds:
+        return 0
+    failed = check(rows)
+    for line in failed:
+        print(f"FAILED\t{line}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Agreement and performance of the stage backends"
+    )
+    parser.add_argument("--size", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--json", default=None)
+    parser.add_argument("--record", action="store_true")
+    args = parser.parse_args()
+    if args.record:
+        print("recorded", record(args.size, args.seed))
+        sys.exit(0)
+    sys.exit(main(args.size, args.seed, args.check, args.json))
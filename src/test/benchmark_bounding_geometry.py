@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: benchmark_bounding_geometry.py
+# Description: Measures the batched bounding geometries of
+# src/compute_attributes/bounding_geometry.py (convex hulls, minimum-area
+# rectangles, minimum enclosing circles) on synthetic crowns: staircase
+# outlines of random ellipses on a 0.25 m grid, in UTM coordinates. A sample
+# of the crowns is checked against a brute-force computation.
+# Usage: python src/test/benchmark_bounding_geometry.py [--crowns 1000000]
+# --------------------------------------------------------------------------- #
+
+import argparse
+import os
+import sys
+import time
+from itertools import combinations
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, project_dir)
+
+from src.compute_attributes.bounding_geometry import (  # noqa: E402
+    convex_hulls,
+    enclosing_circles,
+    minimum_rectangles,
+)
+
+CELL_SIZE = 0.25
+
+# crowns checked against the brute force
+N_SAMPLE = 200
+
+
+def make_crowns(n_crowns: int, seed: int = 0) -> tuple:
+    """
+    Returns the vertices of n_crowns staircase crowns: ellipses (radius 1 to
+    6 m, random orientation) sampled at 16 angles and snapped to the grid.
+
+    Returns:
+        tuple: (xy, group)
+    """
+    rng = np.random.default_rng(seed)
+    n_angles = 16
+    theta = np.linspace(0, 2 * np.pi, n_angles, endpoint=False)
+    a = rng.uniform(1, 6, n_crowns)[:, None]
+    b = a * rng.uniform(0.4, 1, n_crowns)[:, None]
+    rotation = rng.uniform(0, np.pi, n_crowns)[:, None]
+    x = a * np.cos(theta) * np.cos(rotation) - b * np.sin(theta) * np.sin(
+        rotation
+    )
+    y = a * np.cos(theta) * np.sin(rotation) + b * np.sin(theta) * np.cos(
+        rotation
+    )
+    centre = rng.uniform([590000, 6640000], [600000, 6650000], (n_crowns, 2))
+    xy = np.column_stack(
+        [(x + centre[:, :1]).ravel(), (y + centre[:, 1:]).ravel()]
+    )
+    xy = np.round(xy / CELL_SIZE) * CELL_SIZE
+    # staircase: a corner vertex between consecutive vertices
+    corner = np.column_stack([xy[:, 0], np.roll(xy[:, 1], -1)])
+    xy = np.stack([xy, corner], axis=1).reshape(-1, 2)
+    group = np.repeat(np.arange(n_crowns), 2 * n_angles)
+    return xy, group
+
+
+def brute_rectangle(points: np.ndarray) -> float:
+    """Smallest rectangle area over all hull edge directions."""
+    hull, _ = convex_hulls(points, np.zeros(len(points), dtype=int))
+    edges = np.roll(hull, -1, axis=0) - hull
+    phi = np.arctan2(edges[:, 1], edges[:, 0])
+    u = np.column_stack([np.cos(phi), np.sin(phi)])
+    n = np.column_stack([-u[:, 1], u[:, 0]])
+    along, across = hull @ u.T, hull @ n.T
+    return float(np.min(np.ptp(along, axis=0) * np.ptp(across, axis=0)))
+
+
+def brute_circle(points: np.ndarray) -> float:
+    """Smallest radius of the circles through 2 or 3 hull vertices that
+    enclose the hull."""
+    hull, _ = convex_hulls(points, np.zeros(len(points), dtype=int))
+    hull = hull - hull[0]
+    best = np.inf
+    for i, j in combinations(range(len(hull)), 2):
+        centre = (hull[i] + hull[j]) / 2
+        radius = np.hypot(*(hull[i] - centre))
+        if np.all(np.hypot(*(hull - centre).T) <= radius + 1e-7):
+            best = min(best, radius)
+    for i, j, k in combinations(range(len(hull)), 3):
+        a, b, c = hull[i], hull[j] - hull[i], hull[k] - hull[i]
+        d = 2 * (b[0] * c[1] - b[1] * c[0])
+        if abs(d) < 1e-12:
+            continue
+        bb, cc = b.dot(b), c.dot(c)
+        centre = a + np.array(
+            [(c[1] * bb - b[1] * cc) / d, (b[0] * cc - c[0] * bb) / d]
+        )
+        radius = np.hypot(*(hull[i] - centre))
+        if np.all(np.hypot(*(hull - centre).T) <= radius + 1e-7):
+            best = min(best, radius)
+    return best
+
+
+def main(n_crowns: int, seed: int) -> int:
+    start = time.perf_counter()
+    xy, group = make_crowns(n_crowns, seed)
+    print(
+        f"{n_crowns} crowns, {len(xy)} vertices:\t"
+        f"{time.perf_counter() - start:.2f} s"
+    )
+
+    results = {}
+    for name, function in [
+        ("convex hulls", lambda: convex_hulls(xy, group)),
+        (
+            "minimum rectangles",
+            lambda: minimum_rectangles(xy, group, n_crowns),
+        ),
+        ("enclosing circles", lambda: enclosing_circles(xy, group, n_crowns)),
+    ]:
+        start = time.perf_counter()
+        results[name] = function()
+        seconds = time.perf_counter() - start
+        print(
+            f"{name}:\t{seconds:.2f} s\t"
+            f"{seconds / n_crowns * 1e6:.2f} us per crown"
+        )
+
+    # brute-force check of a sample
+    rectangle = results["minimum rectangles"]
+    circle = results["enclosing circles"]
+    failed = 0
+    rng = np.random.default_rng(seed)
+    for crown in rng.choice(n_crowns, min(N_SAMPLE, n_crowns), replace=False):
+        points = xy[group == crown]
+        expected_area = brute_rectangle(points)
+        expected_radius = brute_circle(points)
+        if not np.isclose(rectangle["area"][crown], expected_area, atol=1e-6):
+            failed += 1
+            print(
+                f"crown {crown}: rectangle area {rectangle['area'][crown]}, "
+                f"expected {expected_area}"
+            )
+        if not np.isclose(
+            circle["diameter"][crown] / 2, expected_radius, atol=1e-6
+        ):
+            failed += 1
+            print(
+                f"crown {crown}: circle radius {circle['diameter'][crown] / 2}, "
+                f"expected {expected_radius}"
+            )
+    print(
+        f"brute-force check of {min(N_SAMPLE, n_crowns)} crowns:\t{failed} failed"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Batched bounding geometries of synthetic crowns"
+    )
+    parser.add_argument("--crowns", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(main(args.crowns, args.seed))
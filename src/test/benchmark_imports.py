@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: benchmark_imports.py
+# Description: Measures the start-up time of a worker process, i.e. the time
+# a fresh interpreter needs to import the src modules. Each import runs in a
+# new process (as a subprocess.run of segment_trees.py / prepare_lidar.py),
+# the time of an empty interpreter is subtracted.
+# Usage: python src/test/benchmark_imports.py [--repeat 7] [--importtime]
+# --------------------------------------------------------------------------- #
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+
+# imports of a worker that does not need the configuration or arcpy
+STATEMENTS = [
+    "import src",
+    "from src import RunJournal, get_run_report",
+    "from src import LasCatalog",
+    "import src.utils.las_utils",
+    "import src.tree_detection.block_index",
+    "import src.tree_detection.array_engine",
+]
+
+# a warm worker must start in well under a second
+MAX_SECONDS = 0.5
+
+
+def time_statement(statement: str, repeat: int) -> float:
+    """Returns the median wall time (s) of a statement in a new process."""
+    code = (
+        f"{statement}\n"
+        "import sys\n"
+        "sys.exit(3 if 'arcpy' in sys.modules else 0)"
+    )
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=project_dir,
+            capture_output=True,
+            text=True,
+        )
+        times.append(time.perf_counter() - start)
+        if result.returncode == 3:
+            raise RuntimeError(f"'{statement}' imports arcpy")
+        if result.returncode != 0:
+            raise RuntimeError(f"'{statement}' failed:\n{result.stderr}")
+    return statistics.median(times)
+
+
+def print_importtime(statement: str, n_modules: int = 15):
+    """Prints the slowest modules of a statement (python -X importtime)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=project_dir,
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append((int(parts[1]), parts[2].rstrip()))
+    for cumulative, module in sorted(rows, reverse=True)[:n_modules]:
+        print(f"\t{cumulative / 1e6:8.3f} s\t{module}")
+
+
+def main(repeat: int, importtime: bool) -> int:
+    baseline = time_statement("pass", repeat)
+    print(f"empty interpreter:\t{baseline:.3f} s")
+    failed = 0
+    for statement in STATEMENTS:
+        seconds = time_statement(statement, repeat) - baseline
+        status = "ok" if seconds < MAX_SECONDS else "SLOW"
+        failed += status != "ok"
+        print(f"{seconds:8.3f} s\t{status}\t{statement}")
+        if importtime:
+            print_importtime(statement)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Start-up time of worker processes"
+    )
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--importtime", action="store_true")
+    args = parser.parse_args()
+    sys.exit(main(args.repeat, args.importtime))
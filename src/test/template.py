@@ -27,12 +27,7 @@ if __name__ == "__main__":
     logger = logging.getLogger(__name__)
 
     # check municipality
-    confirm_municipality = (
-        input(f"Is '{MUNICIPALITY}' the correct municipality? (y/n): ")
-        .strip()
-        .lower()
-    )
-    if confirm_municipality != "y":
+    if not confirm_municipality(MUNICIPALITY):
         logger.info("User disagreed with the municipality.")
         exit()
 
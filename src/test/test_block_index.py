@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: test_block_index.py
+# Description: Tests the extent queries of the block occupancy index
+# (src/tree_detection/block_index.py) against a scan of all blocks.
+# Usage: python -m pytest src/test/test_block_index.py
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, os.path.join(project_dir, "src", "tree_detection"))
+
+from block_index import BlockIndex  # noqa: E402
+
+
+def scan_query(index: BlockIndex, extent: tuple) -> tuple:
+    """Answers a query by a scan of all occupied blocks."""
+    cols, rows = index._block_range(extent)
+    n_blocks = len(cols) * len(rows)
+    if n_blocks == 0:
+        return 0.0, None
+    occupied = [
+        (c, r)
+        for c, r in index.blocks
+        if cols.start <= c < cols.stop and rows.start <= r < rows.stop
+    ]
+    if not occupied:
+        return 1.0, None
+    length = index.block_length
+    c_occ, r_occ = zip(*occupied)
+    return 1 - len(occupied) / n_blocks, (
+        max(extent[0], min(c_occ) * length),
+        max(extent[1], min(r_occ) * length),
+        min(extent[2], (max(c_occ) + 1) * length),
+        min(extent[3], (max(r_occ) + 1) * length),
+    )
+
+
+def test_query_matches_scan():
+    rng = np.random.default_rng(0)
+    blocks = zip(
+        rng.integers(5000, 5100, 500).tolist(),
+        rng.integers(-20, 60, 500).tolist(),
+    )
+    index = BlockIndex(0.25, 64, blocks)
+    length = index.block_length
+    for _ in range(500):
+        x = np.sort(rng.uniform(4990, 5110, 2)) * length
+        y = np.sort(rng.uniform(-30, 70, 2)) * length
+        extent = (x[0], y[0], x[1], y[1])
+        fraction, occupied = index.query(extent)
+        expected_fraction, expected_occupied = scan_query(index, extent)
+        assert np.isclose(fraction, expected_fraction)
+        if expected_occupied is None:
+            assert occupied is None
+        else:
+            assert np.allclose(occupied, expected_occupied)
+
+
+def test_query_after_merge():
+    index = BlockIndex(1.0, 10)
+    assert index.query((0, 0, 100, 100)) == (1.0, None)
+    index.merge(BlockIndex(1.0, 10, [(2, 3)]))
+    assert index.query((0, 0, 100, 100)) == (0.99, (20.0, 30.0, 30.0, 40.0))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: test_block_watershed.py
+# Description: Tests that the block wise watershed
+# (src/tree_detection/block_watershed.py) gives the crowns of the watershed
+# of the whole CHM in one window, also for flats wider than the halo, and
+# the lookup of the neighbourhood of the tree tops.
+# Usage: python -m pytest src/test/test_block_watershed.py
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, os.path.join(project_dir, "src", "tree_detection"))
+
+from block_watershed import (  # noqa: E402
+    BlockWatershed,
+    assign_units,
+    segment_window,
+)
+
+
+def window_labels(chm: np.ndarray) -> np.ndarray:
+    """Crown labels of the whole CHM segmented in one window."""
+    codes, tops, _ = segment_window(
+        chm, np.isfinite(chm), 0, 0, chm.shape[1], (False,) * 4
+    )
+    labels = np.zeros(chm.shape, dtype=np.int64)
+    has_sink = codes >= 0
+    labels[has_sink] = np.searchsorted(np.sort(tops["id"]), codes[has_sink])
+    labels[has_sink] += 1
+    return labels
+
+
+def block_labels(chm: np.ndarray, block_size: int, halo: int) -> tuple:
+    """Crown labels and tree tops of the CHM segmented block by block."""
+    labels = np.zeros(chm.shape, dtype=np.int64)
+
+    def read_window(r0, r1, c0, c1):
+        return chm[r0:r1, c0:c1]
+
+    def write_labels(block, r0, c0):
+        labels[r0 : r0 + block.shape[0], c0 : c0 + block.shape[1]] = block
+
+    tops = BlockWatershed(chm.shape, block_size, halo).run(
+        read_window, write_labels
+    )
+    return labels, tops
+
+
+def assert_same_crowns(expected: np.ndarray, labels: np.ndarray):
+    """The two label arrays are the same up to the numbering."""
+    assert np.array_equal(expected > 0, labels > 0)
+    pairs = np.unique(np.column_stack([expected.ravel(), labels.ravel()]), 0)
+    assert len(pairs) == len(np.unique(expected)) == len(np.unique(labels))
+
+
+def crowns(size: int, seed: int) -> np.ndarray:
+    """Round crowns quantized to cm, with flats at the crown tops."""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size]
+    chm = np.zeros((size, size), dtype=np.float32)
+    for r, c, radius, height in zip(
+        *rng.uniform((0, 0, 4, 6), (size, size, 14, 20), (40, 4)).T
+    ):
+        crown = height * (1 - ((rows - r) ** 2 + (cols - c) ** 2) / radius**2)
+        chm = np.maximum(chm, np.minimum(crown, height - 1.5))
+    return np.where(chm > 2, np.round(chm, 2), np.nan)
+
+
+def test_block_watershed_matches_window():
+    chm = crowns(150, 0)
+    labels, tops = block_labels(chm, block_size=50, halo=4)
+    expected = window_labels(chm)
+    assert_same_crowns(expected, labels)
+    assert len(tops["label"]) == expected.max()
+
+
+def test_flat_roof_wider_than_halo():
+    # a flat roof of 30 x 40 cells across four blocks, a slope next to it
+    chm = np.full((100, 100), np.nan, dtype=np.float32)
+    chm[20:50, 16:56] = 9.0
+    chm[70:90, 70:90] = np.arange(1, 21, dtype=np.float32)[:, None]
+    labels, tops = block_labels(chm, block_size=32, halo=4)
+    expected = window_labels(chm)
+    assert_same_crowns(expected, labels)
+    roof = np.unique(labels[20:50, 16:56])
+    assert roof.size == 1 and roof[0] > 0
+    assert len(tops["label"]) == expected.max()
+
+
+def test_assign_units_reads_blocks_with_tops():
+    grid = np.arange(100 * 130, dtype=np.int32).reshape(100, 130)
+    tops = {"row": np.array([5, 99, 40, 6]), "col": np.array([129, 0, 64, 3])}
+    windows = []
+
+    def read_window(r0, r1, c0, c1):
+        windows.append((r0, r1, c0, c1))
+        return grid[r0:r1, c0:c1]
+
+    units = assign_units(tops, read_window, grid.shape, block_size=32)
+    assert units.tolist() == grid[tops["row"], tops["col"]].tolist()
+    # one read per block with tops, never wider than a block
+    assert sorted(windows) == [
+        (0, 32, 0, 32),
+        (0, 32, 128, 130),
+        (32, 64, 64, 96),
+        (96, 100, 0, 32),
+    ]
+    empty = assign_units({"row": [], "col": []}, read_window, grid.shape)
+    assert empty.size == 0
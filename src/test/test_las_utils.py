@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: test_las_utils.py
+# Description: Tests of the header patching and the point reader of
+# src/utils/las_utils.py on small LAS files written by the test.
+# Usage: python -m pytest src/test/test_las_utils.py
+# --------------------------------------------------------------------------- #
+
+import os
+import struct
+import sys
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, project_dir)
+
+from src.utils import las_utils  # noqa: E402
+
+WKT_UTM32 = (
+    'PROJCS["ETRS89 / UTM zone 32N",GEOGCS["ETRS89",'
+    'AUTHORITY["EPSG","4258"]],UNIT["metre",1,AUTHORITY["EPSG","9001"]],'
+    'AUTHORITY["EPSG","25832"]]'
+)
+WKT_UTM33 = WKT_UTM32.replace("32N", "33N").replace("25832", "25833")
+
+
+def make_vlr(record_id: int, payload: bytes, user_id: str = None) -> bytes:
+    """Returns a variable length record."""
+    user_id = user_id or las_utils.PROJECTION_USER_ID
+    return (
+        struct.pack(
+            las_utils._VLR_FORMAT,
+            0,
+            user_id.encode("ascii"),
+            record_id,
+            len(payload),
+            b"",
+        )
+        + payload
+    )
+
+
+def write_las(
+    path: str,
+    minor: int = 2,
+    point_format: int = 1,
+    records: bytes = b"",
+    record_length: int = 28,
+    n_points: int = 0,
+    vlrs: list = (),
+    padding: int = 1024,
+):
+    """Writes a LAS 1.<minor> file with the given VLRs and point records."""
+    header_size = 375 if minor >= 4 else 227
+    vlr_block = b"".join(vlrs)
+    offset_to_points = header_size + len(vlr_block) + padding
+    header = struct.pack(
+        las_utils._HEADER_FORMAT,
+        b"LASF",
+        0,
+        0,
+        b"\0" * 16,
+        1,
+        minor,
+        b"test",
+        b"test",
+        1,
+        2024,
+        header_size,
+        offset_to_points,
+        len(vlrs),
+        point_format,
+        record_length,
+        n_points,
+        n_points,
+        0,
+        0,
+        0,
+        0,
+        0.01,
+        0.01,
+        0.01,
+        0.0,
+        0.0,
+        0.0,
+        1.0,
+        0.0,
+        1.0,
+        0.0,
+        1.0,
+        0.0,
+    )
+    if minor >= 4:
+        header += struct.pack(
+            "<QQIQ15Q", 0, 0, 0, n_points, n_points, *[0] * 14
+        )
+    with open(path, "wb") as f:
+        f.write(header + vlr_block + b"\0" * padding + records)
+
+
+def crs_records(path: str) -> list:
+    """Returns the record ids of the coordinate system records."""
+    return [
+        vlr["record_id"]
+        for vlr in las_utils.read_vlrs(path)
+        if vlr["record_id"] in las_utils.CRS_RECORD_IDS
+    ]
+
+
+def test_epsg_from_wkt():
+    assert las_utils.epsg_from_wkt(WKT_UTM32) == 25832
+    assert las_utils.epsg_from_wkt('PROJCRS["x",ID["EPSG",25833]]') == 25833
+    # the AUTHORITY of the datum is not the code of the coordinate system
+    assert (
+        las_utils.epsg_from_wkt(
+            'PROJCS["x",GEOGCS["y",AUTHORITY["EPSG","4258"]]]'
+        )
+        is None
+    )
+
+
+def test_stamp_crs_geokeys_before_las14(tmp_path):
+    path = str(tmp_path / "tile.las")
+    write_las(path, minor=2)
+
+    assert las_utils.stamp_crs(path, WKT_UTM32) == "added"
+    assert crs_records(path) == [las_utils.GEOKEY_RECORD_ID]
+    assert las_utils.read_crs(path) == "EPSG:25832"
+    assert las_utils.stamp_crs(path, WKT_UTM32) == "exists"
+    assert not os.path.exists(str(tmp_path / "tile.prj"))
+
+
+def test_stamp_crs_replaces_crs_records(tmp_path):
+    path = str(tmp_path / "tile.las")
+    other = make_vlr(1, b"keep", user_id="other")
+    write_las(
+        path,
+        minor=2,
+        vlrs=[
+            make_vlr(las_utils.WKT_RECORD_ID, WKT_UTM33.encode() + b"\0"),
+            other,
+            make_vlr(las_utils.GEOKEY_RECORD_ID, b"\0" * 32),
+            make_vlr(las_utils.GEOASCII_RECORD_ID, b"UTM 33\0"),
+        ],
+    )
+
+    assert las_utils.stamp_crs(path, WKT_UTM32) == "replaced"
+    vlrs = las_utils.read_vlrs(path)
+    assert [v["record_id"] for v in vlrs] == [1, las_utils.GEOKEY_RECORD_ID]
+    assert las_utils.read_header(path)["number_of_vlrs"] == 2
+    assert las_utils.read_crs(path) == "EPSG:25832"
+
+
+def test_stamp_crs_wkt_las14(tmp_path):
+    path = str(tmp_path / "tile.las")
+    write_las(
+        path,
+        minor=4,
+        point_format=6,
+        record_length=30,
+        vlrs=[make_vlr(las_utils.GEOKEY_RECORD_ID, b"\0" * 32)],
+    )
+
+    assert las_utils.stamp_crs(path, WKT_UTM32) == "replaced"
+    assert crs_records(path) == [las_utils.WKT_RECORD_ID]
+    assert las_utils.read_wkt(path) == WKT_UTM32
+    header = las_utils.read_header(path)
+    assert header["global_encoding"] & las_utils.WKT_GLOBAL_ENCODING_BIT
+
+
+def test_stamp_crs_sidecar(tmp_path):
+    # no room for the record before the point data
+    path = str(tmp_path / "tile.las")
+    write_las(path, minor=4, point_format=6, record_length=30, padding=0)
+    assert las_utils.stamp_crs(path, WKT_UTM32, sidecar=False) == "skipped"
+    assert las_utils.stamp_crs(path, WKT_UTM32) == "sidecar"
+    assert crs_records(path) == []
+
+    # no EPSG code for the GeoKeys of a LAS 1.2 file
+    path = str(tmp_path / "old.las")
+    write_las(path, minor=2)
+    assert las_utils.stamp_crs(path, 'PROJCS["x"]') == "sidecar"
+    assert las_utils.read_crs(path) == 'PROJCS["x"]'
+
+
+def test_read_points_withheld_bit(tmp_path):
+    # PDRF 6: one point per classification flag bit (synthetic, key-point,
+    # withheld, overlap)
+    dtype = las_utils.point_dtype(6, 30)
+    records = np.zeros(4, dtype=dtype)
+    records["return_byte"] = 0x11
+    records["flag_byte"] = [0x01, 0x02, 0x04, 0x08]
+    records["class_byte"] = 5
+    path = str(tmp_path / "pdrf6.las")
+    write_las(path, 4, 6, records.tobytes(), 30, len(records))
+
+    points = next(las_utils.read_points(path))
+    assert points["withheld"].tolist() == [False, False, True, False]
+    assert points["classification"].tolist() == [5, 5, 5, 5]
+
+    # PDRF 1: the flags are bits 5-7 of the classification byte
+    dtype = las_utils.point_dtype(1, 28)
+    records = np.zeros(3, dtype=dtype)
+    records["class_byte"] = [0x20 | 5, 0x40 | 5, 0x80 | 5]
+    path = str(tmp_path / "pdrf1.las")
+    write_las(path, 2, 1, records.tobytes(), 28, len(records))
+
+    points = next(las_utils.read_points(path))
+    assert points["withheld"].tolist() == [False, False, True]
+    assert points["classification"].tolist() == [5, 5, 5]
+
+
+def test_color_depth(tmp_path):
+    dtype = las_utils.point_dtype(2, 26)
+    paths = []
+    for i, red in enumerate([[10, 255], [0, 65280]]):
+        records = np.zeros(2, dtype=dtype)
+        records["red"] = red
+        paths.append(str(tmp_path / f"tile_{i}.las"))
+        write_las(paths[-1], 2, 2, records.tobytes(), 26, len(records))
+
+    assert las_utils.color_depth(paths[:1]) == 8
+    # one file with 16 bit colours decides for all files
+    assert las_utils.color_depth(paths) == 16
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: test_stage_graph.py
+# Description: Tests of the stage graph executor (src/utils/stage_graph.py)
+# and of the run report records of its worker processes.
+# Usage: python -m pytest src/test/test_stage_graph.py
+# --------------------------------------------------------------------------- #
+
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, project_dir)
+
+from src.utils.resource_monitor import (  # noqa: E402
+    RunReport,
+    get_run_report,
+    set_run_report,
+)
+from src.utils.stage_graph import StageGraph  # noqa: E402
+
+# stage functions as in src/tree_detection, per-unit stages get a list of
+# units
+
+
+def split(units):
+    for unit in units:
+        with get_run_report().stage("split", unit) as monitor:
+            monitor.extra["blocks_skipped"] = 0.5
+
+
+def segment(units):
+    for unit in units:
+        with get_run_report().stage("segment", unit):
+            if unit == "b":
+                raise ValueError("no CHM")
+
+
+def merge():
+    with get_run_report().stage("merge"):
+        pass
+
+
+def build_graph() -> StageGraph:
+    graph = StageGraph("test")
+    graph.add_stage("split", split, outputs=["chm_nb"], per_unit=True)
+    graph.add_stage("segment", segment, ["chm_nb"], ["trees"], per_unit=True)
+    graph.add_stage("merge", merge, ["trees"])
+    return graph
+
+
+def test_dependencies():
+    dependencies = build_graph().dependencies(["a", "b"])
+    assert dependencies[("segment", "a")] == [("split", "a")]
+    assert dependencies[("merge", None)] == [("segment", "a"), ("segment", "b")]
+
+
+def test_stage_units():
+    graph = StageGraph("test")
+    graph.add_stage("tiles", split, outputs=["tiles"], per_unit=True)
+    graph.add_stage(
+        "chm", split, outputs=["chm_tiles"], per_unit=True, units=["1", "2"]
+    )
+    graph.add_stage("mosaic", merge, ["chm_tiles", "tiles"], ["chm"])
+    graph.add_stage("segment", segment, ["chm", "tiles"], ["trees"], True)
+    dependencies = graph.dependencies(["a"])
+    assert dependencies[("chm", "2")] == []
+    assert dependencies[("mosaic", None)] == [
+        ("chm", "1"),
+        ("chm", "2"),
+        ("tiles", "a"),
+    ]
+    assert dependencies[("segment", "a")] == [("mosaic", None), ("tiles", "a")]
+    with pytest.raises(ValueError):
+        graph.add_stage("mask", merge, units=["1"])
+
+
+@pytest.mark.parametrize("locks", [(), ["gdb"]])
+def test_locks(tmp_path, locks):
+    running = []
+    overlap = []
+    guard = threading.Lock()
+
+    def write(units):
+        with guard:
+            running.append(units[0])
+            overlap.append(len(running))
+        time.sleep(0.05)
+        with guard:
+            running.remove(units[0])
+
+    graph = StageGraph("test")
+    graph.add_stage("write", write, per_unit=True, locks=locks)
+    set_run_report(RunReport(str(tmp_path / "report.jsonl")))
+    try:
+        graph.run(["a", "b", "c"], workers=3)
+    finally:
+        set_run_report(None)
+    assert max(overlap) == (1 if locks else 3)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_worker_records_in_parent_report(tmp_path, processes):
+    path = str(tmp_path / "report.jsonl")
+    report = set_run_report(RunReport(path))
+    try:
+        with pytest.raises(RuntimeError, match="1 nodes failed, 1 skipped"):
+            build_graph().run(["a", "b"], workers=2, processes=processes)
+    finally:
+        set_run_report(None)
+
+    stages = sorted(
+        (r["stage"], r["unit"], r["failed"]) for r in report.records
+    )
+    assert stages == [
+        ("segment", "a", False),
+        ("segment", "b", True),
+        ("split", "a", False),
+        ("split", "b", False),
+        ("test", None, False),
+    ]
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == len(report.records)
+    summary = report.summary()
+    assert summary["split"]["units"] == 2
+    assert summary["split"]["blocks_skipped"] == 0.5
+    assert not [name for name in os.listdir(tmp_path) if name != "report.jsonl"]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------- #
+# Name: test_void_fill.py
+# Description: Tests of the block wise void fill of the DTM and DSM
+# (src/tree_detection/void_fill.py).
+# Usage: python -m pytest src/test/test_void_fill.py
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+
+import numpy as np
+
+project_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+sys.path.insert(0, os.path.join(project_dir, "src", "tree_detection"))
+
+from void_fill import fill_voids  # noqa: E402
+
+
+def plane(n: int) -> np.ndarray:
+    rows, cols = np.mgrid[0:n, 0:n]
+    return (100 + 0.01 * cols + 0.02 * rows).astype(np.float32)
+
+
+def test_fill_voids_plane():
+    # a building footprint with scattered gaps around it
+    rng = np.random.default_rng(0)
+    expected = plane(300)
+    array = expected.copy()
+    array[rng.random(array.shape) < 0.3] = np.nan
+    array[100:180, 60:200] = np.nan
+
+    filled = fill_voids(array, block_size=128, halo=96)
+    assert not np.isnan(filled).any()
+    # the footprint is interpolated linearly, the gaps from the neighbours
+    assert (
+        np.abs(filled[110:170, 70:190] - expected[110:170, 70:190]).max() < 1e-3
+    )
+    assert np.abs(filled - expected).max() < 0.05
+
+
+def test_fill_voids_without_data_in_window():
+    # the windows far from the only data cell have no data cell at all
+    array = np.full((200, 200), np.nan, dtype=np.float32)
+    array[0, 0] = 5.0
+    array[2:5, 2:5] = 5.0
+    filled = fill_voids(array, block_size=16, halo=2)
+    assert np.all(filled == 5.0)
+
+    # a small void that fills its whole window
+    array = np.full((4, 4), np.nan, dtype=np.float32)
+    array[0, 0] = 1.0
+    assert np.all(fill_voids(array, block_size=2, halo=0) == 1.0)
@@ -6,6 +6,11 @@ Modules necessary for the module:
 - tree
 """
 
-from src import AdminAttributes  # noqa
-from src import LaserAttributes  # noqa
-from src import arcpy_utils  # noqa
+
+def __getattr__(name: str):
+    # arcpy-backed names of src, imported on first access (see src/__init__.py)
+    if name in ("AdminAttributes", "LaserAttributes", "arcpy_utils"):
+        import src
+
+        return getattr(src, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,231 @@
+"""NumPy implementations of raster steps of the tree detection.
+
+The functions work on plain numpy arrays (row 0 is the northern edge) and do
+not depend on arcpy, the arcpy wrappers in tree.py convert the rasters from
+and to numpy. The functions take no BlockIndex, the other-tree step skips
+the blocks without vegetation by restricting the processing extent to the
+occupied blocks (see block_index.py) before the rasters are read.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 4-connectivity, cells that touch only at a corner are not connected
+# (same as two polygons that share only a vertex)
+CONNECTIVITY_4 = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool)
+
+# bits of the FKB mask raster (tree.create_fkbMask)
+ROAD_BIT = 1
+BUILDING_BIT = 2
+
+
+# ------------------------------------------------------ #
+# Connected components
+# ------------------------------------------------------ #
+
+
+def label_components(mask: np.ndarray, min_cells: int = 1):
+    """
+    Labels the connected components of a mask and removes small components.
+
+    Args:
+        mask (np.ndarray): 2D boolean array
+        min_cells (int): components with fewer cells are removed
+
+    Returns:
+        tuple: (labels, n_labels), labels is an int32 array with 0 for the
+            background and 1..n_labels for the components
+    """
+    # scipy is imported on first use, it is slow to import in a worker
+    from scipy import ndimage
+
+    labels, n_labels = ndimage.label(mask, structure=CONNECTIVITY_4)
+    labels = labels.astype(np.int32, copy=False)
+    if n_labels == 0 or min_cells <= 1:
+        return labels, n_labels
+
+    # cell count per label, relabel the components that are large enough
+    counts = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    keep = counts >= min_cells
+    keep[0] = False
+    new_labels = np.zeros(n_labels + 1, dtype=np.int32)
+    new_labels[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return new_labels[labels], int(np.count_nonzero(keep))
+
+
+def other_tree_components(
+    chm: np.ndarray,
+    crown_labels: np.ndarray,
+    cell_size: float,
+    min_area: float = 12,
+    nodata=None,
+):
+    """
+    Labels the vegetation that is not covered by watershed crowns.
+
+    Raster version of: CHM to polygons, select the polygons that do not
+    intersect a watershed crown, dissolve (single part) and remove the crowns
+    with Shape_Area < min_area. Cells that are covered by or touch a crown
+    cell are removed (INTERSECT includes touching), the remaining data cells
+    are grouped into 4-connected components. Components smaller than
+    min_area are removed by their cell count, before any polygon is created.
+
+    Args:
+        chm (np.ndarray): 2D CHM array
+        crown_labels (np.ndarray): 2D array on the CHM grid, > 0 where a
+            watershed crown covers the cell
+        cell_size (float): cell size in map units
+        min_area (float): minimum crown area in map units squared
+        nodata (float, optional): NODATA value of the CHM, NaN is always
+            treated as NODATA
+
+    Returns:
+        tuple: (labels, n_labels) of the "other" crowns
+    """
+    if chm.shape != crown_labels.shape:
+        raise ValueError(
+            f"CHM {chm.shape} and crown labels {crown_labels.shape} are not on the same grid"
+        )
+
+    data = (
+        np.isfinite(chm) if chm.dtype.kind == "f" else np.ones_like(chm, bool)
+    )
+    if nodata is not None:
+        data &= chm != nodata
+
+    from scipy import ndimage
+
+    crowns = crown_labels > 0
+    crowns = ndimage.binary_dilation(crowns, structure=CONNECTIVITY_4)
+    mask = data & ~crowns
+
+    # Shape_Area < min_area as cell count
+    min_cells = int(np.ceil(min_area / (cell_size * cell_size) - 1e-9))
+    return label_components(mask, min_cells)
+
+
+def drop_maskedComponents(labels: np.ndarray, n_labels: int, mask: np.ndarray):
+    """
+    Removes the components that have a cell on the mask.
+
+    Raster version of selecting the crowns that intersect the FKB roads and
+    buildings (SelectLayerByLocation INTERSECT) and deleting them: one
+    lookup of the mask per labelled cell.
+
+    Args:
+        labels (np.ndarray): 2D component labels, 0 is the background
+        n_labels (int): number of components
+        mask (np.ndarray): 2D array on the same grid, != 0 on masked cells
+            (ROAD_BIT | BUILDING_BIT)
+
+    Returns:
+        tuple: (labels, n_labels, n_dropped), the remaining components are
+            relabelled 1..n_labels
+    """
+    if labels.shape != mask.shape:
+        raise ValueError(
+            f"Labels {labels.shape} and mask {mask.shape} are not on the same grid"
+        )
+    if n_labels == 0:
+        return labels, 0, 0
+
+    hits = np.bincount(
+        labels[mask != 0].ravel(), minlength=n_labels + 1
+    ).astype(bool)
+    hits[0] = True
+    n_dropped = int(np.count_nonzero(hits[1:]))
+    if n_dropped == 0:
+        return labels, n_labels, 0
+
+    new_labels = np.zeros(n_labels + 1, dtype=np.int32)
+    keep = ~hits
+    new_labels[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return new_labels[labels], n_labels - n_dropped, n_dropped
+
+
+# ------------------------------------------------------ #
+# Crown profiles
+# ------------------------------------------------------ #
+
+
+def crown_profiles(
+    chm: np.ndarray,
+    labels: np.ndarray,
+    n_labels: int,
+    cell_size: float,
+    x_min: float = 0.0,
+    y_max: float = 0.0,
+    percentiles: tuple = (25, 50, 75, 95),
+) -> dict:
+    """
+    Integrates the CHM over the cells of each crown.
+
+    All crowns are reduced at once: the crown cells are sorted by label and
+    height once, the sums are bincounts and the percentiles are read from
+    the sorted heights (linear interpolation, as np.percentile). Cells
+    without height (NaN) are not part of a crown.
+
+    Args:
+        chm (np.ndarray): 2D CHM array (heights, NaN is NODATA)
+        labels (np.ndarray): 2D crown labels on the CHM grid, 0 is no crown
+        n_labels (int): largest label
+        cell_size (float): cell size in map units
+        x_min, y_max (float): coordinates of the upper left corner of the
+            grid
+        percentiles (tuple): height percentiles (0 - 100)
+
+    Returns:
+        dict: arrays of n_labels values, index i is label i + 1, NaN for
+            labels without cells
+            "cells": number of crown cells
+            "volume": canopy volume (sum of height x cell area)
+            "mean", "max": mean and maximum height
+            "p<q>": height percentiles
+            "x", "y": height-weighted centroid
+    """
+    if chm.shape != labels.shape:
+        raise ValueError(
+            f"CHM {chm.shape} and labels {labels.shape} are not on the same grid"
+        )
+    crown = (labels > 0) & np.isfinite(chm)
+    rows, cols = np.nonzero(crown)
+    label = labels[rows, cols].astype(np.int64)
+    height = chm[rows, cols].astype(np.float64)
+
+    size = n_labels + 1
+    cells = np.bincount(label, minlength=size)[1:].astype(np.float64)
+    height_sum = np.bincount(label, height, minlength=size)[1:]
+    x = x_min + (cols + 0.5) * cell_size
+    y = y_max - (rows + 0.5) * cell_size
+    weighted_x = np.bincount(label, height * x, minlength=size)[1:]
+    weighted_y = np.bincount(label, height * y, minlength=size)[1:]
+
+    has_cells = cells > 0
+    result = {"cells": cells}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["volume"] = np.where(
+            has_cells, height_sum * cell_size**2, np.nan
+        )
+        result["mean"] = np.where(has_cells, height_sum / cells, np.nan)
+        result["x"] = np.where(has_cells, weighted_x / height_sum, np.nan)
+        result["y"] = np.where(has_cells, weighted_y / height_sum, np.nan)
+
+    # heights sorted within each crown, crown i starts at starts[i]
+    order = np.lexsort((height, label))
+    sorted_height = height[order]
+    starts = np.r_[0, np.cumsum(cells.astype(np.int64))[:-1]]
+    last = starts + np.maximum(cells.astype(np.int64) - 1, 0)
+    result["max"] = np.full(n_labels, np.nan)
+    result["max"][has_cells] = sorted_height[last[has_cells]]
+    for q in percentiles:
+        position = (cells[has_cells] - 1) * q / 100.0
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, cells[has_cells].astype(np.int64) - 1)
+        fraction = position - below
+        low = sorted_height[starts[has_cells] + below]
+        high = sorted_height[starts[has_cells] + above]
+        result[f"p{q}"] = np.full(n_labels, np.nan)
+        result[f"p{q}"][has_cells] = low + (high - low) * fraction
+    return result
@@ -0,0 +1,308 @@
+"""Sparse block occupancy index of the canopy height model (CHM).
+
+The CHM grid is divided into fixed-size blocks (``BLOCK_SIZE`` x
+``BLOCK_SIZE`` cells) aligned to the coordinate origin, so the blocks of
+different tiles and neighbourhoods line up. The index stores the (column,
+row) numbers of the blocks that contain at least one vegetation cell (a cell
+with data and a height >= MIN_HEIGHT). All other blocks are treeless (roads,
+water, buildings, NODATA) and are skipped by the processing steps.
+
+The index is built per tile while the CHM is refined (model_chm.py), merged
+for the mosaic and stored as .npz next to the elevation data.
+"""
+import logging
+import os
+from itertools import chain
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# block size in cells
+BLOCK_SIZE = 64
+
+
+def block_index_path(r_chm: str) -> str:
+    """
+    Returns the path of the block index of a CHM raster in a file gdb.
+
+    Example: <general>/baerum_hoydedata.gdb/chm_025m_int_100x
+        -> <general>/chm_025m_int_100x_blocks.npz
+    """
+    gdb_path, raster_name = os.path.split(r_chm)
+    return os.path.join(os.path.dirname(gdb_path), raster_name + "_blocks.npz")
+
+
+class BlockIndex:
+    """
+    Set of the blocks of a CHM grid that contain vegetation cells.
+
+    Attributes:
+    -----------
+    cell_size : float
+        cell size of the CHM in map units
+    block_size : int
+        number of cells per block side
+    blocks : set
+        (column, row) numbers of the occupied blocks, column = floor(x /
+        block_length) and row = floor(y / block_length), queries look them
+        up in a boolean grid that is built on the first query
+
+    Methods:
+    --------
+    - from_array(cls, array, x_min, y_max, cell_size, min_height, nodata)
+    - from_raster(cls, raster, min_height, block_size, encoding)
+    - load(cls, path)
+    - save(self, path)
+    - merge(self, other)
+    - query(self, extent)
+    """
+
+    def __init__(
+        self, cell_size: float, block_size: int = BLOCK_SIZE, blocks=()
+    ):
+        self.cell_size = float(cell_size)
+        self.block_size = int(block_size)
+        self.blocks = set(blocks)
+
+    @property
+    def blocks(self) -> set:
+        """(column, row) numbers of the occupied blocks."""
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks: set):
+        self._blocks = blocks
+        # (grid, first column, first row), rebuilt on the next query
+        self._grid = None
+
+    @property
+    def block_length(self) -> float:
+        """Side length of a block in map units."""
+        return self.cell_size * self.block_size
+
+    def __len__(self):
+        return len(self.blocks)
+
+    # ------------------------------------------------------ #
+    # Build, load, save
+    # ------------------------------------------------------ #
+
+    @classmethod
+    def from_array(
+        cls,
+        array: np.ndarray,
+        x_min: float,
+        y_max: float,
+        cell_size: float,
+        min_height: float,
+        nodata=None,
+        block_size: int = BLOCK_SIZE,
+    ):
+        """
+        Builds the index from a CHM array.
+
+        Args:
+            array (np.ndarray): 2D CHM array, row 0 is the northern edge
+            x_min (float): x coordinate of the western edge
+            y_max (float): y coordinate of the northern edge
+            cell_size (float): cell size in map units
+            min_height (float): minimum tree height (same unit as array)
+            nodata (float, optional): NODATA value of the array, NaN is
+                always treated as NODATA
+            block_size (int): number of cells per block side
+
+        Returns:
+            BlockIndex: the occupancy index
+        """
+        index = cls(cell_size, block_size)
+        if array.size == 0:
+            return index
+
+        with np.errstate(invalid="ignore"):
+            vegetation = array >= min_height
+        if nodata is not None:
+            vegetation &= array != nodata
+
+        # global block number of each column and row (cell centers)
+        length = index.block_length
+        n_rows, n_cols = array.shape
+        cols = np.floor(
+            (x_min + (np.arange(n_cols) + 0.5) * cell_size) / length
+        ).astype(np.int64)
+        rows = np.floor(
+            (y_max - (np.arange(n_rows) + 0.5) * cell_size) / length
+        ).astype(np.int64)
+
+        # any() per block: reduce over the runs of equal block numbers
+        col_starts = np.flatnonzero(np.diff(cols, prepend=cols[0] - 1))
+        row_starts = np.flatnonzero(np.diff(rows, prepend=rows[0] + 1))
+        occupied = np.logical_or.reduceat(vegetation, col_starts, axis=1)
+        occupied = np.logical_or.reduceat(occupied, row_starts, axis=0)
+
+        block_rows, block_cols = np.nonzero(occupied)
+        index.blocks = set(
+            zip(
+                cols[col_starts][block_cols].tolist(),
+                rows[row_starts][block_rows].tolist(),
+            )
+        )
+        return index
+
+    @classmethod
+    def from_raster(
+        cls,
+        raster: str,
+        min_height: float,
+        block_size: int = BLOCK_SIZE,
+        encoding=None,
+    ):
+        """
+        Builds the index from a CHM raster (requires arcpy).
+
+        Args:
+            raster (str): path to the CHM raster
+            min_height (float): minimum tree height in map units
+            block_size (int): number of cells per block side
+            encoding (HeightEncoding, optional): encoding of an integer CHM
+                (see height_encoding.py), the stored values are compared
+                with the threshold in stored units, without decoding
+
+        Returns:
+            BlockIndex: the occupancy index
+        """
+        import arcpy
+
+        desc = arcpy.Describe(raster)
+        if encoding is None:
+            array = arcpy.RasterToNumPyArray(raster, nodata_to_value=np.nan)
+            array = array.astype(np.float32, copy=False)
+            nodata = None
+        else:
+            array = arcpy.RasterToNumPyArray(
+                raster, nodata_to_value=encoding.nodata
+            )
+            array = array.astype(encoding.dtype, copy=False)
+            min_height = encoding.to_units(min_height)
+            nodata = encoding.nodata
+        return cls.from_array(
+            array,
+            desc.extent.XMin,
+            desc.extent.YMax,
+            desc.meanCellWidth,
+            min_height,
+            nodata,
+            block_size=block_size,
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads an index saved with save()."""
+        with np.load(path) as data:
+            return cls(
+                float(data["cell_size"]),
+                int(data["block_size"]),
+                map(tuple, data["blocks"].tolist()),
+            )
+
+    def save(self, path: str):
+        """Saves the index as .npz."""
+        blocks = np.array(sorted(self.blocks), dtype=np.int64).reshape(-1, 2)
+        # write to a temporary file first, np.savez adds the .npz extension
+        tmp_path = os.path.splitext(path)[0] + "_partial.npz"
+        np.savez_compressed(
+            tmp_path,
+            cell_size=self.cell_size,
+            block_size=self.block_size,
+            blocks=blocks,
+        )
+        os.replace(tmp_path, path)
+
+    def merge(self, other):
+        """Adds the blocks of another index with the same grid."""
+        if (other.cell_size, other.block_size) != (
+            self.cell_size,
+            self.block_size,
+        ):
+            raise ValueError(
+                "Cannot merge block indices with different cell or block sizes"
+            )
+        self.blocks |= other.blocks
+        return self
+
+    # ------------------------------------------------------ #
+    # Queries
+    # ------------------------------------------------------ #
+
+    def _block_range(self, extent: tuple):
+        """Returns the column and row ranges of the blocks in an extent."""
+        x_min, y_min, x_max, y_max = extent
+        length = self.block_length
+        cols = range(
+            int(np.floor(x_min / length)), int(np.ceil(x_max / length))
+        )
+        rows = range(
+            int(np.floor(y_min / length)), int(np.ceil(y_max / length))
+        )
+        return cols, rows
+
+    def _occupancy_grid(self) -> tuple:
+        """
+        Returns the occupied blocks as a boolean grid (grid[row - first row,
+        column - first column]) over the bounding box of the blocks.
+        """
+        if self._grid is None:
+            blocks = np.fromiter(
+                chain.from_iterable(self._blocks),
+                dtype=np.int64,
+                count=2 * len(self._blocks),
+            ).reshape(-1, 2)
+            if len(blocks) == 0:
+                self._grid = (np.zeros((0, 0), dtype=bool), 0, 0)
+            else:
+                col0, row0 = blocks.min(axis=0)
+                n_cols, n_rows = blocks.max(axis=0) - (col0, row0) + 1
+                grid = np.zeros((n_rows, n_cols), dtype=bool)
+                grid[blocks[:, 1] - row0, blocks[:, 0] - col0] = True
+                self._grid = (grid, int(col0), int(row0))
+        return self._grid
+
+    def query(self, extent: tuple):
+        """
+        Returns the fraction of empty blocks in an extent and the extent of
+        the occupied blocks.
+
+        Args:
+            extent (tuple): (x_min, y_min, x_max, y_max)
+
+        Returns:
+            tuple: (fraction of empty blocks, occupied extent), the occupied
+                extent is None if the extent has no vegetation
+        """
+        cols, rows = self._block_range(extent)
+        n_blocks = len(cols) * len(rows)
+        if n_blocks == 0:
+            return 0.0, None
+
+        # slice of the extent in the occupancy grid
+        grid, col0, row0 = self._occupancy_grid()
+        c_start, r_start = max(cols.start, col0), max(rows.start, row0)
+        window = grid[
+            r_start - row0 : max(rows.stop - row0, 0),
+            c_start - col0 : max(cols.stop - col0, 0),
+        ]
+        n_occupied = int(np.count_nonzero(window))
+        fraction_empty = 1 - n_occupied / n_blocks
+        if n_occupied == 0:
+            return fraction_empty, None
+
+        length = self.block_length
+        c_occ = c_start + np.flatnonzero(window.any(axis=0))
+        r_occ = r_start + np.flatnonzero(window.any(axis=1))
+        occupied_extent = (
+            max(extent[0], c_occ[0] * length),
+            max(extent[1], r_occ[0] * length),
+            min(extent[2], (c_occ[-1] + 1) * length),
+            min(extent[3], (r_occ[-1] + 1) * length),
+        )
+        return fraction_empty, occupied_extent
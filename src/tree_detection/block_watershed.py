@@ -0,0 +1,582 @@
+"""Watershed segmentation of the whole CHM, block by block.
+
+The watershed of the neighbourhoods (tree.watershed_segmentation) flips the
+CHM of a 200 m buffered neighbourhood clip and runs FlowDirection, Sink and
+Watershed on it. The cells in the buffers are segmented once per
+neighbourhood that overlaps them, and the crowns at the neighbourhood edges
+are resolved afterwards by the "top intersects neighbourhood" rule.
+
+BlockWatershed segments the municipal CHM once, in blocks of block_size x
+block_size cells:
+
+- every cell flows to its steepest ascending neighbour (the D8 flow
+  direction of the flipped CHM), cells without a higher neighbour are
+  sinks; connected sink cells are one sink (tree top), a flat sink with an
+  exit of the same height flows into the exit
+- a block is read with a halo of halo cells, so the flow directions and the
+  flat sinks at the block border are the same as in the whole CHM; a flat
+  that the window edge cuts (a roof wider than the halo) is segmented again
+  in a larger window, up to MAX_WINDOW cells per side
+- the crown id of a cell is the id of the sink its flow path ends in; the id
+  of a sink is the global (row-major) index of its first cell, the same in
+  every block that sees the sink
+- a flow path that leaves the window of a block ends on an "open" cell of
+  the neighbouring block, its sink is looked up in the border cells (rim)
+  that the neighbouring block stored in the first pass
+
+First pass: segment each block, store the sink ids of its rim cells and the
+tree tops (sinks) of the block. Second pass: segment each block again,
+resolve the open paths with the rims of the neighbouring blocks and write
+the crown labels 1..n of the block. Each cell is segmented in exactly one
+block (twice, once per pass), the memory use depends on the block size.
+
+The neighbourhood of a crown is the neighbourhood of its tree top, see
+assign_units().
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# D8 neighbours (row, column offset)
+OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+SQRT2 = np.float32(np.sqrt(2.0))
+
+# code of the cells without data
+NO_CROWN = np.iinfo(np.int64).min
+
+# maximum number of blocks an open flow path is followed through
+MAX_HOPS = 64
+
+# largest window (cells per side) of a block with a cut flat
+MAX_WINDOW = 3072
+
+
+def flow_receivers(z: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    Returns the steepest ascending neighbour of each cell.
+
+    Args:
+        z (np.ndarray): 2D height array (any numeric dtype)
+        valid (np.ndarray): boolean mask of the cells with data
+
+    Returns:
+        np.ndarray: flat index of the receiver per cell, the index of the
+            cell itself for cells without a higher neighbour
+    """
+    n_rows, n_cols = z.shape
+    zf = np.where(valid, z, -np.inf).astype(np.float32)
+    pad = np.pad(zf, 1, mode="constant", constant_values=-np.inf)
+    best = np.zeros(z.shape, dtype=np.float32)
+    best_k = np.full(z.shape, -1, dtype=np.int8)
+    with np.errstate(invalid="ignore"):
+        for k, (dr, dc) in enumerate(OFFSETS):
+            neighbour = pad[1 + dr : 1 + dr + n_rows, 1 + dc : 1 + dc + n_cols]
+            slope = neighbour - zf
+            if dr and dc:
+                slope /= SQRT2
+            better = slope > best
+            best[better] = slope[better]
+            best_k[better] = k
+
+    receivers = np.arange(z.size, dtype=np.int64).reshape(z.shape)
+    for k, (dr, dc) in enumerate(OFFSETS):
+        receivers[best_k == k] += dr * n_cols + dc
+    receivers[~valid] = np.flatnonzero(~valid)
+    return receivers.ravel()
+
+
+def _flat_exits(z, valid, sinks, labels, n_sinks):
+    """Returns per sink the flat index of a cell of the same height that is
+    not a sink (the exit of a flat), -1 for real sinks."""
+    n_rows, n_cols = z.shape
+    exits = np.full(n_sinks + 1, -1, dtype=np.int64)
+    index = np.arange(z.size, dtype=np.int64).reshape(z.shape)
+    for dr, dc in OFFSETS:
+        # cell (r, c) and its neighbour (r + dr, c + dc), both in the window
+        r0, r1 = max(-dr, 0), n_rows - max(dr, 0)
+        c0, c1 = max(-dc, 0), n_cols - max(dc, 0)
+        cell = (slice(r0, r1), slice(c0, c1))
+        other = (slice(r0 + dr, r1 + dr), slice(c0 + dc, c1 + dc))
+        exit_cells = (
+            sinks[cell] & valid[other] & ~sinks[other] & (z[cell] == z[other])
+        )
+        exits[labels[cell][exit_cells]] = index[other][exit_cells]
+    exits[0] = -1
+    return exits
+
+
+def segment_window(
+    z: np.ndarray,
+    valid: np.ndarray,
+    row0: int,
+    col0: int,
+    n_cols_total: int,
+    open_edges: tuple,
+):
+    """
+    Segments a window of the CHM into the sinks its cells flow to.
+
+    Args:
+        z (np.ndarray): 2D CHM window
+        valid (np.ndarray): boolean mask of the cells with data
+        row0, col0 (int): position of the window in the whole CHM
+        n_cols_total (int): number of columns of the whole CHM
+        open_edges (tuple): (top, bottom, left, right) True for the window
+            edges that are not the edge of the whole CHM
+
+    Returns:
+        tuple: (codes, tops, cut)
+            codes: int64 array of the window, the sink id (>= 0) of each
+            cell, -(g + 1) for paths that end on the open cell g at the
+            window edge, NO_CROWN for cells without data;
+            tops: dict with the sink id, row and column (whole CHM) of the
+            tree top of each sink in the window;
+            cut: boolean array of the window, True for the cells whose path
+            runs through a flat that an open window edge cuts (its id and
+            exit may be different in a larger window)
+    """
+    from scipy import ndimage
+
+    n_rows, n_cols = z.shape
+    receivers = flow_receivers(z, valid)
+    own = np.arange(z.size, dtype=np.int64)
+    sinks = (receivers == own).reshape(z.shape) & valid
+
+    # connected sink cells (8-neighbours) are one sink, they have the same
+    # height; a flat with an exit of the same height flows into the exit
+    labels, n_sinks = ndimage.label(sinks, structure=np.ones((3, 3), bool))
+    exits = _flat_exits(z, valid, sinks, labels, n_sinks)
+    flat = sinks & (exits[labels] >= 0)
+    receivers[flat.ravel()] = exits[labels[flat]]
+    sinks &= ~flat
+
+    # cells at an open window edge end the paths, their sink is found in the
+    # neighbouring block
+    open_cells = np.zeros(z.shape, dtype=bool)
+    top, bottom, left, right = open_edges
+    open_cells[0, :] |= top
+    open_cells[-1, :] |= bottom
+    open_cells[:, 0] |= left
+    open_cells[:, -1] |= right
+    open_cells &= valid
+    receivers[open_cells.ravel()] = own[open_cells.ravel()]
+    sinks &= ~open_cells
+
+    # flats with cells on an open edge and inside the window
+    on_edge = np.zeros(n_sinks + 1, dtype=bool)
+    on_edge[labels[open_cells]] = True
+    inside = np.zeros(n_sinks + 1, dtype=bool)
+    inside[labels[~open_cells]] = True
+    cut_flats = on_edge & inside
+    cut_flats[0] = False
+
+    # follow the paths to their end by pointer jumping, a path is cut if
+    # any of its cells is in a cut flat
+    ends = receivers
+    cut = cut_flats[labels.ravel()]
+    while True:
+        cut = cut | cut[ends]
+        next_ends = ends[ends]
+        if np.array_equal(next_ends, ends):
+            break
+        ends = next_ends
+
+    rows, cols = np.divmod(own, n_cols)
+    global_index = (rows + row0) * n_cols_total + (cols + col0)
+
+    # id of a sink: global index of its first cell (row-major)
+    sink_cells = np.flatnonzero(sinks)
+    sink_labels = labels.ravel()[sink_cells]
+    order = np.argsort(sink_labels, kind="stable")
+    sink_cells, sink_labels = sink_cells[order], sink_labels[order]
+    starts = np.flatnonzero(np.r_[True, sink_labels[1:] != sink_labels[:-1]])
+    sink_ids = np.full(n_sinks + 1, NO_CROWN, dtype=np.int64)
+    if sink_cells.size:
+        sink_ids[sink_labels[starts]] = global_index[sink_cells[starts]]
+
+    codes = np.full(z.size, NO_CROWN, dtype=np.int64)
+    valid_flat = valid.ravel()
+    end_cells = ends[valid_flat]
+    end_open = open_cells.ravel()[end_cells]
+    codes[valid_flat] = np.where(
+        end_open,
+        -(global_index[end_cells] + 1),
+        sink_ids[labels.ravel()[end_cells]],
+    )
+
+    # tree top: the cell of the sink closest to its centre
+    tops = {"id": [], "row": [], "col": []}
+    if sink_cells.size:
+        ends_of_run = np.r_[starts[1:], sink_cells.size]
+        count = (ends_of_run - starts).astype(np.float64)
+        r = rows[sink_cells].astype(np.float64)
+        c = cols[sink_cells].astype(np.float64)
+        centre_r = np.add.reduceat(r, starts) / count
+        centre_c = np.add.reduceat(c, starts) / count
+        run = np.repeat(np.arange(starts.size), ends_of_run - starts)
+        distance = (r - centre_r[run]) ** 2 + (c - centre_c[run]) ** 2
+        closest = np.lexsort((distance, run))
+        first = closest[starts]
+        tops = {
+            "id": sink_ids[sink_labels[starts]],
+            "row": rows[sink_cells[first]] + row0,
+            "col": cols[sink_cells[first]] + col0,
+        }
+    return codes.reshape(z.shape), tops, cut.reshape(z.shape)
+
+
+class BlockWatershed:
+    """
+    Watershed segmentation of a large CHM in blocks with a halo.
+
+    Attributes:
+    -----------
+    shape : tuple
+        (rows, columns) of the whole CHM
+    block_size : int
+        number of cells per block side
+    halo : int
+        number of cells read around a block, flat sinks up to this size are
+        the same in neighbouring blocks
+    nodata : number
+        NODATA value of the CHM, NaN is always treated as NODATA
+    tmp_dir : str
+        folder of the rim files of the first pass
+
+    Methods:
+    --------
+    - blocks(self)
+    - run(self, read_window, write_labels, skip_block)
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        block_size: int = 1024,
+        halo: int = 16,
+        nodata=None,
+        tmp_dir: str = None,
+    ):
+        if halo < 1 or halo >= block_size:
+            raise ValueError("The halo must be >= 1 and < block_size")
+        self.shape = tuple(shape)
+        self.block_size = int(block_size)
+        self.halo = int(halo)
+        self.nodata = nodata
+        self.tmp_dir = tmp_dir
+        self._rims = {}
+
+    def blocks(self) -> list:
+        """Returns the (row0, row1, col0, col1) of the blocks."""
+        n_rows, n_cols = self.shape
+        return [
+            (
+                r0,
+                min(r0 + self.block_size, n_rows),
+                c0,
+                min(c0 + self.block_size, n_cols),
+            )
+            for r0 in range(0, n_rows, self.block_size)
+            for c0 in range(0, n_cols, self.block_size)
+        ]
+
+    def _segment_window(self, read_window, block, halo):
+        """
+        Segments the window of a block with a halo, returns the codes and
+        the cut mask of the core and the final tops (not cut) of the core.
+        """
+        n_rows, n_cols = self.shape
+        r0, r1, c0, c1 = block
+        w_r0, w_r1 = max(r0 - halo, 0), min(r1 + halo, n_rows)
+        w_c0, w_c1 = max(c0 - halo, 0), min(c1 + halo, n_cols)
+        z = read_window(w_r0, w_r1, w_c0, w_c1)
+        valid = np.ones(z.shape, dtype=bool)
+        if z.dtype.kind == "f":
+            valid &= np.isfinite(z)
+        if self.nodata is not None:
+            valid &= z != self.nodata
+        codes, tops, cut = segment_window(
+            z,
+            valid,
+            w_r0,
+            w_c0,
+            n_cols,
+            (w_r0 > 0, w_r1 < n_rows, w_c0 > 0, w_c1 < n_cols),
+        )
+        core = (slice(r0 - w_r0, r1 - w_r0), slice(c0 - w_c0, c1 - w_c0))
+
+        # the tops of the block are the sinks whose top cell is in the core
+        tops = {key: np.asarray(v, np.int64) for key, v in tops.items()}
+        if tops["id"].size:
+            keep = (
+                (tops["row"] >= r0)
+                & (tops["row"] < r1)
+                & (tops["col"] >= c0)
+                & (tops["col"] < c1)
+                & ~cut[tops["row"] - w_r0, tops["col"] - w_c0]
+            )
+            tops = {key: values[keep] for key, values in tops.items()}
+        return codes[core], cut[core], tops
+
+    def _segment_block(self, read_window, block):
+        """
+        Segments the window of a block, returns the codes and the tops of
+        the core and the number of cells of flats that are still cut.
+
+        The cells whose path runs through a flat that the window edge cuts
+        are segmented again in a window with twice the halo, until the flat
+        is in the window or the window is MAX_WINDOW cells wide.
+        """
+        n_rows, n_cols = self.shape
+        halo = self.halo
+        core, cut, tops = self._segment_window(read_window, block, halo)
+        parts = [tops]
+        max_halo = min(
+            max((MAX_WINDOW - self.block_size) // 2, self.halo),
+            max(n_rows, n_cols),
+        )
+        while cut.any() and halo < max_halo:
+            halo = min(2 * halo, max_halo)
+            grown, grown_cut, grown_tops = self._segment_window(
+                read_window, block, halo
+            )
+            # a path that leaves the larger window ends outside the rims of
+            # the neighbouring blocks, it is followed in the next window
+            done = cut & ~grown_cut & ((grown >= 0) | (grown == NO_CROWN))
+            core[done] = grown[done]
+            cut &= ~done
+            keep = np.isin(grown_tops["id"], grown[done])
+            parts.append({key: v[keep] for key, v in grown_tops.items()})
+
+        ids, first = np.unique(
+            np.concatenate([np.asarray(t["id"], np.int64) for t in parts]),
+            return_index=True,
+        )
+        tops = {
+            key: np.concatenate([np.asarray(t[key], np.int64) for t in parts])[
+                first
+            ]
+            for key in ("row", "col")
+        }
+        tops["id"] = ids
+        return core, tops, int(np.count_nonzero(cut))
+
+    def _rim_path(self, block) -> str:
+        return os.path.join(self.tmp_dir, "rim_{}_{}.npz".format(*block[::2]))
+
+    def _save_rim(self, block, core):
+        """Stores the codes of the cells within halo + 1 of the block edge."""
+        r0, r1, c0, c1 = block
+        n_cols = self.shape[1]
+        width = self.halo + 1
+        rim = np.zeros(core.shape, dtype=bool)
+        rim[:width, :] = rim[-width:, :] = True
+        rim[:, :width] = rim[:, -width:] = True
+        rim &= core != NO_CROWN
+        rows, cols = np.nonzero(rim)
+        index = (rows + r0) * n_cols + (cols + c0)
+        # index is sorted (row-major), searchsorted in _lookup
+        np.savez(self._rim_path(block), index=index, code=core[rim])
+
+    def _owner(self, g: int) -> tuple:
+        """Returns the block that contains the global cell g."""
+        n_rows, n_cols = self.shape
+        row, col = divmod(int(g), n_cols)
+        r0 = row // self.block_size * self.block_size
+        c0 = col // self.block_size * self.block_size
+        return (
+            r0,
+            min(r0 + self.block_size, n_rows),
+            c0,
+            min(c0 + self.block_size, n_cols),
+        )
+
+    def _lookup(self, g: int) -> int:
+        """Returns the code of the global cell g from the rim of its block."""
+        block = self._owner(g)
+        if block not in self._rims:
+            path = self._rim_path(block)
+            if not os.path.exists(path):
+                self._rims[block] = None  # skipped block
+            else:
+                with np.load(path) as rim:
+                    self._rims[block] = (rim["index"], rim["code"])
+            # keep the rims of a few blocks, the paths are local
+            if len(self._rims) > 64:
+                self._rims.pop(next(iter(self._rims)))
+        rim = self._rims[block]
+        if rim is None:
+            return NO_CROWN
+        index, code = rim
+        i = np.searchsorted(index, g)
+        if i == index.size or index[i] != g:
+            return NO_CROWN
+        return int(code[i])
+
+    def _resolve(self, code: int, resolved: dict) -> int:
+        """Follows an open path through the neighbouring blocks."""
+        path = []
+        for _ in range(MAX_HOPS):
+            if code >= 0 or code == NO_CROWN:
+                break
+            if code in resolved:
+                code = resolved[code]
+                break
+            path.append(code)
+            code = self._lookup(-code - 1)
+        else:
+            # a flat larger than the halo, the open cell is the sink
+            code = -path[-1] - 1
+        for open_code in path:
+            resolved[open_code] = code
+        return code
+
+    def run(self, read_window, write_labels, skip_block=None) -> dict:
+        """
+        Segments the CHM and writes the crown labels block by block.
+
+        Args:
+            read_window (callable): read_window(row0, row1, col0, col1)
+                returns the CHM cells of a window (row 0 is north)
+            write_labels (callable): write_labels(labels, row0, col0) is
+                called with the int32 crown labels (0 = no crown) of each
+                block that is not skipped
+            skip_block (callable, optional): skip_block(row0, row1, col0,
+                col1) returns True for blocks without vegetation
+
+        Returns:
+            dict: tree tops, arrays "label", "row" and "col"
+        """
+        own_tmp = self.tmp_dir is None
+        if own_tmp:
+            self.tmp_dir = tempfile.mkdtemp(prefix="block_watershed_")
+        try:
+            blocks = [
+                b
+                for b in self.blocks()
+                if skip_block is None or not skip_block(*b)
+            ]
+            logger.info(
+                "\t\tWatershed of {} x {} cells in {} blocks ({} without vegetation skipped)".format(
+                    *self.shape, len(blocks), len(self.blocks()) - len(blocks)
+                )
+            )
+
+            # first pass: rims and tops of the blocks
+            top_parts = []
+            for block in blocks:
+                core, tops, _ = self._segment_block(read_window, block)
+                self._save_rim(block, core)
+                top_parts.append(tops)
+            ids = np.concatenate(
+                [np.asarray(t["id"], dtype=np.int64) for t in top_parts]
+                + [np.empty(0, np.int64)]
+            )
+            order = np.argsort(ids)
+            sink_ids = ids[order]
+            tops = {
+                "label": np.arange(1, sink_ids.size + 1, dtype=np.int32),
+                "row": np.concatenate(
+                    [np.asarray(t["row"], dtype=np.int64) for t in top_parts]
+                    + [np.empty(0, np.int64)]
+                )[order],
+                "col": np.concatenate(
+                    [np.asarray(t["col"], dtype=np.int64) for t in top_parts]
+                    + [np.empty(0, np.int64)]
+                )[order],
+            }
+            logger.info("\t\t{} tree tops".format(sink_ids.size))
+
+            # second pass: resolve the open paths, write the labels
+            resolved = {}
+            n_cut = n_unresolved = 0
+            for block in blocks:
+                core, _, block_cut = self._segment_block(read_window, block)
+                n_cut += block_cut
+                has_data = core != NO_CROWN
+                open_codes = np.unique(core[(core < 0) & (core != NO_CROWN)])
+                if open_codes.size:
+                    targets = np.array(
+                        [self._resolve(int(c), resolved) for c in open_codes],
+                        dtype=np.int64,
+                    )
+                    is_open = (core < 0) & (core != NO_CROWN)
+                    core[is_open] = targets[
+                        np.searchsorted(open_codes, core[is_open])
+                    ]
+                labels = np.zeros(core.shape, dtype=np.int32)
+                has_sink = core >= 0
+                position = np.searchsorted(sink_ids, core[has_sink])
+                position = np.minimum(position, max(sink_ids.size - 1, 0))
+                known = (
+                    sink_ids[position] == core[has_sink]
+                    if sink_ids.size
+                    else np.zeros(position.shape, bool)
+                )
+                values = np.zeros(position.shape, dtype=np.int32)
+                values[known] = position[known] + 1
+                labels[has_sink] = values
+                n_unresolved += np.count_nonzero(has_data & (labels == 0))
+                write_labels(labels, block[0], block[2])
+            if n_unresolved:
+                logger.warning(
+                    "\t\t{} cells without a crown ({} in flats larger than the window of their block)".format(
+                        n_unresolved, n_cut
+                    )
+                )
+        finally:
+            self._rims = {}
+            if own_tmp:
+                shutil.rmtree(self.tmp_dir, ignore_errors=True)
+                self.tmp_dir = None
+        return tops
+
+
+def assign_units(tops: dict, read_window, shape: tuple, block_size: int = 1024):
+    """
+    Looks up the unit (neighbourhood) of each tree top in a unit grid.
+
+    Only the square blocks of the grid that contain tops are read, a block
+    of block_size x block_size cells at a time.
+
+    Args:
+        tops (dict): tree tops, arrays "row" and "col" (see BlockWatershed)
+        read_window (callable): read_window(row0, row1, col0, col1) returns
+            the unit codes of a window of the grid (same grid as the CHM)
+        shape (tuple): (rows, columns) of the grid
+        block_size (int): rows and columns of a block that is read
+
+    Returns:
+        np.ndarray: unit code of each top
+    """
+    rows = np.asarray(tops["row"], dtype=np.int64)
+    cols = np.asarray(tops["col"], dtype=np.int64)
+    units = np.zeros(rows.size, dtype=np.int32)
+    if rows.size == 0:
+        return units
+
+    # tops grouped by their block
+    n_block_cols = -(-shape[1] // block_size)
+    block_ids = (rows // block_size) * n_block_cols + cols // block_size
+    order = np.argsort(block_ids, kind="stable")
+    starts = np.flatnonzero(np.diff(block_ids[order], prepend=-1))
+    for i, start in enumerate(starts):
+        stop = starts[i + 1] if i + 1 < len(starts) else order.size
+        in_block = order[start:stop]
+        block_row, block_col = divmod(int(block_ids[in_block[0]]), n_block_cols)
+        r0, c0 = block_row * block_size, block_col * block_size
+        window = read_window(
+            r0,
+            min(r0 + block_size, shape[0]),
+            c0,
+            min(c0 + block_size, shape[1]),
+        )
+        if i == 0:
+            units = units.astype(window.dtype)
+        units[in_block] = window[rows[in_block] - r0, cols[in_block] - c0]
+    return units
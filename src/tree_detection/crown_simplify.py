@@ -0,0 +1,311 @@
+"""Topology-preserving simplification of the tree crown polygons.
+
+The crowns are vectorized from the watershed raster with NO_SIMPLIFY
+(tree.identify_treeCrowns): the boundaries are staircases with a vertex at
+every corner of a 0.25 m cell. Simplifying each crown on its own (e.g.
+SimplifyPolygon) moves the two sides of a shared boundary differently and
+creates gaps and overlaps between neighbouring crowns.
+
+SharedEdgeSimplifier simplifies the shared edges instead:
+
+- the rings are snapped to the cell grid and split into unit cell edges, a
+  boundary between two crowns consists of the same unit edges in both rings
+- grid points where more than two unit edges meet are nodes (junctions of
+  three crowns, or two crowns and the outside)
+- the boundary between two nodes is a chain, each chain is simplified once
+  (Douglas-Peucker, the nodes are kept) and used by both crowns, so the
+  crowns stay gap-free and do not overlap
+- with a vertex budget, the tolerance of the chains of crowns that have more
+  vertices than the budget is doubled until they fit (at most MAX_ROUNDS)
+
+Rings that are not on the grid (already simplified) are kept as they are.
+A tolerance below one cell keeps neighbouring chains apart, the chains of a
+staircase are at least one cell apart.
+
+Usage:
+    simplifier = SharedEdgeSimplifier(cell_size=0.25, origin=(x_min, y_min))
+    crowns, stats = simplifier.simplify(crowns, tolerance=0.3)
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# rounds of the vertex budget, the tolerance doubles each round
+MAX_ROUNDS = 6
+
+# key of a grid point: x * KEY_FACTOR + y
+KEY_FACTOR = np.int64(2**31)
+
+
+def douglas_peucker(
+    points: np.ndarray, tolerance: float, min_interior: int = 0
+) -> np.ndarray:
+    """
+    Returns the indices of the points kept by Douglas-Peucker.
+
+    Args:
+        points (np.ndarray): (n, 2) coordinates of an open line
+        tolerance (float): maximum distance of a removed point to the line
+        min_interior (int): minimum number of interior points that are
+            kept (the farthest points), a ring needs at least 3 vertices
+
+    Returns:
+        np.ndarray: sorted indices of the kept points, first and last
+            included
+    """
+    n = len(points)
+    if n <= 2:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    # farthest remaining points, used for min_interior
+    candidates = []
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        length = np.hypot(*segment)
+        inner = points[first + 1 : last]
+        if length == 0:
+            distance = np.hypot(*(inner - start).T)
+        else:
+            distance = (
+                np.abs(
+                    segment[0] * (inner[:, 1] - start[1])
+                    - segment[1] * (inner[:, 0] - start[0])
+                )
+                / length
+            )
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            keep[first + 1 + i] = True
+            stack.append((first, first + 1 + i))
+            stack.append((first + 1 + i, last))
+        else:
+            candidates.append((distance[i], first + 1 + i))
+
+    n_interior = int(keep[1:-1].sum())
+    if n_interior < min_interior:
+        for _, i in sorted(candidates, reverse=True)[
+            : min_interior - n_interior
+        ]:
+            keep[i] = True
+    return np.flatnonzero(keep)
+
+
+def _densify(grid: np.ndarray) -> np.ndarray:
+    """Returns the unit steps of a closed ring of axis-parallel grid
+    segments (without the closing point)."""
+    start = grid
+    delta = np.roll(grid, -1, axis=0) - grid
+    steps = np.abs(delta).max(axis=1)
+    direction = np.sign(delta)
+    segment = np.repeat(np.arange(len(grid)), steps)
+    offset = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+    return start[segment] + direction[segment] * offset[:, None]
+
+
+class SharedEdgeSimplifier:
+    """
+    Simplifies polygons of a raster partition along their shared edges.
+
+    Attributes:
+    -----------
+    cell_size : float
+        cell size of the raster the polygons are vectorized from
+    origin : tuple
+        (x, y) of a cell corner of the raster
+
+    Methods:
+    --------
+    - simplify(self, polygons, tolerance, max_vertices)
+    """
+
+    def __init__(self, cell_size: float, origin: tuple):
+        self.cell_size = float(cell_size)
+        self.origin = np.asarray(origin, dtype=np.float64)
+
+    def _to_grid(self, ring: np.ndarray):
+        """Returns the unit steps of a ring as grid points, None if the
+        ring is not on the grid."""
+        ring = np.asarray(ring, dtype=np.float64)
+        if len(ring) > 1 and np.allclose(ring[0], ring[-1]):
+            ring = ring[:-1]
+        if len(ring) < 3:
+            return None
+        scaled = (ring - self.origin) / self.cell_size
+        grid = np.round(scaled).astype(np.int64)
+        if not np.allclose(scaled, grid, atol=1e-3):
+            return None
+        delta = np.roll(grid, -1, axis=0) - grid
+        if np.any((delta[:, 0] != 0) & (delta[:, 1] != 0)):
+            return None
+        # remove repeated points
+        grid = grid[np.any(delta != 0, axis=1)]
+        if len(grid) < 3:
+            return None
+        return _densify(grid)
+
+    def simplify(
+        self, polygons: list, tolerance: float, max_vertices: int = None
+    ) -> tuple:
+        """
+        Simplifies the polygons along their shared edges.
+
+        Args:
+            polygons (list): polygons, each a list of rings ((n, 2) arrays
+                of x, y, orientation as in the input)
+            tolerance (float): Douglas-Peucker tolerance in map units
+            max_vertices (int, optional): vertex budget per polygon
+
+        Returns:
+            tuple: (polygons, stats), the simplified polygons in the same
+                structure and a dict with the vertex counts before and
+                after and the number of polygons over the budget
+        """
+        # unit steps of all rings
+        rings = []  # (polygon, steps or None, original)
+        for p, polygon in enumerate(polygons):
+            for ring in polygon:
+                rings.append((p, self._to_grid(ring), np.asarray(ring)))
+        vertices_before = sum(
+            len(ring) for polygon in polygons for ring in polygon
+        )
+
+        # nodes: grid points with more than two distinct unit edges
+        keys = [
+            steps[:, 0] * KEY_FACTOR + steps[:, 1]
+            for _, steps, _ in rings
+            if steps is not None
+        ]
+        if keys:
+            a = np.concatenate(keys)
+            b = np.concatenate([np.roll(k, -1) for k in keys])
+            edges = np.unique(
+                np.column_stack([np.minimum(a, b), np.maximum(a, b)]), axis=0
+            )
+            points, degree = np.unique(edges, return_counts=True)
+            nodes = points[degree != 2]
+        else:
+            nodes = np.empty(0, dtype=np.int64)
+
+        # chains: the unit steps between two nodes, keyed by their first
+        # node and first step in canonical direction
+        chains = {}  # key -> grid points of the chain
+        ring_chains = []  # per ring: list of (key, reversed) or None
+        for p, steps, _ in rings:
+            if steps is None:
+                ring_chains.append(None)
+                continue
+            key = steps[:, 0] * KEY_FACTOR + steps[:, 1]
+            is_node = np.isin(key, nodes)
+            if not is_node.any():
+                # isolated ring: the smallest point is the node
+                is_node[np.argmin(key)] = True
+            start = int(np.flatnonzero(is_node)[0])
+            steps = np.roll(steps, -start, axis=0)
+            key = np.roll(key, -start)
+            node_at = np.flatnonzero(np.roll(is_node, -start))
+            bounds = np.r_[node_at, len(steps)]
+            closed = np.vstack([steps, steps[:1]])
+            closed_key = np.r_[key, key[:1]]
+            parts = []
+            for i0, i1 in zip(bounds[:-1], bounds[1:]):
+                forward = (int(closed_key[i0]), int(closed_key[i0 + 1]))
+                backward = (int(closed_key[i1]), int(closed_key[i1 - 1]))
+                reverse = backward < forward
+                chain_key = backward if reverse else forward
+                if chain_key not in chains:
+                    chain = closed[i0 : i1 + 1]
+                    chains[chain_key] = chain[::-1] if reverse else chain
+                parts.append((chain_key, reverse))
+            ring_chains.append(parts)
+
+        # a ring of one chain keeps 2 interior vertices, of two chains 1
+        min_interior = {}
+        for parts in ring_chains:
+            if parts is None or len(parts) > 2:
+                continue
+            for chain_key, _ in parts:
+                min_interior[chain_key] = max(
+                    min_interior.get(chain_key, 0), 3 - len(parts)
+                )
+
+        # simplify each chain once, in grid units
+        grid_tolerance = tolerance / self.cell_size
+        chain_tolerance = dict.fromkeys(chains, grid_tolerance)
+
+        def simplify_chain(chain_key):
+            chain = chains[chain_key]
+            kept = douglas_peucker(
+                chain.astype(np.float64),
+                chain_tolerance[chain_key],
+                min_interior.get(chain_key, 0),
+            )
+            return chain[kept]
+
+        simplified = {k: simplify_chain(k) for k in chains}
+
+        # vertex budget: double the tolerance of the chains of the polygons
+        # over the budget
+        polygon_rings = {}
+        for (p, _, _), parts in zip(rings, ring_chains):
+            polygon_rings.setdefault(p, []).append(parts)
+
+        def n_vertices(p):
+            return sum(
+                len(ring)
+                if parts is None
+                else sum(len(simplified[k]) - 1 for k, _ in parts) + 1
+                for parts, ring in zip(
+                    polygon_rings[p], [r for r in polygons[p]]
+                )
+            )
+
+        over_budget = []
+        if max_vertices:
+            for _ in range(MAX_ROUNDS):
+                over_budget = [
+                    p for p in polygon_rings if n_vertices(p) > max_vertices
+                ]
+                if not over_budget:
+                    break
+                changed = set()
+                for p in over_budget:
+                    for parts in polygon_rings[p]:
+                        for chain_key, _ in parts or []:
+                            changed.add(chain_key)
+                for chain_key in changed:
+                    chain_tolerance[chain_key] *= 2
+                    simplified[chain_key] = simplify_chain(chain_key)
+
+        # rebuild the rings from the simplified chains
+        output = [[] for _ in polygons]
+        for (p, _, original), parts in zip(rings, ring_chains):
+            if parts is None:
+                output[p].append(original)
+                continue
+            coords = []
+            for chain_key, reverse in parts:
+                chain = simplified[chain_key]
+                chain = chain[::-1] if reverse else chain
+                coords.append(chain[:-1])
+            grid = np.vstack(coords + [coords[0][:1]])
+            output[p].append(grid * self.cell_size + self.origin)
+
+        vertices_after = sum(
+            len(ring) for polygon in output for ring in polygon
+        )
+        stats = {
+            "polygons": len(polygons),
+            "chains": len(chains),
+            "vertices_before": vertices_before,
+            "vertices_after": vertices_after,
+            "over_budget": len(over_budget),
+        }
+        return output, stats
@@ -0,0 +1,236 @@
+"""Classifies detected tree crowns as false positives.
+
+The crown attributes are read once into numpy arrays and the rules are
+evaluated as boolean arrays:
+
+- lamp posts: small, almost perfect circles (crown_area 6.5 - 9 m2,
+  ratio_CA_CHA > 0.85, ratio_CA_ECA > 0.7) that intersect a road. The road
+  test is only run for the crowns that match the attribute rule, as one
+  location query that uses the spatial index of the road layer.
+- geometry outliers: outlier_CA, outlier_ratio_CA_CHA or
+  outlier_ratio_CA_ECA is not 0.
+
+NULL values never match a rule (as in the SQL where clauses).
+
+The rules do not depend on arcpy, arcpy is imported by the functions that
+read and write the feature classes (the backend harness in
+src/test/benchmark_backends.py evaluates the rules without arcpy).
+"""
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# lamp post rule
+LAMPPOST_MIN_AREA = 6.5
+LAMPPOST_MAX_AREA = 9
+LAMPPOST_MIN_RATIO_CHA = 0.85
+LAMPPOST_MIN_RATIO_ECA = 0.7
+
+CROWN_FIELDS = [
+    "OID@",
+    "crown_id",
+    "crown_area",
+    "ratio_CA_CHA",
+    "ratio_CA_ECA",
+    "outlier_CA",
+    "outlier_ratio_CA_CHA",
+    "outlier_ratio_CA_ECA",
+]
+
+
+# ------------------------------------------------------ #
+# Rules
+# ------------------------------------------------------ #
+
+
+def lamppost_rule(crown_area, ratio_ca_cha, ratio_ca_eca) -> np.ndarray:
+    """Returns True for crowns with the size and shape of a lamp post."""
+    with np.errstate(invalid="ignore"):
+        return (
+            (crown_area > LAMPPOST_MIN_AREA)
+            & (crown_area < LAMPPOST_MAX_AREA)
+            & (ratio_ca_cha > LAMPPOST_MIN_RATIO_CHA)
+            & (ratio_ca_eca > LAMPPOST_MIN_RATIO_ECA)
+        )
+
+
+def outlier_rule(outlier_ca, outlier_cha, outlier_eca) -> np.ndarray:
+    """Returns True for crowns that are an outlier in any geometry ratio."""
+    return (outlier_ca != 0) | (outlier_cha != 0) | (outlier_eca != 0)
+
+
+# ------------------------------------------------------ #
+# arcpy functions
+# ------------------------------------------------------ #
+
+
+def read_crownColumns(v_crown: str) -> dict:
+    """
+    Reads the attribute columns of the crowns used by the rules.
+
+    Args:
+        v_crown (str): path to the crown feature class
+
+    Returns:
+        dict: field name -> numpy array, NULL is NaN for the ratios and 0 for
+            the outlier classes
+    """
+    import arcpy
+
+    rows = list(arcpy.da.SearchCursor(v_crown, CROWN_FIELDS))
+    columns = {
+        field: [row[i] for row in rows] for i, field in enumerate(CROWN_FIELDS)
+    }
+    result = {
+        "OID@": np.array(columns["OID@"], dtype=np.int64),
+        "crown_id": np.array(
+            ["" if v is None else str(v) for v in columns["crown_id"]],
+            dtype=object,
+        ),
+    }
+    for field in ["crown_area", "ratio_CA_CHA", "ratio_CA_ECA"]:
+        result[field] = np.array(
+            [np.nan if v is None else v for v in columns[field]],
+            dtype=np.float64,
+        )
+    for field in ["outlier_CA", "outlier_ratio_CA_CHA", "outlier_ratio_CA_ECA"]:
+        result[field] = np.array(
+            [0 if v is None else v for v in columns[field]], dtype=np.int16
+        )
+    return result
+
+
+def _where_in(field: str, values) -> str:
+    """Returns a where clause that selects the values of a field."""
+    values = list(values)
+    if not values:
+        return "1 = 0"
+    if isinstance(values[0], str):
+        return "{} IN ({})".format(
+            field,
+            ", ".join("'{}'".format(v.replace("'", "''")) for v in values),
+        )
+    return "{} IN ({})".format(field, ", ".join(str(int(v)) for v in values))
+
+
+def intersecting_oids(v_crown: str, oids, lyr_roads) -> set:
+    """
+    Returns the object ids of the crowns in oids that intersect the roads.
+
+    Args:
+        v_crown (str): path to the crown feature class
+        oids (list): object ids of the candidate crowns
+        lyr_roads: road layer
+
+    Returns:
+        set: object ids of the candidates that intersect a road
+    """
+    import arcpy
+
+    if len(oids) == 0:
+        return set()
+    oid_field = arcpy.Describe(v_crown).OIDFieldName
+    lyr_candidates = arcpy.MakeFeatureLayer_management(
+        v_crown, "lyr_fp_candidates", _where_in(oid_field, oids)
+    )
+    arcpy.SelectLayerByLocation_management(
+        lyr_candidates, "INTERSECT", lyr_roads, "", "NEW_SELECTION"
+    )
+    selected = {row[0] for row in arcpy.da.SearchCursor(lyr_candidates, "OID@")}
+    arcpy.Delete_management(lyr_candidates)
+    return selected
+
+
+def classify_crowns(v_crown: str, lyr_roads) -> dict:
+    """
+    Classifies the crowns of a feature class as false positives.
+
+    Args:
+        v_crown (str): path to the crown feature class with the geometry
+            attributes
+        lyr_roads: road layer
+
+    Returns:
+        dict: crown columns and the boolean arrays "lamppost", "outlier" and
+            "false_positive"
+    """
+    columns = read_crownColumns(v_crown)
+    lamppost = lamppost_rule(
+        columns["crown_area"], columns["ratio_CA_CHA"], columns["ratio_CA_ECA"]
+    )
+    # road test only for the lamp post candidates
+    on_road = intersecting_oids(v_crown, columns["OID@"][lamppost], lyr_roads)
+    lamppost &= np.isin(columns["OID@"], list(on_road))
+
+    outlier = outlier_rule(
+        columns["outlier_CA"],
+        columns["outlier_ratio_CA_CHA"],
+        columns["outlier_ratio_CA_ECA"],
+    )
+    columns["lamppost"] = lamppost
+    columns["outlier"] = outlier
+    columns["false_positive"] = lamppost | outlier
+    logger.info(
+        "\t\t{} of {} crowns are false positives ({} lamp posts, {} outliers).".format(
+            int(columns["false_positive"].sum()),
+            len(columns["OID@"]),
+            int(lamppost.sum()),
+            int(outlier.sum()),
+        )
+    )
+    return columns
+
+
+def _export(in_fc: str, out_fc: str, where_clause: str):
+    """Copies the features that match the where clause in one pass."""
+    import arcpy
+
+    arcpy.conversion.FeatureClassToFeatureClass(
+        in_features=in_fc,
+        out_path=os.path.dirname(out_fc),
+        out_name=os.path.basename(out_fc),
+        where_clause=where_clause,
+    )
+
+
+def write_partitions(
+    v_crown_in: str,
+    v_top_in: str,
+    columns: dict,
+    v_false_positives: str,
+    v_crown: str,
+    v_top: str,
+):
+    """
+    Writes the false positive crowns, the kept crowns and the tops of the
+    kept crowns (selected by crown_id).
+
+    Args:
+        v_crown_in (str): path to the classified crowns
+        v_top_in (str): path to the tops, with the attribute crown_id
+        columns (dict): output of classify_crowns()
+        v_false_positives (str): output path of the false positive crowns
+        v_crown (str): output path of the kept crowns
+        v_top (str): output path of the kept tops
+    """
+    import arcpy
+
+    oid_field = arcpy.Describe(v_crown_in).OIDFieldName
+    fp = columns["false_positive"]
+    fp_oids = columns["OID@"][fp]
+    fp_crown_ids = [c for c in columns["crown_id"][fp] if c]
+
+    _export(v_crown_in, v_false_positives, _where_in(oid_field, fp_oids))
+    if len(fp_oids):
+        _export(v_crown_in, v_crown, "NOT " + _where_in(oid_field, fp_oids))
+    else:
+        _export(v_crown_in, v_crown, "")
+
+    # tops without crown are removed, as the INTERSECT topology check did
+    where_top = "crown_id IS NOT NULL AND crown_id <> ''"
+    if fp_crown_ids:
+        where_top += " AND NOT " + _where_in("crown_id", fp_crown_ids)
+    _export(v_top_in, v_top, where_top)
@@ -0,0 +1,198 @@
+"""Integer encoding of the heights of the canopy height model (CHM).
+
+The height models are stored as integer rasters with the heights in
+centimetres (``*_int_100x``, see arcpy_utils.convert_toIntRaster). Tree
+heights are below 327.67 m, so the CHM fits in 16 bit signed integers: half
+the memory and disk of the 32 bit mosaic and of a float32 array. The DTM and
+DSM hold altitudes (up to ~2500 m in centimetres) and stay 32 bit.
+
+A HeightEncoding describes the stored values explicitly:
+
+    height (m) = value * scale + offset,   value == nodata -> NODATA
+
+and is saved as a .json file next to the raster, so readers do not have to
+parse the "100x" of the raster name. The array steps work on the stored
+integers: thresholds in metres are converted to stored units with
+to_units(), instead of decoding the whole tile to float.
+
+Usage:
+    values = CHM_ENCODING.encode(chm)                 # float m -> int16 cm
+    trees = values >= CHM_ENCODING.to_units(2.5)      # int16 comparison
+    CHM_ENCODING.save(encoding_path(r_chm))
+"""
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# arcpy pixel type of the integer dtypes
+PIXEL_TYPES = {"int16": "16_BIT_SIGNED", "int32": "32_BIT_SIGNED"}
+
+# rows that are encoded at once, bounds the float temporaries
+CHUNK_ROWS = 1024
+
+
+def encoding_path(raster: str) -> str:
+    """
+    Returns the path of the encoding file of a raster in a file gdb.
+
+    Example: <general>/baerum_hoydedata.gdb/chm_025m_int_100x
+        -> <general>/chm_025m_int_100x_encoding.json
+    """
+    gdb_path, raster_name = os.path.split(raster)
+    return os.path.join(
+        os.path.dirname(gdb_path), raster_name + "_encoding.json"
+    )
+
+
+class HeightEncoding:
+    """
+    Scale, offset and NODATA value of an integer height raster.
+
+    Attributes:
+    -----------
+    scale : float
+        height in map units of one stored unit (0.01: centimetres)
+    offset : float
+        height of the stored value 0
+    dtype : str
+        integer dtype of the stored values, "int16" or "int32"
+    nodata : int
+        stored value of NODATA cells, the smallest value of the dtype
+    pixel_type : str
+        arcpy pixel type of the dtype
+
+    Methods:
+    --------
+    - encode(self, heights)
+    - decode(self, values, dtype)
+    - to_units(self, height)
+    - load(cls, path)
+    - save(self, path)
+    """
+
+    def __init__(
+        self,
+        scale: float = 0.01,
+        offset: float = 0.0,
+        dtype: str = "int16",
+        nodata: int = None,
+    ):
+        if dtype not in PIXEL_TYPES:
+            raise ValueError(f"Unsupported dtype {dtype}, use {PIXEL_TYPES}")
+        self.scale = float(scale)
+        self.offset = float(offset)
+        self.dtype = dtype
+        info = np.iinfo(dtype)
+        self.nodata = int(info.min if nodata is None else nodata)
+        # NODATA is kept out of the range of the valid values
+        self._min = int(info.min + 1 if self.nodata == info.min else info.min)
+        self._max = int(info.max)
+
+    @property
+    def pixel_type(self) -> str:
+        return PIXEL_TYPES[self.dtype]
+
+    @property
+    def multiplier(self) -> str:
+        """Multiplier of the raster name, e.g. "100x"."""
+        return "{}x".format(int(round(1 / self.scale)))
+
+    def encode(self, heights: np.ndarray) -> np.ndarray:
+        """
+        Encodes float heights (NaN = NODATA) to stored integer values.
+
+        Heights outside the range of the dtype are clipped. The rows are
+        encoded in chunks, the float temporaries have the size of a chunk.
+
+        Args:
+            heights (np.ndarray): 2D float array of heights in map units
+
+        Returns:
+            np.ndarray: array of the stored values (dtype of the encoding)
+        """
+        heights = np.asarray(heights)
+        values = np.empty(heights.shape, dtype=self.dtype)
+        for r0 in range(0, heights.shape[0], CHUNK_ROWS):
+            chunk = heights[r0 : r0 + CHUNK_ROWS]
+            scaled = np.round((chunk - self.offset) / self.scale)
+            missing = np.isnan(scaled)
+            np.clip(scaled, self._min, self._max, out=scaled)
+            scaled[missing] = self.nodata
+            values[r0 : r0 + CHUNK_ROWS] = scaled
+        return values
+
+    def decode(self, values: np.ndarray, dtype=np.float32) -> np.ndarray:
+        """
+        Decodes stored values to heights, NODATA to NaN.
+
+        Args:
+            values (np.ndarray): stored integer values
+            dtype: float dtype of the heights
+
+        Returns:
+            np.ndarray: heights in map units
+        """
+        dtype = np.dtype(dtype).type
+        heights = values.astype(dtype) * dtype(self.scale) + dtype(self.offset)
+        heights[values == self.nodata] = np.nan
+        return heights
+
+    def to_units(self, height: float) -> int:
+        """
+        Converts a height threshold to stored units.
+
+        values >= to_units(h) selects the same cells as heights >= h, without
+        decoding the values.
+
+        Args:
+            height (float): height in map units
+
+        Returns:
+            int: smallest stored value with a height >= height
+        """
+        units = math.ceil(round((height - self.offset) / self.scale, 6))
+        return int(min(max(units, self._min), self._max))
+
+    def to_dict(self) -> dict:
+        return {
+            "scale": self.scale,
+            "offset": self.offset,
+            "dtype": self.dtype,
+            "nodata": self.nodata,
+        }
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads an encoding saved with save()."""
+        with open(path, "r") as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str):
+        """Saves the encoding as .json (written to a temp file first)."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, HeightEncoding)
+            and self.to_dict() == other.to_dict()
+        )
+
+    def __repr__(self):
+        return "HeightEncoding(scale={}, offset={}, dtype={!r})".format(
+            self.scale, self.offset, self.dtype
+        )
+
+
+# canopy height model: int16 centimetres
+CHM_ENCODING = HeightEncoding(scale=0.01, offset=0.0, dtype="int16")
+
+# terrain and surface model: int32 centimetres
+ELEVATION_ENCODING = HeightEncoding(scale=0.01, offset=0.0, dtype="int32")
@@ -0,0 +1,307 @@
+"""Single pass rasterizer of LAS points into several grids at once.
+
+create_DTM, create_DSM and create_RGB (tree.py) each make a LAS dataset
+layer and read all points of a tile with LasDatasetToRaster: three passes
+over the same points. The LasRasterizer reads each point once (see
+las_utils.read_points) and updates the accumulators of all products at the
+same time:
+
+- DTM: mean elevation of the ground points (BINNING AVERAGE)
+- DSM: maximum elevation of the surface points (BINNING MAXIMUM)
+- RGB: mean colour of all points
+
+Each product has its own point filter (class codes, return values) and cell
+size, e.g. the RGB image at 1 m and the DTM/DSM at 0.25 m. The grids are
+aligned to multiples of their cell size, so the grids of neighbouring tiles
+line up in the mosaic. Empty cells are NaN (NoData in the rasters),
+void_fill.py fills the DTM/DSM like the LINEAR void fill of
+LasDatasetToRaster. 16 bit colours are scaled to 8 bit, the colour depth is
+decided once per run (las_utils.color_depth), not per tile.
+
+The module does not depend on arcpy, tree.create_elevationModels() writes
+the grids as rasters.
+"""
+import logging
+import math
+
+import numpy as np
+
+from src.utils.las_utils import read_header, read_points
+
+logger = logging.getLogger(__name__)
+
+# statistics of the elevation grids
+STATISTICS = ("mean", "max", "min")
+
+
+class GridProduct:
+    """
+    Grid that is rasterized from the LAS points.
+
+    Attributes:
+    -----------
+    name : str
+        product name, e.g. "dtm"
+    cell_size : float
+        cell size in map units
+    value : str
+        "z" (elevation) or "rgb" (mean colour, three bands)
+    statistic : str
+        "mean", "max" or "min" of the elevations in a cell
+    class_codes : list
+        LAS classes that are used, None for all classes
+    return_values : list
+        return numbers (1, 2, ...) or "LAST", "SINGLE", "FIRST_OF_MANY",
+        "LAST_OF_MANY", None for all returns (as MakeLasDatasetLayer)
+    color_depth : int
+        8 or 16 bit colours of the "rgb" value, None to decide from the
+        maximum colour of the points read by the rasterizer
+    """
+
+    def __init__(
+        self,
+        name: str,
+        cell_size: float,
+        value: str = "z",
+        statistic: str = "mean",
+        class_codes: list = None,
+        return_values: list = None,
+        color_depth: int = None,
+    ):
+        if value not in ("z", "rgb"):
+            raise ValueError(f"Unknown value {value} of product {name}")
+        if statistic not in STATISTICS:
+            raise ValueError(f"Unknown statistic {statistic} of {name}")
+        if color_depth not in (None, 8, 16):
+            raise ValueError(f"Unknown colour depth {color_depth} of {name}")
+        self.name = name
+        self.cell_size = float(cell_size)
+        self.value = value
+        self.statistic = statistic
+        self.class_codes = (
+            None if class_codes is None else [int(c) for c in class_codes]
+        )
+        self.return_values = (
+            None if return_values is None else [str(r) for r in return_values]
+        )
+        self.color_depth = color_depth
+
+    def select(self, points: dict) -> np.ndarray:
+        """Returns the boolean mask of the points of the product."""
+        mask = ~points["withheld"]
+        if self.class_codes is not None:
+            mask &= np.isin(points["classification"], self.class_codes)
+        if self.return_values is not None:
+            return_number = points["return_number"]
+            n_returns = points["number_of_returns"]
+            returns = np.zeros_like(mask)
+            for value in self.return_values:
+                if value.isdigit():
+                    returns |= return_number == int(value)
+                elif value == "LAST":
+                    returns |= return_number == n_returns
+                elif value == "SINGLE":
+                    returns |= n_returns == 1
+                elif value == "FIRST_OF_MANY":
+                    returns |= (return_number == 1) & (n_returns > 1)
+                elif value == "LAST_OF_MANY":
+                    returns |= (return_number == n_returns) & (n_returns > 1)
+                else:
+                    raise ValueError(f"Unknown return value {value}")
+            mask &= returns
+        return mask
+
+    def __repr__(self):
+        return f"GridProduct({self.name!r}, {self.cell_size})"
+
+
+class LasRasterizer:
+    """
+    Accumulates the points of one or more LAS files into several grids.
+
+    Attributes:
+    -----------
+    products : list
+        GridProduct per output grid
+    extent : tuple
+        (x_min, y_min, x_max, y_max) of the points that are rasterized
+    grids : dict
+        product name -> dict with the grid origin, shape and accumulators
+    n_points : int
+        number of points read
+    max_rgb : int
+        maximum raw colour value of the points of the "rgb" products
+
+    Methods:
+    --------
+    - from_files(cls, las_paths, products)
+    - add_points(self, points)
+    - add_file(self, las_path)
+    - result(self, name)
+    """
+
+    def __init__(self, products: list, extent: tuple):
+        self.products = list(products)
+        self.extent = tuple(extent)
+        self.n_points = 0
+        self.max_rgb = 0
+        x_min, y_min, x_max, y_max = self.extent
+        self.grids = {}
+        for product in self.products:
+            cell = product.cell_size
+            # grid aligned to multiples of the cell size
+            gx_min = math.floor(x_min / cell) * cell
+            gy_max = math.ceil(y_max / cell) * cell
+            # points on the max x / min y edge fall in the last column/row
+            n_cols = int(math.floor((x_max - gx_min) / cell)) + 1
+            n_rows = int(math.floor((gy_max - y_min) / cell)) + 1
+            n_cells = n_rows * n_cols
+            grid = {
+                "x_min": gx_min,
+                "y_max": gy_max,
+                "shape": (n_rows, n_cols),
+                "count": np.zeros(n_cells, dtype=np.uint32),
+            }
+            if product.value == "rgb":
+                grid["sum"] = np.zeros((3, n_cells), dtype=np.float64)
+            elif product.statistic == "mean":
+                grid["sum"] = np.zeros(n_cells, dtype=np.float64)
+            else:
+                fill = -np.inf if product.statistic == "max" else np.inf
+                grid["value"] = np.full(n_cells, fill, dtype=np.float32)
+            self.grids[product.name] = grid
+
+    @classmethod
+    def from_files(cls, las_paths: list, products: list):
+        """
+        Creates a rasterizer for the extent of LAS files and reads them.
+
+        Args:
+            las_paths (list): paths to the .las files
+            products (list): GridProduct per output grid
+
+        Returns:
+            LasRasterizer: the rasterizer with the points of all files
+        """
+        headers = [read_header(p) for p in las_paths]
+        extent = (
+            min(h["min_x"] for h in headers),
+            min(h["min_y"] for h in headers),
+            max(h["max_x"] for h in headers),
+            max(h["max_y"] for h in headers),
+        )
+        rasterizer = cls(products, extent)
+        for las_path in las_paths:
+            rasterizer.add_file(las_path)
+        return rasterizer
+
+    def add_file(self, las_path: str):
+        """Reads the points of a LAS file (once) into all grids."""
+        for points in read_points(las_path):
+            self.add_points(points)
+
+    def _cell_index(self, grid: dict, cell_size: float, x, y) -> tuple:
+        """Returns the flat cell index of the points and the inside mask."""
+        n_rows, n_cols = grid["shape"]
+        cols = np.floor((x - grid["x_min"]) / cell_size).astype(np.int64)
+        rows = np.floor((grid["y_max"] - y) / cell_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+        return rows[inside] * n_cols + cols[inside], inside
+
+    def add_points(self, points: dict):
+        """
+        Adds a chunk of points to the accumulators of all products.
+
+        The points of a product are sorted by cell and the runs of equal
+        cells are reduced (count, sum, maximum), the temporary arrays have
+        the size of the chunk and not of the grid.
+
+        Args:
+            points (dict): arrays of a chunk, see las_utils.read_points()
+        """
+        self.n_points += len(points["x"])
+        for product in self.products:
+            grid = self.grids[product.name]
+            selected = product.select(points)
+            if not selected.any():
+                continue
+            cells, inside = self._cell_index(
+                grid,
+                product.cell_size,
+                points["x"][selected],
+                points["y"][selected],
+            )
+            if cells.size == 0:
+                continue
+            order = np.argsort(cells, kind="stable")
+            cells = cells[order]
+            starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+            ends = np.r_[starts[1:], cells.size]
+            cell_ids = cells[starts]
+            grid["count"][cell_ids] += (ends - starts).astype(np.uint32)
+
+            if product.value == "rgb":
+                if "red" not in points:
+                    raise ValueError("The LAS points have no RGB values")
+                for band, name in enumerate(("red", "green", "blue")):
+                    values = points[name][selected][inside][order]
+                    self.max_rgb = max(self.max_rgb, int(values.max()))
+                    grid["sum"][band, cell_ids] += np.add.reduceat(
+                        values.astype(np.float64), starts
+                    )
+                continue
+
+            z = points["z"][selected][inside][order]
+            if product.statistic == "mean":
+                grid["sum"][cell_ids] += np.add.reduceat(z, starts)
+            elif product.statistic == "max":
+                grid["value"][cell_ids] = np.fmax(
+                    grid["value"][cell_ids],
+                    np.maximum.reduceat(z, starts).astype(np.float32),
+                )
+            else:
+                grid["value"][cell_ids] = np.fmin(
+                    grid["value"][cell_ids],
+                    np.minimum.reduceat(z, starts).astype(np.float32),
+                )
+
+    def result(self, name: str) -> tuple:
+        """
+        Returns the grid of a product.
+
+        Args:
+            name (str): product name
+
+        Returns:
+            tuple: (array, x_min, y_min, cell_size), the array is a float32
+                (rows, cols) grid or a float32 (3, rows, cols) RGB image with
+                8 bit colours, with NaN in empty cells
+        """
+        product = next(p for p in self.products if p.name == name)
+        grid = self.grids[name]
+        n_rows, n_cols = grid["shape"]
+        count = grid["count"]
+        empty = count == 0
+        y_min = grid["y_max"] - n_rows * product.cell_size
+
+        if product.value == "rgb":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rgb = grid["sum"] / count
+            color_depth = product.color_depth or (
+                16 if self.max_rgb > 255 else 8
+            )
+            if color_depth == 16:
+                rgb /= 256.0
+            array = np.clip(np.round(rgb), 0, 255).astype(np.float32)
+            array[:, empty] = np.nan
+            array = array.reshape(3, n_rows, n_cols)
+        elif product.statistic == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                array = (grid["sum"] / count).astype(np.float32)
+            array[empty] = np.nan
+            array = array.reshape(n_rows, n_cols)
+        else:
+            array = grid["value"].copy()
+            array[empty] = np.nan
+            array = array.reshape(n_rows, n_cols)
+        return array, grid["x_min"], y_min, product.cell_size
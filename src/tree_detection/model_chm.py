@@ -17,24 +17,21 @@ import arcpy
 import tree
 from arcpy import env
 from arcpy.ia import *
+from block_index import BlockIndex, block_index_path
+from height_encoding import CHM_ENCODING, ELEVATION_ENCODING, encoding_path
+from las_rasterizer import GridProduct
 
 # local sub-package utils
-from src import (
-    COORD_SYSTEM,
-    DATA_PATH,
-    FOCAL_MAX_RADIUS,
-    INTERIM_PATH,
-    MIN_HEIGHT,
-    MUNICIPALITY,
-    POINT_DENSITY,
-    RGB_AVAILABLE,
-    SPATIAL_REFERENCE,
-    VEG_CLASSES_AVAILABLE,
-)
+from src import MUNICIPALITY, RunContext
 from src import arcpy_utils as au
-from src import logger
+from src import get_bool_option, get_run_report, get_workers, logger
+from src.utils.las_utils import color_depth
 
 logger = logging.getLogger(__name__)
+
+# cell size of the RGB image (m), the TGI vegetation mask is made at 1 m
+RGB_CELL_SIZE = 1
+
 # ------------------------------------------------------ #
 # Functions
 # ------------------------------------------------------ #
@@ -47,353 +44,527 @@ def end_time1(start_time1):
     logger.info("\tTIME:\t {:.2f} sec".format(execution_time1))
 
 
-# define the spatial resolution of the DSM/DTM/CHM grid based on lidar point density
-# TODO move to config
-def get_spatial_resolution():
-    if POINT_DENSITY >= 4:
-        spatial_resolution = 0.25
-    elif POINT_DENSITY < 4 and POINT_DENSITY >= 2:
-        spatial_resolution = 0.5
-    else:
-        spatial_resolution = 1
-    return spatial_resolution
+def list_tiles(ctx) -> list:
+    """Returns the tile codes, the subfolders of ctx.lidar_path with the LAS
+    files of a tile (5000 maplist)."""
+    return sorted(
+        f.name
+        for f in os.scandir(ctx.lidar_path)
+        if f.is_dir() and not f.name.endswith(".gdb")
+    )
 
 
-def model_chm(lidar_path, kommune):
-    """_summary_
+def tile_outputs(ctx, tile_code: str) -> tuple:
+    """
+    Returns the paths of the outputs of a tile that are mosaiced.
 
     Args:
-        lidar_path (str): path to lidar data
-        kommune (str): munciaplity name
+        ctx (RunContext): parameters and paths of the municipality
+        tile_code (str): tile code
+
+    Returns:
+        tuple: (filegdb_path, r_dtm_int, r_dsm_int, r_chm_int, f_blocks) the
+            interim file gdb of the tile, the integer DTM, DSM and CHM and
+            the block occupancy index of the CHM
     """
-    logger.info("Start modelling the DTM, DSM and CHM ...")
-    logger.info("-" * 100)
+    # temporary filegdb for each tile to store intermediate results
+    filegdb_path = os.path.join(ctx.lidar_path, "chm_" + tile_code + ".gdb")
 
-    # only read las files from project folder run the rest locally
-    # p_lidar = input("Enter path to lidar data on P-drive: ")
-    p_lidar = r"P:\152022_itree_eco_ifront_synliggjore_trars_rolle_i_okosyst\data\baerum\urban-treeDetection\interim\lidar"
+    # integer rasters that are mosaiced
+    r_dtm_int = os.path.join(filegdb_path, "int_dtm_" + tile_code)
+    r_dsm_int = os.path.join(filegdb_path, "int_dsm_" + tile_code)
+    r_chm_int = os.path.join(filegdb_path, "int_chm_" + tile_code)
 
-    list_dtm_files = []
-    list_dsm_files = []
-    list_chm_files = []
+    # block occupancy index of the refined chm
+    f_blocks = os.path.join(ctx.lidar_path, "blocks_" + tile_code + ".npz")
+    return filegdb_path, r_dtm_int, r_dsm_int, r_chm_int, f_blocks
 
-    # List the subdirectories in the folder
-    tile_list = [
-        f.name
-        for f in os.scandir(p_lidar)
-        if f.is_dir() and not f.name.endswith(".gdb")
-    ]
-    n_tiles = len(
-        [
-            f
-            for f in os.listdir(p_lidar)
-            if os.path.isdir(os.path.join(p_lidar, f))
-        ]
-    )
 
+def model_chm(ctx):
+    """
+    Models the DTM, DSM and CHM of all tiles and mosaics them.
+
+    Args:
+        ctx (RunContext): parameters and paths of the municipality, tiles
+            that are completed in a previous run (ctx.journal) are skipped
+    """
+    logger.info("Start modelling the DTM, DSM and CHM ...")
+    logger.info("-" * 100)
+
+    tile_list = list_tiles(ctx)
     logger.info(
         "In {} kommune {} tiles (5000 maplist) are processed:\n".format(
-            kommune, n_tiles
+            ctx.municipality, len(tile_list)
         )
     )
     logger.info(tile_list)
 
+    model_chm_tiles(ctx, tile_list)
+    mosaic_chm(ctx, tile_list)
+
+
+def model_chm_tiles(ctx, tile_list: list):
+    """
+    Models the DTM, DSM and CHM of each tile in its interim file gdb. The
+    tiles are independent, the stage graph (segment_trees.py) runs them in
+    parallel.
+
+    Args:
+        ctx (RunContext): parameters and paths of the municipality, tiles
+            that are completed in a previous run (ctx.journal) are skipped
+        tile_list (list): tile codes
+    """
+    kommune = ctx.municipality
+    lidar_path = ctx.lidar_path
+
+    # colour depth of the LAS files of all tiles (not only of tile_list),
+    # decided on first use so that all RGB images of the run are scaled the
+    # same
+    rgb_depth = None
+
     # Detect trees per tile in tile_list
     for tile_code in tile_list:
+        filegdb_path, r_dtm_int, r_dsm_int, r_chm_int, f_blocks = tile_outputs(
+            ctx, tile_code
+        )
+
         # skip tiles that are already processed
+        if ctx.journal.is_done("model_chm", tile_code, arcpy.Exists):
+            logger.info(
+                "\tTile <<{}>> is completed in a previous run. Continue ...".format(
+                    tile_code
+                )
+            )
+            continue
 
         logger.info("\t---------------------".format())
         logger.info("\tPROCESSING TILE <<{}>>".format(tile_code))
         logger.info("\t---------------------".format())
+        with get_run_report().stage("model_chm", tile_code):
+            # layer paths
+            l_las_folder = os.path.join(lidar_path, tile_code)
+            d_las = os.path.join(lidar_path, "tile_" + tile_code + ".lasd")
 
-        # layer paths
-        l_las_folder = os.path.join(
-            p_lidar, tile_code
-        )  # IF NECESSARY, CHANGE PATH TO .las FILES
-        d_las = os.path.join(p_lidar, "tile_" + tile_code + ".lasd")
-
-        # temporary filegdb for each tile to store intermediate results
-        filegdb_path = os.path.join(lidar_path, "chm_" + tile_code + ".gdb")
-        au.createGDB_ifNotExists(filegdb_path)
-
-        # workspace settings
-        env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
-        env.workspace = filegdb_path
-
-        # ------------------------------------------------------ #
-        # Dynamic Path Variables
-        # ------------------------------------------------------ #
-
-        # temporary buffer of the study area to avoid edge effect
-        study_area_buffer = os.path.join(filegdb_path, "analyseomrade_buffer")
-
-        # height models
-        r_dtm = os.path.join(filegdb_path, "dtm")  # exported
-        r_dsm = os.path.join(filegdb_path, "dsm")  # exported
-        r_chm = os.path.join(
-            filegdb_path, "chm"
-        )  # input_chm if vegetation mask not available
-
-        # vegetation mask
-        r_rgb = os.path.join(filegdb_path, "rgb")
-        r_tgi = os.path.join(filegdb_path, "r_tgi")
-        v_tgi = os.path.join(filegdb_path, "v_tgi")
-
-        # refining and smoothing of chm
-        r_chm_tgi = os.path.join(
-            filegdb_path, "chm_tgi"
-        )  # input chm if vegetation mask available
-        r_chm_mask = os.path.join(
-            filegdb_path, "chm_mask"
-        )  # chm masked with municipality specific mask
-        r_chm_h = os.path.join(
-            filegdb_path, "chm_h"
-        )  # chm filtered by min height
-        r_chm_edge = os.path.join(
-            filegdb_path, "chm_edge"
-        )  # chm where building edges are removed
-        r_chm_smooth = os.path.join(
-            filegdb_path, "chm_smooth"
-        )  # chm filtered by focal max filter to smooth the chm, final chm output.
-
-        # ------------------------------------------------------ #
-        # 1.0 Create a 200m buffer around study area to avoid edge effect
-        # ------------------------------------------------------ #
-        if not arcpy.Exists(study_area_buffer):
-            logger.info(
-                "\t1.0 Create a 200m buffer around study area to avoid edge effect"
-            )
-            arcpy.Buffer_analysis(
-                in_features=study_area_path,
-                out_feature_class=study_area_buffer,
-                buffer_distance_or_field=200,
+            au.createGDB_ifNotExists(filegdb_path)
+
+            # workspace settings
+            env.overwriteOutput = True
+            env.outputCoordinateSystem = arcpy.SpatialReference(
+                ctx.spatial_reference
             )
+            env.workspace = filegdb_path
 
-        # ------------------------------------------------------ #
-        # 1.1 Create LAS Dataset
-        # ------------------------------------------------------ #
-        logger.info("\t1.1 Create LAS Dataset")
+            # ------------------------------------------------------ #
+            # Dynamic Path Variables
+            # ------------------------------------------------------ #
 
-        if arcpy.Exists(d_las):
-            logger.info(
-                "\t\tLAS Dataset for tile <<{}>> exists in database. Continue ...".format(
-                    tile_code
-                )
+            # temporary buffer of the study area to avoid edge effect
+            study_area_buffer = os.path.join(
+                filegdb_path, "analyseomrade_buffer"
             )
-        if not arcpy.Exists(d_las):
-            logger.info(
-                "\t\tCreate LAS Dataset for tile <<{}>>".format(tile_code)
-            )
-            start_time1 = time.time()
-            tree.create_lasDataset(l_las_folder, d_las)
-            end_time1(start_time1)
-
-        # ------------------------------------------------------ #
-        # 1.2 CANOPY height MODEL
-        #     Create DTM (old 1.5)
-        #     Create DSM (old 1.6)
-        #     Create CHM (old 1.7)
-        #     Create CHM for the study area
-        # ------------------------------------------------------ #
-        logger.info("\t1.2 Create Canopy Height Model (CHM)")
-
-        if arcpy.Exists(r_chm):
-            logger.info(
-                "\t\tCHM for tile <<{}>> exists in database. Continue ...".format(
-                    tile_code
-                )
-            )
-        else:
-            start_time1 = time.time()
 
-            # create DTM
-            tree.create_DTM(d_las, r_dtm, spatial_resolution, study_area_buffer)
-
-            # create DSM
-            if VEG_CLASSES_AVAILABLE:
+            # height models
+            r_dtm = os.path.join(filegdb_path, "dtm")  # exported
+            r_dsm = os.path.join(filegdb_path, "dsm")  # exported
+            r_chm = os.path.join(
+                filegdb_path, "chm"
+            )  # input_chm if vegetation mask not available
+
+            # vegetation mask
+            r_rgb = os.path.join(filegdb_path, "rgb")
+            r_tgi = os.path.join(filegdb_path, "r_tgi")
+            v_tgi = os.path.join(filegdb_path, "v_tgi")
+
+            # refining and smoothing of chm
+            r_chm_tgi = os.path.join(
+                filegdb_path, "chm_tgi"
+            )  # input chm if vegetation mask available
+            r_chm_mask = os.path.join(
+                filegdb_path, "chm_mask"
+            )  # chm masked with municipality specific mask
+            r_chm_h = os.path.join(
+                filegdb_path, "chm_h"
+            )  # chm filtered by min height
+            r_chm_edge = os.path.join(
+                filegdb_path, "chm_edge"
+            )  # chm where building edges are removed
+            r_chm_smooth = os.path.join(
+                filegdb_path, "chm_smooth"
+            )  # chm filtered by focal max filter to smooth the chm, final chm output.
+
+            # ------------------------------------------------------ #
+            # 1.0 Create a 200m buffer around study area to avoid edge effect
+            # ------------------------------------------------------ #
+            if not arcpy.Exists(study_area_buffer):
                 logger.info(
-                    "\t\tLiDAR point clouds are classified for vegetation in {} kommune. \n\t\tThe classes unclassified (1), low- (3), medium- (4), and, high (5) vegetation are used to create the DSM.".format(
-                        kommune
-                    )
+                    "\t1.0 Create a 200m buffer around study area to avoid edge effect"
                 )
-                class_code = ["1", "3", "4", "5"]
-                return_values = ["1", "3", "4", "5"]
-                tree.create_DSM(
-                    d_las,
-                    r_dsm,
-                    spatial_resolution,
-                    class_code,
-                    return_values,
-                    study_area_buffer,
+                arcpy.Buffer_analysis(
+                    in_features=ctx.study_area_path,
+                    out_feature_class=study_area_buffer,
+                    buffer_distance_or_field=200,
                 )
-            else:
+
+            # ------------------------------------------------------ #
+            # 1.1 Create LAS Dataset
+            # ------------------------------------------------------ #
+            logger.info("\t1.1 Create LAS Dataset")
+
+            if arcpy.Exists(d_las):
                 logger.info(
-                    "\t\tLiDAR point clouds are not classified for vegetation in {} kommune. \n\t\tSolely the class unclassified (1) is used to create the DSM.".format(
-                        kommune
+                    "\t\tLAS Dataset for tile <<{}>> exists in database. Continue ...".format(
+                        tile_code
                     )
                 )
-                class_code = ["1"]
-                return_values = ["1"]
-                tree.create_DSM(
-                    d_las,
-                    r_dsm,
-                    spatial_resolution,
-                    class_code,
-                    return_values,
-                    study_area_buffer,
+            if not arcpy.Exists(d_las):
+                logger.info(
+                    "\t\tCreate LAS Dataset for tile <<{}>>".format(tile_code)
                 )
+                start_time1 = time.time()
+                with au.atomic_output(d_las) as d_las_partial:
+                    tree.create_lasDataset(l_las_folder, d_las_partial)
+                end_time1(start_time1)
+
+            # ------------------------------------------------------ #
+            # 1.2 CANOPY height MODEL
+            #     Create DTM (old 1.5)
+            #     Create DSM (old 1.6)
+            #     Create CHM (old 1.7)
+            #     Create CHM for the study area
+            # ------------------------------------------------------ #
+            logger.info("\t1.2 Create Canopy Height Model (CHM)")
 
-            # create CHM
-            tree.create_CHM(r_dtm, r_dsm, r_chm)
-            end_time1(start_time1)
-
-        # ------------------------------------------------------ #
-        # 1.3 VEGETATION MASK and building mask
-        #     Create RGB image (old 1.2)
-        #     Create TGI vegetation mask (old 1.3)
-        #     Vectorize vegetation mask (old 1.4)
-        # ------------------------------------------------------ #
-        logger.info("\t1.3 Create Vegetation Mask (TGI)")
-        # check if rgb-image is available
-        if RGB_AVAILABLE:
-            # check if file exists
-            if arcpy.Exists(v_tgi):
+            if arcpy.Exists(r_chm):
                 logger.info(
-                    "\t\tVegetation mask for tile <<{}>> exists in database. Continue ...".format(
+                    "\t\tCHM for tile <<{}>> exists in database. Continue ...".format(
                         tile_code
                     )
                 )
             else:
                 start_time1 = time.time()
-                # create RGB-image
-                tree.create_RGB(d_las, r_rgb, study_area_buffer)
-                # create vegation mask
-                tree.create_vegMask(r_rgb, r_tgi)
-                # vegetation mask to Vector
-                tree.tgi_toVector(r_tgi, v_tgi)
-                end_time1(start_time1)
-        else:
-            logger.info(
-                "\t\tRGB image for {} kommune does not exits. Vegetation mask cannot be created. Continue... ".format(
-                    kommune
-                )
-            )
-
-        start_time1 = time.time()
 
-        # ------------------------------------------------------ #
-        # 1.4 REFINING CANOPY HEIGHT MODEL
-        #     Refine CHM with vegetation mask (old 1.8)
-        #     Filter CHM by minimum height (old 1.9)
-        #     Refine CHM by focal maximum filter (old 1.10)
-        #       --> best filter size can vary locally, dependent on tree species
-        # ------------------------------------------------------ #
-        logger.info(
-            "\t1.3 Smoothing and Filtering the Canopy Height Model (CHM)"
-        )
+                # DSM points
+                if ctx.veg_classes_available:
+                    logger.info(
+                        "\t\tLiDAR point clouds are classified for vegetation in {} kommune. \n\t\tThe classes unclassified (1), low- (3), medium- (4), and, high (5) vegetation are used to create the DSM.".format(
+                            kommune
+                        )
+                    )
+                    class_code = ["1", "3", "4", "5"]
+                    return_values = ["1", "3", "4", "5"]
+                else:
+                    logger.info(
+                        "\t\tLiDAR point clouds are not classified for vegetation in {} kommune. \n\t\tSolely the class unclassified (1) is used to create the DSM.".format(
+                            kommune
+                        )
+                    )
+                    class_code = ["1"]
+                    return_values = ["1"]
+
+                # the numpy engine reads uncompressed .las files only
+                las_files = [
+                    os.path.join(l_las_folder, f)
+                    for f in os.listdir(l_las_folder)
+                    if f.lower().endswith((".las", ".laz"))
+                ]
+                if (
+                    ctx.las_engine == "numpy"
+                    and las_files
+                    and all(f.lower().endswith(".las") for f in las_files)
+                ):
+                    # create DTM, DSM (and RGB image) in one read of the points
+                    outputs = {
+                        "dtm": (
+                            GridProduct(
+                                "dtm",
+                                ctx.spatial_resolution,
+                                "z",
+                                "mean",
+                                ["2"],
+                                ["2"],
+                            ),
+                            r_dtm,
+                        ),
+                        "dsm": (
+                            GridProduct(
+                                "dsm",
+                                ctx.spatial_resolution,
+                                "z",
+                                "max",
+                                class_code,
+                                return_values,
+                            ),
+                            r_dsm,
+                        ),
+                    }
+                    if ctx.rgb_available and not arcpy.Exists(v_tgi):
+                        if rgb_depth is None:
+                            rgb_depth = color_depth(
+                                [
+                                    os.path.join(lidar_path, tile, f)
+                                    for tile in list_tiles(ctx)
+                                    for f in os.listdir(
+                                        os.path.join(lidar_path, tile)
+                                    )
+                                    if f.lower().endswith(".las")
+                                ]
+                            )
+                            logger.info(
+                                "\t\tThe LAS files have {} bit colours".format(
+                                    rgb_depth
+                                )
+                            )
+                        outputs["rgb"] = (
+                            GridProduct(
+                                "rgb",
+                                RGB_CELL_SIZE,
+                                "rgb",
+                                color_depth=rgb_depth,
+                            ),
+                            r_rgb,
+                        )
+                    tree.create_elevationModels(
+                        las_files,
+                        outputs,
+                        study_area_buffer,
+                        ctx.spatial_reference,
+                        ctx.void_fill,
+                    )
+                else:
+                    # create DTM
+                    tree.create_DTM(
+                        d_las, r_dtm, ctx.spatial_resolution, study_area_buffer
+                    )
 
-        start_time1 = time.time()
+                    # create DSM
+                    tree.create_DSM(
+                        d_las,
+                        r_dsm,
+                        ctx.spatial_resolution,
+                        class_code,
+                        return_values,
+                        study_area_buffer,
+                    )
 
-        if arcpy.Exists(r_chm_smooth):
-            logger.info(
-                "\t\tRefined vegetation mask for tile <<{}>> exists in database. Continue ...".format(
-                    tile_code
-                )
-            )
-        else:
-            # check if vegetation mask exists
-            if arcpy.Exists(v_tgi):
-                # 1. refine with veg mask
-                tree.extract_vegMask(v_tgi, r_chm, r_chm_tgi)
-                # 2. filter by min tree height (municipality-sepcific)
-                input_chm = r_chm_tgi  # vegetation masked chm
-                # 3. mask with muncipality specific mask
-                tree.extract_Mask(mask_path, input_chm, r_chm_mask)
-                # 4. filter by min tree height
-                tree.extract_minHeight(r_chm_mask, r_chm_h, MIN_HEIGHT)
-                # 5. noise removal of building edges etc.
-                tree.focal_meanFilter(r_chm_h, r_chm_edge)
-                # 6. focal maximum filter
-                tree.focal_maxFilter(r_chm_edge, r_chm_smooth, FOCAL_MAX_RADIUS)
-                arcpy.Delete_management(r_chm_tgi)
+                # create CHM, DTM and DSM are rewritten if the CHM is not published
+                with au.atomic_output(r_chm) as r_chm_partial:
+                    tree.create_CHM(r_dtm, r_dsm, r_chm_partial)
                 end_time1(start_time1)
+
+            # ------------------------------------------------------ #
+            # 1.3 VEGETATION MASK and building mask
+            #     Create RGB image (old 1.2)
+            #     Create TGI vegetation mask (old 1.3)
+            #     Vectorize vegetation mask (old 1.4)
+            # ------------------------------------------------------ #
+            logger.info("\t1.3 Create Vegetation Mask (TGI)")
+            # check if rgb-image is available
+            if ctx.rgb_available:
+                # check if file exists
+                if arcpy.Exists(v_tgi):
+                    logger.info(
+                        "\t\tVegetation mask for tile <<{}>> exists in database. Continue ...".format(
+                            tile_code
+                        )
+                    )
+                else:
+                    start_time1 = time.time()
+                    # create RGB-image, unless it is made with the DTM and DSM
+                    if not arcpy.Exists(r_rgb):
+                        tree.create_RGB(d_las, r_rgb, study_area_buffer)
+                    # create vegation mask
+                    tree.create_vegMask(r_rgb, r_tgi)
+                    # vegetation mask to Vector
+                    with au.atomic_output(v_tgi) as v_tgi_partial:
+                        tree.tgi_toVector(r_tgi, v_tgi_partial)
+                    end_time1(start_time1)
             else:
-                # refine with veg mask
                 logger.info(
-                    "\t\tVegetation maks is not generated for {} kommune. CHM cannot be refined using the vegetation mask. Continue... ".format(
+                    "\t\tRGB image for {} kommune does not exits. Vegetation mask cannot be created. Continue... ".format(
                         kommune
                     )
                 )
-                # 1. filter by min tree height (municipality-sepcific)
-                input_chm = r_chm  # non-vegetation masked chm
-                # 2. mask with muncipality specific mask
-                tree.extract_Mask(mask_path, input_chm, r_chm_mask)
-                # 3. filter by min tree height
-                tree.extract_minHeight(r_chm_mask, r_chm_h, MIN_HEIGHT)
-                # 4. noise removal of building edges etc.
-                tree.focal_meanFilter(r_chm_h, r_chm_edge)
-                # 5. focal maximum filter
-                tree.focal_maxFilter(r_chm_edge, r_chm_smooth, FOCAL_MAX_RADIUS)
-                end_time1(start_time1)
 
-        # ------------------------------------------------------ #
-        # 1.5 CONVERT CHM, DTM, DSM to integer rasters
-        # ------------------------------------------------------ #
+            start_time1 = time.time()
 
-        logger.info(
-            "\t1.4 Convert CHM, DTM, DSM to integer by multiplying by 100"
-        )
-        # multiply x 1000
-        r_dtm_int = os.path.join(filegdb_path, "int_dtm_" + tile_code)
-        r_dsm_int = os.path.join(filegdb_path, "int_dsm_" + tile_code)
-        r_chm_int = os.path.join(filegdb_path, "int_chm_" + tile_code)
+            # ------------------------------------------------------ #
+            # 1.4 REFINING CANOPY HEIGHT MODEL
+            #     Refine CHM with vegetation mask (old 1.8)
+            #     Filter CHM by minimum height (old 1.9)
+            #     Refine CHM by focal maximum filter (old 1.10)
+            #       --> best filter size can vary locally, dependent on tree species
+            # ------------------------------------------------------ #
+            logger.info(
+                "\t1.3 Smoothing and Filtering the Canopy Height Model (CHM)"
+            )
 
-        au.convert_toIntRaster(r_dtm, r_dtm_int)
-        au.convert_toIntRaster(r_dsm, r_dsm_int)
-        au.convert_toIntRaster(r_chm_smooth, r_chm_int)
+            start_time1 = time.time()
 
-        # ------------------------------------------------------ #
-        # 1.6 APPEND CHM, DTM, DSM to lists
-        # ------------------------------------------------------ #
+            if arcpy.Exists(r_chm_smooth):
+                logger.info(
+                    "\t\tRefined vegetation mask for tile <<{}>> exists in database. Continue ...".format(
+                        tile_code
+                    )
+                )
+            else:
+                # check if vegetation mask exists
+                if arcpy.Exists(v_tgi):
+                    # 1. refine with veg mask
+                    tree.extract_vegMask(v_tgi, r_chm, r_chm_tgi)
+                    # 2. filter by min tree height (municipality-sepcific)
+                    input_chm = r_chm_tgi  # vegetation masked chm
+                    # 3. mask with muncipality specific mask
+                    tree.extract_Mask(ctx.mask_path, input_chm, r_chm_mask)
+                    # 4. filter by min tree height
+                    tree.extract_minHeight(r_chm_mask, r_chm_h, ctx.min_height)
+                    # 5. noise removal of building edges etc.
+                    tree.focal_meanFilter(r_chm_h, r_chm_edge)
+                    # 6. focal maximum filter
+                    with au.atomic_output(r_chm_smooth) as r_chm_smooth_partial:
+                        tree.focal_maxFilter(
+                            r_chm_edge,
+                            r_chm_smooth_partial,
+                            ctx.focal_max_radius,
+                        )
+                    arcpy.Delete_management(r_chm_tgi)
+                    end_time1(start_time1)
+                else:
+                    # refine with veg mask
+                    logger.info(
+                        "\t\tVegetation maks is not generated for {} kommune. CHM cannot be refined using the vegetation mask. Continue... ".format(
+                            kommune
+                        )
+                    )
+                    # 1. filter by min tree height (municipality-sepcific)
+                    input_chm = r_chm  # non-vegetation masked chm
+                    # 2. mask with muncipality specific mask
+                    tree.extract_Mask(ctx.mask_path, input_chm, r_chm_mask)
+                    # 3. filter by min tree height
+                    tree.extract_minHeight(r_chm_mask, r_chm_h, ctx.min_height)
+                    # 4. noise removal of building edges etc.
+                    tree.focal_meanFilter(r_chm_h, r_chm_edge)
+                    # 5. focal maximum filter
+                    with au.atomic_output(r_chm_smooth) as r_chm_smooth_partial:
+                        tree.focal_maxFilter(
+                            r_chm_edge,
+                            r_chm_smooth_partial,
+                            ctx.focal_max_radius,
+                        )
+                    end_time1(start_time1)
+
+            # ------------------------------------------------------ #
+            # 1.5 CONVERT CHM, DTM, DSM to integer rasters
+            # ------------------------------------------------------ #
+
+            logger.info(
+                "\t1.4 Convert CHM, DTM, DSM to integer by multiplying by 100"
+            )
+            # multiply x 1000
+            with au.atomic_outputs([r_dtm_int, r_dsm_int, r_chm_int]) as (
+                r_dtm_int_partial,
+                r_dsm_int_partial,
+                r_chm_int_partial,
+            ):
+                au.convert_toIntRaster(r_dtm, r_dtm_int_partial)
+                au.convert_toIntRaster(r_dsm, r_dsm_int_partial)
+                au.convert_toIntRaster(
+                    r_chm_smooth, r_chm_int_partial, CHM_ENCODING.pixel_type
+                )
 
-        logger.info("\t1.5 Append CHM, DTM, DSM to lists")
-        list_dtm_files.append(r_dtm_int)
-        list_dsm_files.append(r_dsm_int)
-        list_chm_files.append(r_chm_int)
+            # blocks of the refined chm that contain vegetation cells, the
+            # watershed segmentation skips the treeless blocks
+            logger.info(
+                "\t\tBuild the block occupancy index of the refined CHM"
+            )
+            BlockIndex.from_raster(
+                r_chm_int, ctx.min_height, encoding=CHM_ENCODING
+            ).save(f_blocks)
+
+            ctx.journal.mark_done(
+                "model_chm",
+                tile_code,
+                [r_dtm_int, r_dsm_int, r_chm_int, f_blocks],
+            )
 
         # break
         print("finished tile {}".format(tile_code))
 
+
+def mosaic_chm(ctx, tile_list: list = None):
+    """
+    Mosaics the integer DTM, DSM and CHM of the tiles and merges their block
+    indices in the elevation file gdb (ctx.gdb_elevation_data).
+
+    Args:
+        ctx (RunContext): parameters and paths of the municipality
+        tile_list (list, optional): tile codes, defaults to all tiles
+    """
+    kommune = ctx.municipality
+    if tile_list is None:
+        tile_list = list_tiles(ctx)
+
+    # terrain data, the mosaics of the tiles
+    au.createGDB_ifNotExists(ctx.gdb_elevation_data)
+
+    outputs = [tile_outputs(ctx, tile_code) for tile_code in tile_list]
+    list_dtm_files = [paths[1] for paths in outputs]
+    list_dsm_files = [paths[2] for paths in outputs]
+    list_chm_files = [paths[3] for paths in outputs]
+    list_block_files = [paths[4] for paths in outputs]
+
     # ------------------------------------------------------ #
     # 1.7 MOSAIC FILES IN THE CHM, DTM, DSM lists
     # ------------------------------------------------------ #
 
     logger.info("\t1.6 Mosaic CHM, DTM, DSM rasters to study area extent")
-    chm_mosaic = "chm_" + str(spatial_resolution) + "m_int_100x"
-    chm_mosaic = chm_mosaic.replace(".", "")
-    dtm_mosaic = "dtm_" + str(spatial_resolution) + "m_int_100x"
-    dtm_mosaic = dtm_mosaic.replace(".", "")
-    dsm_mosaic = "dsm_" + str(spatial_resolution) + "m_int_100x"
-    dsm_mosaic = dsm_mosaic.replace(".", "")
-
-    # loop over raster lists and output names to mosaic the rasters
-    raster_lists = [list_chm_files, list_dtm_files, list_dsm_files]
-    mosaic_names = [chm_mosaic, dtm_mosaic, dsm_mosaic]
-
-    for raster_list, mosaic_name in zip(raster_lists, mosaic_names):
-        au.rasterList_toMosaic(
-            raster_list=raster_list,
-            ouput_gdb=gdb_elevation_data,
-            output_name=mosaic_name,
-            coord_system=COORD_SYSTEM,
-            spatial_resolution=spatial_resolution,
+    with get_run_report().stage("mosaic_chm", kommune):
+        chm_mosaic = "chm_" + str(ctx.spatial_resolution) + "m_int_100x"
+        chm_mosaic = chm_mosaic.replace(".", "")
+        dtm_mosaic = "dtm_" + str(ctx.spatial_resolution) + "m_int_100x"
+        dtm_mosaic = dtm_mosaic.replace(".", "")
+        dsm_mosaic = "dsm_" + str(ctx.spatial_resolution) + "m_int_100x"
+        dsm_mosaic = dsm_mosaic.replace(".", "")
+
+        # loop over raster lists and output names to mosaic the rasters
+        raster_lists = [list_chm_files, list_dtm_files, list_dsm_files]
+        mosaic_names = [chm_mosaic, dtm_mosaic, dsm_mosaic]
+
+        # the CHM is stored as int16 cm, the DTM and DSM as int32 cm
+        encodings = [CHM_ENCODING, ELEVATION_ENCODING, ELEVATION_ENCODING]
+
+        for raster_list, mosaic_name, encoding in zip(
+            raster_lists, mosaic_names, encodings
+        ):
+            au.rasterList_toMosaic(
+                raster_list=raster_list,
+                ouput_gdb=ctx.gdb_elevation_data,
+                output_name=mosaic_name,
+                coord_system=ctx.coord_system,
+                spatial_resolution=ctx.spatial_resolution,
+                pixel_type=encoding.pixel_type,
+            )
+            encoding.save(
+                encoding_path(os.path.join(ctx.gdb_elevation_data, mosaic_name))
+            )
+
+        # merge the block indices of the tiles
+        block_index = BlockIndex(ctx.spatial_resolution)
+        for f_blocks in list_block_files:
+            if os.path.exists(f_blocks):
+                block_index.merge(BlockIndex.load(f_blocks))
+        block_index.save(
+            block_index_path(os.path.join(ctx.gdb_elevation_data, chm_mosaic))
+        )
+        logger.info(
+            "\t\tBlock index:\t{} blocks of {}x{} cells contain vegetation".format(
+                len(block_index), block_index.block_size, block_index.block_size
+            )
         )
 
     logger.info("Finished modelling the DTM, DSM and CHM ...")
     logger.info(
         "The mosaiced DTM, DSM and CHM for {} are stored in the file geodatabase:\n\t {}".format(
-            kommune, gdb_elevation_data
+            kommune, ctx.gdb_elevation_data
         )
     )
     logger.info("\t\tDTM:\t{}".format(dtm_mosaic))
@@ -407,67 +578,41 @@ def model_chm(lidar_path, kommune):
 if __name__ == "__main__":
     # start timer
     start_time0 = time.time()
-    kommune = MUNICIPALITY
-    # TODO move get_spatial_resolution() to config file
-    spatial_resolution = get_spatial_resolution()
-
-    # ------------------------------------------------------ #
-    # Path variables Parameters
-    # ------------------------------------------------------ #
-
-    # specific file paths
-    lidar_path = os.path.join(INTERIM_PATH, "lidar")
 
-    # admin data
-    admin_data_path = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_admindata.gdb"
-    )
-    study_area_path = os.path.join(admin_data_path, "analyseomrade")
-    mask_path = os.path.join(admin_data_path, "analyseomrade_mask")
-
-    # base data
-    base_data_path = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_basisdata.gdb"
-    )
-    fkb_bygning_omrade = os.path.join(base_data_path, "fkb_bygning_omrade")
-    fkb_vann_omrade = os.path.join(base_data_path, "fkb_vann_omrade")
-
-    # terrain data
-    gdb_elevation_data = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_hoydedata.gdb"
-    )
-    au.createGDB_ifNotExists(gdb_elevation_data)
+    # parameters and paths of the municipality of the run
+    ctx = RunContext.from_config(MUNICIPALITY)
 
     logger.info("\n")
-    logger.info("municipality:\t\t\t" + kommune)
-    logger.info("spatial reference:\t\t" + SPATIAL_REFERENCE)
-    logger.info("RGB image available:\t\t" + str(RGB_AVAILABLE))
-    logger.info("Vegetation Classes available:\t" + str(VEG_CLASSES_AVAILABLE))
-    logger.info("Point Density:\t\t\t" + str(POINT_DENSITY))
-    logger.info("Spatial Resolution:\t\t" + str(spatial_resolution))
-    logger.info("Minimum Tree Height:\t\t" + str(MIN_HEIGHT))
-    logger.info("Focal Max Radius:\t\t\t" + str(FOCAL_MAX_RADIUS))
+    ctx.log_parameters()
     logger.info("-" * 100)
 
-    user_input = input("Do you want to keep the interim chm filegdb's? (y/n):")
-
-    if user_input == "y" or "yes" or "true" or "1" or "True":
-        keep_temp = True
+    keep_temp = get_bool_option(
+        "keep_temp",
+        "Do you want to keep the interim chm filegdb's? (y/n):",
+        default=False,
+    )
+    if keep_temp:
         logger.info("\tInterim filegdb's will be kept ...")
-    if user_input == "n" or "no" or "false" or "0" or "False":
-        keep_temp = False
+    else:
         logger.info("\tInterim filegdb's will be deleted ...")
 
-    # start moddelling dsm, dtm and chm
-    model_chm(lidar_path, kommune)
+    # share of the worker budget of a batch run for the arcpy tools
+    workers = get_workers()
+    if workers:
+        env.parallelProcessingFactor = str(workers)
+
+    # start moddelling dsm, dtm and chm, the journal of completed tiles
+    # (ctx.journal) lets a restarted run resume at the first unfinished tile
+    model_chm(ctx)
 
     # delete all interim filegdb's
     if keep_temp == False:
         logger.info("\tDeleting all interim filegdb's ...")
-        for file in os.listdir(lidar_path):
+        for file in os.listdir(ctx.lidar_path):
             if file.startswith("chm_"):
-                arcpy.Delete_management(os.path.join(lidar_path, file))
+                arcpy.Delete_management(os.path.join(ctx.lidar_path, file))
 
     end_time0 = time.time()
     execution_time1 = end_time0 - start_time0
     logger.info("\n\tEXCEUTION TIME:\t {:.2f} sec".format(execution_time1))
+    get_run_report().log_summary()
@@ -4,31 +4,12 @@ import os
 import arcpy
 from arcpy import env
 
-from src import (
-    DATA_PATH,
-    INTERIM_PATH,
-    MUNICIPALITY,
-    POINT_DENSITY,
-    SPATIAL_REFERENCE,
-)
+from src import MUNICIPALITY, RunContext
 from src import arcpy_utils as au
+from src import get_run_report
 
 
-# define the spatial resolution of the DSM/DTM/CHM grid based on lidar point density
-# move to config
-def get_spatial_resolution():
-    if POINT_DENSITY >= 4:
-        spatial_resolution = 0.25
-    elif POINT_DENSITY < 4 and POINT_DENSITY >= 2:
-        spatial_resolution = 0.5
-    else:
-        spatial_resolution = 1
-    return spatial_resolution
-
-
-def split_chm_nb(
-    neighbourhood_list, split_neighbourhoods_gdb, r_chm, split_chm_gdb
-):
+def split_chm_nb(ctx, neighbourhood_list):
     logger = logging.getLogger(__name__)
     logger.info("Splitting neighbourhoods...")
     logger.info("-" * 100)
@@ -41,57 +22,70 @@ def split_chm_nb(
         logger.info("\tPROCESSING NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("\t---------------------".format())
 
-        # workspace settings
-        env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
+        if ctx.journal.is_done("split_chm", n_code, arcpy.Exists):
+            logger.info(
+                "\t\tThe clipped CHM for neighbourhood <<{}>> is completed in a previous run. Continue ...".format(
+                    n_code
+                )
+            )
+            continue
 
-        # ------------------------------------------------------ #
-        # Dynamic Path Variables
-        # ------------------------------------------------------ #
+        with get_run_report().stage("split_chm", n_code):
+            # workspace settings
+            env.overwriteOutput = True
+            env.outputCoordinateSystem = arcpy.SpatialReference(
+                ctx.spatial_reference
+            )
 
-        # neighbourhood specific file paths
-        v_neighb = os.path.join(split_neighbourhoods_gdb, "b_" + n_code)
-        v_neighb_buffer = os.path.join(
-            split_neighbourhoods_gdb, "b_" + n_code + "_buffer200"
-        )
+            # ------------------------------------------------------ #
+            # Dynamic Path Variables
+            # ------------------------------------------------------ #
 
-        # chm clipped by neighbourhood
-        r_chm_neighb = os.path.join(
-            split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
-        )
+            # neighbourhood specific file paths
+            v_neighb = os.path.join(ctx.split_neighbourhoods_gdb, "b_" + n_code)
+            v_neighb_buffer = os.path.join(
+                ctx.split_neighbourhoods_gdb, "b_" + n_code + "_buffer200"
+            )
 
-        # ------------------------------------------------------ #
-        # 1.1 Clip CHM to neighbourhood + 200m buffer to avoid edge effects
-        # ------------------------------------------------------ #
-        try:
-            logger.info(
-                "\t1.1 Clip CHM to {} + 200m buffer to avoid edge effects".format(
-                    n_code
-                )
+            # chm clipped by neighbourhood
+            r_chm_neighb = os.path.join(
+                ctx.split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
             )
-            if arcpy.Exists(r_chm_neighb):
+
+            # ------------------------------------------------------ #
+            # 1.1 Clip CHM to neighbourhood + 200m buffer to avoid edge effects
+            # ------------------------------------------------------ #
+            try:
                 logger.info(
-                    "\t\tThe clipped CHM for neighbourhood <<{}>> exists in database. Continue ...".format(
+                    "\t1.1 Clip CHM to {} + 200m buffer to avoid edge effects".format(
                         n_code
                     )
                 )
-            else:
-                arcpy.Buffer_analysis(
-                    in_features=v_neighb,
-                    out_feature_class=v_neighb_buffer,
-                    buffer_distance_or_field=200,
-                )
+                if arcpy.Exists(r_chm_neighb):
+                    logger.info(
+                        "\t\tThe clipped CHM for neighbourhood <<{}>> exists in database. Continue ...".format(
+                            n_code
+                        )
+                    )
+                else:
+                    arcpy.Buffer_analysis(
+                        in_features=v_neighb,
+                        out_feature_class=v_neighb_buffer,
+                        buffer_distance_or_field=200,
+                    )
 
-                arcpy.Clip_management(
-                    in_raster=r_chm,
-                    out_raster=r_chm_neighb,
-                    in_template_dataset=v_neighb_buffer,
-                    clipping_geometry="ClippingGeometry",
-                )
+                    with au.atomic_output(r_chm_neighb) as r_chm_neighb_tmp:
+                        arcpy.Clip_management(
+                            in_raster=ctx.r_chm,
+                            out_raster=r_chm_neighb_tmp,
+                            in_template_dataset=v_neighb_buffer,
+                            clipping_geometry="ClippingGeometry",
+                        )
+                ctx.journal.mark_done("split_chm", n_code, [r_chm_neighb])
 
-        except Exception as e:
-            # catch any exception and print error message.
-            logger.info(f"\t\tERROR: {e}. \nContinue...")
+            except Exception as e:
+                # catch any exception and print error message.
+                logger.info(f"\t\tERROR: {e}. \nContinue...")
 
 
 if __name__ == "__main__":
@@ -101,53 +95,33 @@ if __name__ == "__main__":
     setup_custom_logging()
     logger = logging.getLogger(__name__)
 
-    kommune = MUNICIPALITY
-
-    # admin data
-    admin_data_path = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_admindata.gdb"
-    )
-    study_area_path = os.path.join(admin_data_path, "analyseomrade")
+    ctx = RunContext.from_config(MUNICIPALITY)
+    kommune = ctx.municipality
 
     # neighbourhood list
-    neighbourhood_path = os.path.join(admin_data_path, "bydeler")
-    n_field_name = "bydelnummer"
     neighbourhood_list = au.get_neighbourhood_list(
-        neighbourhood_path, n_field_name
+        ctx.neighbourhood_path, ctx.n_field_name
     )
     logger.info("Processing neighbourhoods: {}".format(neighbourhood_list))
     keep_temp = True
 
     # split neighbourhoods
-    split_neighbourhoods_gdb = os.path.join(INTERIM_PATH, "bydeler_split.gdb")
-    if not arcpy.Exists(split_neighbourhoods_gdb):
+    if not arcpy.Exists(ctx.split_neighbourhoods_gdb):
         logger.info("Splitting neighbourhoods...")
         au.split_neighbourhoods(
-            neighbourhood_path, n_field_name, split_neighbourhoods_gdb
+            ctx.neighbourhood_path,
+            ctx.n_field_name,
+            ctx.split_neighbourhoods_gdb,
         )
 
     # terrain data
-    gdb_elevation_data = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_hoydedata.gdb"
-    )
-
-    if not arcpy.Exists(gdb_elevation_data):
+    if not arcpy.Exists(ctx.gdb_elevation_data):
         logger.error(
             f"The elevation and canopy height model data for {kommune} kommune is not available.\
                      \nPlease run the script 'model_chm.py' first."
         )
         exit()
 
-    # chm data
-    spatial_resolution = get_spatial_resolution()
-    str_resolution = str(spatial_resolution).replace(".", "")
-    r_chm = os.path.join(
-        gdb_elevation_data, "chm_" + str(str_resolution) + "m_int_100x"
-    )
-
     # split neighbourhoods
-    split_chm_gdb = os.path.join(INTERIM_PATH, "chm_split.gdb")
-    au.createGDB_ifNotExists(split_chm_gdb)
-    split_chm_nb(
-        neighbourhood_list, split_neighbourhoods_gdb, r_chm, split_chm_gdb
-    )
+    au.createGDB_ifNotExists(ctx.split_chm_gdb)
+    split_chm_nb(ctx, neighbourhood_list)
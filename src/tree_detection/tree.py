@@ -2,8 +2,14 @@ import logging
 import os
 
 import arcpy
+import array_engine
+import block_watershed
+import crown_simplify
+import las_rasterizer
+import numpy as np
 from arcpy import env
 from arcpy.sa import *
+from void_fill import fill_voids
 
 from src import logger
 
@@ -145,6 +151,62 @@ def create_DSM(
     arcpy.Delete_management(temp)
 
 
+def create_elevationModels(
+    las_files, outputs, study_area_path, spatial_reference, fill_method="linear"
+):
+    """
+    Creates the DTM, DSM and RGB image of a tile in one read of the points.
+
+    The points of each LAS file are read once and rasterized into all
+    products (see las_rasterizer.py), instead of one LasDatasetToRaster
+    pass per product. Empty DTM/DSM cells are filled block by block (see
+    void_fill.py).
+
+    Args:
+        las_files (list): paths to the .las files of the tile
+        outputs (dict): product name -> (GridProduct, output raster path)
+        study_area_path (str): mask of the outputs
+        spatial_reference: spatial reference of the outputs
+        fill_method (str): void fill of the DTM/DSM, "linear" or "nearest"
+    """
+    logger.info(
+        "\t\tCreating {} in one pass over the LAS points ...".format(
+            ", ".join(
+                "{} ({}x{}m)".format(name, p.cell_size, p.cell_size)
+                for name, (p, _) in outputs.items()
+            )
+        )
+    )
+    rasterizer = las_rasterizer.LasRasterizer.from_files(
+        las_files, [product for product, _ in outputs.values()]
+    )
+    logger.info("\t\t{} points read".format(rasterizer.n_points))
+
+    for name, (product, r_out) in outputs.items():
+        array, x_min, y_min, cell_size = rasterizer.result(name)
+        if product.value == "z":
+            array = fill_voids(array, method=fill_method)
+
+        temp = r_out + "_temp"
+        raster = arcpy.NumPyArrayToRaster(
+            array, arcpy.Point(x_min, y_min), cell_size, cell_size
+        )
+        raster.save(temp)
+        arcpy.DefineProjection_management(
+            temp, arcpy.SpatialReference(spatial_reference)
+        )
+
+        logger.info(
+            "\t\tMasking the {} with the study area extent...".format(name)
+        )
+        r_masked = arcpy.sa.ExtractByMask(
+            in_raster=temp,
+            in_mask_data=study_area_path,
+        )
+        r_masked.save(r_out)
+        arcpy.Delete_management(temp)
+
+
 def create_CHM(r_dtm, r_dsm, r_chm):
     """_summary_
 
@@ -385,6 +447,171 @@ def watershed_segmentation(
     return r_watersheds
 
 
+def watershed_municipality(
+    r_chm,
+    neighbourhood_path,
+    n_field_name,
+    r_watersheds,
+    v_tops,
+    block_index=None,
+    encoding=None,
+    block_size=1024,
+    halo=16,
+):
+    """
+    Watershed segmentation of the municipal CHM, block by block.
+
+    The CHM is read in windows of block_size cells with a halo (see
+    block_watershed.py), the crown labels of the blocks are mosaiced to
+    r_watersheds. The tree tops are written as points with the crown label
+    (gridcode) and the code of the neighbourhood they are located in.
+
+    Args:
+        r_chm (str): path to the municipal CHM
+        neighbourhood_path (str): neighbourhood polygons
+        n_field_name (str): field with the neighbourhood code
+        r_watersheds (str): output crown labels
+        v_tops (str): output tree tops
+        block_index (BlockIndex, optional): blocks without vegetation are
+            skipped
+        encoding (HeightEncoding, optional): encoding of an integer CHM, an
+            integer CHM without an encoding is segmented in stored units
+        block_size (int): number of cells per block side
+        halo (int): number of cells read around a block
+
+    Returns:
+        str: path to the crown labels
+    """
+    desc = arcpy.Describe(r_chm)
+    cell_size = desc.meanCellWidth
+    x_min, y_max = desc.extent.XMin, desc.extent.YMax
+    shape = (desc.height, desc.width)
+    if encoding is not None:
+        nodata = encoding.nodata
+    elif desc.pixelType.startswith(("S", "U")):
+        # integer CHM without an encoding: its NoData value, or the end of
+        # the value range of the pixel type (NaN is not an integer)
+        info = np.iinfo(
+            "{}int{}".format(
+                "u" if desc.pixelType[0] == "U" else "",
+                max(int(desc.pixelType[1:]), 8),
+            )
+        )
+        nodata = getattr(desc, "noDataValue", None)
+        if nodata is None:
+            nodata = info.max if desc.pixelType[0] == "U" else info.min
+        nodata = int(nodata)
+    else:
+        nodata = np.nan
+    out_gdb = os.path.dirname(r_watersheds)
+
+    def lower_left(r1, c0):
+        return arcpy.Point(x_min + c0 * cell_size, y_max - r1 * cell_size)
+
+    def read_window(r0, r1, c0, c1):
+        return arcpy.RasterToNumPyArray(
+            r_chm, lower_left(r1, c0), c1 - c0, r1 - r0, nodata_to_value=nodata
+        )
+
+    def skip_block(r0, r1, c0, c1):
+        if block_index is None:
+            return False
+        _, occupied_extent = block_index.query(
+            (
+                x_min + c0 * cell_size,
+                y_max - r1 * cell_size,
+                x_min + c1 * cell_size,
+                y_max - r0 * cell_size,
+            )
+        )
+        return occupied_extent is None
+
+    r_blocks = []
+
+    def write_labels(labels, r0, c0):
+        r_block = os.path.join(out_gdb, "ws_block_{}_{}".format(r0, c0))
+        raster = arcpy.NumPyArrayToRaster(
+            labels,
+            lower_left(r0 + labels.shape[0], c0),
+            cell_size,
+            cell_size,
+            value_to_nodata=0,
+        )
+        raster.save(r_block)
+        r_blocks.append(r_block)
+
+    logger.info("\t\tSegmenting the municipal CHM block by block...")
+    segmentation = block_watershed.BlockWatershed(
+        shape, block_size, halo, nodata=None if np.isnan(nodata) else nodata
+    )
+    tops = segmentation.run(read_window, write_labels, skip_block)
+
+    logger.info("\t\tMosaicing {} label blocks...".format(len(r_blocks)))
+    arcpy.management.MosaicToNewRaster(
+        input_rasters=r_blocks,
+        output_location=out_gdb,
+        raster_dataset_name_with_extension=os.path.basename(r_watersheds),
+        coordinate_system_for_the_raster=desc.spatialReference,
+        pixel_type="32_BIT_SIGNED",
+        cellsize=cell_size,
+        number_of_bands=1,
+        mosaic_method="FIRST",
+    )
+    for r_block in r_blocks:
+        arcpy.Delete_management(r_block)
+
+    # neighbourhood of the tops: lookup in the rasterized neighbourhoods
+    logger.info("\t\tLooking up the neighbourhood of the tree tops...")
+    r_units = os.path.join(out_gdb, "neighbourhood_oid")
+    with arcpy.EnvManager(snapRaster=r_chm, extent=desc.extent):
+        arcpy.conversion.PolygonToRaster(
+            in_features=neighbourhood_path,
+            value_field=arcpy.Describe(neighbourhood_path).OIDFieldName,
+            out_rasterdataset=r_units,
+            cell_assignment="CELL_CENTER",
+            cellsize=cell_size,
+        )
+
+    def read_units(r0, r1, c0, c1):
+        # cells outside the neighbourhood raster are 0
+        return arcpy.RasterToNumPyArray(
+            r_units, lower_left(r1, c0), c1 - c0, r1 - r0, nodata_to_value=0
+        )
+
+    unit_oids = block_watershed.assign_units(
+        tops, read_units, shape, block_size
+    )
+    with arcpy.da.SearchCursor(
+        neighbourhood_path, ["OID@", n_field_name]
+    ) as cursor:
+        n_codes = {oid: str(code) for oid, code in cursor}
+    arcpy.Delete_management(r_units)
+
+    # tree tops as points at the cell centres
+    arcpy.CreateFeatureclass_management(
+        out_path=os.path.dirname(v_tops),
+        out_name=os.path.basename(v_tops),
+        geometry_type="POINT",
+        spatial_reference=desc.spatialReference,
+    )
+    arcpy.AddField_management(v_tops, "gridcode", "LONG")
+    arcpy.AddField_management(v_tops, n_field_name, "TEXT", field_length=20)
+    with arcpy.da.InsertCursor(
+        v_tops, ["SHAPE@XY", "gridcode", n_field_name]
+    ) as cursor:
+        for label, row, col, oid in zip(
+            tops["label"].tolist(),
+            tops["row"].tolist(),
+            tops["col"].tolist(),
+            unit_oids.tolist(),
+        ):
+            x = x_min + (col + 0.5) * cell_size
+            y = y_max - (row + 0.5) * cell_size
+            cursor.insertRow(((x, y), label, n_codes.get(oid)))
+    logger.info("\t\t{} tree tops".format(len(tops["label"])))
+    return r_watersheds
+
+
 # ------------------------------------------------------ #
 # 1.6 IDENTIFY TREE TOPS
 # step 7 perform_tree_detection_v2 (version 1 not used)
@@ -465,6 +692,309 @@ def identify_treeCrowns(r_watersheds, v_crown_watershed):
     return v_crown_watershed
 
 
+def simplify_crowns(v_crowns, r_labels, tolerance, max_vertices=None):
+    """
+    Simplifies the crowns along their shared edges (see crown_simplify.py).
+
+    The crowns are vectorized from r_labels with NO_SIMPLIFY, their
+    boundaries are staircases on the cell grid. Each boundary between two
+    crowns is simplified once for both crowns, the crowns stay gap-free and
+    do not overlap. The geometries are updated in place.
+
+    Args:
+        v_crowns (str): crown polygons vectorized from r_labels
+        r_labels (str): crown label raster (cell size and grid origin)
+        tolerance (float): Douglas-Peucker tolerance in map units
+        max_vertices (int, optional): vertex budget per crown
+
+    Returns:
+        dict: number of crowns, vertices before and after
+    """
+    desc = arcpy.Describe(r_labels)
+    simplifier = crown_simplify.SharedEdgeSimplifier(
+        desc.meanCellWidth, (desc.extent.XMin, desc.extent.YMin)
+    )
+    spatial_reference = arcpy.Describe(v_crowns).spatialReference
+
+    # rings of the crowns, the parts are kept as (part, ring) structure
+    oids, polygons, structures = [], [], []
+    with arcpy.da.SearchCursor(v_crowns, ["OID@", "SHAPE@"]) as cursor:
+        for oid, shape in cursor:
+            if shape is None:
+                continue
+            rings, structure = [], []
+            for p, part in enumerate(shape):
+                ring = []
+                for point in part:
+                    if point is None:  # start of an interior ring
+                        rings.append(np.array(ring))
+                        structure.append(p)
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+                rings.append(np.array(ring))
+                structure.append(p)
+            oids.append(oid)
+            polygons.append(rings)
+            structures.append(structure)
+
+    logger.info(
+        "\t\tSimplifying the shared edges of {} crowns (tolerance {} m{})...".format(
+            len(polygons),
+            tolerance,
+            "" if not max_vertices else f", max. {max_vertices} vertices",
+        )
+    )
+    simplified, stats = simplifier.simplify(polygons, tolerance, max_vertices)
+
+    geometries = {}
+    for oid, rings, structure in zip(oids, simplified, structures):
+        parts = {}
+        for p, ring in zip(structure, rings):
+            part = parts.setdefault(p, arcpy.Array())
+            if part.count:
+                part.add(None)
+            for x, y in ring:
+                part.add(arcpy.Point(x, y))
+        geometries[oid] = arcpy.Polygon(
+            arcpy.Array(list(parts.values())), spatial_reference
+        )
+    with arcpy.da.UpdateCursor(v_crowns, ["OID@", "SHAPE@"]) as cursor:
+        for oid, _ in cursor:
+            if oid in geometries:
+                cursor.updateRow((oid, geometries[oid]))
+
+    logger.info(
+        "\t\tVertices:\t{} -> {} ({:.1%} removed)".format(
+            stats["vertices_before"],
+            stats["vertices_after"],
+            1 - stats["vertices_after"] / max(stats["vertices_before"], 1),
+        )
+    )
+    return stats
+
+
+# ------------------------------------------------------ #
+#  2.1 OTHER TREES
+# ------------------------------------------------------ #
+
+
+def create_fkbMask(
+    r_chm,
+    fkb_veg_omrade,
+    fkb_bygning_omrade,
+    r_fkb_mask,
+    scratch_gdb,
+    building_buffer=2,
+):
+    """
+    Rasterizes the FKB roads and the buffered FKB buildings once for the
+    municipality on the CHM grid.
+
+    The cells of the mask hold array_engine.ROAD_BIT where the cell centre
+    is on a road and array_engine.BUILDING_BIT where it is within
+    building_buffer of a building (8 bit unsigned, 0 elsewhere). The
+    other-trees step removes the crowns with a cell on the mask instead of
+    selecting them by location against the FKB layers per neighbourhood.
+
+    The intermediate rasters have the extent of the municipal CHM and are
+    written to a file gdb (scratch_gdb), they do not fit in memory.
+
+    Args:
+        r_chm (str): municipal CHM (grid of the mask)
+        fkb_veg_omrade (str): FKB road polygons
+        fkb_bygning_omrade (str): FKB building polygons
+        r_fkb_mask (str): output mask raster
+        scratch_gdb (str): existing file gdb of the intermediate data
+        building_buffer (float): search distance of the buildings in meters
+    """
+    desc = arcpy.Describe(r_chm)
+    cell_size = desc.meanCellWidth
+    v_buildings = os.path.join(scratch_gdb, "fkb_buildings_buffer")
+    r_roads = os.path.join(scratch_gdb, "fkb_roads")
+    r_buildings = os.path.join(scratch_gdb, "fkb_buildings")
+
+    logger.info(
+        "\t\tBuffering the FKB buildings by {} m...".format(building_buffer)
+    )
+    arcpy.analysis.PairwiseBuffer(
+        in_features=fkb_bygning_omrade,
+        out_feature_class=v_buildings,
+        buffer_distance_or_field="{} Meters".format(building_buffer),
+        dissolve_option="NONE",
+    )
+
+    logger.info(
+        "\t\tRasterizing the FKB roads and buildings on the CHM grid..."
+    )
+    with arcpy.EnvManager(
+        snapRaster=r_chm,
+        extent=desc.extent,
+        cellSize=cell_size,
+        scratchWorkspace=scratch_gdb,
+    ):
+        for v_fkb, r_fkb in [
+            (fkb_veg_omrade, r_roads),
+            (v_buildings, r_buildings),
+        ]:
+            arcpy.conversion.PolygonToRaster(
+                in_features=v_fkb,
+                value_field=arcpy.Describe(v_fkb).OIDFieldName,
+                out_rasterdataset=r_fkb,
+                cell_assignment="CELL_CENTER",
+                cellsize=cell_size,
+            )
+        r_mask = Con(IsNull(r_roads), 0, array_engine.ROAD_BIT) + Con(
+            IsNull(r_buildings), 0, array_engine.BUILDING_BIT
+        )
+        arcpy.management.CopyRaster(
+            r_mask, r_fkb_mask, pixel_type="8_BIT_UNSIGNED"
+        )
+
+    for layer in [v_buildings, r_roads, r_buildings]:
+        arcpy.Delete_management(layer)
+    return r_fkb_mask
+
+
+def create_emptyTrees(v_trees, geometry_type, r_chm):
+    """
+    Creates an empty feature class of tree tops or crowns with the gridcode
+    field of the vectorized trees, for a CHM (part) without trees.
+
+    Args:
+        v_trees (str): path to the output feature class
+        geometry_type (str): "POINT" (tops) or "POLYGON" (crowns)
+        r_chm (str): CHM, defines the spatial reference
+    """
+    arcpy.CreateFeatureclass_management(
+        out_path=os.path.dirname(v_trees),
+        out_name=os.path.basename(v_trees),
+        geometry_type=geometry_type,
+        spatial_reference=arcpy.Describe(r_chm).spatialReference,
+    )
+    arcpy.AddField_management(v_trees, "gridcode", "LONG")
+    return v_trees
+
+
+def identify_otherTreeCrowns(
+    r_chm,
+    v_crown_watershed,
+    r_crown_labels,
+    r_other_labels,
+    v_other_crowns,
+    min_area=12,
+    r_fkb_mask=None,
+    extent=None,
+):
+    """
+    Identifies the crowns of trees that are not detected by the watershed
+    segmentation method in the raster domain.
+
+    The watershed crowns are rasterized on the CHM grid, the CHM cells that
+    are not covered by (or touch) a crown are grouped into connected
+    components and components smaller than min_area are removed by their
+    cell count. With r_fkb_mask, the components with a cell on a road or
+    near a building are removed as well (see create_fkbMask). Only the
+    remaining components are converted to polygons. With extent, only that
+    part of the CHM is processed.
+
+    Args:
+        r_chm (str): path to the CHM raster
+        v_crown_watershed (str): path to the watershed crowns
+        r_crown_labels (str): path to the rasterized crowns (temporary)
+        r_other_labels (str): path to the labelled other crowns (temporary)
+        v_other_crowns (str): path to the output crowns
+        min_area (float): minimum crown area in m2
+        r_fkb_mask (str, optional): FKB road and building mask on the CHM
+            grid
+        extent (arcpy.Extent, optional): part of the CHM that is processed,
+            defaults to the extent of the CHM
+    """
+    logger.info(
+        "\t\tLabelling the CHM cells that are not covered by watershed crowns..."
+    )
+    desc = arcpy.Describe(r_chm)
+    cell_size = desc.meanCellWidth
+
+    # processing window snapped to the CHM grid
+    if extent is None:
+        extent = desc.extent
+    x_min = desc.extent.XMin + cell_size * round(
+        (max(extent.XMin, desc.extent.XMin) - desc.extent.XMin) / cell_size
+    )
+    y_min = desc.extent.YMin + cell_size * round(
+        (max(extent.YMin, desc.extent.YMin) - desc.extent.YMin) / cell_size
+    )
+    n_cols = int(
+        round((min(extent.XMax, desc.extent.XMax) - x_min) / cell_size)
+    )
+    n_rows = int(
+        round((min(extent.YMax, desc.extent.YMax) - y_min) / cell_size)
+    )
+    lower_left = arcpy.Point(x_min, y_min)
+
+    # rasterize the watershed crowns on the same grid
+    with arcpy.EnvManager(snapRaster=r_chm, extent=desc.extent):
+        arcpy.conversion.PolygonToRaster(
+            in_features=v_crown_watershed,
+            value_field="OBJECTID",
+            out_rasterdataset=r_crown_labels,
+            cell_assignment="CELL_CENTER",
+            cellsize=cell_size,
+        )
+
+    nodata = -9999
+    chm = arcpy.RasterToNumPyArray(
+        r_chm, lower_left, n_cols, n_rows, nodata_to_value=nodata
+    )
+    crown_labels = arcpy.RasterToNumPyArray(
+        r_crown_labels, lower_left, n_cols, n_rows, nodata_to_value=0
+    )
+
+    labels, n_labels = array_engine.other_tree_components(
+        chm, crown_labels, cell_size, min_area, nodata
+    )
+    logger.info(
+        "\t\t{} crowns of at least {} m2 are not covered by watershed crowns.".format(
+            n_labels, min_area
+        )
+    )
+
+    if r_fkb_mask is not None and n_labels > 0:
+        fkb_mask = arcpy.RasterToNumPyArray(
+            r_fkb_mask, lower_left, n_cols, n_rows, nodata_to_value=0
+        )
+        labels, n_labels, n_dropped = array_engine.drop_maskedComponents(
+            labels, n_labels, fkb_mask
+        )
+        logger.info(
+            "\t\t{} crowns are on the FKB road and building mask and are deleted.".format(
+                n_dropped
+            )
+        )
+
+    if n_labels == 0:
+        # RasterToPolygon fails on a raster without data
+        return create_emptyTrees(v_other_crowns, "POLYGON", r_chm)
+
+    r_labels = arcpy.NumPyArrayToRaster(
+        labels, lower_left, cell_size, cell_size, value_to_nodata=0
+    )
+    r_labels.save(r_other_labels)
+    arcpy.DefineProjection_management(r_other_labels, desc.spatialReference)
+
+    arcpy.RasterToPolygon_conversion(
+        in_raster=r_other_labels,
+        out_polygon_features=v_other_crowns,
+        simplify="SIMPLIFY",
+        raster_field="Value",
+        create_multipart_features="SINGLE_OUTER_PART",
+        max_vertices_per_feature="",
+    )
+
+    return v_other_crowns
+
+
 # ------------------------------------------------------ #
 #  1.8
 # ------------------------------------------------------ #
@@ -0,0 +1,237 @@
+"""Void filling of elevation grids, one block at a time.
+
+LasDatasetToRaster fills the empty cells of the DTM and DSM with a LINEAR
+interpolation (a triangulation of the cell values). In urban tiles the ground
+grid has large voids under buildings and dense canopy. fill_voids() fills
+them without a triangulation of the whole grid:
+
+- the grid is processed in blocks of block_size x block_size cells, a block
+  without voids is skipped
+- small voids (a few edge-connected cells, e.g. missing ground points
+  between trees) are inpainted with the mean of their neighbours, a few
+  filter passes
+- a block is read with a halo of data cells around it, only the data cells
+  on the edge of a large void (in block + halo) are triangulated, once per
+  block
+- only the void cells of the block (not of the halo) are interpolated in the
+  triangles that contain them (barycentric weights), void cells outside the
+  triangulation get the value of the nearest cell
+
+The memory use depends on the block size and the halo, not on the grid
+size. A void that is larger than the halo is filled from the edges that are
+within the halo.
+
+Usage:
+    dtm = fill_voids(dtm, method="linear")
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# void fill methods
+METHODS = ("linear", "nearest")
+
+# voids of at most this number of edge-connected cells are inpainted, not
+# triangulated
+SMALL_VOID = 16
+
+
+def _fill_nearest(array: np.ndarray, voids: np.ndarray) -> np.ndarray:
+    """Returns the array with the voids set to the nearest data cell."""
+    from scipy import ndimage
+
+    if not voids.any() or voids.all():
+        return array.copy()
+    indices = ndimage.distance_transform_edt(
+        voids, return_distances=False, return_indices=True
+    )
+    return array[tuple(indices)]
+
+
+def _inpaint_small(
+    array: np.ndarray, voids: np.ndarray, max_cells: int
+) -> np.ndarray:
+    """
+    Fills the voids of at most max_cells cells with the mean of their data
+    neighbours, from the edge inwards.
+
+    The voids are connected through the cell edges only. Scattered empty
+    cells that touch at a corner stay separate small voids, the rim of a
+    void of diagonal chains would be most of the data cells of the window.
+
+    Args:
+        array (np.ndarray): 2D float window with NaN in the voids
+        voids (np.ndarray): boolean mask of the voids
+        max_cells (int): largest void that is inpainted
+
+    Returns:
+        np.ndarray: boolean mask of the voids that are left (the large voids
+            and the cells without a data cell around)
+    """
+    from scipy import ndimage
+
+    structure = np.ones((3, 3), bool)
+    labels, n_voids = ndimage.label(voids)
+    if n_voids == 0:
+        return voids
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    small = (sizes <= max_cells)[labels] & voids
+    if not small.any():
+        return voids
+
+    # only the bounding box of the small voids is filtered
+    rows, cols = np.nonzero(small)
+    r0, r1 = max(rows.min() - 1, 0), rows.max() + 2
+    c0, c1 = max(cols.min() - 1, 0), cols.max() + 2
+    sub = array[r0:r1, c0:c1]
+    todo = small[r0:r1, c0:c1].copy()
+    valid = ~voids[r0:r1, c0:c1]
+    while todo.any():
+        data = np.where(valid, sub, 0.0)
+        total = ndimage.convolve(
+            data, structure.astype(sub.dtype), mode="constant"
+        )
+        count = ndimage.convolve(
+            valid.astype(np.float32),
+            structure.astype(np.float32),
+            mode="constant",
+        )
+        ready = todo & (count > 0)
+        if not ready.any():
+            # voids without a data cell in the window
+            break
+        sub[ready] = total[ready] / count[ready]
+        valid = valid | ready
+        todo = todo & ~ready
+    left = voids.copy()
+    left[r0:r1, c0:c1] &= ~valid
+    return left
+
+
+def _fill_linear(
+    array: np.ndarray, voids: np.ndarray, block: tuple = None
+) -> np.ndarray:
+    """
+    Interpolates the voids of a window in one triangulation of its void
+    edges.
+
+    Args:
+        array (np.ndarray): 2D float window with NaN in the voids
+        voids (np.ndarray): boolean mask of the voids
+        block (tuple, optional): row and column slices of the cells to fill,
+            the whole window by default
+
+    Returns:
+        np.ndarray: the filled window, voids without data around are NaN
+    """
+    from scipy import ndimage
+    from scipy.spatial import Delaunay
+
+    filled = array.copy()
+    voids = _inpaint_small(filled, voids, SMALL_VOID)
+    if not voids.any():
+        return filled
+    array = filled.copy()
+    # data cells that touch a void (8-neighbourhood)
+    edges = (
+        ndimage.binary_dilation(voids, structure=np.ones((3, 3), bool)) & ~voids
+    )
+    if np.count_nonzero(edges) < 3:
+        return _fill_nearest(array, voids)
+
+    points = np.column_stack(np.nonzero(edges)).astype(np.float64)
+    values = array[edges]
+    if block is not None:
+        # the halo cells are read for their data only
+        in_block = np.zeros(voids.shape, dtype=bool)
+        in_block[block] = True
+        voids = voids & in_block
+    targets = np.column_stack(np.nonzero(voids)).astype(np.float64)
+    try:
+        triangulation = Delaunay(points)
+    except (ValueError, RuntimeError):
+        # edge cells on one line, no triangles
+        return _fill_nearest(array, voids)
+
+    simplex = triangulation.find_simplex(targets)
+    inside = simplex >= 0
+    transform = triangulation.transform[simplex[inside]]
+    b = np.einsum(
+        "ijk,ik->ij", transform[:, :2], targets[inside] - transform[:, 2]
+    )
+    weights = np.column_stack([b, 1.0 - b.sum(axis=1)])
+    corners = values[triangulation.simplices[simplex[inside]]]
+    void_values = np.full(len(targets), np.nan, dtype=array.dtype)
+    void_values[inside] = (corners * weights).sum(axis=1)
+    filled[voids] = void_values
+
+    # voids outside the triangulation (at the window edge)
+    remaining = np.isnan(filled)
+    if remaining.any():
+        filled = _fill_nearest(filled, remaining)
+    return filled
+
+
+def fill_voids(
+    array: np.ndarray,
+    method: str = "linear",
+    block_size: int = 1024,
+    halo: int = 64,
+) -> np.ndarray:
+    """
+    Fills the NaN cells of an elevation grid.
+
+    Args:
+        array (np.ndarray): 2D float array with NaN in empty cells
+        method (str): "linear" (triangulation of the void edges, as the
+            LINEAR void fill of LasDatasetToRaster) or "nearest"
+        block_size (int): number of rows and columns of a block
+        halo (int): number of cells read around a block
+
+    Returns:
+        np.ndarray: the filled array (a copy)
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown void fill method {method}, use {METHODS}")
+    voids = np.isnan(array)
+    if not voids.any() or voids.all():
+        return array.copy()
+    if method == "nearest":
+        return _fill_nearest(array, voids)
+
+    filled = array.copy()
+    n_rows, n_cols = array.shape
+    n_blocks = 0
+    for r0 in range(0, n_rows, block_size):
+        r1 = min(r0 + block_size, n_rows)
+        for c0 in range(0, n_cols, block_size):
+            c1 = min(c0 + block_size, n_cols)
+            if not voids[r0:r1, c0:c1].any():
+                continue
+            # block with halo
+            hr0, hr1 = max(r0 - halo, 0), min(r1 + halo, n_rows)
+            hc0, hc1 = max(c0 - halo, 0), min(c1 + halo, n_cols)
+            window = _fill_linear(
+                array[hr0:hr1, hc0:hc1],
+                voids[hr0:hr1, hc0:hc1],
+                (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0)),
+            )
+            filled[r0:r1, c0:c1] = window[
+                r0 - hr0 : r1 - hr0, c0 - hc0 : c1 - hc0
+            ]
+            n_blocks += 1
+
+    # blocks without data in block + halo
+    remaining = np.isnan(filled)
+    if remaining.any():
+        logger.info(
+            "\t\t\t{} cells without data within the halo of {} cells, nearest fill".format(
+                np.count_nonzero(remaining), halo
+            )
+        )
+        filled = _fill_nearest(filled, remaining)
+    logger.debug(f"\t\t\tvoids filled in {n_blocks} blocks")
+    return filled
@@ -12,28 +12,27 @@ import os
 import time
 
 import arcpy
+import false_positives
 
 # local sub-package modules
 import tree
 from arcpy import env
+from height_encoding import CHM_ENCODING
 from merge_trees import merge_trees
 from split_chm import split_chm_nb
 
 # local sub-package utils
 from src import (
-    COORD_SYSTEM,
-    DATA_PATH,
-    INTERIM_PATH,
     MUNICIPALITY,
-    POINT_DENSITY,
-    PROCESSED_PATH,
-    SPATIAL_REFERENCE,
     AdminAttributes,
+    AttributeBuffer,
     GeometryAttributes,
     LaserAttributes,
+    RunContext,
+    StageGraph,
 )
 from src import arcpy_utils as au
-from src import logger
+from src import get_option, get_run_report, get_workers, logger
 
 # ------------------------------------------------------ #
 # Functions
@@ -46,19 +45,194 @@ def end_time1(start_time1):
     logger.info("\tTIME:\t {:.2f} sec".format(execution_time1))
 
 
-# define the spatial resolution of the DSM/DTM/CHM grid based on lidar point density
-# move to config
-def get_spatial_resolution():
-    if POINT_DENSITY >= 4:
-        spatial_resolution = 0.25
-    elif POINT_DENSITY < 4 and POINT_DENSITY >= 2:
-        spatial_resolution = 0.5
-    else:
-        spatial_resolution = 1
-    return spatial_resolution
+def restrict_toVegetationBlocks(ctx, r_chm_neighb, n_code):
+    """Returns the processing extent of the blocks of the neighbourhood CHM
+    that contain vegetation (see block_index.py), as arcpy environment
+    settings for arcpy.EnvManager. The global environment is not changed.
+
+    Args:
+        ctx (RunContext): context of the run (block index of the CHM)
+        r_chm_neighb (str): path to the CHM of the neighbourhood
+        n_code (str): neighbourhood code
+
+    Returns:
+        tuple: (settings, fraction skipped) the extent and snap raster of the
+            bounding box of the blocks with vegetation and the fraction of
+            the CHM area outside it; ({}, None) if there is no block index,
+            ({}, 1.0) if no block contains vegetation
+    """
+    if ctx.block_index is None or not arcpy.Exists(r_chm_neighb):
+        return {}, None
+
+    extent = arcpy.Describe(r_chm_neighb).extent
+    fraction_empty, occupied_extent = ctx.block_index.query(
+        (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+    )
+    if occupied_extent is None:
+        logger.info(
+            "\t\tThe CHM of neighbourhood <<{}>> contains no vegetation and is skipped.".format(
+                n_code
+            )
+        )
+        return {}, 1.0
+
+    # the extent is the bounding box of the occupied blocks, the empty
+    # blocks inside it are processed
+    x_min, y_min, x_max, y_max = occupied_extent
+    fraction_skipped = 1 - (x_max - x_min) * (y_max - y_min) / (
+        extent.width * extent.height
+    )
+    logger.info(
+        "\t\t{:.1%} of the CHM blocks of neighbourhood <<{}>> contain no vegetation, {:.1%} of the CHM is outside their extent and skipped.".format(
+            fraction_empty, n_code, fraction_skipped
+        )
+    )
+    settings = {
+        "extent": arcpy.Extent(*occupied_extent),
+        "snapRaster": r_chm_neighb,
+    }
+    return settings, fraction_skipped
+
+
+def simplify_treeCrowns(ctx, v_crowns, r_labels):
+    """Simplifies the staircase boundaries of the watershed crowns along
+    their shared edges (tree.simplify_crowns), ctx.crown_tolerance 0 keeps
+    the cell boundaries.
+
+    Args:
+        ctx (RunContext): context of the run
+        v_crowns (str): crowns vectorized from r_labels
+        r_labels (str): crown label raster
+
+    Returns:
+        dict: vertex counts for the run report, empty if not simplified
+    """
+    if not ctx.crown_tolerance:
+        return {}
+    stats = tree.simplify_crowns(
+        v_crowns, r_labels, ctx.crown_tolerance, ctx.crown_max_vertices
+    )
+    return {
+        "crowns": stats["polygons"],
+        "vertices_before": stats["vertices_before"],
+        "vertices_after": stats["vertices_after"],
+    }
+
+
+def detect_watershed_municipality(ctx):
+    """Segments the CHM of the municipality once, block by block (see
+    block_watershed.py). The tree tops get the code of the neighbourhood
+    they are located in, detect_watershed() selects the trees of a
+    neighbourhood by this code.
+
+    Args:
+        ctx (RunContext): context of the run
+    """
+    logger.info("1. Start the municipal watershed segmentation...")
+    if ctx.journal.is_done(
+        "watershed_municipality", ctx.municipality, arcpy.Exists
+    ):
+        logger.info(
+            "\tThe municipal watershed is completed in a previous run. Continue ..."
+        )
+        return
+
+    with get_run_report().stage(
+        "watershed_municipality", ctx.municipality
+    ) as monitor:
+        au.createGDB_ifNotExists(ctx.watershed_gdb)
+        env.overwriteOutput = True
+
+        with au.atomic_outputs(
+            [ctx.r_watersheds, ctx.v_tops_watershed, ctx.v_crowns_watershed]
+        ) as (r_watersheds_tmp, v_tops_tmp, v_crowns_tmp):
+            tree.watershed_municipality(
+                ctx.r_chm,
+                ctx.neighbourhood_path,
+                ctx.n_field_name,
+                r_watersheds_tmp,
+                v_tops_tmp,
+                block_index=ctx.block_index,
+                encoding=CHM_ENCODING,
+            )
+            tree.identify_treeCrowns(r_watersheds_tmp, v_crowns_tmp)
+            simplify_stats = simplify_treeCrowns(
+                ctx, v_crowns_tmp, r_watersheds_tmp
+            )
+
+            # the neighbourhood of a crown is the neighbourhood of its top
+            arcpy.JoinField_management(
+                in_data=v_crowns_tmp,
+                in_field="gridcode",
+                join_table=v_tops_tmp,
+                join_field="gridcode",
+                fields=[ctx.n_field_name],
+            )
+
+        ctx.journal.mark_done(
+            "watershed_municipality",
+            ctx.municipality,
+            [ctx.r_watersheds, ctx.v_tops_watershed, ctx.v_crowns_watershed],
+        )
+        monitor.extra.update(simplify_stats)
 
 
-def detect_watershed(neighbourhood_list, r_chm):
+def create_fkbMask(ctx):
+    """Rasterizes the FKB roads and the buildings (+2m buffer) of the
+    municipality once on the CHM grid (tree.create_fkbMask). The other-trees
+    stage of each neighbourhood looks up its crowns in this mask.
+
+    Args:
+        ctx (RunContext): context of the run
+    """
+    logger.info("Rasterize the FKB roads and buildings of the municipality...")
+    if ctx.journal.is_done("fkb_mask", ctx.municipality, arcpy.Exists):
+        logger.info(
+            "\tThe FKB mask is completed in a previous run. Continue ..."
+        )
+        return
+
+    with get_run_report().stage("fkb_mask", ctx.municipality):
+        env.overwriteOutput = True
+        # the intermediate rasters of the municipal extent
+        scratch_gdb = os.path.join(ctx.interim_path, "fkb_mask.gdb")
+        au.createGDB_ifNotExists(scratch_gdb)
+        with au.atomic_output(ctx.r_fkb_mask) as r_fkb_mask_tmp:
+            tree.create_fkbMask(
+                ctx.r_chm,
+                ctx.fkb_veg_omrade,
+                ctx.fkb_bygning_omrade,
+                r_fkb_mask_tmp,
+                scratch_gdb,
+                building_buffer=2,
+            )
+        arcpy.Delete_management(scratch_gdb)
+        ctx.journal.mark_done("fkb_mask", ctx.municipality, [ctx.r_fkb_mask])
+
+
+def select_municipalTrees(ctx, n_code, v_top_out, v_crown_out):
+    """Copies the trees of a neighbourhood from the municipal watershed.
+
+    Args:
+        ctx (RunContext): context of the run
+        n_code (str): neighbourhood code
+        v_top_out (str): output tree tops
+        v_crown_out (str): output tree crowns
+    """
+    where_clause = f"{ctx.n_field_name} = '{n_code}'"
+    arcpy.Select_analysis(ctx.v_tops_watershed, v_top_out, where_clause)
+    arcpy.Select_analysis(ctx.v_crowns_watershed, v_crown_out, where_clause)
+    # the code is added again with the other admin attributes (1.7)
+    for fc in [v_top_out, v_crown_out]:
+        arcpy.DeleteField_management(fc, [ctx.n_field_name])
+    logger.info(
+        "\t\t{} tree tops in neighbourhood <<{}>>".format(
+            arcpy.GetCount_management(v_top_out)[0], n_code
+        )
+    )
+
+
+def detect_watershed(ctx, neighbourhood_list):
     logger = logging.getLogger(__name__)
     logger.info("1. Start watershed segmentation method...")
     logger.info("-" * 100)
@@ -71,252 +245,332 @@ def detect_watershed(neighbourhood_list, r_chm):
         logger.info("\tPROCESSING NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("\t---------------------".format())
 
-        # temporary filegdb containing detected trees per neighbourhood
-        filegdb_path = os.path.join(
-            tree_detection_path, "tree_detection_b" + n_code + ".gdb"
-        )
-        au.createGDB_ifNotExists(filegdb_path)
-
-        # workspace settings
-        env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
-        # not necessary as full paths are used, change accordingly if you work with relative paths
-        # env.workspace = filegdb_path
+        if ctx.journal.is_done("watershed", n_code, arcpy.Exists):
+            logger.info(
+                "\t\tThe watershed-trees for neighbourhood <<{}>> are completed in a previous run. Continue ...".format(
+                    n_code
+                )
+            )
+            continue
 
-        # ------------------------------------------------------ #
-        # Dynamic Path Variables
-        # ------------------------------------------------------ #
+        with get_run_report().stage("watershed", n_code) as monitor:
+            # temporary filegdb containing detected trees per neighbourhood
+            filegdb_path = ctx.neighbourhood_gdb(n_code)
+            au.createGDB_ifNotExists(filegdb_path)
 
-        # neighbourhood specific file paths
-        v_neighb = os.path.join(split_neighbourhoods_gdb, "b_" + n_code)
-        v_neighb_buffer = os.path.join(
-            split_neighbourhoods_gdb, "b_" + n_code + "_buffer200"
-        )
+            # workspace settings
+            env.overwriteOutput = True
+            env.outputCoordinateSystem = arcpy.SpatialReference(
+                ctx.spatial_reference
+            )
+            # not necessary as full paths are used, change accordingly if you work with relative paths
+            # env.workspace = filegdb_path
 
-        # chm clipped by neighbourhood
-        r_chm_neighb = os.path.join(
-            split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
-        )
+            # ------------------------------------------------------ #
+            # Dynamic Path Variables
+            # ------------------------------------------------------ #
 
-        # watershed segmentation
-        r_chm_flip = os.path.join(filegdb_path, "chm_flip")
-        r_flowdir = os.path.join(filegdb_path, "flowdir")
-        r_sinks = os.path.join(filegdb_path, "sinks")
-        r_watersheds = os.path.join(filegdb_path, "watersheds")
-
-        # identify tree tops
-        r_focflow = os.path.join(filegdb_path, "focflow_temp")
-        v_top_poly = os.path.join(filegdb_path, "top_poly_temp")
-        v_top_singlepoly = os.path.join(filegdb_path, "top_singlepoly_temp")
-        v_top_ws_temp = os.path.join(filegdb_path, "top_ws_temp")
-        v_top_watershed = os.path.join(
-            filegdb_path, "tops_watershed_" + n_code
-        )  # RESULTING tree tops from watershed
-
-        # identify tree crowns
-        v_crown_ws_temp = os.path.join(filegdb_path, "crown_ws_temp")
-        v_crown_watershed = os.path.join(
-            filegdb_path, "crowns_watershed_" + n_code
-        )  # RESULTING tree crowns from watershed
+            # neighbourhood specific file paths
+            v_neighb = os.path.join(ctx.split_neighbourhoods_gdb, "b_" + n_code)
+            v_neighb_buffer = os.path.join(
+                ctx.split_neighbourhoods_gdb, "b_" + n_code + "_buffer200"
+            )
 
-        # ------------------------------------------------------ #
-        # 1.1 Clip CHM to neighbourhood + 200m buffer to avoid edge effects
-        # ------------------------------------------------------ #
-        try:
-            logger.info(
-                "\t1.1 Clip CHM to {} + 200m buffer to avoid edge effects".format(
-                    n_code
-                )
+            # chm clipped by neighbourhood
+            r_chm_neighb = os.path.join(
+                ctx.split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
             )
-            if arcpy.Exists(r_chm_neighb):
+
+            # watershed segmentation
+            r_chm_flip = os.path.join(filegdb_path, "chm_flip")
+            r_flowdir = os.path.join(filegdb_path, "flowdir")
+            r_sinks = os.path.join(filegdb_path, "sinks")
+            r_watersheds = os.path.join(filegdb_path, "watersheds")
+
+            # identify tree tops
+            r_focflow = os.path.join(filegdb_path, "focflow_temp")
+            v_top_poly = os.path.join(filegdb_path, "top_poly_temp")
+            v_top_singlepoly = os.path.join(filegdb_path, "top_singlepoly_temp")
+            v_top_ws_temp = os.path.join(filegdb_path, "top_ws_temp")
+            v_top_watershed = os.path.join(
+                filegdb_path, "tops_watershed_" + n_code
+            )  # RESULTING tree tops from watershed
+
+            # identify tree crowns
+            v_crown_ws_temp = os.path.join(filegdb_path, "crown_ws_temp")
+            v_crown_watershed = os.path.join(
+                filegdb_path, "crowns_watershed_" + n_code
+            )  # RESULTING tree crowns from watershed
+
+            # the resulting trees are written under a temporary name
+            # and published after all attributes are added (step 1.9)
+            v_top_ws_partial = au.partial_path(v_top_watershed)
+            v_crown_ws_partial = au.partial_path(v_crown_watershed)
+
+            # vertex counts of the simplified crowns for the run report
+            simplify_stats = {}
+            if ctx.watershed_mode == "municipality":
+                # the municipal CHM is segmented once (detect_watershed_municipality)
                 logger.info(
-                    "\t\tThe clipped CHM for neighbourhood <<{}>> exists in database. Continue ...".format(
-                        n_code
-                    )
+                    "\t1.1 Select the trees of the neighbourhood from the municipal watershed."
+                )
+                select_municipalTrees(
+                    ctx, n_code, v_top_ws_partial, v_crown_ws_partial
                 )
+                r_chm_height = ctx.r_chm
+                blocks_skipped = None
             else:
-                arcpy.Buffer_analysis(
-                    in_features=v_neighb,
-                    out_feature_class=v_neighb_buffer,
-                    buffer_distance_or_field=200,
+                # ------------------------------------------------------ #
+                # 1.1 Clip CHM to neighbourhood + 200m buffer to avoid edge effects
+                # ------------------------------------------------------ #
+                try:
+                    logger.info(
+                        "\t1.1 Clip CHM to {} + 200m buffer to avoid edge effects".format(
+                            n_code
+                        )
+                    )
+                    if arcpy.Exists(r_chm_neighb):
+                        logger.info(
+                            "\t\tThe clipped CHM for neighbourhood <<{}>> exists in database. Continue ...".format(
+                                n_code
+                            )
+                        )
+                    else:
+                        arcpy.Buffer_analysis(
+                            in_features=v_neighb,
+                            out_feature_class=v_neighb_buffer,
+                            buffer_distance_or_field=200,
+                        )
+
+                        with au.atomic_output(r_chm_neighb) as r_chm_neighb_tmp:
+                            arcpy.Clip_management(
+                                in_raster=ctx.r_chm,
+                                out_raster=r_chm_neighb_tmp,
+                                in_template_dataset=v_neighb_buffer,
+                                clipping_geometry="ClippingGeometry",
+                            )
+
+                except Exception as e:
+                    # catch any exception and print error message.
+                    logger.info(f"\t\tERROR: {e}. \nContinue...")
+
+                # restrict the processing extent to the blocks with vegetation
+                veg_env, blocks_skipped = restrict_toVegetationBlocks(
+                    ctx, r_chm_neighb, n_code
                 )
-
-                arcpy.Clip_management(
-                    in_raster=r_chm,
-                    out_raster=r_chm_neighb,
-                    in_template_dataset=v_neighb_buffer,
-                    clipping_geometry="ClippingGeometry",
+                if blocks_skipped == 1:
+                    # no block contains vegetation, steps 1.2-1.4 are skipped
+                    tree.create_emptyTrees(v_top_ws_temp, "POINT", r_chm_neighb)
+                    tree.create_emptyTrees(
+                        v_crown_ws_temp, "POLYGON", r_chm_neighb
+                    )
+                else:
+                    with arcpy.EnvManager(**veg_env):
+                        # ------------------------------------------------------ #
+                        # 1.2 THE WATERSHED SEGMENTATION METHOD
+                        #     Flip CHM (old 1.11)
+                        #     Compute flow direction (old 1.12)
+                        #     Identify sinks (old 1.13)
+                        #     Identify watersheds (old 1.14)
+                        # ------------------------------------------------------ #
+
+                        try:
+                            logger.info(
+                                "\t1.2 The Watershed Segmentation Method"
+                            )
+                            start_time1 = time.time()
+                            if arcpy.Exists(r_watersheds):
+                                logger.info(
+                                    "\t\t The watershed raster for neighbourhood <<{}>> exists in database. Continue ...".format(
+                                        n_code
+                                    )
+                                )
+                            else:
+                                # nested function for watershed segmentation method
+                                with au.atomic_output(
+                                    r_watersheds
+                                ) as r_watersheds_tmp:
+                                    tree.watershed_segmentation(
+                                        r_chm_neighb,
+                                        r_chm_flip,
+                                        r_flowdir,
+                                        r_sinks,
+                                        r_watersheds_tmp,
+                                    )
+                                end_time1(start_time1)
+                        except Exception as e:
+                            # catch any exception and print error message.
+                            logger.info(f"\t\tERROR: {e}. \nContinue...")
+
+                        # ------------------------------------------------------ #
+                        # 1.3 IDENTIFY TREE TOPS
+                        #     Identify tree tops (I) by identifying focal flow (old 1.15)
+                        #     Identify tree tops (II) by converting focal flow values from 0 to 1 (old 1.16)
+                        #     Vectorize tree tops to polygons (old 1.17)
+                        #     Convert tree top polygons to points (old 1.18)
+                        # ------------------------------------------------------ #
+
+                        try:
+                            logger.info("\t1.3 Identify Tree Tops  ")
+                            start_time1 = time.time()
+                            if arcpy.Exists(v_top_ws_temp):
+                                logger.info(
+                                    "\t\tThe treetop vector for neighbourhood <<{}>> exists in database. Continue ...".format(
+                                        n_code
+                                    )
+                                )
+                            else:
+                                # nested function to identify treeTops
+                                with au.atomic_output(v_top_ws_temp) as tmp_top:
+                                    tree.identify_treeTops(
+                                        r_sinks,
+                                        r_focflow,
+                                        v_top_poly,
+                                        v_top_singlepoly,
+                                        tmp_top,
+                                    )
+                                end_time1(start_time1)
+                        except Exception as e:
+                            # catch any exception and print error message.
+                            logger.info(f"\t\tERROR: {e}. \nContinue...")
+
+                        # ------------------------------------------------------ #
+                        #  1.4 IDENTIFY TREE CROWNS
+                        #      Identify tree crowns by vectorizing watersheds (old 1.19)
+                        # ------------------------------------------------------ #
+
+                        logger.info("\t1.4 Identify Tree Crowns ")
+                        start_time1 = time.time()
+                        if arcpy.Exists(v_crown_ws_temp):
+                            logger.info(
+                                "\t\tThe tree crown vector for neighbourhood <<{}>> exists in database. Continue ...".format(
+                                    n_code
+                                )
+                            )
+                        else:
+                            with au.atomic_output(v_crown_ws_temp) as tmp_crown:
+                                tree.identify_treeCrowns(
+                                    r_watersheds, tmp_crown
+                                )
+                                simplify_stats = simplify_treeCrowns(
+                                    ctx, tmp_crown, r_watersheds
+                                )
+                            end_time1(start_time1)
+
+                # ------------------------------------------------------ #
+                # 1.5 DELETE TREES THAT ARE NOT WHITHIN THE NEIGHBOURHOOD
+                # ------------------------------------------------------ #
+
+                # TOPS
+                logger.info(
+                    "\t1.5 Delete trees that are not located whithin the neighbourhood."
                 )
 
-        except Exception as e:
-            # catch any exception and print error message.
-            logger.info(f"\t\tERROR: {e}. \nContinue...")
-
-        # ------------------------------------------------------ #
-        # 1.2 THE WATERSHED SEGMENTATION METHOD
-        #     Flip CHM (old 1.11)
-        #     Compute flow direction (old 1.12)
-        #     Identify sinks (old 1.13)
-        #     Identify watersheds (old 1.14)
-        # ------------------------------------------------------ #
-
-        try:
-            logger.info("\t1.2 The Watershed Segmentation Method")
-            start_time1 = time.time()
-            if arcpy.Exists(r_watersheds):
-                logger.info(
-                    "\t\t The watershed raster for neighbourhood <<{}>> exists in database. Continue ...".format(
-                        n_code
-                    )
+                # create a layer using the the tops within the buffered neighbourhood
+                l_top_watershed = arcpy.MakeFeatureLayer_management(
+                    v_top_ws_temp, "lyr_top_watershed"
                 )
-            else:
-                # nested function for watershed segmentation method
-                tree.watershed_segmentation(
-                    r_chm_neighb, r_chm_flip, r_flowdir, r_sinks, r_watersheds
+                arcpy.SelectLayerByLocation_management(
+                    l_top_watershed, "INTERSECT", v_neighb, "", "NEW_SELECTION"
                 )
-                end_time1(start_time1)
-        except Exception as e:
-            # catch any exception and print error message.
-            logger.info(f"\t\tERROR: {e}. \nContinue...")
 
-        # ------------------------------------------------------ #
-        # 1.3 IDENTIFY TREE TOPS
-        #     Identify tree tops (I) by identifying focal flow (old 1.15)
-        #     Identify tree tops (II) by converting focal flow values from 0 to 1 (old 1.16)
-        #     Vectorize tree tops to polygons (old 1.17)
-        #     Convert tree top polygons to points (old 1.18)
-        # ------------------------------------------------------ #
+                # save selection to ouput file
+                arcpy.CopyFeatures_management(
+                    l_top_watershed, v_top_ws_partial  # output
+                )
 
-        try:
-            logger.info("\t1.3 Identify Tree Tops  ")
-            start_time1 = time.time()
-            if arcpy.Exists(v_top_ws_temp):
-                logger.info(
-                    "\t\tThe treetop vector for neighbourhood <<{}>> exists in database. Continue ...".format(
-                        n_code
-                    )
+                # CROWNS
+                # create a layer using the the crowns within the buffered neighbourhood
+                l_crown_watershed = arcpy.MakeFeatureLayer_management(
+                    v_crown_ws_temp, "lyr_crown_watershed"
                 )
-            else:
-                # nested function to identify treeTops
-                tree.identify_treeTops(
-                    r_sinks,
-                    r_focflow,
-                    v_top_poly,
-                    v_top_singlepoly,
-                    v_top_ws_temp,
+                # only select crowns that intersect with the tree tops that fall within the neighbourhood
+                arcpy.SelectLayerByLocation_management(
+                    l_crown_watershed,
+                    "INTERSECT",
+                    v_top_ws_partial,
+                    "",
+                    "NEW_SELECTION",
                 )
-                end_time1(start_time1)
-        except Exception as e:
-            # catch any exception and print error message.
-            logger.info(f"\t\tERROR: {e}. \nContinue...")
 
-        # ------------------------------------------------------ #
-        #  1.4 IDENTIFY TREE CROWNS
-        #      Identify tree crowns by vectorizing watersheds (old 1.19)
-        # ------------------------------------------------------ #
-
-        logger.info("\t1.4 Identify Tree Crowns ")
-        start_time1 = time.time()
-        if arcpy.Exists(v_crown_ws_temp):
-            logger.info(
-                "\t\tThe tree crown vector for neighbourhood <<{}>> exists in database. Continue ...".format(
-                    n_code
+                # save selection to ouput file
+                arcpy.CopyFeatures_management(
+                    l_crown_watershed, v_crown_ws_partial  # output
                 )
+                r_chm_height = r_chm_neighb
+
+            # ------------------------------------------------------ #
+            # 1.6 ADD METHOD AS ATTRIBUTE TO TREES
+            # ------------------------------------------------------ #
+
+            # init attribute classes, the attributes are staged in memory and
+            # written in one pass per feature class (1.8)
+            crown_buffer = AttributeBuffer(v_crown_ws_partial, deferred=True)
+            top_buffer = AttributeBuffer(v_top_ws_partial, deferred=True)
+            buffers = (crown_buffer, top_buffer)
+            LaserAttribute = LaserAttributes(
+                filegdb_path, v_crown_ws_partial, v_top_ws_partial, *buffers
             )
-        else:
-            tree.identify_treeCrowns(r_watersheds, v_crown_ws_temp)
-            end_time1(start_time1)
-
-        # ------------------------------------------------------ #
-        # 1.5 DELETE TREES THAT ARE NOT WHITHIN THE NEIGHBOURHOOD
-        # ------------------------------------------------------ #
-
-        # TOPS
-        logger.info(
-            "\t1.5 Delete trees that are not located whithin the neighbourhood."
-        )
-
-        # create a layer using the the tops within the buffered neighbourhood
-        l_top_watershed = arcpy.MakeFeatureLayer_management(
-            v_top_ws_temp, "lyr_top_watershed"
-        )
-        arcpy.SelectLayerByLocation_management(
-            l_top_watershed, "INTERSECT", v_neighb, "", "NEW_SELECTION"
-        )
-
-        # save selection to ouput file
-        arcpy.CopyFeatures_management(
-            l_top_watershed, v_top_watershed  # output
-        )
-
-        # CROWNS
-        # create a layer using the the crowns within the buffered neighbourhood
-        l_crown_watershed = arcpy.MakeFeatureLayer_management(
-            v_crown_ws_temp, "lyr_crown_watershed"
-        )
-        # only select crowns that intersect with the tree tops that fall within the neighbourhood
-        arcpy.SelectLayerByLocation_management(
-            l_crown_watershed, "INTERSECT", v_top_watershed, "", "NEW_SELECTION"
-        )
-
-        # save selection to ouput file
-        arcpy.CopyFeatures_management(
-            l_crown_watershed, v_crown_watershed  # output
-        )
 
-        # ------------------------------------------------------ #
-        # 1.6 ADD METHOD AS ATTRIBUTE TO TREES
-        # ------------------------------------------------------ #
-
-        # init attribute classes
-        LaserAttribute = LaserAttributes(
-            filegdb_path, v_crown_watershed, v_top_watershed
-        )
+            AdminAttribute = AdminAttributes(
+                filegdb_path, v_crown_ws_partial, v_top_ws_partial, *buffers
+            )
 
-        AdminAttribute = AdminAttributes(
-            filegdb_path, v_crown_watershed, v_top_watershed
-        )
+            logger.info(
+                "\t1.6 Add tree detection method as attribute to trees."
+            )
+            segmentation_method = '"watershed_segmentation"'
+            LaserAttribute.attr_segMethod(segmentation_method)
 
-        logger.info("\t1.6 Add tree detection method as attribute to trees.")
-        segmentation_method = '"watershed_segmentation"'
-        LaserAttribute.attr_segMethod(segmentation_method)
+            # ------------------------------------------------------ #
+            # 1.7 ADD NEIGHBOURHOOD CODE AS ATTRIBUTE TO TREES
+            # ------------------------------------------------------ #
 
-        # ------------------------------------------------------ #
-        # 1.7 ADD NEIGHBOURHOOD CODE AS ATTRIBUTE TO TREES
-        # ------------------------------------------------------ #
+            logger.info("\t1.7 Add neighbourhood code as attribute to trees.")
+            AdminAttribute.delete_adminAttr()
+            AdminAttribute.attr_neighbCode(n_code)
 
-        logger.info("\t1.7 Add neighbourhood code as attribute to trees.")
-        AdminAttribute.delete_adminAttr()
-        AdminAttribute.attr_neighbCode(n_code)
+            # ------------------------------------------------------ #
+            # 1.8 ADD TREE HEIGHT AS ATTRIBUTE TO TREE TOPS
+            # ------------------------------------------------------ #
+            logger.info(
+                "\t1.8 Add tree height and tree altitude as attribute to tree tops."
+            )
+            str_multiplier = CHM_ENCODING.multiplier
+            LaserAttribute.attr_topHeight(
+                v_top_ws_partial, r_chm_height, ctx.r_dtm, str_multiplier
+            )
+            crown_buffer.flush()
+            top_buffer.flush()
+
+            # ------------------------------------------------------ #
+            # 1.9 DELETE TEMPORARY LARYERS
+            # ------------------------------------------------------ #
+            logger.info("\t1.9 Delete temporary layers.")
+            temp_layers = [
+                r_chm_flip,
+                r_flowdir,
+                r_sinks,
+                r_watersheds,
+                r_focflow,
+                v_top_poly,
+                v_top_singlepoly,
+                v_top_ws_temp,
+                v_crown_ws_temp,
+            ]
+            for layer in temp_layers:
+                if arcpy.Exists(layer):
+                    arcpy.Delete_management(layer)
+
+            # publish the complete trees and record the neighbourhood as done
+            au.publish_output(v_top_ws_partial, v_top_watershed)
+            au.publish_output(v_crown_ws_partial, v_crown_watershed)
+            ctx.journal.mark_done(
+                "watershed", n_code, [v_top_watershed, v_crown_watershed]
+            )
 
-        # ------------------------------------------------------ #
-        # 1.8 ADD TREE HEIGHT AS ATTRIBUTE TO TREE TOPS
-        # ------------------------------------------------------ #
-        logger.info(
-            "\t1.8 Add tree height and tree altitude as attribute to tree tops."
-        )
-        str_multiplier = "100x"
-        LaserAttribute.attr_topHeight(
-            v_top_watershed, r_chm_neighb, r_dtm, str_multiplier
-        )
-
-        # ------------------------------------------------------ #
-        # 1.9 DELETE TEMPORARY LARYERS
-        # ------------------------------------------------------ #
-        logger.info("\t1.9 Delete temporary layers.")
-        temp_layers = [
-            r_chm_flip,
-            r_flowdir,
-            r_sinks,
-            r_watersheds,
-            r_focflow,
-            v_top_poly,
-            v_top_singlepoly,
-            v_top_ws_temp,
-            v_crown_ws_temp,
-        ]
-        for layer in temp_layers:
-            arcpy.Delete_management(layer)
+            monitor.extra["blocks_skipped"] = blocks_skipped
+            monitor.extra.update(simplify_stats)
 
     logger.info(
         "Finished modelling treecrowns using the Watershed Segmentation Method ..."
@@ -331,7 +585,7 @@ def detect_watershed(neighbourhood_list, r_chm):
     # ------------------------------------------------------ #
 
 
-def detect_other_trees(neighbourhood_list):
+def detect_other_trees(ctx, neighbourhood_list):
     logger = logging.getLogger(__name__)
     logger.info(
         "2. Start detecting trees that are NOT detected with the watershed segmentation method..."
@@ -340,6 +594,9 @@ def detect_other_trees(neighbourhood_list):
     logger.info("Processing neighbourhoods...")
     logger.info(neighbourhood_list)
 
+    # FKB roads and buildings on the CHM grid, once per municipality
+    create_fkbMask(ctx)
+
     # Detect trees per neighbourhood
     for n_code in neighbourhood_list:
         logger.info("\t---------------------".format())
@@ -347,13 +604,13 @@ def detect_other_trees(neighbourhood_list):
         logger.info("\t---------------------".format())
 
         # temporary filegdb containing detected trees per neighbourhood
-        filegdb_path = os.path.join(
-            tree_detection_path, "tree_detection_b" + n_code + ".gdb"
-        )
+        filegdb_path = ctx.neighbourhood_gdb(n_code)
 
         # workspace settings
         env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
+        env.outputCoordinateSystem = arcpy.SpatialReference(
+            ctx.spatial_reference
+        )
         # not necessary as full paths are used, change accordingly if you work with relative paths
         # env.workspace = filegdb_path
 
@@ -362,11 +619,11 @@ def detect_other_trees(neighbourhood_list):
         # ------------------------------------------------------ #
 
         # neighbourhood specific file paths
-        v_neighb = os.path.join(split_neighbourhoods_gdb, "b_" + n_code)
+        v_neighb = os.path.join(ctx.split_neighbourhoods_gdb, "b_" + n_code)
 
         # chm clipped by neighbourhood
         r_chm_neighb = os.path.join(
-            split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
+            ctx.split_chm_gdb, "chm_" + "b_" + n_code + "_buffer200"
         )
 
         # watershed trees
@@ -375,14 +632,11 @@ def detect_other_trees(neighbourhood_list):
         )  # RESULTING tree crowns from watershed
 
         # other trees
-        v_chm_polygons = os.path.join(filegdb_path, "chm_polygons")
-        v_other_crowns_temp = os.path.join(filegdb_path, "other_crowns_temp")
+        r_crown_labels = os.path.join(filegdb_path, "crown_labels_temp")
+        r_other_labels = os.path.join(filegdb_path, "other_labels_temp")
         v_other_crowns_dissolved = os.path.join(
             filegdb_path, "other_crowns_dissolved_temp"
         )
-        v_other_crowns_all = os.path.join(
-            filegdb_path, "other_crowns_dissolved"
-        )
         v_other_crowns = os.path.join(
             filegdb_path, "crowns_other_" + n_code
         )  # Resulting other crowns
@@ -393,231 +647,188 @@ def detect_other_trees(neighbourhood_list):
             filegdb_path, "tops_other_" + n_code
         )  # Resulting other tops
 
-        if arcpy.Exists(v_other_crowns) and arcpy.Exists(v_other_tops):
+        if ctx.journal.is_done("other_trees", n_code, arcpy.Exists):
             logger.info(
-                "\t\tThe other-trees for neighbourhood <<{}>> exist in database. Continue ...".format(
+                "\t\tThe other-trees for neighbourhood <<{}>> are completed in a previous run. Continue ...".format(
                     n_code
                 )
             )
             continue
 
-        # ------------------------------------------------------ #
-        # 2.1 Convert CHM to polygons
-        # TODO move to tree module
-        # ------------------------------------------------------ #
+        # the resulting trees are written under a temporary name
+        # and published after all attributes are added (step 2.9)
+        v_other_crowns_partial = au.partial_path(v_other_crowns)
+        v_other_tops_partial = au.partial_path(v_other_tops)
+
+        with get_run_report().stage("other_trees", n_code) as monitor:
+            # ------------------------------------------------------ #
+            # 2.1 Label CHM cells that are not covered by watershed trees
+            #     (replaces CHM to polygons, select polygons that do not
+            #     intersect with watershed trees and dissolve polygons)
+            # 2.2 Delete crowns smaller than 12 m2 by their cell count
+            # 2.3 Delete crowns on the FKB road and building mask (2.5) and
+            #     convert the remaining crowns to polygons
+            # ------------------------------------------------------ #
+
+            # if exists continue
+            blocks_skipped = None
+            if not arcpy.Exists(v_other_crowns_dissolved):
+                logger.info(
+                    "\t2.1 Label CHM cells that are not covered by watershed trees"
+                )
+                veg_env, blocks_skipped = restrict_toVegetationBlocks(
+                    ctx, r_chm_neighb, n_code
+                )
+                with au.atomic_output(
+                    v_other_crowns_dissolved
+                ) as v_dissolved_tmp:
+                    if blocks_skipped == 1:
+                        # no block contains vegetation
+                        tree.create_emptyTrees(
+                            v_dissolved_tmp, "POLYGON", r_chm_neighb
+                        )
+                    else:
+                        tree.identify_otherTreeCrowns(
+                            r_chm=r_chm_neighb,
+                            v_crown_watershed=v_crown_watershed,
+                            r_crown_labels=r_crown_labels,
+                            r_other_labels=r_other_labels,
+                            v_other_crowns=v_dissolved_tmp,
+                            min_area=12,
+                            r_fkb_mask=ctx.r_fkb_mask,
+                            extent=veg_env.get("extent"),
+                        )
+
+            # ------------------------------------------------------ #
+            # 2.4 Delete crowns that are not whithin the neighbourhood
+            # ------------------------------------------------------ #
 
-        # if exists continue
-        if not arcpy.Exists(v_chm_polygons):
-            logger.info("\t2.1 Convert CHM to polygons")
-            arcpy.conversion.RasterToPolygon(
-                in_raster=r_chm_neighb,
-                out_polygon_features=v_chm_polygons,
-                simplify="SIMPLIFY",
-                raster_field="Value",
-                create_multipart_features="SINGLE_OUTER_PART",
-                max_vertices_per_feature=None,
+            logger.info(
+                "\t2.4 Delete other trees that are not located whithin the neighbourhood."
             )
 
-        # ------------------------------------------------------ #
-        # 2.2 Select polygons that do not intersect with watershed trees
-        # ------------------------------------------------------ #
-
-        logger.info(
-            "\t2.2 Select polygons that do not intersect with watershed trees"
-        )
-        # create a layer for the converted CHM polygons
-        l_chm_polygons = arcpy.MakeFeatureLayer_management(
-            v_chm_polygons, "lyr_chm_polygons"
-        )
-
-        # inverse selection of watershed trees
-        arcpy.SelectLayerByLocation_management(
-            l_chm_polygons,
-            "INTERSECT",
-            v_crown_watershed,
-            None,
-            "NEW_SELECTION",
-            "INVERT",
-        )
-
-        # save selection to ouput file
-        arcpy.CopyFeatures_management(
-            l_chm_polygons, v_other_crowns_temp  # output
-        )
-
-        # ------------------------------------------------------ #
-        # 2.3 Disolve polygons to crowns
-        # ------------------------------------------------------ #
-        logger.info("\t2.3 Disolve polygons to crowns")
-        arcpy.management.Dissolve(
-            in_features=v_other_crowns_temp,
-            out_feature_class=v_other_crowns_dissolved,
-            dissolve_field=None,
-            statistics_fields=None,
-            multi_part="SINGLE_PART",
-            unsplit_lines="DISSOLVE_LINES",
-            concatenation_separator="",
-        )
-
-        # ------------------------------------------------------ #
-        # 2.4 Delete crowns that are not whithin the neighbourhood
-        # ------------------------------------------------------ #
-
-        logger.info(
-            "\t2.4 Delete other trees that are not located whithin the neighbourhood."
-        )
-
-        # create a layer using the the crowns within the buffered neighbourhood
-        l_other_crowns = arcpy.MakeFeatureLayer_management(
-            v_other_crowns_dissolved, "lyr_crown_watershed"
-        )
-        # only select crowns that intersect with the tree tops that fall within the neighbourhood
-        arcpy.SelectLayerByLocation_management(
-            l_other_crowns, "INTERSECT", v_neighb, "", "NEW_SELECTION"
-        )
-
-        # save selection to ouput file
-        arcpy.CopyFeatures_management(
-            l_other_crowns, v_other_crowns_all  # output
-        )
-
-        # ------------------------------------------------------ #
-        # 2.5 Delete crowns smaller than 4 m2
-        # ------------------------------------------------------ #
-
-        lyr_crowns_other = arcpy.MakeFeatureLayer_management(
-            v_other_crowns_all, "lyr_crowns_other"
-        )
-        lyr_roads = arcpy.MakeFeatureLayer_management(
-            fkb_veg_omrade, "lyr_roads"
-        )
-        lyr_buildings = arcpy.MakeFeatureLayer_management(
-            fkb_bygning_omrade, "lyr_buildings"
-        )
-
-        # ------------------------------------------------------ #
-        # 4.2 Detect False Positives for the other_dissolve_method
-        # ------------------------------------------------------ #
-
-        logger.info(
-            "\t2.5 Detect False Positives for the other tree detection method."
-        )
-        logger.info(
-            "\t Delete trees that intersect with buildings (+2m buffer), roads and are smaller than 12 m2."
-        )
-        # select crowns that intersect or ar within 2m of buildings
-        arcpy.SelectLayerByLocation_management(
-            lyr_crowns_other,
-            "INTERSECT",
-            lyr_buildings,
-            "2",
-            "SUBSET_SELECTION",
-            invert_spatial_relationship=False,
-        )
-
-        # add crowns that intersect with roads to selection
-        arcpy.SelectLayerByLocation_management(
-            lyr_crowns_other,
-            "INTERSECT",
-            lyr_roads,
-            "",
-            "ADD_TO_SELECTION",
-            invert_spatial_relationship=False,
-        )
-
-        # add crowns that are smaller than 12 m2 to selection
-        arcpy.management.SelectLayerByAttribute(
-            in_layer_or_view=lyr_crowns_other,
-            selection_type="ADD_TO_SELECTION",
-            where_clause="Shape_Area < 12",
-        )
-
-        # switch selection e.g. keep on
-        arcpy.SelectLayerByAttribute_management(
-            in_layer_or_view=lyr_crowns_other, selection_type="SWITCH_SELECTION"
-        )
-
-        arcpy.CopyFeatures_management(
-            in_features=lyr_crowns_other, out_feature_class=v_other_crowns
-        )
+            # create a layer using the the crowns within the buffered neighbourhood
+            l_other_crowns = arcpy.MakeFeatureLayer_management(
+                v_other_crowns_dissolved, "lyr_crown_watershed"
+            )
+            # only select crowns that intersect with the tree tops that fall within the neighbourhood
+            arcpy.SelectLayerByLocation_management(
+                l_other_crowns, "INTERSECT", v_neighb, "", "NEW_SELECTION"
+            )
 
-        # ------------------------------------------------------ #
-        # 2.6 Identify "other" tree tops
-        # ------------------------------------------------------ #
+            # save selection to ouput file
+            arcpy.CopyFeatures_management(
+                l_other_crowns, v_other_crowns_partial  # output
+            )
 
-        # polygon to point
-        arcpy.management.FeatureToPoint(
-            in_features=v_other_crowns,
-            out_feature_class=v_other_tops,
-            point_location="INSIDE",
-        )
+            # ------------------------------------------------------ #
+            # 2.5 Detect False Positives for the other_dissolve_method
+            #     crowns that intersect with buildings (+2m buffer) and roads
+            #     are deleted in step 2.3 by a lookup in the FKB mask
+            #     (create_fkbMask), no selection by location per neighbourhood
+            # ------------------------------------------------------ #
+
+            # ------------------------------------------------------ #
+            # 2.6 Identify "other" tree tops
+            # ------------------------------------------------------ #
+
+            # polygon to point
+            arcpy.management.FeatureToPoint(
+                in_features=v_other_crowns_partial,
+                out_feature_class=v_other_tops_partial,
+                point_location="INSIDE",
+            )
 
-        # ------------------------------------------------------ #
-        # 2.8 ADD METHOD AS ATTRIBUTE TO TREES
-        # ------------------------------------------------------ #
+            # ------------------------------------------------------ #
+            # 2.8 ADD METHOD AS ATTRIBUTE TO TREES
+            # ------------------------------------------------------ #
 
-        # init attribute classes
-        LaserAttribute = LaserAttributes(
-            filegdb_path, v_other_crowns, v_other_tops
-        )
+            # init attribute classes, the attributes are staged in memory and
+            # written in one pass per feature class (2.9)
+            crown_buffer = AttributeBuffer(
+                v_other_crowns_partial, deferred=True
+            )
+            top_buffer = AttributeBuffer(v_other_tops_partial, deferred=True)
+            buffers = (crown_buffer, top_buffer)
+            LaserAttribute = LaserAttributes(
+                filegdb_path,
+                v_other_crowns_partial,
+                v_other_tops_partial,
+                *buffers,
+            )
 
-        AdminAttribute = AdminAttributes(
-            filegdb_path, v_other_crowns, v_other_tops
-        )
+            AdminAttribute = AdminAttributes(
+                filegdb_path,
+                v_other_crowns_partial,
+                v_other_tops_partial,
+                *buffers,
+            )
 
-        logger.info("\t2.7 Add tree detection method as attribute to trees.")
+            logger.info(
+                "\t2.7 Add tree detection method as attribute to trees."
+            )
 
-        segmentation_method = '"other_dissolve"'
-        LaserAttribute.attr_segMethod(segmentation_method)
+            segmentation_method = '"other_dissolve"'
+            LaserAttribute.attr_segMethod(segmentation_method)
 
-        # ------------------------------------------------------ #
-        # 2.7 ADD NEIGHBOURHOOD CODE AS ATTRIBUTE TO TREES
-        # ------------------------------------------------------ #
+            # ------------------------------------------------------ #
+            # 2.7 ADD NEIGHBOURHOOD CODE AS ATTRIBUTE TO TREES
+            # ------------------------------------------------------ #
 
-        logger.info("\t2.9 Add neighbourhood code as attribute to trees.")
-        AdminAttribute.delete_adminAttr()
-        AdminAttribute.attr_neighbCode(n_code)
+            logger.info("\t2.9 Add neighbourhood code as attribute to trees.")
+            AdminAttribute.delete_adminAttr()
+            AdminAttribute.attr_neighbCode(n_code)
 
-        # ------------------------------------------------------ #
-        # 2.9 ADD TREE HEIGHT AS ATTRIBUTE TO TREES
-        # ------------------------------------------------------ #
-        logger.info(
-            "\t2.9 Add tree height and tree altitude as attribute to tree tops."
-        )
-        # use zonal max to determin highest value in crown area
-        zonalMax = arcpy.ia.ZonalStatistics(
-            in_zone_data=v_other_crowns,
-            zone_field="OBJECTID",
-            in_value_raster=r_chm_neighb,
-            statistics_type="MAXIMUM",
-            ignore_nodata="DATA",
-            process_as_multidimensional="CURRENT_SLICE",
-            percentile_value=90,
-            percentile_interpolation_type="AUTO_DETECT",
-            circular_calculation="ARITHMETIC",
-            circular_wrap_value=360,
-        )
-        zonalMax.save(r_zonal_max)
+            # ------------------------------------------------------ #
+            # 2.9 ADD TREE HEIGHT AS ATTRIBUTE TO TREES
+            # ------------------------------------------------------ #
+            logger.info(
+                "\t2.9 Add tree height and tree altitude as attribute to tree tops."
+            )
+            # use zonal max to determin highest value in crown area
+            zonalMax = arcpy.ia.ZonalStatistics(
+                in_zone_data=v_other_crowns_partial,
+                zone_field="OBJECTID",
+                in_value_raster=r_chm_neighb,
+                statistics_type="MAXIMUM",
+                ignore_nodata="DATA",
+                process_as_multidimensional="CURRENT_SLICE",
+                percentile_value=90,
+                percentile_interpolation_type="AUTO_DETECT",
+                circular_calculation="ARITHMETIC",
+                circular_wrap_value=360,
+            )
+            zonalMax.save(r_zonal_max)
 
-        str_multiplier = "100x"
+            str_multiplier = CHM_ENCODING.multiplier
 
-        LaserAttribute.attr_topHeight(
-            v_other_tops, r_zonal_max, r_dtm, str_multiplier
-        )
+            LaserAttribute.attr_topHeight(
+                v_other_tops_partial, r_zonal_max, ctx.r_dtm, str_multiplier
+            )
+            crown_buffer.flush()
+            top_buffer.flush()
+
+            # ------------------------------------------------------ #
+            # 2.9 DELETE TEMPORARY LARYERS
+            # ------------------------------------------------------ #
+            logger.info("\t2.9 Delete temporary layers.")
+            temp_layers = [
+                r_crown_labels,
+                r_other_labels,
+                v_other_crowns_dissolved,
+                r_zonal_max,
+            ]
+            for layer in temp_layers:
+                arcpy.Delete_management(layer)
+
+            # publish the complete trees and record the neighbourhood as done
+            au.publish_output(v_other_crowns_partial, v_other_crowns)
+            au.publish_output(v_other_tops_partial, v_other_tops)
+            ctx.journal.mark_done(
+                "other_trees", n_code, [v_other_crowns, v_other_tops]
+            )
 
-        # ------------------------------------------------------ #
-        # 2.9 DELETE TEMPORARY LARYERS
-        # ------------------------------------------------------ #
-        logger.info("\t2.9 Delete temporary layers.")
-        temp_layers = [
-            v_chm_polygons,
-            v_other_crowns_temp,
-            v_other_crowns_dissolved,
-            v_other_crowns_all,
-            r_zonal_max,
-        ]
-        for layer in temp_layers:
-            arcpy.Delete_management(layer)
+            monitor.extra["blocks_skipped"] = blocks_skipped
 
     logger.info(
         "Finished modelling the treecrowns that could not be identified with the watershed segmentation method  ..."
@@ -633,7 +844,7 @@ def detect_other_trees(neighbourhood_list):
 
 
 # TODO move to separate module
-def calculate_attributes():
+def calculate_attributes(ctx, neighbourhood_list):
     logger = logging.getLogger(__name__)
     logger.info("5. Calculate Attributes...")
     logger.info("-" * 100)
@@ -646,164 +857,326 @@ def calculate_attributes():
         logger.info("\tPROCESSING NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("\t---------------------".format())
 
-        # temporary filegdb containing detected trees per neighbourhood
-        filegdb_path = os.path.join(
-            tree_detection_path, "tree_detection_b" + n_code + ".gdb"
-        )
+        if ctx.journal.is_done("attributes", n_code, arcpy.Exists):
+            logger.info(
+                "\t\tThe attributes for neighbourhood <<{}>> are completed in a previous run. Continue ...".format(
+                    n_code
+                )
+            )
+            continue
 
-        # workspace settings
-        env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
-        # not necessary as full paths are used, change accordingly if you work with relative paths
-        # env.workspace = filegdb_path
+        with get_run_report().stage("attributes", n_code) as monitor:
+            # temporary filegdb containing detected trees per neighbourhood
+            filegdb_path = ctx.neighbourhood_gdb(n_code)
 
-        # ------------------------------------------------------ #
-        # Dynamic Path Variables
-        # ------------------------------------------------------ #
-        v_top_temp = os.path.join(filegdb_path, "tops_tmp_" + n_code)
-        v_crown_temp = os.path.join(filegdb_path, "crowns_tmp_" + n_code)
+            # workspace settings
+            env.overwriteOutput = True
+            env.outputCoordinateSystem = arcpy.SpatialReference(
+                ctx.spatial_reference
+            )
+            # not necessary as full paths are used, change accordingly if you work with relative paths
+            # env.workspace = filegdb_path
+
+            # ------------------------------------------------------ #
+            # Dynamic Path Variables
+            # ------------------------------------------------------ #
+            v_top_temp = os.path.join(filegdb_path, "tops_tmp_" + n_code)
+            v_crown_temp = os.path.join(filegdb_path, "crowns_tmp_" + n_code)
+
+            # ------------------------------------------------------ #
+            # 4. Calculate attributes
+            # ------------------------------------------------------ #
+
+            # the attributes are added in place to the merged trees,
+            # if this stage crashes the next run merges the trees again
+            ctx.journal.invalidate("merge_trees", n_code)
+
+            # init class to calculate attributes, all classes stage their
+            # attributes in the same buffers that are written once at the end
+            crown_buffer = AttributeBuffer(v_crown_temp, deferred=True)
+            top_buffer = AttributeBuffer(v_top_temp, deferred=True)
+            buffers = (crown_buffer, top_buffer)
+            AdminAttribute = AdminAttributes(
+                filegdb_path, v_crown_temp, v_top_temp, *buffers
+            )
+            LaserAttribute = LaserAttributes(
+                filegdb_path, v_crown_temp, v_top_temp, *buffers
+            )
+            GeometryAttribute = GeometryAttributes(
+                filegdb_path, v_crown_temp, v_top_temp, *buffers
+            )
+            # calculate attributes for tree crowns
+            # nb_code in loop
+            AdminAttribute.delete_adminAttr()
+            AdminAttribute.attr_crownID(n_code)
+            GeometryAttribute.attr_crownDiam()
+            GeometryAttribute.attr_crownArea()  # crown_area and crown_perimeter
+
+            # calculate attributes for enclosing circle, convex hull and envelope
+            # if you want to keep the temporary MBG layers, set keep_temp=True
+            GeometryAttribute.attr_enclosingCircle(keep_temp=True)
+            GeometryAttribute.attr_convexHull(keep_temp=True)
+            GeometryAttribute.attr_envelope(keep_temp=True)
+
+            # calculate attributes for tree tops
+            # nb_code and tree height/altitude in loop
+            AdminAttribute.delete_adminAttr()
+            AdminAttribute.join_crownID_toTop(ctx.spatial_resolution)
+
+            # join top attributes to crown polygons
+            LaserAttribute.join_topAttr_toCrown()  # tree_height_laser and tree_altit
+            GeometryAttribute.attr_crownVolume()
+            # canopy volume, height percentiles and centroid from the CHM
+            LaserAttribute.attr_canopyProfile(
+                ctx.r_chm, ctx.spatial_resolution, CHM_ENCODING
+            )
 
-        # ------------------------------------------------------ #
-        # 4. Calculate attributes
-        # ------------------------------------------------------ #
+            # write the staged attributes, one pass per feature class
+            crown_buffer.flush()
+            top_buffer.flush()
 
-        # init class to calculate attributes
-        AdminAttribute = AdminAttributes(filegdb_path, v_crown_temp, v_top_temp)
-        LaserAttribute = LaserAttributes(filegdb_path, v_crown_temp, v_top_temp)
-        GeometryAttribute = GeometryAttributes(
-            filegdb_path, v_crown_temp, v_top_temp
-        )
-        # calculate attributes for tree crowns
-        # nb_code in loop
-        AdminAttribute.delete_adminAttr()
-        AdminAttribute.attr_crownID(n_code)
-        GeometryAttribute.attr_crownDiam()
-        GeometryAttribute.attr_crownArea()  # crown_area and crown_perimeter
-
-        # calculate attributes for enclosing circle, convex hull and envelope
-        # if you want to keep the temporary MBG layers, set keep_temp=True
-        GeometryAttribute.attr_enclosingCircle(keep_temp=True)
-        GeometryAttribute.attr_convexHull(keep_temp=True)
-        GeometryAttribute.attr_envelope(keep_temp=True)
-
-        # calculate attributes for tree tops
-        # nb_code and tree height/altitude in loop
-        AdminAttribute.delete_adminAttr()
-        AdminAttribute.join_crownID_toTop()
-
-        # join top attributes to crown polygons
-        LaserAttribute.join_topAttr_toCrown()  # tree_height_laser and tree_altit
-        GeometryAttribute.attr_crownVolume()
+            ctx.journal.mark_done(
+                "attributes", n_code, [v_crown_temp, v_top_temp]
+            )
+            ctx.journal.mark_done(
+                "merge_trees", n_code, [v_crown_temp, v_top_temp]
+            )
+
+            # the run time of the geometry attributes grows with the vertices
+            monitor.extra["crown_vertices"] = au.count_vertices(v_crown_temp)
 
     logger.info("Finished calculating attributes for the detected trees ...")
 
 
 # TODO move to separate module
-def detect_falsePositives(neighbourhood_list):
+def detect_falsePositives(ctx, neighbourhood_list):
     logger = logging.getLogger(__name__)
     logger.info("4. Detect False Positives...")
     logger.info("-" * 100)
     logger.info("Processing neighbourhoods...")
     logger.info(neighbourhood_list)
 
-    # layers for selection
-    lyr_roads = arcpy.MakeFeatureLayer_management(fkb_veg_omrade, "lyr_roads")
-
     # Detect trees per neighbourhood
     for n_code in neighbourhood_list:
         logger.info("\t---------------------".format())
         logger.info("\tPROCESSING NEIGHBOURHOOD <<{}>>".format(n_code))
         logger.info("\t---------------------".format())
 
-        # temporary filegdb containing detected trees per neighbourhood
-        filegdb_path = os.path.join(
-            tree_detection_path, "tree_detection_b" + n_code + ".gdb"
-        )
-        au.createGDB_ifNotExists(filegdb_path)
+        if ctx.journal.is_done("false_positives", n_code, arcpy.Exists):
+            logger.info(
+                "\t\tThe false positives for neighbourhood <<{}>> are completed in a previous run. Continue ...".format(
+                    n_code
+                )
+            )
+            continue
 
-        # workspace settings
-        env.overwriteOutput = True
-        env.outputCoordinateSystem = arcpy.SpatialReference(SPATIAL_REFERENCE)
-        env.workspace = filegdb_path
+        with get_run_report().stage("false_positives", n_code):
+            # temporary filegdb containing detected trees per neighbourhood
+            filegdb_path = ctx.neighbourhood_gdb(n_code)
+            au.createGDB_ifNotExists(filegdb_path)
 
-        # ------------------------------------------------------ #
-        # Dynamic Path Variables
-        # ------------------------------------------------------ #
-        # input
-        v_top_temp = os.path.join(filegdb_path, "tops_tmp_" + n_code)
-        v_crown_temp = os.path.join(filegdb_path, "crowns_tmp_" + n_code)
-        lyr_crown_temp = arcpy.MakeFeatureLayer_management(
-            v_crown_temp, "lyr_crown_temp"
-        )
+            # workspace settings
+            env.overwriteOutput = True
+            env.outputCoordinateSystem = arcpy.SpatialReference(
+                ctx.spatial_reference
+            )
+            env.workspace = filegdb_path
+
+            # ------------------------------------------------------ #
+            # Dynamic Path Variables
+            # ------------------------------------------------------ #
+            # input
+            v_top_temp = os.path.join(filegdb_path, "tops_tmp_" + n_code)
+            v_crown_temp = os.path.join(filegdb_path, "crowns_tmp_" + n_code)
+
+            # output
+            v_top = os.path.join(ctx.ds_tops, "b_" + n_code + "topper")
+            v_crown = os.path.join(ctx.ds_crowns, "b_" + n_code + "_kroner")
+            v_crown_false_positives = os.path.join(
+                ctx.ds_false_positives, "b_" + n_code + "_fp_kroner"
+            )
 
-        # output
-        v_top = os.path.join(ds_tops, "b_" + n_code + "topper")
-        v_crown = os.path.join(ds_crowns, "b_" + n_code + "_kroner")
-        v_crown_false_positives = os.path.join(
-            ds_false_positives, "b_" + n_code + "_fp_kroner"
-        )
+            # ------------------------------------------------------ #
+            # 4.1 Detect False Positives based on polygon geometry
+            # - lampposts: perfect circles that intersect with roads
+            # - outliers in crown_area
+            # - outliers in ratio crown/area convex hull
+            # - outliers in ratio crown/area enclosing circle
+            # ------------------------------------------------------ #
 
-        # ------------------------------------------------------ #
-        # 4.1 Detect False Positives based on polygon geometry
-        # - lampposts: perfect circles that intersect with roads
-        # - outliers in crown_area
-        # - outliers in ratio crown/area convex hull
-        # - outliers in ratio crown/area enclosing circle
-        # ------------------------------------------------------ #
+            logger.info(
+                "\t4.1 Detect False Positives based on polygon geometry."
+            )
 
-        logger.info("\t4.1 Detect False Positives based on polygon geometry.")
+            # roads of the neighbourhood (+200m), clipped once (reference cache)
+            lyr_roads = arcpy.MakeFeatureLayer_management(
+                ctx.reference_layer("fkb_veg_omrade", n_code), "lyr_roads"
+            )
+            columns = false_positives.classify_crowns(v_crown_temp, lyr_roads)
+            arcpy.Delete_management(lyr_roads)
+
+            with au.atomic_outputs(
+                [v_crown_false_positives, v_crown, v_top]
+            ) as (
+                v_fp_partial,
+                v_crown_partial,
+                v_top_partial,
+            ):
+                # export false positives, the crowns that passed the test and
+                # their tops (by crown_id) to separate feature classes
+                false_positives.write_partitions(
+                    v_crown_temp,
+                    v_top_temp,
+                    columns,
+                    v_fp_partial,
+                    v_crown_partial,
+                    v_top_partial,
+                )
 
-        # lamp posts
-        arcpy.SelectLayerByLocation_management(
-            lyr_crown_temp,
-            "INTERSECT",
-            lyr_roads,
-            "",
-            "NEW_SELECTION",
-            invert_spatial_relationship=False,
-        )
+            ctx.journal.mark_done(
+                "false_positives",
+                n_code,
+                [v_crown_false_positives, v_crown, v_top],
+            )
 
-        arcpy.management.SelectLayerByAttribute(
-            in_layer_or_view=lyr_crown_temp,
-            selection_type="SUBSET_SELECTION",
-            where_clause="crown_area > 6.5 And crown_area < 9 And ratio_CA_CHA > 0.85 And ratio_CA_ECA > 0.7",
-        )
+        # ------------------------------------------------------ #
 
-        # geometery outliers
-        arcpy.management.SelectLayerByAttribute(
-            in_layer_or_view=lyr_crown_temp,
-            selection_type="ADD_TO_SELECTION",
-            where_clause="outlier_CA <> 0 Or outlier_ratio_CA_CHA <> 0 Or outlier_ratio_CA_ECA <> 0",
-            invert_where_clause=None,
+    logger.info("Finished detecting false positives ...")
+    logger.info(
+        "The false postives and the cleaned tree dataset is stored in the filegdb {}:\n\t".format(
+            ctx.gdb_laser_urban_trees
         )
+    )
+    return
 
-        # export false positives
-        arcpy.CopyFeatures_management(
-            in_features=lyr_crown_temp,
-            out_feature_class=v_crown_false_positives,
-        )
 
-        # switch selection
-        arcpy.SelectLayerByAttribute_management(
-            in_layer_or_view=lyr_crown_temp, selection_type="SWITCH_SELECTION"
-        )
+def prepare_outputs(ctx):
+    """Creates the folders and file gdbs of the tree detection and splits
+    the neighbourhoods.
+
+    Args:
+        ctx (RunContext): context of the run
+    """
+    # create folder in tree_detection_path if not exits
+    if not os.path.exists(ctx.tree_detection_path):
+        logger.info("Creating folder {} ...".format(ctx.tree_detection_path))
+        os.makedirs(ctx.tree_detection_path, exist_ok=True)
 
-        # copy features that passed the test to separate feature class
-        arcpy.CopyFeatures_management(
-            in_features=lyr_crown_temp, out_feature_class=v_crown
+    # split neighbourhoods
+    if not arcpy.Exists(ctx.split_neighbourhoods_gdb):
+        logger.info("Splitting neighbourhoods...")
+        au.split_neighbourhoods(
+            ctx.neighbourhood_path,
+            ctx.n_field_name,
+            ctx.split_neighbourhoods_gdb,
+        )
+    au.createGDB_ifNotExists(ctx.split_chm_gdb)
+
+    # output gdb and feature datasets
+    au.createGDB_ifNotExists(ctx.gdb_laser_urban_trees)
+    for ds_path in [ctx.ds_false_positives, ctx.ds_crowns, ctx.ds_tops]:
+        au.createDataset_ifNotExists(
+            ctx.gdb_laser_urban_trees,
+            os.path.basename(ds_path),
+            ctx.coord_system,
         )
-        # topology check delete all tops (false positives) that are not within the crown layer
-        tree.topology_crownTop(v_top_temp, v_crown, v_top)
 
-        # ------------------------------------------------------ #
 
-    logger.info("Finished detecting false positives ...")
-    logger.info(
-        "The false postives and the cleaned tree dataset is stored in the filegdb {}:\n\t".format(
-            gdb_laser_urban_trees
+def build_stageGraph(graph=None, municipal_watershed=True):
+    """Declares the stages of the tree detection per neighbourhood.
+
+    The stages of a neighbourhood run in this order, different
+    neighbourhoods are independent: the watershed segmentation of one
+    neighbourhood runs while another is in the other-trees or attributes
+    stage. The CHM (chm) is the input of the graph, add the model_chm and
+    mosaic_chm stages with the output "chm" to run them in the same graph
+    (see segment_trees.py).
+
+    The per-unit stages write into the file gdb of their neighbourhood,
+    except split_chm and false_positives, which write into shared file gdbs
+    and hold a lock on them (one neighbourhood at a time).
+
+    With municipal_watershed the CHM is segmented once for the municipality
+    (ctx.watershed_mode "municipality") and the watershed stage of a
+    neighbourhood only selects its trees.
+
+    Args:
+        graph (StageGraph, optional): graph to add the stages to
+        municipal_watershed (bool): segment the municipal CHM once
+
+    Returns:
+        StageGraph: the graph, run it with graph.run(neighbourhood_list, ctx)
+    """
+    if graph is None:
+        graph = StageGraph("tree_detection")
+    graph.add_stage(
+        "prepare_outputs",
+        prepare_outputs,
+        outputs=["neighbourhoods", "output_datasets"],
+    )
+    graph.add_stage(
+        "split_chm",
+        split_chm_nb,
+        inputs=["chm", "neighbourhoods"],
+        outputs=["chm_neighbourhood"],
+        per_unit=True,
+        locks=["split_neighbourhoods_gdb", "split_chm_gdb"],
+    )
+    if municipal_watershed:
+        graph.add_stage(
+            "watershed_municipality",
+            detect_watershed_municipality,
+            inputs=["chm"],
+            outputs=["municipal_watershed"],
         )
+    graph.add_stage(
+        "watershed",
+        detect_watershed,
+        inputs=(
+            ["municipal_watershed", "neighbourhoods"]
+            if municipal_watershed
+            else ["chm_neighbourhood"]
+        ),
+        outputs=["watershed_trees"],
+        per_unit=True,
     )
-    return
+    graph.add_stage(
+        "fkb_mask",
+        create_fkbMask,
+        inputs=["chm"],
+        outputs=["fkb_mask"],
+        locks=["gdb_elevation_data"],
+    )
+    graph.add_stage(
+        "other_trees",
+        detect_other_trees,
+        inputs=["chm_neighbourhood", "watershed_trees", "fkb_mask"],
+        outputs=["other_trees"],
+        per_unit=True,
+    )
+    graph.add_stage(
+        "merge_trees",
+        merge_trees,
+        inputs=["watershed_trees", "other_trees"],
+        outputs=["merged_trees"],
+        per_unit=True,
+    )
+    graph.add_stage(
+        "attributes",
+        calculate_attributes,
+        inputs=["merged_trees"],
+        outputs=["tree_attributes"],
+        per_unit=True,
+    )
+    graph.add_stage(
+        "false_positives",
+        detect_falsePositives,
+        inputs=["tree_attributes", "output_datasets"],
+        outputs=["laser_trees"],
+        per_unit=True,
+        locks=["gdb_laser_urban_trees"],
+    )
+    return graph
 
 
 if __name__ == "__main__":
@@ -815,35 +1188,17 @@ if __name__ == "__main__":
 
     # start timer
     start_time0 = time.time()
-    kommune = MUNICIPALITY
-    # TODO move get_spatial_resolution() to config file
-    spatial_resolution = get_spatial_resolution()
-
-    # ------------------------------------------------------ #
-    # INPUT PATHS
-    # ------------------------------------------------------ #
 
-    # specific file paths
-    tree_detection_path = os.path.join(INTERIM_PATH, "tree_detection")
-    # create folder in tree_detection_path if not exits
-    if not os.path.exists(tree_detection_path):
-        logger.info("Creating folder {} ...".format(tree_detection_path))
-        os.makedirs(tree_detection_path)
-
-    # admin data
-    admin_data_path = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_admindata.gdb"
-    )
-    study_area_path = os.path.join(admin_data_path, "analyseomrade")
-
-    # neighbourhood list
-    neighbourhood_path = os.path.join(admin_data_path, "bydeler")
-    n_field_name = "bydelnummer"
+    # parameters and paths of the municipality of the run
+    ctx = RunContext.from_config(MUNICIPALITY)
+    kommune = ctx.municipality
 
     # TODO add test an prod config settings
-    user_input = input("Is this a TEST or PROD run? (TEST/PROD):")
+    run_mode = get_option(
+        "run_mode", "Is this a TEST or PROD run? (TEST/PROD):", default="PROD"
+    ).upper()
 
-    if user_input == "TEST" or "test" or "Test":
+    if run_mode == "TEST":
         if kommune == "kristiansand":
             n_test = ["420409", "420411"]
         if kommune == "bodo":
@@ -860,117 +1215,59 @@ if __name__ == "__main__":
         keep_temp = True
         logger.info("\tInterim filegdb's will be kept ...")
 
-    if user_input == "PROD" or "prod" or "Prod":
+    if run_mode == "PROD":
         neighbourhood_list = au.get_neighbourhood_list(
-            neighbourhood_path, n_field_name
+            ctx.neighbourhood_path, ctx.n_field_name
         )
         logger.info("Processing neighbourhoods: {}".format(neighbourhood_list))
         keep_temp = False
         logger.info("\tInterim filegdb's will be deleted ...")
 
     keep_temp = True
-    # split neighbourhoods
-    split_neighbourhoods_gdb = os.path.join(INTERIM_PATH, "bydeler_split.gdb")
-    if not arcpy.Exists(split_neighbourhoods_gdb):
-        logger.info("Splitting neighbourhoods...")
-        au.split_neighbourhoods(
-            neighbourhood_path, n_field_name, split_neighbourhoods_gdb
-        )
-
-    # base data
-    base_data_path = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_basisdata.gdb"
-    )
-    fkb_bygning_omrade = os.path.join(base_data_path, "fkb_bygning_omrade")
-    fkb_vann_omrade = os.path.join(base_data_path, "fkb_vann_omrade")
-    fkb_veg_omrade = os.path.join(base_data_path, "fkb_veg_omrade")
 
     # terrain data
     # if database does not exists exit the code with the message: "The elevation data for the kommune is not available. Please run the script 'model_chm.py' first."
-    gdb_elevation_data = os.path.join(
-        DATA_PATH, kommune, "general", kommune + "_hoydedata.gdb"
-    )
-
-    if not arcpy.Exists(gdb_elevation_data):
+    if not arcpy.Exists(ctx.gdb_elevation_data):
         logger.error(
             f"The elevation and canopy height model data for {kommune} kommune is not available.\
                      \nPlease run the script 'model_chm.py' first."
         )
         exit()
 
-    # canopy height raster (note values are x100)
-    # TODO move chm_025m_int_100x to config file
-    str_resolution = str(spatial_resolution).replace(".", "")
-
-    r_chm = os.path.join(
-        gdb_elevation_data, "chm_" + str(str_resolution) + "m_int_100x"
-    )
-    r_dtm = os.path.join(
-        gdb_elevation_data, "dtm_" + str(str_resolution) + "m_int_100x"
-    )  # for adding tree altitude to tree points
-
-    # split neighbourhoods
-    split_chm_gdb = os.path.join(INTERIM_PATH, "chm_split.gdb")
-    if not arcpy.Exists(split_chm_gdb):
-        au.createGDB_ifNotExists(split_chm_gdb)
-    # TODO check if folder structure exists (especially intierm/tree_detection)
-    # ------------------------------------------------------ #
-    # OUTPUT PATHS
-    # ------------------------------------------------------ #
-
-    gdb_laser_urban_trees = os.path.join(
-        PROCESSED_PATH, kommune + "_laser_bytraer.gdb"
-    )
-    au.createGDB_ifNotExists(gdb_laser_urban_trees)
-
-    ds_false_positives = os.path.join(
-        gdb_laser_urban_trees, "falsk_positive_trekroner"
-    )
-    au.createDataset_ifNotExists(
-        gdb_laser_urban_trees, "falsk_positive_trekroner", COORD_SYSTEM
-    )
-
-    ds_crowns = os.path.join(gdb_laser_urban_trees, "trekroner")
-    au.createDataset_ifNotExists(
-        gdb_laser_urban_trees, "trekroner", COORD_SYSTEM
-    )
-
-    ds_tops = os.path.join(gdb_laser_urban_trees, "tretopper")
-    au.createDataset_ifNotExists(
-        gdb_laser_urban_trees, "tretopper", COORD_SYSTEM
-    )
-
-    # ------------------------------------------------------ #
+    # share of the worker budget of a batch run for the arcpy tools
+    workers = get_workers()
+    if workers:
+        env.parallelProcessingFactor = str(workers)
 
     logger.info("-" * 100)
     logger.info("municipality:\t\t\t" + kommune)
-    logger.info("spatial reference:\t\t" + SPATIAL_REFERENCE)
-    logger.info("Spatial Resolution:\t\t" + str(spatial_resolution))
-    logger.info("Canopy Height Model:\t\t" + os.path.basename(r_chm))
-    logger.info("Output gdb:\t\t\t" + gdb_laser_urban_trees)
+    logger.info("spatial reference:\t\t" + ctx.spatial_reference)
+    logger.info("Spatial Resolution:\t\t" + str(ctx.spatial_resolution))
+    logger.info("Canopy Height Model:\t\t" + os.path.basename(ctx.r_chm))
+    logger.info("Output gdb:\t\t\t" + ctx.gdb_laser_urban_trees)
     logger.info("-" * 100)
 
     # ------------------------------------------------------ #
     # RUN FUNCTIONS
     # ------------------------------------------------------ #
 
-    # TODO move functions to separate modules and run from root
-    split_chm_nb(
-        neighbourhood_list, split_neighbourhoods_gdb, r_chm, split_chm_gdb
+    # the stages per neighbourhood run as soon as the previous stage of
+    # the neighbourhood is finished, one process per running stage
+    graph = build_stageGraph(
+        municipal_watershed=ctx.watershed_mode == "municipality"
     )
-    # detect_watershed(neighbourhood_list, r_chm)
-    detect_other_trees(neighbourhood_list)
-    merge_trees(neighbourhood_list, tree_detection_path)
-    calculate_attributes()
-    detect_falsePositives(neighbourhood_list)
+    graph.run(neighbourhood_list, ctx, workers=workers or 1, processes=True)
 
     # delete all interim filegdb's
     if keep_temp == False:
         logger.info("\n\tDeleting all interim filegdb's ...")
-        for file in os.listdir(tree_detection_path):
+        for file in os.listdir(ctx.tree_detection_path):
             if file.startswith("tree_detection"):
-                arcpy.Delete_management(os.path.join(tree_detection_path, file))
+                arcpy.Delete_management(
+                    os.path.join(ctx.tree_detection_path, file)
+                )
 
     end_time0 = time.time()
     execution_time1 = end_time0 - start_time0
     logger.info("\n\tEXCEUTION TIME:\t {:.2f} sec".format(execution_time1))
+    get_run_report().log_summary()
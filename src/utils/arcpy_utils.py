@@ -1,6 +1,7 @@
 """util functions for working with arcpy."""
 import logging
 import os
+from contextlib import contextmanager
 
 import arcpy
 from arcpy.ia import *
@@ -193,7 +194,8 @@ def copyFeature_ifNotExists(in_fc: str, out_fc: str):
             f"\tFeature {os.path.basename(out_fc)} already exists. Continue..."
         )
     else:
-        arcpy.management.CopyFeatures(in_fc, out_fc)
+        with atomic_output(out_fc) as tmp_fc:
+            arcpy.management.CopyFeatures(in_fc, tmp_fc)
 
 
 def fieldExist(featureclass: str, fieldname: str):
@@ -361,31 +363,141 @@ def deleteDuplicates(table, field):
     # print(f"Unique Tree IDs: {len(unique_tree_ids)}")
 
 
+# --------------------------------------------------------------------------- #
+# Atomic output functions
+# --------------------------------------------------------------------------- #
+
+
+def partial_path(out_path: str) -> str:
+    """
+    Returns the temporary path under which an output is written
+    until it is complete, e.g. <gdb>/crowns_302401_partial.
+
+    Args:
+        out_path (str): path to the final output
+    """
+    root, ext = os.path.splitext(out_path)
+    return root + "_partial" + ext
+
+
+def publish_output(tmp_path: str, out_path: str):
+    """
+    Publishes a completely written output by renaming it to its final name.
+    Renaming is a catalog operation in a fileGDB and does not copy the data.
+    A crash between deleting the old and renaming the new output leaves only
+    the temporary output behind, which is never read by the next run.
+
+    Args:
+        tmp_path (str): path to the complete temporary output
+        out_path (str): path to the final output
+    """
+    if arcpy.Exists(out_path):
+        arcpy.Delete_management(out_path)
+    if os.path.isfile(tmp_path):
+        # plain files, e.g. LAS datasets (.lasd)
+        os.replace(tmp_path, out_path)
+    else:
+        arcpy.Rename_management(tmp_path, out_path)
+
+
+@contextmanager
+def atomic_outputs(out_paths: list):
+    """
+    Context manager that yields temporary paths for a list of outputs and
+    publishes all outputs when the block finishes without an exception.
+    Partial outputs of a previous crashed run are deleted first.
+
+    Example:
+        with au.atomic_outputs([v_top, v_crown]) as (tmp_top, tmp_crown):
+            arcpy.CopyFeatures_management(l_top, tmp_top)
+            arcpy.CopyFeatures_management(l_crown, tmp_crown)
+
+    Args:
+        out_paths (list): paths to the final outputs
+    """
+    tmp_paths = [partial_path(p) for p in out_paths]
+    for tmp_path in tmp_paths:
+        if arcpy.Exists(tmp_path):
+            logger.info(
+                f"\tDeleting partial output {os.path.basename(tmp_path)} of a previous run..."
+            )
+            arcpy.Delete_management(tmp_path)
+    try:
+        yield tmp_paths
+    except Exception:
+        for tmp_path in tmp_paths:
+            if arcpy.Exists(tmp_path):
+                arcpy.Delete_management(tmp_path)
+        raise
+    for tmp_path, out_path in zip(tmp_paths, out_paths):
+        publish_output(tmp_path, out_path)
+
+
+@contextmanager
+def atomic_output(out_path: str):
+    """
+    Context manager that yields a temporary path for one output and
+    publishes the output when the block finishes without an exception.
+
+    Example:
+        with au.atomic_output(v_crown) as tmp_crown:
+            arcpy.CopyFeatures_management(l_crown, tmp_crown)
+
+    Args:
+        out_path (str): path to the final output
+    """
+    with atomic_outputs([out_path]) as tmp_paths:
+        yield tmp_paths[0]
+
+
+def count_vertices(feature_class: str) -> int:
+    """Returns the total number of vertices of the features."""
+    with arcpy.da.SearchCursor(feature_class, ["SHAPE@"]) as cursor:
+        return sum(shape.pointCount for (shape,) in cursor if shape)
+
+
 # --------------------------------------------------------------------------- #
 # Raster functions
 # --------------------------------------------------------------------------- #
 
 
-def convert_toIntRaster(float_raster, int_raster):
+def convert_toIntRaster(float_raster, int_raster, pixel_type=None):
     """Converst a float to an integer raster by first multipyling
     the cell value by 100 and then converting it to integer.
 
     Args:
         float_raster (raster): input raster
         int_raster (raster):
+        pixel_type (str, optional): pixel type of the output, e.g.
+            "16_BIT_SIGNED" for the CHM (see height_encoding.py), defaults
+            to the 32 bit output of Int
     """
     # multiply raster by 1000
     inRaster = Raster(float_raster)
     outTimes = inRaster * 100
     # convert raster to integer
     outInt = Int(outTimes)
-    outInt.save(int_raster)
+    if pixel_type is None:
+        outInt.save(int_raster)
+    else:
+        arcpy.management.CopyRaster(
+            in_raster=outInt,
+            out_rasterdataset=int_raster,
+            pixel_type=pixel_type,
+        )
 
 
 def rasterList_toMosaic(
-    raster_list, ouput_gdb, output_name, coord_system, spatial_resolution
+    raster_list,
+    ouput_gdb,
+    output_name,
+    coord_system,
+    spatial_resolution,
+    pixel_type="32_BIT_SIGNED",
 ):
-    """Mosaics a list of rasters to a new 32 bit signed raster dataset using the mean cell values.
+    """Mosaics a list of rasters to a new integer raster dataset using the mean cell values.
+
+    The mosaic is compressed with LZ77 (lossless).
 
     Args:
         raster_list (_type_): _description_
@@ -393,20 +505,25 @@ def rasterList_toMosaic(
         output_name (_type_): _description_
         COORD_SYSTEM (_type_): _description_
         SPATIAL_RESOLUTION (_type_): _description_
+        pixel_type (str): pixel type of the mosaic, "16_BIT_SIGNED" for
+            the CHM (see height_encoding.py)
     """
     output_name = output_name.replace(".", "-")
 
-    arcpy.management.MosaicToNewRaster(
-        input_rasters=raster_list,
-        output_location=ouput_gdb,
-        raster_dataset_name_with_extension=output_name,
-        coordinate_system_for_the_raster=coord_system,
-        pixel_type="32_BIT_SIGNED",
-        cellsize=spatial_resolution,
-        number_of_bands=1,
-        mosaic_method="MEAN",
-        mosaic_colormap_mode="FIRST",
-    )
+    with atomic_output(
+        os.path.join(ouput_gdb, output_name)
+    ) as tmp_mosaic, arcpy.EnvManager(compression="LZ77"):
+        arcpy.management.MosaicToNewRaster(
+            input_rasters=raster_list,
+            output_location=ouput_gdb,
+            raster_dataset_name_with_extension=os.path.basename(tmp_mosaic),
+            coordinate_system_for_the_raster=coord_system,
+            pixel_type=pixel_type,
+            cellsize=spatial_resolution,
+            number_of_bands=1,
+            mosaic_method="MEAN",
+            mosaic_colormap_mode="FIRST",
+        )
 
 
 # --------------------------------------------------------------------------- #
@@ -1,106 +1,242 @@
-import os
+"""Project configuration.
+
+The configuration is read from ~/trekroner.env and config/config.yaml on first
+use, not when the module is imported. Importing src, or any module that uses
+the constants, is then cheap for worker processes that do not need them.
 
-from dotenv import load_dotenv
+The constants are attributes of the lazy CONFIG object and can still be
+imported by name (e.g. ``from src.utils.config import MUNICIPALITY``), which
+resolves the configuration at that point.
 
-from src.utils import yaml_load
+CONFIG is the configuration of the municipality of the run (config.yaml or
+TREKRONER_MUNICIPALITY). get_config() returns the configuration of any other
+municipality, so one process can work on several municipalities (see
+src/utils/run_context.py).
+"""
+import functools
+import os
 
 # --------------------------------------------------------------------------- #
 # Load YAML dictionairy
 # --------------------------------------------------------------------------- #
 
-# for .env file in USER directory
-# user_dir = C:\\USERS\\<<firstname.lastname>>
-user_dir = os.path.join(os.path.expanduser("~"))
-dotenv_path = os.path.join(user_dir, "trekroner.env")
-load_dotenv(dotenv_path)
 
-# path to yaml project configuration file
-LOCAL_GIT = os.getenv("LOCAL_GIT")
-config_file = os.path.join(
-    LOCAL_GIT, "NINAnor", "urban-treeDetection", "config", "config.yaml"
-)
+def _load_config(municipality: str = None) -> dict:
+    """
+    Reads the project configuration and returns the global constants.
 
-with open(config_file, "r") as f:
-    config = yaml_load(f)
+    Args:
+        municipality (str, optional): municipality of the constants, defaults
+            to TREKRONER_MUNICIPALITY or the municipality in config.yaml
+    """
+    from dotenv import load_dotenv
 
-# --------------------------------------------------------------------------- #
-# Global path variables
-# --------------------------------------------------------------------------- #
+    from src.utils import yaml_load
 
-# get municipality (kommune)
-MUNICIPALITY = config["municipality"]
-
-# get path to log folder
-LOG_PATH = os.path.join(LOCAL_GIT, "src", "log")
-
-# get static datasets
-FKB_BUILDING_PATH = config["paths"]["fkb_building"]
-FKB_WATER_PATH = config["paths"]["fkb_water"]
-SSB_DISTRICT_PATH = config["paths"]["ssb_district"]
-AR5_LANDUSE_PATH = config["paths"]["ar5_landuse"]
-
-# get project data paths
-DATA_PATH = config["paths"]["data_path"]
-TOOL_PATH = config["paths"]["tool_path"]
-RAW_PATH = os.path.join(DATA_PATH, MUNICIPALITY, "urban-treeDetection", "raw")
-INTERIM_PATH = os.path.join(
-    DATA_PATH, MUNICIPALITY, "urban-treeDetection", "interim"
-)
-PROCESSED_PATH = os.path.join(
-    DATA_PATH, MUNICIPALITY, "urban-treeDetection", "processed"
-)
-
-# project file gdbs
-ADMIN_GDB = os.path.join(INTERIM_PATH, f"{MUNICIPALITY}_admin.gdb")
-IN_SITU_TREES_GDB = os.path.join(
-    INTERIM_PATH, MUNICIPALITY + "_in_situ_trees.gdb"
-)  # municipal tree dataset (stem points)
-LASER_TREES_GDB = os.path.join(
-    INTERIM_PATH, MUNICIPALITY + "_laser_trees.gdb"
-)  # segmented laser tree dataset (tree top points, tree crown polygons)
-URBAN_TREES_GDB = os.path.join(
-    PROCESSED_PATH, MUNICIPALITY + "_urban_trees.gdb"
-)  # joined tree dataset (input for itree eco)
+    # for .env file in USER directory
+    # user_dir = C:\\USERS\\<<firstname.lastname>>
+    user_dir = os.path.join(os.path.expanduser("~"))
+    dotenv_path = os.path.join(user_dir, "trekroner.env")
+    load_dotenv(dotenv_path)
 
-# --------------------------------------------------------------------------- #
-# Tree segmentation configuration
-# --------------------------------------------------------------------------- #
-if MUNICIPALITY.lower() == "oslo" or "baerum":
-    SPATIAL_REFERENCE = config["spatial_reference"]["utm32"]
-    COORD_SYSTEM = 'PROJCS["ETRS_1989_UTM_Zone_32N",\
+    # path to yaml project configuration file
+    LOCAL_GIT = os.getenv("LOCAL_GIT")
+    config_file = os.path.join(
+        LOCAL_GIT, "NINAnor", "urban-treeDetection", "config", "config.yaml"
+    )
+
+    with open(config_file, "r") as f:
+        config = yaml_load(f)
+
+    # ----------------------------------------------------------------------- #
+    # Global path variables
+    # ----------------------------------------------------------------------- #
+
+    # get municipality (kommune), a batch run sets it per job
+    MUNICIPALITY = (
+        municipality
+        or os.getenv("TREKRONER_MUNICIPALITY")
+        or config["municipality"]
+    )
+
+    # get path to log folder
+    LOG_PATH = os.path.join(LOCAL_GIT, "src", "log")
+
+    # get static datasets
+    FKB_BUILDING_PATH = config["paths"]["fkb_building"]
+    FKB_WATER_PATH = config["paths"]["fkb_water"]
+    SSB_DISTRICT_PATH = config["paths"]["ssb_district"]
+    AR5_LANDUSE_PATH = config["paths"]["ar5_landuse"]
+
+    # get project data paths
+    DATA_PATH = config["paths"]["data_path"]
+    TOOL_PATH = config["paths"]["tool_path"]
+    RAW_PATH = os.path.join(
+        DATA_PATH, MUNICIPALITY, "urban-treeDetection", "raw"
+    )
+    INTERIM_PATH = os.path.join(
+        DATA_PATH, MUNICIPALITY, "urban-treeDetection", "interim"
+    )
+    PROCESSED_PATH = os.path.join(
+        DATA_PATH, MUNICIPALITY, "urban-treeDetection", "processed"
+    )
+
+    # header catalog of the LAS tiles (see src/data/las_catalog.py)
+    LAS_CATALOG_PATH = os.path.join(INTERIM_PATH, "las_catalog.sqlite")
+
+    # project file gdbs
+    ADMIN_GDB = os.path.join(INTERIM_PATH, f"{MUNICIPALITY}_admin.gdb")
+    IN_SITU_TREES_GDB = os.path.join(
+        INTERIM_PATH, MUNICIPALITY + "_in_situ_trees.gdb"
+    )  # municipal tree dataset (stem points)
+    LASER_TREES_GDB = os.path.join(
+        INTERIM_PATH, MUNICIPALITY + "_laser_trees.gdb"
+    )  # segmented laser tree dataset (tree top points, tree crown polygons)
+    URBAN_TREES_GDB = os.path.join(
+        PROCESSED_PATH, MUNICIPALITY + "_urban_trees.gdb"
+    )  # joined tree dataset (input for itree eco)
+
+    # ----------------------------------------------------------------------- #
+    # Tree segmentation configuration
+    # ----------------------------------------------------------------------- #
+    if MUNICIPALITY.lower() in ("oslo", "baerum"):
+        SPATIAL_REFERENCE = config["spatial_reference"]["utm32"]
+        COORD_SYSTEM = 'PROJCS["ETRS_1989_UTM_Zone_32N",\
             GEOGCS["GCS_ETRS_1989",DATUM["D_ETRS_1989",SPHEROID["GRS_1980",6378137.0,298.257222101]],\
             PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],\
             PROJECTION["Transverse_Mercator"],\
             PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",9.0],\
             PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
-    RGB_AVAILABLE = (
-        False  # set to true if you want to use TGI maks for tree segmentation
-    )
-    VEG_CLASSES_AVAILABLE = True
-    POINT_DENSITY = 10
-    MIN_HEIGHT = 2.5
-    FOCAL_MAX_RADIUS = 1.5
-if MUNICIPALITY.lower() == "kristiansand":
-    SPATIAL_REFERENCE = config["spatial_reference"]["utm32"]
-    COORD_SYSTEM = 'PROJCS["ETRS_1989_UTM_Zone_32N",\
+        RGB_AVAILABLE = False  # set to true if you want to use TGI maks for tree segmentation
+        VEG_CLASSES_AVAILABLE = True
+        POINT_DENSITY = 10
+        MIN_HEIGHT = 2.5
+        FOCAL_MAX_RADIUS = 1.5
+    if MUNICIPALITY.lower() == "kristiansand":
+        SPATIAL_REFERENCE = config["spatial_reference"]["utm32"]
+        COORD_SYSTEM = 'PROJCS["ETRS_1989_UTM_Zone_32N",\
         GEOGCS["GCS_ETRS_1989",DATUM["D_ETRS_1989",SPHEROID["GRS_1980",6378137.0,298.257222101]],\
         PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],\
         PROJECTION["Transverse_Mercator"],\
         PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",9.0],\
         PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
-    RGB_AVAILABLE = False
-    VEG_CLASSES_AVAILABLE = False
-    POINT_DENSITY = 5
-    MIN_HEIGHT = 2.5
-    FOCAL_MAX_RADIUS = 1.5  # specifically tested for Bærum, r= 1.5 gives most realistic results
-if MUNICIPALITY.lower() == "bodo":
-    # Bærum specific configurations
-    SPATIAL_REFERENCE = config["spatial_reference"]["utm33"]
-    RGB_AVAILABLE = False
-    VEG_CLASSES_AVAILABLE = False
-    POINT_DENSITY = 2
-    MIN_HEIGHT = 2
-    FOCAL_MAX_RADIUS = 1  # 1.5 makes trees too big!
+        RGB_AVAILABLE = False
+        VEG_CLASSES_AVAILABLE = False
+        POINT_DENSITY = 5
+        MIN_HEIGHT = 2.5
+        FOCAL_MAX_RADIUS = 1.5  # specifically tested for Bærum, r= 1.5 gives most realistic results
+    if MUNICIPALITY.lower() == "bodo":
+        # Bærum specific configurations
+        SPATIAL_REFERENCE = config["spatial_reference"]["utm33"]
+        RGB_AVAILABLE = False
+        VEG_CLASSES_AVAILABLE = False
+        POINT_DENSITY = 2
+        MIN_HEIGHT = 2
+        FOCAL_MAX_RADIUS = 1  # 1.5 makes trees too big!
+
+    # all upper case names are the global constants
+    return {name: value for name, value in locals().items() if name.isupper()}
+
+
+class LazyConfig:
+    """
+    Project configuration that is resolved on first attribute access.
+
+    Attributes:
+    -----------
+    loader : callable
+        function that returns the constants as a dict
+
+    Methods:
+    --------
+    - resolve(self)
+    - reset(self)
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._values = None
+
+    def resolve(self) -> dict:
+        """Loads the configuration (once) and returns all constants."""
+        if self._values is None:
+            self._values = self.loader()
+        return self._values
+
+    def reset(self):
+        """Forgets the loaded values, the next access reads them again."""
+        self._values = None
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or name == "loader":
+            raise AttributeError(name)
+        try:
+            return self.resolve()[name]
+        except KeyError:
+            raise AttributeError(
+                f"The project configuration has no constant {name!r}"
+            ) from None
+
+
+CONFIG = LazyConfig(_load_config)
+
+# municipality -> LazyConfig, see get_config()
+_MUNICIPAL_CONFIGS = {}
+
+
+def get_config(municipality: str = None) -> LazyConfig:
+    """
+    Returns the (lazy) configuration of a municipality.
+
+    Args:
+        municipality (str, optional): municipality name, defaults to the
+            municipality of the run (CONFIG)
+
+    Returns:
+        LazyConfig: the configuration constants of the municipality
+    """
+    if municipality is None:
+        return CONFIG
+    # the cache key is case insensitive, the name is passed on as given
+    key = municipality.lower()
+    if key not in _MUNICIPAL_CONFIGS:
+        _MUNICIPAL_CONFIGS.setdefault(
+            key, LazyConfig(functools.partial(_load_config, municipality))
+        )
+    return _MUNICIPAL_CONFIGS[key]
+
+
+def __getattr__(name: str):
+    """Resolves the module constants (e.g. MUNICIPALITY) from CONFIG."""
+    if name.isupper():
+        return getattr(CONFIG, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --------------------------------------------------------------------------- #
+# Spatial resolution of the DSM/DTM/CHM grid
+# --------------------------------------------------------------------------- #
+def get_spatial_resolution(point_density: float = None) -> float:
+    """
+    Returns the spatial resolution of the DSM/DTM/CHM grid based on the
+    lidar point density.
+
+    Args:
+        point_density (float, optional): points/m2, defaults to POINT_DENSITY
+
+    Returns:
+        float: cell size in meters
+    """
+    if point_density is None:
+        point_density = CONFIG.POINT_DENSITY
+    if point_density >= 4:
+        spatial_resolution = 0.25
+    elif point_density < 4 and point_density >= 2:
+        spatial_resolution = 0.5
+    else:
+        spatial_resolution = 1
+    return spatial_resolution
+
 
 # TODO add focal_mean_radius to config.yaml (1.5 bodo, 1 kristiansand)
 # test
@@ -0,0 +1,537 @@
+"""Functions that read and patch the header of LAS files without arcpy.
+
+Only the public header block and the variable length records (VLRs) are read
+or written, the point records are never touched. This makes stamping a
+coordinate system on a .las file a write of a few kilobytes instead of a
+rewrite of the whole file.
+
+read_points() reads the point records of an uncompressed .las file in chunks
+(memory mapped), for the single pass rasterizer (las_rasterizer.py).
+"""
+import logging
+import os
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# public header block (LAS 1.0 - 1.4), offsets in bytes
+_HEADER_FORMAT = "<4sHH16sBB32s32sHHHIIBHI5I3d3d6d"
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)  # 227 bytes, LAS 1.0 - 1.2
+_GLOBAL_ENCODING_OFFSET = 6
+_NUMBER_OF_VLRS_OFFSET = 100
+
+# variable length record header
+_VLR_FORMAT = "<H16sHH32s"
+_VLR_HEADER_SIZE = struct.calcsize(_VLR_FORMAT)  # 54 bytes
+
+# coordinate system records: OGC WKT (LAS 1.4) and GeoTIFF keys (LAS 1.0 - 1.3)
+PROJECTION_USER_ID = "LASF_Projection"
+WKT_RECORD_ID = 2112
+GEOKEY_RECORD_ID = 34735
+GEODOUBLE_RECORD_ID = 34736
+GEOASCII_RECORD_ID = 34737
+CRS_RECORD_IDS = (
+    WKT_RECORD_ID,
+    GEOKEY_RECORD_ID,
+    GEODOUBLE_RECORD_ID,
+    GEOASCII_RECORD_ID,
+)
+WKT_GLOBAL_ENCODING_BIT = 0x10
+
+# GeoTIFF keys
+GT_MODEL_TYPE_KEY = 1024
+GT_RASTER_TYPE_KEY = 1025
+GEOGRAPHIC_TYPE_KEY = 2048
+PROJECTED_CS_TYPE_KEY = 3072
+
+# EPSG code of an AUTHORITY["EPSG","25832"] or ID["EPSG",25832]
+_EPSG_PATTERN = re.compile(r'(?:AUTHORITY|ID)\[\s*"EPSG"\s*,\s*"?(\d+)"?')
+
+
+def read_header(las_path: str) -> dict:
+    """
+    Reads the public header block of a LAS file.
+
+    Args:
+        las_path (str): path to the .las file
+
+    Returns:
+        dict: header fields (version, point format, point count, offsets,
+            scale, extent, ...)
+    """
+    with open(las_path, "rb") as f:
+        data = f.read(375)  # size of the LAS 1.4 header
+    return _parse_header(data, las_path)
+
+
+def _parse_header(data: bytes, las_path: str = "") -> dict:
+    """Parses the public header block."""
+    if len(data) < _HEADER_SIZE or data[:4] != b"LASF":
+        raise ValueError(f"{las_path} is not a LAS file")
+
+    values = struct.unpack_from(_HEADER_FORMAT, data)
+    header = {
+        "global_encoding": values[2],
+        "version": f"{values[4]}.{values[5]}",
+        "header_size": values[10],
+        "offset_to_point_data": values[11],
+        "number_of_vlrs": values[12],
+        "point_format": values[13] & 0x3F,  # bits 6-7 flag laszip
+        "compressed": bool(values[13] & 0xC0),
+        "point_record_length": values[14],
+        "point_count": values[15],
+        "points_by_return": list(values[16:21]),
+        "scale": list(values[21:24]),
+        "offset": list(values[24:27]),
+        "max_x": values[27],
+        "min_x": values[28],
+        "max_y": values[29],
+        "min_y": values[30],
+        "max_z": values[31],
+        "min_z": values[32],
+    }
+    # LAS 1.4 stores 64 bit point counts after the waveform/EVLR fields
+    if values[5] >= 4 and len(data) >= 375:
+        header["point_count"] = struct.unpack_from("<Q", data, 247)[0]
+        header["points_by_return"] = list(struct.unpack_from("<15Q", data, 255))
+    return header
+
+
+def read_vlrs(las_path: str) -> list:
+    """
+    Reads the headers of the variable length records of a LAS file.
+
+    Args:
+        las_path (str): path to the .las file
+
+    Returns:
+        list: per record a dict with user_id, record_id, record_length, the
+            file offset of the record header and the offset of its payload
+    """
+    header = read_header(las_path)
+    vlrs = []
+    with open(las_path, "rb") as f:
+        position = header["header_size"]
+        for _ in range(header["number_of_vlrs"]):
+            f.seek(position)
+            data = f.read(_VLR_HEADER_SIZE)
+            if len(data) < _VLR_HEADER_SIZE:
+                break
+            _, user_id, record_id, length, _ = struct.unpack(_VLR_FORMAT, data)
+            vlrs.append(
+                {
+                    "user_id": user_id.rstrip(b"\0").decode("ascii", "ignore"),
+                    "record_id": record_id,
+                    "record_length": length,
+                    "offset": position,
+                    "data_offset": position + _VLR_HEADER_SIZE,
+                }
+            )
+            position += _VLR_HEADER_SIZE + length
+    return vlrs
+
+
+def read_wkt(las_path: str) -> str:
+    """
+    Returns the OGC WKT of a LAS file, None if the file has no WKT record.
+
+    Args:
+        las_path (str): path to the .las file
+    """
+    for vlr in read_vlrs(las_path):
+        if (
+            vlr["user_id"] == PROJECTION_USER_ID
+            and vlr["record_id"] == WKT_RECORD_ID
+        ):
+            with open(las_path, "rb") as f:
+                f.seek(vlr["data_offset"])
+                wkt = f.read(vlr["record_length"])
+            return wkt.rstrip(b"\0").decode("utf-8", "ignore")
+    return None
+
+
+def _read_geokey_epsg(las_path: str, vlr: dict) -> str:
+    """Returns the EPSG code of a GeoKeyDirectory record, None if not set."""
+    with open(las_path, "rb") as f:
+        f.seek(vlr["data_offset"])
+        data = f.read(vlr["record_length"])
+    n_values = len(data) // 2
+    values = struct.unpack(f"<{n_values}H", data[: n_values * 2])
+    # header (version, revision, minor revision, number of keys), then
+    # (key id, tag location, count, value) per key
+    n_keys = values[3] if n_values >= 4 else 0
+    for i in range(n_keys):
+        key_id, location, _, value = values[4 + i * 4 : 8 + i * 4]
+        # ProjectedCSTypeGeoKey, GeographicTypeGeoKey
+        if key_id in (3072, 2048) and location == 0 and value not in (0, 32767):
+            return f"EPSG:{value}"
+    return None
+
+
+def read_crs(las_path: str) -> str:
+    """
+    Returns the coordinate system of a LAS/LAZ file from its header.
+
+    The WKT record is used first, then the EPSG code of the GeoTIFF keys and
+    last a .prj file next to the LAS file.
+
+    Args:
+        las_path (str): path to the .las/.laz file
+
+    Returns:
+        str: WKT or "EPSG:<code>", None if the file has no coordinate system
+    """
+    wkt = read_wkt(las_path)
+    if wkt:
+        return wkt
+    for vlr in read_vlrs(las_path):
+        if (
+            vlr["user_id"] == PROJECTION_USER_ID
+            and vlr["record_id"] == GEOKEY_RECORD_ID
+        ):
+            epsg = _read_geokey_epsg(las_path, vlr)
+            if epsg:
+                return epsg
+    prj_path = os.path.splitext(las_path)[0] + ".prj"
+    if os.path.exists(prj_path):
+        with open(prj_path, "r") as f:
+            return f.read().strip()
+    return None
+
+
+def _write_prj(las_path: str, wkt: str):
+    """Writes the WKT to a .prj file next to the LAS file."""
+    with open(os.path.splitext(las_path)[0] + ".prj", "w") as f:
+        f.write(wkt)
+
+
+def epsg_from_wkt(wkt: str) -> int:
+    """
+    Returns the EPSG code of the outermost AUTHORITY (WKT1) or ID (WKT2) of a
+    WKT, None if the coordinate system itself has no EPSG code.
+
+    Args:
+        wkt (str): OGC WKT of the coordinate system
+    """
+    for match in reversed(list(_EPSG_PATTERN.finditer(wkt))):
+        before = wkt[: match.start()]
+        depth = (
+            before.count("[")
+            + before.count("(")
+            - before.count("]")
+            - before.count(")")
+        )
+        if depth == 1:
+            return int(match.group(1))
+    return None
+
+
+def _geokey_payload(epsg: int, geographic: bool) -> bytes:
+    """Returns a GeoKeyDirectory with the model type and the EPSG code."""
+    keys = [
+        (GT_MODEL_TYPE_KEY, 0, 1, 2 if geographic else 1),
+        (GT_RASTER_TYPE_KEY, 0, 1, 1),  # RasterPixelIsArea
+        (
+            GEOGRAPHIC_TYPE_KEY if geographic else PROJECTED_CS_TYPE_KEY,
+            0,
+            1,
+            epsg,
+        ),
+    ]
+    # header (key directory version, revision, minor revision, number of keys)
+    values = [1, 1, 0, len(keys)] + [value for key in keys for value in key]
+    return struct.pack(f"<{len(values)}H", *values)
+
+
+def _crs_record(header: dict, wkt: str, epsg: int = None) -> tuple:
+    """
+    Returns the (record id, description, payload) of the coordinate system
+    record for the version of a LAS file, None if it cannot be made.
+
+    The WKT record is defined from LAS 1.4 on, older versions get the EPSG
+    code in a GeoKeyDirectory record.
+    """
+    if int(header["version"].split(".")[1]) >= 4:
+        payload = wkt.encode("utf-8") + b"\0"
+        return WKT_RECORD_ID, b"OGC COORDINATE SYSTEM WKT", payload
+    epsg = epsg or epsg_from_wkt(wkt)
+    if epsg is None or epsg > 0xFFFF:
+        return None
+    geographic = wkt.lstrip().upper().startswith(("GEOGCS", "GEOGCRS"))
+    payload = _geokey_payload(epsg, geographic)
+    return GEOKEY_RECORD_ID, b"GeoTiff GeoKeyDirectoryTag", payload
+
+
+def stamp_crs(
+    las_path: str, wkt: str, sidecar: bool = True, epsg: int = None
+) -> str:
+    """
+    Stamps a coordinate system on a LAS file by patching its header in place.
+
+    LAS 1.4 files get an OGC WKT record, older versions a GeoTIFF
+    GeoKeyDirectory record with the EPSG code. The coordinate system records
+    already in the file (WKT, GeoKeys, GeoDoubleParams, GeoAsciiParams) are
+    removed, the other records are kept. The records are rewritten in the
+    space between the public header and the point data. If they do not fit,
+    or the EPSG code for a LAS 1.0 - 1.3 file is not known, the file would
+    have to be rewritten, instead the WKT is written to a .prj file next to
+    the LAS file (as DefineProjection does for LAS files).
+
+    Args:
+        las_path (str): path to the .las file
+        wkt (str): OGC WKT of the coordinate system
+        sidecar (bool): write a .prj file if the header cannot be patched
+        epsg (int): EPSG code for the GeoKeys of LAS 1.0 - 1.3 files, read
+            from the WKT if None
+
+    Returns:
+        str: "exists", "replaced", "added", "sidecar" or "skipped"
+    """
+    header = read_header(las_path)
+    vlrs = read_vlrs(las_path)
+    record = _crs_record(header, wkt, epsg)
+
+    # split the records into coordinate system records and other records
+    kept, crs_records = [], []
+    with open(las_path, "rb") as f:
+        for vlr in vlrs:
+            f.seek(vlr["offset"])
+            data = f.read(_VLR_HEADER_SIZE + vlr["record_length"])
+            if (
+                vlr["user_id"] == PROJECTION_USER_ID
+                and vlr["record_id"] in CRS_RECORD_IDS
+            ):
+                crs_records.append((vlr["record_id"], data[_VLR_HEADER_SIZE:]))
+            else:
+                kept.append(data)
+
+    status = None
+    if record is not None and len(record[2]) <= 0xFFFF:
+        record_id, description, payload = record
+        if crs_records == [(record_id, payload)]:
+            return "exists"
+        new_vlr = (
+            struct.pack(
+                _VLR_FORMAT,
+                0,
+                PROJECTION_USER_ID.encode("ascii"),
+                record_id,
+                len(payload),
+                description,
+            )
+            + payload
+        )
+        block = b"".join(kept) + new_vlr
+        vlr_end = (
+            vlrs[-1]["data_offset"] + vlrs[-1]["record_length"]
+            if vlrs
+            else header["header_size"]
+        )
+        if header["header_size"] + len(block) <= header["offset_to_point_data"]:
+            with open(las_path, "r+b") as f:
+                # rewrite the records, null the rest of the old records
+                f.seek(header["header_size"])
+                f.write(block.ljust(vlr_end - header["header_size"], b"\0"))
+                f.seek(_NUMBER_OF_VLRS_OFFSET)
+                f.write(struct.pack("<I", len(kept) + 1))
+                if record_id == WKT_RECORD_ID:
+                    f.seek(_GLOBAL_ENCODING_OFFSET)
+                    f.write(
+                        struct.pack(
+                            "<H",
+                            header["global_encoding"] | WKT_GLOBAL_ENCODING_BIT,
+                        )
+                    )
+            status = "replaced" if crs_records else "added"
+
+    if status is None:
+        if not sidecar:
+            return "skipped"
+        _write_prj(las_path, wkt)
+        status = "sidecar"
+    return status
+
+
+def stamp_crs_files(
+    las_paths: list, wkt: str, workers: int = 8, epsg: int = None
+) -> dict:
+    """
+    Stamps a coordinate system on a list of LAS files in parallel.
+
+    Args:
+        las_paths (list): paths to the .las files
+        wkt (str): OGC WKT of the coordinate system
+        workers (int): number of threads
+        epsg (int): EPSG code for the GeoKeys of LAS 1.0 - 1.3 files
+
+    Returns:
+        dict: number of files per status of stamp_crs() and failed files
+    """
+    summary = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (executor.submit(stamp_crs, path, wkt, True, epsg), path)
+            for path in las_paths
+        ]
+        for future, path in futures:
+            try:
+                status = future.result()
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f"\t\tCould not stamp the CRS on {path}: {e}")
+                status = "failed"
+            summary[status] = summary.get(status, 0) + 1
+    logger.info(f"\tCRS stamped on {len(las_paths)} LAS files: {summary}")
+    return summary
+
+
+# --------------------------------------------------------------------------- #
+# Point records
+# --------------------------------------------------------------------------- #
+
+# byte offset of the RGB values per point format
+_RGB_OFFSETS = {2: 20, 3: 28, 5: 28, 7: 30, 8: 30, 10: 30}
+
+
+def point_dtype(point_format: int, record_length: int) -> np.dtype:
+    """
+    Returns the numpy dtype of the point records of a point format.
+
+    Only the fields used by the rasterizer are named, extra bytes at the end
+    of a record are skipped (itemsize = record_length).
+
+    Args:
+        point_format (int): LAS point data record format (0-10)
+        record_length (int): point data record length in bytes
+    """
+    names = ["X", "Y", "Z", "return_byte"]
+    formats = ["<i4", "<i4", "<i4", "u1"]
+    offsets = [0, 4, 8, 14]
+    if point_format < 6:
+        # return number bits 0-2, number of returns bits 3-5, class bits
+        # 0-4 and the withheld flag (bit 7) in one byte
+        names.append("class_byte")
+        formats.append("u1")
+        offsets.append(15)
+    else:
+        # return number bits 0-3, number of returns bits 4-7, classification
+        # flags (synthetic, key-point, withheld = bit 2, overlap = bit 3) and
+        # the classification in own bytes
+        names += ["flag_byte", "class_byte"]
+        formats += ["u1", "u1"]
+        offsets += [15, 16]
+    if point_format in _RGB_OFFSETS:
+        names += ["red", "green", "blue"]
+        formats += ["<u2", "<u2", "<u2"]
+        rgb_offset = _RGB_OFFSETS[point_format]
+        offsets += [rgb_offset, rgb_offset + 2, rgb_offset + 4]
+    return np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": record_length,
+        }
+    )
+
+
+def read_points(las_path: str, chunk_size: int = 2_000_000):
+    """
+    Reads the point records of an uncompressed LAS file in chunks.
+
+    Args:
+        las_path (str): path to the .las file
+        chunk_size (int): number of points per chunk
+
+    Yields:
+        dict: numpy arrays x, y, z (scaled, float64), classification,
+            return_number, number_of_returns, withheld (bool) and red,
+            green, blue if the point format has colours
+    """
+    header = read_header(las_path)
+    if header["compressed"] or las_path.lower().endswith(".laz"):
+        raise ValueError(
+            f"{las_path} is LAZ compressed, extract it to .las first"
+        )
+    point_format = header["point_format"]
+    dtype = point_dtype(point_format, header["point_record_length"])
+    n_points = header["point_count"]
+    if n_points == 0:
+        return
+    records = np.memmap(
+        las_path,
+        dtype=dtype,
+        mode="r",
+        offset=header["offset_to_point_data"],
+        shape=(n_points,),
+    )
+    scale = header["scale"]
+    offset = header["offset"]
+    for start in range(0, n_points, chunk_size):
+        chunk = records[start : start + chunk_size]
+        points = {
+            "x": chunk["X"] * scale[0] + offset[0],
+            "y": chunk["Y"] * scale[1] + offset[1],
+            "z": chunk["Z"] * scale[2] + offset[2],
+        }
+        return_byte = np.asarray(chunk["return_byte"])
+        class_byte = np.asarray(chunk["class_byte"])
+        if point_format < 6:
+            points["return_number"] = return_byte & 0x07
+            points["number_of_returns"] = (return_byte >> 3) & 0x07
+            points["classification"] = class_byte & 0x1F
+            points["withheld"] = (class_byte & 0x80) > 0
+        else:
+            points["return_number"] = return_byte & 0x0F
+            points["number_of_returns"] = return_byte >> 4
+            points["classification"] = class_byte
+            points["withheld"] = (np.asarray(chunk["flag_byte"]) & 0x04) > 0
+        if point_format in _RGB_OFFSETS:
+            for band in ("red", "green", "blue"):
+                points[band] = np.asarray(chunk[band])
+        yield points
+    del records
+
+
+def color_depth(las_paths: list, n_points: int = 10_000) -> int:
+    """
+    Returns the colour depth of the RGB values of a set of LAS files.
+
+    The LAS header does not record the colour depth. The specification
+    normalizes the colours to 16 bit, but many files store 8 bit values.
+    The first n_points of each file are read, the colours are 16 bit if any
+    value is above 255.
+
+    Args:
+        las_paths (list): paths to the .las files, e.g. all files of a run
+        n_points (int): number of points read per file
+
+    Returns:
+        int: 16 or 8, 8 if the files have no colours
+    """
+    max_value = 0
+    for las_path in las_paths:
+        header = read_header(las_path)
+        point_format = header["point_format"]
+        if header["compressed"] or point_format not in _RGB_OFFSETS:
+            continue
+        dtype = point_dtype(point_format, header["point_record_length"])
+        n_read = min(n_points, header["point_count"])
+        if n_read == 0:
+            continue
+        records = np.memmap(
+            las_path,
+            dtype=dtype,
+            mode="r",
+            offset=header["offset_to_point_data"],
+            shape=(n_read,),
+        )
+        for band in ("red", "green", "blue"):
+            max_value = max(max_value, int(records[band].max()))
+        del records
+        if max_value > 255:
+            return 16
+    return 8
@@ -0,0 +1,205 @@
+"""Cache of the reference layers clipped to the neighbourhoods.
+
+The reference layers (FKB roads, buildings and water, SSB districts, AR5 land
+use) cover the whole municipality or the whole country. A stage that selects
+the trees of a neighbourhood by location against such a layer searches all
+its features, in every neighbourhood and in every rerun.
+
+A ReferenceCache clips each layer once to the buffered neighbourhood and
+keeps the clip in a file gdb of the neighbourhood, with a spatial index:
+
+    <cache_path>/b_<n_code>.gdb/<layer name>
+    <cache_path>/b_<n_code>.json        layer name -> source, fingerprint
+
+The fingerprint of a source is the size and modification time of its files
+(the files of the file gdb, or of the shapefile). A clip is reused as long as
+the fingerprint of its source is unchanged, an updated source (e.g. a new
+FKB delivery) is clipped again on the next request. Each neighbourhood has
+its own file gdb and manifest, workers that process different
+neighbourhoods do not share a file.
+
+Usage:
+    cache = ReferenceCache(ctx.reference_cache_path)
+    lyr_roads = cache.get("fkb_veg_omrade", ctx.fkb_veg_omrade, n_code, v_neighb)
+"""
+import json
+import logging
+import os
+
+import arcpy
+
+from src import arcpy_utils as au
+
+logger = logging.getLogger(__name__)
+
+# name of the buffered neighbourhood in the cache gdb
+EXTENT_NAME = "neighbourhood_buffer"
+
+
+def source_fingerprint(source: str) -> list:
+    """
+    Returns the fingerprint of a feature class: the sorted (name, size,
+    mtime) of the files it is stored in.
+
+    A feature class in a file gdb is fingerprinted by all files of the gdb
+    (the table files of a feature class are not named after it), any edit
+    of the gdb invalidates its clips.
+
+    Args:
+        source (str): path to the feature class or shapefile
+
+    Returns:
+        list: [[file name, size, mtime], ...]
+    """
+    source = os.path.abspath(source)
+    gdb_path = source
+    while gdb_path and not gdb_path.lower().endswith(".gdb"):
+        parent = os.path.dirname(gdb_path)
+        if parent == gdb_path:
+            gdb_path = None
+            break
+        gdb_path = parent
+
+    if gdb_path:
+        folder = gdb_path
+        names = os.listdir(folder)
+    else:
+        # shapefile and its sidecar files
+        folder, base_name = os.path.split(source)
+        stem = os.path.splitext(base_name)[0].lower()
+        names = [
+            f
+            for f in os.listdir(folder)
+            if os.path.splitext(f)[0].lower() == stem
+        ]
+
+    fingerprint = []
+    for name in sorted(names):
+        # lock files come and go with the readers of the source
+        if name.endswith(".lock"):
+            continue
+        stat = os.stat(os.path.join(folder, name))
+        fingerprint.append([name, stat.st_size, stat.st_mtime])
+    return fingerprint
+
+
+class ReferenceCache:
+    """
+    Reference layers clipped to the buffered neighbourhoods.
+
+    Attributes:
+    -----------
+    cache_path : str
+        folder of the file gdbs and manifests of the neighbourhoods
+    buffer_distance : float
+        distance (m) the neighbourhood is buffered by before clipping
+
+    Methods:
+    --------
+    - get(self, name, source, n_code, v_neighb)
+    - invalidate(self, n_code)
+    """
+
+    def __init__(self, cache_path: str, buffer_distance: float = 200):
+        self.cache_path = cache_path
+        self.buffer_distance = buffer_distance
+
+    def _gdb_path(self, n_code: str) -> str:
+        return os.path.join(self.cache_path, "b_" + n_code + ".gdb")
+
+    def _manifest_path(self, n_code: str) -> str:
+        return os.path.join(self.cache_path, "b_" + n_code + ".json")
+
+    def _load_manifest(self, n_code: str) -> dict:
+        path = self._manifest_path(n_code)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"\t\tCorrupt reference cache manifest {path}")
+            return {}
+
+    def _save_manifest(self, n_code: str, manifest: dict):
+        """Saves the manifest (written to a temp file first)."""
+        path = self._manifest_path(n_code)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def _extent(self, gdb_path: str, v_neighb: str) -> str:
+        """Returns the buffered neighbourhood, buffered on first use."""
+        v_extent = os.path.join(gdb_path, EXTENT_NAME)
+        if not arcpy.Exists(v_extent):
+            with au.atomic_output(v_extent) as v_extent_tmp:
+                arcpy.analysis.PairwiseBuffer(
+                    in_features=v_neighb,
+                    out_feature_class=v_extent_tmp,
+                    buffer_distance_or_field="{} Meters".format(
+                        self.buffer_distance
+                    ),
+                )
+        return v_extent
+
+    def get(self, name: str, source: str, n_code: str, v_neighb: str) -> str:
+        """
+        Returns the reference layer clipped to the buffered neighbourhood.
+
+        The clip is made on the first request and again when the source has
+        changed since the clip was made.
+
+        Args:
+            name (str): name of the reference layer (e.g. "fkb_veg_omrade")
+            source (str): path to the full reference layer
+            n_code (str): neighbourhood code
+            v_neighb (str): neighbourhood polygon
+
+        Returns:
+            str: path to the clipped layer
+        """
+        gdb_path = self._gdb_path(n_code)
+        v_clip = os.path.join(gdb_path, name)
+        fingerprint = source_fingerprint(source)
+        manifest = self._load_manifest(n_code)
+        entry = manifest.get(name)
+        if (
+            entry is not None
+            and entry["source"] == os.path.abspath(source)
+            and entry["fingerprint"] == fingerprint
+            and arcpy.Exists(v_clip)
+        ):
+            return v_clip
+
+        logger.info(
+            "\t\tClipping the reference layer {} to neighbourhood <<{}>>...".format(
+                name, n_code
+            )
+        )
+        os.makedirs(self.cache_path, exist_ok=True)
+        au.createGDB_ifNotExists(gdb_path)
+        v_extent = self._extent(gdb_path, v_neighb)
+        with au.atomic_output(v_clip) as v_clip_tmp:
+            arcpy.analysis.PairwiseClip(
+                in_features=source,
+                clip_features=v_extent,
+                out_feature_class=v_clip_tmp,
+            )
+            arcpy.management.AddSpatialIndex(v_clip_tmp)
+
+        manifest[name] = {
+            "source": os.path.abspath(source),
+            "fingerprint": fingerprint,
+        }
+        self._save_manifest(n_code, manifest)
+        return v_clip
+
+    def invalidate(self, n_code: str):
+        """Deletes the clips of a neighbourhood (e.g. its boundary changed)."""
+        gdb_path = self._gdb_path(n_code)
+        if arcpy.Exists(gdb_path):
+            arcpy.Delete_management(gdb_path)
+        manifest_path = self._manifest_path(n_code)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
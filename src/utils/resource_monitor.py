@@ -0,0 +1,397 @@
+"""Peak-memory and I/O accounting per pipeline stage.
+
+A background thread samples the resident set size (RSS) of the process while
+a stage runs. The I/O counters are read at the start and the end of the stage,
+they count the bytes fetched from and sent to the storage layer (read_bytes,
+write_bytes), not the page cache hits nor the reads of /proc by the sampler.
+Each finished stage is written to the log and appended as one JSON line to a
+machine-readable run report, next to its wall time.
+
+The values are read from ``/proc/self`` on Linux. On other platforms (e.g. the
+ArcGIS Pro env on Windows) ``psutil`` is used when it is installed.
+"""
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc/self is used on Linux
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# default folder for the run reports, same folder as the log files
+LOG_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "log")
+
+
+# --------------------------------------------------------------------------- #
+# Process counters
+# --------------------------------------------------------------------------- #
+
+
+def _read_proc_status_rss():
+    """Returns the current RSS in bytes read from /proc/self/status."""
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _read_proc_io():
+    """Returns the bytes read from and written to the storage layer."""
+    counters = {}
+    with open("/proc/self/io", "r") as f:
+        for line in f:
+            key, value = line.split(":")
+            counters[key] = int(value)
+    return counters.get("read_bytes", 0), counters.get("write_bytes", 0)
+
+
+def current_rss():
+    """
+    Returns the resident set size (RSS) of the current process in bytes.
+
+    Returns:
+        int: RSS in bytes, 0 if it cannot be read on this platform.
+    """
+    if os.path.exists("/proc/self/status"):
+        return _read_proc_status_rss()
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return 0
+
+
+def current_io():
+    """
+    Returns the cumulative bytes read and written by the current process.
+
+    Returns:
+        tuple: (bytes_read, bytes_written), (0, 0) if not available.
+    """
+    try:
+        if os.path.exists("/proc/self/io"):
+            return _read_proc_io()
+        if psutil is not None:
+            io = psutil.Process().io_counters()
+            return io.read_bytes, io.write_bytes
+    except (OSError, AttributeError):
+        # /proc/self/io can be restricted in containers
+        pass
+    return 0, 0
+
+
+def format_bytes(n_bytes: float) -> str:
+    """Formats a number of bytes as a human readable string."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n_bytes) < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TB"
+
+
+# --------------------------------------------------------------------------- #
+# Stage monitor
+# --------------------------------------------------------------------------- #
+
+
+class StageMonitor:
+    """
+    Records wall time, peak RSS and I/O of one stage for one unit of work.
+
+    The peak RSS is the maximum of the RSS samples taken by a background
+    thread every ``interval`` seconds. Stages that run concurrently in the
+    same process share the process counters, the values are then an upper
+    bound for each stage.
+
+    Attributes:
+    -----------
+    stage : str
+        name of the pipeline stage (e.g. "watershed")
+    unit : str
+        unit of work (e.g. the neighbourhood code or the tile code)
+    record : dict
+        resource record, filled in when the monitor is stopped
+    extra : dict
+        additional values stored with the record (e.g. blocks_skipped)
+
+    Methods:
+    --------
+    - start(self)
+    - stop(self)
+    """
+
+    def __init__(self, stage: str, unit: str = None, interval: float = 0.1):
+        self.stage = stage
+        self.unit = unit
+        self.interval = interval
+        self.record = None
+        self.extra = {}
+        self._peak_rss = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            self._peak_rss = max(self._peak_rss, current_rss())
+
+    def start(self):
+        """Starts the timer and the RSS sampling thread."""
+        self._start_date = datetime.datetime.now().isoformat(timespec="seconds")
+        self._start_time = time.perf_counter()
+        self._start_rss = current_rss()
+        self._peak_rss = self._start_rss
+        self._start_read, self._start_written = current_io()
+        self._thread = threading.Thread(
+            target=self._sample, name=f"monitor-{self.stage}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the sampling thread and returns the resource record."""
+        if self.record is not None:
+            return self.record
+
+        self._stop_event.set()
+        self._thread.join()
+        end_rss = current_rss()
+        end_read, end_written = current_io()
+
+        self.record = {
+            "stage": self.stage,
+            "unit": self.unit,
+            "start": self._start_date,
+            "duration_sec": round(time.perf_counter() - self._start_time, 3),
+            "start_rss": self._start_rss,
+            "end_rss": end_rss,
+            "peak_rss": max(self._peak_rss, end_rss),
+            "bytes_read": end_read - self._start_read,
+            "bytes_written": end_written - self._start_written,
+        }
+        return self.record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+# --------------------------------------------------------------------------- #
+# Run report
+# --------------------------------------------------------------------------- #
+
+
+def default_report_path(log_path: str = LOG_PATH) -> str:
+    """Returns a report path named like the log file of the running script."""
+    script_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(
+        os.path.abspath(log_path), f"{date}_{script_name}_report.jsonl"
+    )
+
+
+class RunReport:
+    """
+    Machine-readable run report with one JSON line per stage and unit.
+
+    Attributes:
+    -----------
+    report_path : str
+        path to the .jsonl report file
+    records : list
+        resource records of the finished stages
+    buffered : bool
+        keep the records in memory only, e.g. in a worker process that
+        returns them to the report of the parent process
+
+    Methods:
+    --------
+    - start_stage(self, stage, unit)
+    - end_stage(self, monitor)
+    - stage(self, stage, unit)
+    - add_records(self, records)
+    - summary(self)
+    - log_summary(self)
+    """
+
+    def __init__(
+        self,
+        report_path: str = None,
+        interval: float = 0.1,
+        buffered: bool = False,
+    ):
+        self.report_path = report_path or default_report_path()
+        self.interval = interval
+        self.buffered = buffered
+        self.records = []
+        self._lock = threading.Lock()
+
+    def start_stage(self, stage: str, unit: str = None) -> StageMonitor:
+        """
+        Starts monitoring a stage for one unit of work.
+
+        Args:
+            stage (str): name of the pipeline stage
+            unit (str): neighbourhood or tile code
+
+        Returns:
+            StageMonitor: the running monitor, pass it to end_stage()
+        """
+        return StageMonitor(stage, unit, self.interval).start()
+
+    def end_stage(self, monitor: StageMonitor, **extra) -> dict:
+        """
+        Stops the monitor, logs the resources and appends them to the report.
+
+        Args:
+            monitor (StageMonitor): monitor returned by start_stage()
+            **extra: additional values stored with the record, next to the
+                values set in monitor.extra
+
+        Returns:
+            dict: the resource record
+        """
+        record = dict(monitor.stop())
+        record.update(monitor.extra)
+        record.update(extra)
+        logger.info(
+            "\tRESOURCES [{} | {}]:\t peak RSS {}, read {}, written {}, {:.2f} sec".format(
+                record["stage"],
+                record["unit"],
+                format_bytes(record["peak_rss"]),
+                format_bytes(record["bytes_read"]),
+                format_bytes(record["bytes_written"]),
+                record["duration_sec"],
+            )
+        )
+        self.add_records([record])
+        return record
+
+    def add_records(self, records: list):
+        """
+        Appends finished records (e.g. of a worker process) to the report.
+
+        Args:
+            records (list): resource records returned by end_stage()
+        """
+        if not records:
+            return
+        with self._lock:
+            self.records.extend(records)
+            if self.buffered:
+                return
+            os.makedirs(os.path.dirname(self.report_path), exist_ok=True)
+            with open(self.report_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, stage: str, unit: str = None):
+        """
+        Context manager that monitors a stage for one unit of work.
+
+        Example:
+            with report.stage("watershed", n_code) as monitor:
+                tree.watershed_segmentation(...)
+                monitor.extra["blocks_skipped"] = 0.4
+        """
+        monitor = self.start_stage(stage, unit)
+        failed = True
+        try:
+            yield monitor
+            failed = False
+        finally:
+            self.end_stage(monitor, failed=failed)
+
+    def summary(self) -> dict:
+        """
+        Aggregates the records per stage.
+
+        Returns:
+            dict: per stage the number of units, the max peak RSS,
+                the total bytes read/written and the total duration
+        """
+        summary = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            s = summary.setdefault(
+                record["stage"],
+                {
+                    "units": 0,
+                    "max_peak_rss": 0,
+                    "max_peak_unit": None,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "duration_sec": 0.0,
+                },
+            )
+            s["units"] += 1
+            if record["peak_rss"] > s["max_peak_rss"]:
+                s["max_peak_rss"] = record["peak_rss"]
+                s["max_peak_unit"] = record["unit"]
+            s["bytes_read"] += record["bytes_read"]
+            s["bytes_written"] += record["bytes_written"]
+            s["duration_sec"] += record["duration_sec"]
+            if record.get("blocks_skipped") is not None:
+                s.setdefault("blocks_skipped", []).append(
+                    record["blocks_skipped"]
+                )
+        for s in summary.values():
+            if "blocks_skipped" in s:
+                # mean fraction of the skipped treeless blocks per unit
+                s["blocks_skipped"] = sum(s["blocks_skipped"]) / len(
+                    s["blocks_skipped"]
+                )
+        return summary
+
+    def log_summary(self):
+        """Logs the per stage summary and writes it next to the report."""
+        summary = self.summary()
+        logger.info("Resource summary per stage:")
+        for stage, s in summary.items():
+            logger.info(
+                "\t{}:\t {} units, max peak RSS {} ({}), read {}, written {}, {:.2f} sec".format(
+                    stage,
+                    s["units"],
+                    format_bytes(s["max_peak_rss"]),
+                    s["max_peak_unit"],
+                    format_bytes(s["bytes_read"]),
+                    format_bytes(s["bytes_written"]),
+                    s["duration_sec"],
+                )
+            )
+        summary_path = os.path.splitext(self.report_path)[0] + "_summary.json"
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Run report:\t{self.report_path}")
+        return summary
+
+
+# module level report shared by the stages of one run
+_run_report = None
+
+
+def get_run_report() -> RunReport:
+    """Returns the run report of this process, creates it on first use."""
+    global _run_report
+    if _run_report is None:
+        _run_report = RunReport()
+    return _run_report
+
+
+def set_run_report(report: RunReport):
+    """Replaces the run report of this process (e.g. to set its path)."""
+    global _run_report
+    _run_report = report
+    return report
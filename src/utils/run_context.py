@@ -0,0 +1,377 @@
+"""Run context of the tree detection of one municipality.
+
+The stage functions used to read the configuration constants (MUNICIPALITY,
+SPATIAL_REFERENCE, MIN_HEIGHT, ...) and the paths that the ``__main__`` block
+of a script defined as module globals. A process could therefore only work on
+the municipality it was started for.
+
+A RunContext holds the municipal parameters and the paths of one run and is
+passed to every stage function as first argument. A long-lived worker pool
+can process neighbourhoods of several municipalities (e.g. Bærum and
+Kristiansand) in the same run, each task receives the context of its
+municipality. The context is picklable, the journal and the block index are
+opened on first use in the process that uses them.
+
+Usage:
+    ctx = RunContext.from_config("baerum")
+    detect_watershed(ctx, ["302401", "302412"])
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _env_number(name: str, cast=float):
+    """Returns a numeric environment variable, None if it is not set."""
+    value = os.getenv(name)
+    return None if value in (None, "") else cast(float(value))
+
+
+class RunContext:
+    """
+    Parameters and paths of the tree detection of one municipality.
+
+    Attributes:
+    -----------
+    municipality : str
+        municipality (kommune) name
+    spatial_reference : str
+        spatial reference of the outputs
+    coord_system : str
+        coordinate system (WKT) of the output datasets
+    point_density : float
+        lidar point density (points/m2)
+    spatial_resolution : float
+        cell size of the DTM/DSM/CHM grid in meters
+    min_height : float
+        minimum tree height in meters
+    focal_max_radius : float
+        radius of the focal maximum filter of the CHM
+    rgb_available : bool
+        an RGB image can be made from the lidar data
+    veg_classes_available : bool
+        the lidar points are classified for vegetation
+    las_engine : str
+        "arcpy" (default) uses LasDatasetToRaster per product, "numpy" reads
+        the LAS points once for the DTM, DSM and RGB image (las_rasterizer.py)
+    void_fill : str
+        void fill of the DTM/DSM of the numpy engine, "linear" or "nearest"
+    watershed_mode : str
+        "neighbourhood" (default) segments the buffered CHM of each
+        neighbourhood, "municipality" segments the municipal CHM once, block
+        by block (block_watershed.py)
+    crown_tolerance : float
+        tolerance (m) of the shared edge simplification of the watershed
+        crowns (crown_simplify.py), 0 (default) keeps the cell boundaries,
+        one cell removes the staircases
+    crown_max_vertices : int
+        vertex budget per crown, None for no budget
+    data_path, interim_path, processed_path : str
+        project data folders of the municipality
+    lidar_path, tree_detection_path : str
+        interim folders of the tile and neighbourhood file gdbs
+    admin_data_path, base_data_path, gdb_elevation_data : str
+        general file gdbs of the municipality
+    study_area_path, mask_path, neighbourhood_path : str
+        study area, study area mask and neighbourhood feature classes
+    n_field_name : str
+        field with the neighbourhood code
+    fkb_bygning_omrade, fkb_vann_omrade, fkb_veg_omrade : str
+        FKB building, water and road polygons
+    ssb_district_path, ar5_landuse_path : str
+        SSB districts and AR5 land use, None if not configured
+    reference_cache_path : str
+        folder of the reference layers clipped per neighbourhood
+    r_chm, r_dtm : str
+        mosaiced canopy height and terrain model (values x100)
+    r_fkb_mask : str
+        FKB roads and buffered buildings rasterized on the CHM grid
+    split_neighbourhoods_gdb, split_chm_gdb : str
+        neighbourhoods and CHM split by neighbourhood
+    watershed_gdb : str
+        interim file gdb of the municipal watershed
+    r_watersheds, v_tops_watershed, v_crowns_watershed : str
+        crown labels, tree tops and crowns of the municipal watershed
+    gdb_laser_urban_trees : str
+        output file gdb
+    ds_false_positives, ds_crowns, ds_tops : str
+        feature datasets of the output file gdb
+    journal_path : str
+        path to the run journal
+    journal : RunJournal
+        run journal, opened on first use
+    block_index : BlockIndex
+        block occupancy index of the CHM, None if it does not exist
+
+    Methods:
+    --------
+    - from_config(cls, municipality)
+    - reference_layer(self, name, n_code)
+    - neighbourhood_gdb(self, n_code)
+    - log_parameters(self)
+    """
+
+    def __init__(
+        self,
+        municipality: str,
+        data_path: str,
+        interim_path: str,
+        processed_path: str,
+        spatial_reference: str,
+        coord_system: str = None,
+        point_density: float = None,
+        spatial_resolution: float = None,
+        min_height: float = None,
+        focal_max_radius: float = None,
+        rgb_available: bool = False,
+        veg_classes_available: bool = False,
+        las_engine: str = "arcpy",
+        void_fill: str = "linear",
+        watershed_mode: str = "neighbourhood",
+        ssb_district_path: str = None,
+        ar5_landuse_path: str = None,
+        crown_tolerance: float = 0.0,
+        crown_max_vertices: int = None,
+    ):
+        self.municipality = municipality
+        self.spatial_reference = spatial_reference
+        self.coord_system = coord_system
+        self.point_density = point_density
+        self.spatial_resolution = spatial_resolution
+        self.min_height = min_height
+        self.focal_max_radius = focal_max_radius
+        self.rgb_available = rgb_available
+        self.veg_classes_available = veg_classes_available
+        self.las_engine = las_engine
+        self.void_fill = void_fill
+        self.watershed_mode = watershed_mode
+        # opt-in, the simplification changes the crown areas
+        self.crown_tolerance = crown_tolerance or 0.0
+        self.crown_max_vertices = crown_max_vertices
+
+        # project data folders
+        self.data_path = data_path
+        self.interim_path = interim_path
+        self.processed_path = processed_path
+        self.lidar_path = os.path.join(interim_path, "lidar")
+        self.tree_detection_path = os.path.join(interim_path, "tree_detection")
+        self.journal_path = os.path.join(interim_path, "run_journal.jsonl")
+
+        # admin data
+        general_path = os.path.join(data_path, municipality, "general")
+        self.admin_data_path = os.path.join(
+            general_path, municipality + "_admindata.gdb"
+        )
+        self.study_area_path = os.path.join(
+            self.admin_data_path, "analyseomrade"
+        )
+        self.mask_path = os.path.join(
+            self.admin_data_path, "analyseomrade_mask"
+        )
+        self.neighbourhood_path = os.path.join(self.admin_data_path, "bydeler")
+        self.n_field_name = "bydelnummer"
+
+        # base data
+        self.base_data_path = os.path.join(
+            general_path, municipality + "_basisdata.gdb"
+        )
+        self.fkb_bygning_omrade = os.path.join(
+            self.base_data_path, "fkb_bygning_omrade"
+        )
+        self.fkb_vann_omrade = os.path.join(
+            self.base_data_path, "fkb_vann_omrade"
+        )
+        self.fkb_veg_omrade = os.path.join(
+            self.base_data_path, "fkb_veg_omrade"
+        )
+        self.ssb_district_path = ssb_district_path
+        self.ar5_landuse_path = ar5_landuse_path
+
+        # reference layers clipped per neighbourhood (reference_cache.py)
+        self.reference_cache_path = os.path.join(
+            interim_path, "reference_cache"
+        )
+
+        # terrain data, canopy height model (note values are x100)
+        self.gdb_elevation_data = os.path.join(
+            general_path, municipality + "_hoydedata.gdb"
+        )
+        str_resolution = str(spatial_resolution).replace(".", "")
+        self.r_chm = os.path.join(
+            self.gdb_elevation_data, "chm_" + str_resolution + "m_int_100x"
+        )
+        self.r_dtm = os.path.join(
+            self.gdb_elevation_data, "dtm_" + str_resolution + "m_int_100x"
+        )
+
+        # FKB roads and buildings on the CHM grid (other trees)
+        self.r_fkb_mask = os.path.join(
+            self.gdb_elevation_data, "fkb_mask_" + str_resolution + "m"
+        )
+
+        # split neighbourhoods
+        self.split_neighbourhoods_gdb = os.path.join(
+            interim_path, "bydeler_split.gdb"
+        )
+        self.split_chm_gdb = os.path.join(interim_path, "chm_split.gdb")
+
+        # municipal watershed
+        self.watershed_gdb = os.path.join(interim_path, "watershed.gdb")
+        self.r_watersheds = os.path.join(self.watershed_gdb, "watersheds")
+        self.v_tops_watershed = os.path.join(
+            self.watershed_gdb, "tops_watershed"
+        )
+        self.v_crowns_watershed = os.path.join(
+            self.watershed_gdb, "crowns_watershed"
+        )
+
+        # output
+        self.gdb_laser_urban_trees = os.path.join(
+            processed_path, municipality + "_laser_bytraer.gdb"
+        )
+        self.ds_false_positives = os.path.join(
+            self.gdb_laser_urban_trees, "falsk_positive_trekroner"
+        )
+        self.ds_crowns = os.path.join(self.gdb_laser_urban_trees, "trekroner")
+        self.ds_tops = os.path.join(self.gdb_laser_urban_trees, "tretopper")
+
+        self._journal = None
+        self._block_index = None
+        self._block_index_loaded = False
+
+    @classmethod
+    def from_config(cls, municipality: str = None):
+        """
+        Creates the context of a municipality from the project configuration.
+
+        Args:
+            municipality (str, optional): municipality name, defaults to the
+                municipality of the run (MUNICIPALITY)
+
+        Returns:
+            RunContext: context of the municipality
+        """
+        from src.data.las_catalog import catalog_point_density
+        from src.utils.config import get_config, get_spatial_resolution
+        from src.utils.run_options import ENV_PREFIX
+
+        config = get_config(municipality)
+        las_catalog_path = config.LAS_CATALOG_PATH
+        point_density = catalog_point_density(
+            las_catalog_path, config.POINT_DENSITY
+        )
+        return cls(
+            municipality=config.MUNICIPALITY,
+            data_path=config.DATA_PATH,
+            interim_path=config.INTERIM_PATH,
+            processed_path=config.PROCESSED_PATH,
+            spatial_reference=config.SPATIAL_REFERENCE,
+            coord_system=config.resolve().get("COORD_SYSTEM"),
+            point_density=point_density,
+            spatial_resolution=get_spatial_resolution(point_density),
+            min_height=config.MIN_HEIGHT,
+            focal_max_radius=config.FOCAL_MAX_RADIUS,
+            rgb_available=config.RGB_AVAILABLE,
+            veg_classes_available=config.VEG_CLASSES_AVAILABLE,
+            las_engine=os.getenv(ENV_PREFIX + "LAS_ENGINE", "arcpy").lower(),
+            void_fill=os.getenv(ENV_PREFIX + "VOID_FILL", "linear").lower(),
+            watershed_mode=os.getenv(
+                ENV_PREFIX + "WATERSHED", "neighbourhood"
+            ).lower(),
+            ssb_district_path=config.resolve().get("SSB_DISTRICT_PATH"),
+            ar5_landuse_path=config.resolve().get("AR5_LANDUSE_PATH"),
+            crown_tolerance=_env_number(ENV_PREFIX + "CROWN_TOLERANCE"),
+            crown_max_vertices=_env_number(
+                ENV_PREFIX + "CROWN_MAX_VERTICES", int
+            ),
+        )
+
+    @property
+    def journal(self):
+        """Run journal of the municipality, opened on first use."""
+        if self._journal is None:
+            from src.utils.run_journal import RunJournal
+
+            self._journal = RunJournal(self.journal_path)
+        return self._journal
+
+    @property
+    def block_index(self):
+        """Block index of the CHM (built by model_chm.py), None if missing."""
+        if not self._block_index_loaded:
+            from src.tree_detection.block_index import (
+                BlockIndex,
+                block_index_path,
+            )
+
+            f_blocks = block_index_path(self.r_chm)
+            if os.path.exists(f_blocks):
+                self._block_index = BlockIndex.load(f_blocks)
+            self._block_index_loaded = True
+        return self._block_index
+
+    @property
+    def reference_layers(self) -> dict:
+        """Reference layers that can be clipped per neighbourhood, by name."""
+        layers = {
+            "fkb_bygning_omrade": self.fkb_bygning_omrade,
+            "fkb_vann_omrade": self.fkb_vann_omrade,
+            "fkb_veg_omrade": self.fkb_veg_omrade,
+            "ssb_district": self.ssb_district_path,
+            "ar5_landuse": self.ar5_landuse_path,
+        }
+        return {name: path for name, path in layers.items() if path}
+
+    def reference_layer(self, name: str, n_code: str) -> str:
+        """
+        Returns a reference layer clipped to the neighbourhood and a 200 m
+        buffer, clipped on first use (see reference_cache.py).
+
+        Args:
+            name (str): name of the layer in reference_layers
+            n_code (str): neighbourhood code
+
+        Returns:
+            str: path to the clipped layer
+        """
+        from src.utils.reference_cache import ReferenceCache
+
+        v_neighb = os.path.join(self.split_neighbourhoods_gdb, "b_" + n_code)
+        return ReferenceCache(self.reference_cache_path).get(
+            name, self.reference_layers[name], n_code, v_neighb
+        )
+
+    def neighbourhood_gdb(self, n_code: str) -> str:
+        """Returns the temporary file gdb of the trees of a neighbourhood."""
+        return os.path.join(
+            self.tree_detection_path, "tree_detection_b" + n_code + ".gdb"
+        )
+
+    def log_parameters(self):
+        """Logs the municipal parameters of the run."""
+        logger.info("municipality:\t\t\t" + self.municipality)
+        logger.info("spatial reference:\t\t" + str(self.spatial_reference))
+        logger.info("RGB image available:\t\t" + str(self.rgb_available))
+        logger.info(
+            "Vegetation Classes available:\t" + str(self.veg_classes_available)
+        )
+        logger.info("Point Density:\t\t\t" + str(self.point_density))
+        logger.info("Spatial Resolution:\t\t" + str(self.spatial_resolution))
+        logger.info("Minimum Tree Height:\t\t" + str(self.min_height))
+        logger.info("Focal Max Radius:\t\t\t" + str(self.focal_max_radius))
+        logger.info("LAS engine:\t\t\t" + self.las_engine)
+        logger.info("Void fill:\t\t\t" + self.void_fill)
+        logger.info("Watershed:\t\t\t" + self.watershed_mode)
+        logger.info("Crown tolerance:\t\t" + str(self.crown_tolerance))
+
+    def __getstate__(self):
+        # the journal holds a lock and is opened again by the worker
+        state = dict(self.__dict__)
+        state["_journal"] = None
+        state["_block_index"] = None
+        state["_block_index_loaded"] = False
+        return state
+
+    def __repr__(self):
+        return f"RunContext({self.municipality!r})"
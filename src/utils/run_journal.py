@@ -0,0 +1,160 @@
+"""Append-only run journal that records completed (stage, unit) pairs.
+
+A stage writes its outputs under a temporary name and publishes them when they
+are complete (see ``arcpy_utils.atomic_output``). Only then the (stage, unit)
+pair is appended to the journal. A restarted run skips the units that are in
+the journal and resumes at the first unfinished unit. Outputs of a unit that
+is not in the journal are never reused.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class RunJournal:
+    """
+    Append-only journal (JSON lines) of completed stages per unit of work.
+
+    Attributes:
+    -----------
+    path : str
+        path to the journal file (.jsonl)
+
+    Methods:
+    --------
+    - is_done(self, stage, unit, exists)
+    - mark_done(self, stage, unit, outputs)
+    - invalidate(self, stage, unit)
+    - pending(self, stage, units)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._done = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Replays the journal file."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a run that crashed while writing
+                    logger.warning(f"\tSkipping corrupt journal line: {line}")
+                    continue
+                key = (entry["stage"], entry["unit"])
+                if entry["status"] == "done":
+                    self._done[key] = entry
+                elif entry["status"] == "invalidated":
+                    self._done.pop(key, None)
+                    if entry["unit"] is None:
+                        for done_key in list(self._done):
+                            if done_key[0] == entry["stage"]:
+                                self._done.pop(done_key)
+
+    def _append(self, entry: dict):
+        """Appends an entry and forces it to disk."""
+        entry["time"] = datetime.datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.path)), exist_ok=True
+            )
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def is_done(self, stage: str, unit=None, exists=None) -> bool:
+        """
+        Checks if a stage is completed for a unit of work.
+
+        Args:
+            stage (str): name of the pipeline stage
+            unit (str): neighbourhood or tile code
+            exists (callable, optional): function that checks if an output
+                exists (e.g. arcpy.Exists). If given, the stage only counts as
+                done if all its recorded outputs still exist.
+
+        Returns:
+            bool: True if the stage is completed for the unit.
+        """
+        entry = self._done.get((stage, None if unit is None else str(unit)))
+        if entry is None:
+            return False
+        if exists is not None:
+            missing = [o for o in entry["outputs"] if not exists(o)]
+            if missing:
+                logger.info(
+                    f"\t\tOutputs of <<{stage}>> for <<{unit}>> are missing: {missing}. Recompute ..."
+                )
+                return False
+        return True
+
+    def mark_done(self, stage: str, unit=None, outputs: list = ()):
+        """
+        Records that a stage is completed for a unit of work.
+        Call this after all outputs of the unit are published.
+
+        Args:
+            stage (str): name of the pipeline stage
+            unit (str): neighbourhood or tile code
+            outputs (list): paths to the published outputs
+        """
+        entry = {
+            "stage": stage,
+            "unit": None if unit is None else str(unit),
+            "status": "done",
+            "outputs": list(outputs),
+        }
+        self._append(entry)
+        self._done[(entry["stage"], entry["unit"])] = entry
+
+    def invalidate(self, stage: str, unit=None):
+        """
+        Marks a stage as not completed, for one unit or for all units.
+
+        Args:
+            stage (str): name of the pipeline stage
+            unit (str, optional): neighbourhood or tile code,
+                None invalidates all units of the stage
+        """
+        self._append(
+            {
+                "stage": stage,
+                "unit": None if unit is None else str(unit),
+                "status": "invalidated",
+            }
+        )
+        if unit is None:
+            for key in list(self._done):
+                if key[0] == stage:
+                    self._done.pop(key)
+        else:
+            self._done.pop((stage, str(unit)), None)
+
+    def pending(self, stage: str, units: list, exists=None) -> list:
+        """
+        Returns the units that are not completed for a stage.
+
+        Args:
+            stage (str): name of the pipeline stage
+            units (list): all units of work of the stage
+            exists (callable, optional): see is_done()
+
+        Returns:
+            list: the unfinished units, in the order of units
+        """
+        pending = [u for u in units if not self.is_done(stage, u, exists)]
+        if pending and len(pending) < len(units):
+            logger.info(
+                f"\t<<{stage}>>: {len(units) - len(pending)} of {len(units)} units completed in a previous run. Resume at <<{pending[0]}>>."
+            )
+        return pending
@@ -0,0 +1,84 @@
+"""Run options of the pipeline scripts, interactive or from the environment.
+
+The scripts used to ask for their options with input() (municipality check,
+TEST/PROD run, keep the interim data). An option is now read from the
+environment variable TREKRONER_<NAME> if it is set. In a batch run
+(TREKRONER_BATCH is set, see src/batch_runner.py) or without a terminal the
+default is used, otherwise the user is asked as before.
+"""
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+ENV_PREFIX = "TREKRONER_"
+BATCH_ENV = ENV_PREFIX + "BATCH"
+
+TRUE_VALUES = ("y", "yes", "true", "1")
+FALSE_VALUES = ("n", "no", "false", "0")
+
+
+def is_batch_run() -> bool:
+    """Returns True if the script runs unattended (no prompts)."""
+    return bool(os.getenv(BATCH_ENV)) or not sys.stdin.isatty()
+
+
+def get_option(name: str, prompt: str, default: str = None) -> str:
+    """
+    Returns a run option from the environment, the user or the default.
+
+    Args:
+        name (str): option name, read from TREKRONER_<NAME>
+        prompt (str): question for the user in an interactive run
+        default (str, optional): value of an unattended run without the
+            environment variable
+
+    Returns:
+        str: the option value
+    """
+    value = os.getenv(ENV_PREFIX + name.upper())
+    if value is None:
+        if is_batch_run():
+            value = default
+        else:
+            value = input(prompt).strip()
+    logger.info(f"\tRun option {name}:\t{value}")
+    return value
+
+
+def get_bool_option(name: str, prompt: str, default: bool) -> bool:
+    """Returns a yes/no run option (y, yes, true, 1 / n, no, false, 0)."""
+    value = get_option(name, prompt, "y" if default else "n")
+    if value is None or value.strip().lower() not in (
+        TRUE_VALUES + FALSE_VALUES
+    ):
+        logger.warning(
+            f"\tInvalid value '{value}' for the run option {name}, using {default}."
+        )
+        return default
+    return value.strip().lower() in TRUE_VALUES
+
+
+def get_workers(default: int = None) -> int:
+    """
+    Returns the number of workers of the process, TREKRONER_WORKERS is set
+    by the batch runner to the share of the global worker budget of a job.
+    """
+    value = os.getenv(ENV_PREFIX + "WORKERS")
+    return max(1, int(value)) if value else default
+
+
+def confirm_municipality(municipality: str) -> bool:
+    """
+    Asks the user to confirm the municipality, always True in a batch run.
+    """
+    if is_batch_run():
+        logger.info(f"Municipality:\t{municipality}")
+        return True
+    return (
+        input(f"Is '{municipality}' the correct municipality? (y/n): ")
+        .strip()
+        .lower()
+        == "y"
+    )
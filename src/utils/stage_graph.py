@@ -0,0 +1,442 @@
+"""In-process executor of the pipeline stages as a dependency graph.
+
+The stages used to run one after the other (or as chained subprocesses),
+each stage for all units (tiles, neighbourhoods) before the next stage
+starts. A StageGraph declares the stages with the data they read (inputs)
+and write (outputs). A stage that reads the output of another stage depends
+on it; an input that no stage of the graph writes already exists.
+
+A per-unit stage fans out into one node per unit. It depends on the same unit
+of a per-unit producer and on all units of a producer that runs once (and
+vice versa, a stage that runs once waits for all units of a per-unit
+producer). A stage can have its own units (e.g. the LiDAR tiles instead of
+the neighbourhoods), it then waits for all units of a per-unit producer with
+other units. Nodes whose dependencies are finished run in parallel on a
+thread or process pool, so the stages of one neighbourhood do not wait for
+the slowest neighbourhood of the previous stage.
+
+Stages that write into the same shared file gdb declare it as a lock. A file
+gdb does not allow two processes to create datasets in it at the same time
+(schema lock), nodes that hold the same lock therefore never run at the same
+time.
+
+After the run the critical path, the longest chain of dependent nodes, is
+logged next to the wall time and the summed time of all nodes. The run time
+cannot be shorter than the critical path, the wall time approaches it when
+there are enough workers.
+
+Usage:
+    graph = StageGraph("trees")
+    graph.add_stage(
+        "split_chm", split_chm_nb, ["chm"], ["chm_nb"], True, locks=["split"]
+    )
+    graph.add_stage("watershed", detect_watershed, ["chm_nb"], ["ws"], True)
+    graph.run(neighbourhood_list, ctx, workers=4, processes=True)
+
+Stage functions are called as func(*args, [unit]) for per-unit stages and
+func(*args) for stages that run once.
+"""
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    Declaration of a pipeline stage.
+
+    Attributes:
+    -----------
+    name : str
+        stage name
+    func : callable
+        stage function, func(*args, [unit]) or func(*args)
+    inputs : list
+        names of the data the stage reads
+    outputs : list
+        names of the data the stage writes
+    per_unit : bool
+        the stage runs once per unit (True) or once for all units (False)
+    units : list
+        units of a per-unit stage, None for the units of the run
+    locks : list
+        names of the shared resources (file gdbs) the stage writes
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func,
+        inputs: list = (),
+        outputs: list = (),
+        per_unit: bool = False,
+        units: list = None,
+        locks: list = (),
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.per_unit = per_unit
+        self.units = list(units) if units is not None else None
+        self.locks = set(locks)
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def node_label(node: tuple) -> str:
+    """Returns the label of a node, e.g. watershed[302401]."""
+    stage, unit = node
+    return stage if unit is None else f"{stage}[{unit}]"
+
+
+def _run_node(func, args: tuple, units: list, report_path: str = None):
+    """
+    Runs one node (in a worker).
+
+    In a worker process (report_path is set) the stages record into a
+    buffered run report, the records are returned to the report of the
+    parent process, also when the node fails.
+
+    Returns:
+        tuple: (start, end, records, error) the start and end time, the run
+            report records of a worker process and the exception of a
+            failed node (None)
+    """
+    from src.utils.resource_monitor import RunReport, set_run_report
+
+    report = None
+    if report_path is not None:
+        report = set_run_report(RunReport(report_path, buffered=True))
+    start = time.time()
+    error = None
+    try:
+        if units is None:
+            func(*args)
+        else:
+            func(*args, units)
+    except Exception as e:
+        error = e
+    records = report.records if report is not None else []
+    return start, time.time(), records, error
+
+
+class StageGraph:
+    """
+    Dependency graph of the pipeline stages.
+
+    Attributes:
+    -----------
+    name : str
+        name of the graph in the log and the run report
+    stages : dict
+        stage name -> Stage, in the order of declaration
+
+    Methods:
+    --------
+    - add_stage(self, name, func, inputs, outputs, per_unit, units, locks)
+    - dependencies(self, units)
+    - run(self, units, *args, workers, processes)
+    - critical_path(self, dependencies, timings)
+    """
+
+    def __init__(self, name: str = "pipeline"):
+        self.name = name
+        self.stages = {}
+
+    def add_stage(
+        self,
+        name: str,
+        func,
+        inputs: list = (),
+        outputs: list = (),
+        per_unit: bool = False,
+        units: list = None,
+        locks: list = (),
+    ) -> Stage:
+        """
+        Declares a stage.
+
+        Args:
+            name (str): stage name
+            func (callable): stage function
+            inputs (list): names of the data the stage reads
+            outputs (list): names of the data the stage writes
+            per_unit (bool): run the stage once per unit
+            units (list, optional): units of a per-unit stage, defaults to
+                the units of the run
+            locks (list): names of the shared resources (e.g. the file gdbs)
+                the stage writes, nodes with a common lock do not run at the
+                same time
+
+        Returns:
+            Stage: the declared stage
+        """
+        if name in self.stages:
+            raise ValueError(f"The stage {name} is already declared")
+        producers = self._producers()
+        for output in outputs:
+            if output in producers:
+                raise ValueError(
+                    f"{output} is written by {producers[output]} and {name}"
+                )
+        if units is not None and not per_unit:
+            raise ValueError(f"The stage {name} has units but is not per unit")
+        stage = Stage(name, func, inputs, outputs, per_unit, units, locks)
+        self.stages[name] = stage
+        return stage
+
+    def _producers(self) -> dict:
+        """Returns output name -> name of the stage that writes it."""
+        return {
+            output: stage.name
+            for stage in self.stages.values()
+            for output in stage.outputs
+        }
+
+    def dependencies(self, units: list) -> dict:
+        """
+        Fans the stages out into nodes (stage, unit) and links them.
+
+        Args:
+            units (list): units of the per-unit stages
+
+        Returns:
+            dict: node -> list of the nodes it depends on, the unit of a
+                stage that runs once is None
+        """
+        producers = self._producers()
+        dependencies = {}
+        for stage in self.stages.values():
+            for unit in self._units(stage, units):
+                node_deps = []
+                for name in stage.inputs:
+                    producer = producers.get(name)
+                    if producer is None or producer == stage.name:
+                        continue  # input exists before the run
+                    producer_stage = self.stages[producer]
+                    if not producer_stage.per_unit:
+                        node_deps.append((producer, None))
+                    elif (
+                        unit is not None and producer_stage.units == stage.units
+                    ):
+                        node_deps.append((producer, unit))
+                    else:
+                        node_deps.extend(
+                            (producer, u)
+                            for u in self._units(producer_stage, units)
+                        )
+                # unique, in order
+                dependencies[(stage.name, unit)] = list(
+                    dict.fromkeys(node_deps)
+                )
+        return dependencies
+
+    @staticmethod
+    def _units(stage: Stage, units: list) -> list:
+        """Returns the units of the nodes of a stage, [None] if it runs once."""
+        if not stage.per_unit:
+            return [None]
+        return list(stage.units if stage.units is not None else units)
+
+    @staticmethod
+    def _topological_order(dependencies: dict) -> list:
+        """Returns the nodes in dependency order, raises on a cycle."""
+        remaining = {node: len(deps) for node, deps in dependencies.items()}
+        dependents = {node: [] for node in dependencies}
+        for node, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].append(node)
+        order = [node for node, n in remaining.items() if n == 0]
+        for node in order:
+            for child in dependents[node]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    order.append(child)
+        if len(order) < len(dependencies):
+            cycle = [node_label(n) for n, c in remaining.items() if c > 0]
+            raise ValueError(f"The stages contain a cycle: {cycle}")
+        return order
+
+    def run(
+        self,
+        units: list,
+        *args,
+        workers: int = 1,
+        processes: bool = False,
+    ) -> dict:
+        """
+        Runs the nodes of the graph as soon as their dependencies finished.
+
+        A node waits while a running node holds one of its locks. A failed
+        node is logged, the nodes that depend on it are skipped and the
+        other nodes still run. A RuntimeError is raised at the end of a
+        run with failed nodes.
+
+        Args:
+            units (list): units of the per-unit stages
+            *args: leading arguments of the stage functions (e.g. ctx)
+            workers (int): number of nodes that run at the same time
+            processes (bool): run the nodes in worker processes, needed for
+                arcpy stages that set arcpy.env or use named layers, the
+                arguments must be picklable; the run report records of the
+                workers are added to the run report of this process
+
+        Returns:
+            dict: wall time, summed node time and the critical path
+        """
+        from src.utils.resource_monitor import get_run_report
+
+        dependencies = self.dependencies(units)
+        order = self._topological_order(dependencies)
+        dependents = {node: [] for node in dependencies}
+        for node, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].append(node)
+
+        # nodes with the longest chain of dependents start first
+        rank = {}
+        for node in reversed(order):
+            rank[node] = 1 + max(
+                (rank[child] for child in dependents[node]), default=0
+            )
+
+        logger.info(
+            "Stage graph <<{}>>: {} nodes of {} stages, {} workers".format(
+                self.name, len(order), len(self.stages), workers
+            )
+        )
+        run_report = get_run_report()
+        # worker processes return their records to this report
+        report_path = run_report.report_path if processes else None
+        with run_report.stage(self.name) as monitor:
+            remaining = {node: len(deps) for node, deps in dependencies.items()}
+            ready = [node for node in order if remaining[node] == 0]
+            timings = {}
+            failed = {}
+            skipped = set()
+            pool = (
+                concurrent.futures.ProcessPoolExecutor
+                if processes
+                else concurrent.futures.ThreadPoolExecutor
+            )
+            with pool(max_workers=max(1, workers)) as executor:
+                running = {}
+                while ready or running:
+                    ready.sort(key=lambda n: rank[n], reverse=True)
+                    held = set()
+                    for node in running.values():
+                        held.update(self.stages[node[0]].locks)
+                    for node in list(ready):
+                        if len(running) >= max(1, workers):
+                            break
+                        stage = self.stages[node[0]]
+                        if stage.locks & held:
+                            continue  # a running node writes the same gdb
+                        ready.remove(node)
+                        held.update(stage.locks)
+                        node_units = [node[1]] if stage.per_unit else None
+                        future = executor.submit(
+                            _run_node,
+                            stage.func,
+                            args,
+                            node_units,
+                            report_path,
+                        )
+                        running[future] = node
+                    done, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        node = running.pop(future)
+                        try:
+                            start, end, records, error = future.result()
+                            run_report.add_records(records)
+                            if error is not None:
+                                raise error
+                            timings[node] = (start, end)
+                        except Exception as e:
+                            failed[node] = e
+                            logger.error(f"\t{node_label(node)} failed: {e}")
+                            skipped.update(self._descendants(node, dependents))
+                            continue
+                        for child in dependents[node]:
+                            remaining[child] -= 1
+                            if remaining[child] == 0 and child not in skipped:
+                                ready.append(child)
+
+            report = self.critical_path(dependencies, timings)
+            report["failed_nodes"] = [node_label(node) for node in failed]
+            report["skipped_nodes"] = [node_label(node) for node in skipped]
+            monitor.extra.update(report)
+        report["wall_sec"] = monitor.record["duration_sec"]
+        logger.info(
+            "\tWall time {:.2f} sec, summed stage time {:.2f} sec, critical path {:.2f} sec:".format(
+                report["wall_sec"],
+                report["summed_sec"],
+                report["critical_path_sec"],
+            )
+        )
+        logger.info("\t\t" + " -> ".join(report["critical_path"]))
+        if failed:
+            raise RuntimeError(
+                "Stage graph <<{}>>: {} nodes failed, {} skipped: {}".format(
+                    self.name,
+                    len(failed),
+                    len(skipped),
+                    report["failed_nodes"],
+                )
+            )
+        return report
+
+    @staticmethod
+    def _descendants(node: tuple, dependents: dict) -> set:
+        """Returns all nodes that depend (indirectly) on a node."""
+        descendants = set()
+        stack = list(dependents[node])
+        while stack:
+            child = stack.pop()
+            if child not in descendants:
+                descendants.add(child)
+                stack.extend(dependents[child])
+        return descendants
+
+    def critical_path(self, dependencies: dict, timings: dict) -> dict:
+        """
+        Returns the longest chain of dependent nodes by run time.
+
+        Args:
+            dependencies (dict): node -> nodes it depends on
+            timings (dict): node -> (start, end) time of the finished nodes
+
+        Returns:
+            dict: summed_sec (all nodes), critical_path_sec and the labels of
+                the nodes on the critical path
+        """
+        duration = {node: end - start for node, (start, end) in timings.items()}
+        finish = {}
+        previous = {}
+        for node in self._topological_order(dependencies):
+            if node not in duration:
+                continue
+            deps = [dep for dep in dependencies[node] if dep in finish]
+            before = max(deps, key=lambda dep: finish[dep], default=None)
+            finish[node] = duration[node] + (
+                finish[before] if before is not None else 0.0
+            )
+            previous[node] = before
+
+        path = []
+        node = max(finish, key=finish.get, default=None)
+        length = finish.get(node, 0.0)
+        while node is not None:
+            path.append(node_label(node))
+            node = previous[node]
+        return {
+            "summed_sec": sum(duration.values()),
+            "critical_path_sec": length,
+            "critical_path": path[::-1],
+        }
@@ -5,11 +5,9 @@ import re
 from typing import IO, Union
 
 import yaml
-from dotenv import load_dotenv
 
 user_dir = os.path.join(os.path.expanduser("~"))
 dotenv_path = os.path.join(user_dir, "trekroner.env")
-load_dotenv(dotenv_path)
 
 
 def get_typed_value(value: str) -> Union[float, int, str]:
@@ -44,6 +42,10 @@ def yaml_load(fh: IO) -> dict:
 
     :returns: `dict` representation of YAML
     """
+    # environment variables used in the config (loaded on first use)
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path)
 
     # support environment variables in config
     # https://stackoverflow.com/a/55301129